@@ -0,0 +1,436 @@
+"""
+Benchmark suite of the pipeline stages.
+
+Every benchmark is run for each dataset size (number of sequences or rows), repeated, and the
+timings are stored per commit, so two commits can be compared with one command:
+
+    python pipeline_benchmarks.py run --sizes 1000,10000,100000
+    python pipeline_benchmarks.py run --sizes 1000 --mafft /path/to/mafft --pg-bin /path/to/pgsql/bin
+    python pipeline_benchmarks.py run --sizes 10000 --bench end_to_end --mafft stand-in
+    python pipeline_benchmarks.py compare <base_commit> <head_commit>
+    python pipeline_benchmarks.py list
+
+The datasets are synthetic and seeded, so every commit is measured on the same input.
+The end-to-end typing/subtyping benchmarks need --mafft, and the upload benchmark needs
+PostgreSQL binaries (--pg-bin or initdb on the PATH); they are skipped otherwise. With
+'--mafft stand-in' the alignment benchmarks use mafft_stand_in.py, which measures scheduling and
+I/O throughput without the cost of real alignment.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.append(os.path.join(CONFIG_DIR, 'seq'))
+sys.path.append(os.path.join(CONFIG_DIR, 'general'))
+
+from qc import process_sequences
+from multistate_character_cleaner import replacing_multistate_characters_with_n
+from pol_region_coordinates_finder import extracting_seq_within_pol_region
+from similarity_calculator import calculate_similarity_between_aligned_seqs
+from hypermutation_calculator import analyze_mutations
+from hiv_subtyping_alignment_worker import identify_unidentified_hiv_subtypes, perform_hiv_subtyping
+from hiv_typing_alignment_worker import perform_hiv_typing
+from parallel_alignment_processor import process_sequence_alignment_parallel
+from mafft_caller import perform_mafft_alignment
+from async_mafft_engine import AsyncMafftEngine
+from alignment_resource_planner import available_cpu_count
+from synthetic_corpus_generator import synthetic_reference_tables, generate_synthetic_queries
+
+MAFFT_STAND_IN = os.path.join(CONFIG_DIR, 'seq', 'mafft_stand_in.py')
+DEFAULT_RESULTS_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'hiv_pipeline', 'benchmarks')
+DEFAULT_SIZES = (1000, 10000, 100000)
+REGRESSION_THRESHOLD = 0.10
+
+BENCHMARKS = {}
+
+
+def benchmark(name, needs=()):
+    """
+    Registers a benchmark. The decorated function takes (size, context) and returns a
+    zero-argument callable that runs the measured work once; the setup before the return
+    is not timed. `needs` lists context keys ('mafft', 'pg') without which it is skipped.
+    """
+    def register(setup):
+        BENCHMARKS[name] = {'setup': setup, 'needs': needs}
+        return setup
+    return register
+
+
+# ---------------------------------------------------------------------------
+# Seeded synthetic datasets
+# ---------------------------------------------------------------------------
+
+def random_sequence(length, rng, alphabet='acgt'):
+    return ''.join(rng.choice(list(alphabet), size=length))
+
+
+def mutate_sequence(seq, rate, rng):
+    """Substitutes a fraction `rate` of the positions, favouring G->A as in hypermutated sequences."""
+    seq = np.array(list(seq))
+    positions = np.flatnonzero(rng.random(len(seq)) < rate)
+    seq[positions] = rng.choice(list('acgt'), size=len(positions))
+    g_positions = np.flatnonzero((seq == 'g') & (rng.random(len(seq)) < rate / 4))
+    seq[g_positions] = 'a'
+    return ''.join(seq)
+
+
+def upload_dataset(size, seed=0):
+    """
+    Rows as they come out of the upload step: pat_id, seq_sample_date and raw 'seq' with
+    ambiguity codes, N blocks, gaps at the ends, duplicates and some short sequences.
+    """
+    rng = np.random.default_rng(seed)
+    reference = random_sequence(1300, rng)
+    seqs = []
+    for i in range(size):
+        if seqs and rng.random() < 0.05:
+            seqs.append(seqs[rng.integers(len(seqs))])
+            continue
+        length = int(rng.integers(300, 600)) if rng.random() < 0.05 else int(rng.integers(900, 1300))
+        seq = mutate_sequence(reference[:length], 0.05, rng)
+        if rng.random() < 0.2:
+            start = int(rng.integers(0, length - 40))
+            seq = seq[:start] + 'n' * 40 + seq[start + 40:]
+        if rng.random() < 0.3:
+            position = int(rng.integers(0, length))
+            seq = seq[:position] + rng.choice(list('rykmswbdhv')) + seq[position + 1:]
+        seqs.append('--nn' + seq.upper() + 'nn-')
+    return pd.DataFrame({'pat_id': rng.integers(1, max(size // 2, 2), size=size),
+                         'seq_sample_date': pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 1500, size), unit='D'),
+                         'seq': seqs})
+
+
+def aligned_pairs(size, length=3000, seed=0):
+    """Pairs of aligned reference/query sequences (same length, gaps in both)."""
+    rng = np.random.default_rng(seed)
+    reference = random_sequence(length, rng)
+    pairs = []
+    for _ in range(size):
+        ref, query = list(reference), list(mutate_sequence(reference, 0.08, rng))
+        for _ in range(int(rng.integers(0, 4))):
+            position, gap_len = int(rng.integers(0, length)), int(rng.integers(1, 10))
+            ref.insert(position, '-' * gap_len)
+            query.insert(position, random_sequence(gap_len, rng))
+        for _ in range(int(rng.integers(0, 4))):
+            position, gap_len = int(rng.integers(0, len(query))), int(rng.integers(1, 10))
+            query[position:position + gap_len] = ['-'] * len(query[position:position + gap_len])
+        pairs.append((''.join(ref), ''.join(query)))
+    return pairs
+
+
+def subtyping_result_dataset(size, n_refs=20, seed=0):
+    """'size' queries with one alignment result row per consensus reference."""
+    rng = np.random.default_rng(seed)
+    subtypes = [f"S{i % 12}" for i in range(n_refs)]
+    return [pd.DataFrame({'hiv1_subtype_lanl': subtypes,
+                          'hiv1_subtype_similarity_percentage': np.round(rng.uniform(60, 95, n_refs), 1),
+                          'hiv1_subtype_lanl_anomaly': [''] * n_refs})
+            for _ in range(size)]
+
+
+def post_qc_queries(size, seed=0):
+    """Synthetic corpus rows after QC, as they go into typing."""
+    type_ref, subtype_ref = synthetic_reference_tables(seed)
+    corpus = pd.concat(generate_synthetic_queries(type_ref, subtype_ref, size, seed=seed), ignore_index=True)
+    _, post_qc_df = process_sequences(corpus[['pat_id', 'seq_sample_date', 'seq']].copy())
+    return post_qc_df
+
+
+# ---------------------------------------------------------------------------
+# Benchmarks
+# ---------------------------------------------------------------------------
+
+@benchmark('qc.process_sequences')
+def bench_process_sequences(size, context):
+    df = upload_dataset(size)
+    return lambda: process_sequences(df.copy())
+
+
+@benchmark('replacing_multistate_characters_with_n')
+def bench_multistate(size, context):
+    seqs = upload_dataset(size)['seq'].str.lower().tolist()
+    return lambda: [replacing_multistate_characters_with_n(seq) for seq in seqs]
+
+
+@benchmark('extracting_seq_within_pol_region')
+def bench_pol_region(size, context):
+    pairs = aligned_pairs(size)
+    return lambda: [extracting_seq_within_pol_region(ref, query, 200, 2800) for ref, query in pairs]
+
+
+@benchmark('calculate_similarity_between_aligned_seqs')
+def bench_similarity(size, context):
+    pairs = aligned_pairs(size)
+    return lambda: [calculate_similarity_between_aligned_seqs(ref, query) for ref, query in pairs]
+
+
+@benchmark('analyze_mutations')
+def bench_hypermutation(size, context):
+    pairs = aligned_pairs(size)
+    return lambda: [analyze_mutations(query, ref) for ref, query in pairs]
+
+
+@benchmark('identify_unidentified_hiv_subtypes')
+def bench_identify_unidentified(size, context):
+    result_dfs = subtyping_result_dataset(size)
+    return lambda: [identify_unidentified_hiv_subtypes(df) for df in result_dfs]
+
+
+@benchmark('filter_dataframe_by_datatype')
+def bench_filter_by_datatype(size, context):
+    from user_prompter import filter_dataframe_by_datatype
+    df = upload_dataset(size)
+    df['pat_id'] = df['pat_id'].astype(str)
+    df.loc[::50, 'pat_id'] = 'x'
+    df['seq_sample_date'] = df['seq_sample_date'].dt.strftime('%Y-%m-%d')
+    df.loc[::70, 'seq_sample_date'] = 'not a date'
+    column_datatype_dict = {'pat_id': ('Patient id', 'INTEGER', 'required'),
+                            'seq_sample_date': ('Sample date', 'DATE', 'required'),
+                            'seq': ('Sequence', 'STRING', 'required')}
+    return lambda: filter_dataframe_by_datatype(df.copy(), column_datatype_dict)
+
+
+@benchmark('upload_df_to_table', needs=('pg',))
+def bench_upload(size, context):
+    import psycopg2
+    from data_uploader import upload_df_to_table
+    df = upload_dataset(size)
+    pg = context['pg']
+    table_name = f"bench_seq_{size}"
+
+    def run():
+        with psycopg2.connect(**pg) as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"DROP TABLE IF EXISTS {table_name}")
+                cur.execute(f"CREATE TABLE {table_name} (id SERIAL PRIMARY KEY, pat_id INTEGER, "
+                            f"seq_sample_date DATE, seq TEXT, mod_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+        result = upload_df_to_table(pg['dbname'], pg['user'], pg['password'], pg['host'], pg['port'], table_name, df.copy())
+        if isinstance(result, str):
+            raise RuntimeError(result)
+    return run
+
+
+@benchmark('end_to_end.hiv_typing', needs=('mafft',))
+def bench_typing(size, context):
+    type_ref, _ = synthetic_reference_tables()
+    query_df = post_qc_queries(size)
+    return lambda: process_sequence_alignment_parallel(query_df, type_ref, 'seq_cleaned', perform_hiv_typing,
+                                                       context['mafft'], cost_model_path=context['cost_model_path'])
+
+
+@benchmark('end_to_end.hiv1_subtyping', needs=('mafft',))
+def bench_subtyping(size, context):
+    _, subtype_ref = synthetic_reference_tables()
+    query_df = post_qc_queries(size).rename(columns={'seq_cleaned': 'extracted_pol_query_seq_cleaned',
+                                                    'seq_cleaned_len': 'extracted_pol_query_seq_cleaned_len'})
+    return lambda: process_sequence_alignment_parallel(query_df, subtype_ref, 'extracted_pol_query_seq_cleaned',
+                                                       perform_hiv_subtyping, context['mafft'],
+                                                       cost_model_path=context['cost_model_path'])
+
+
+def alignment_pairs_against_hxb2(size):
+    type_ref, _ = synthetic_reference_tables()
+    hxb2 = type_ref['pol_ref_seq'][0]
+    return [(hxb2, seq) for seq in post_qc_queries(size)['seq_cleaned']]
+
+
+@benchmark('mafft.threaded_pairs', needs=('mafft',))
+def bench_threaded_pairs(size, context):
+    from concurrent.futures import ThreadPoolExecutor
+    pairs = alignment_pairs_against_hxb2(size)
+
+    def run():
+        with ThreadPoolExecutor(available_cpu_count()) as executor:
+            list(executor.map(lambda pair: perform_mafft_alignment(*pair, context['mafft']), pairs))
+    return run
+
+
+@benchmark('mafft.async_batch', needs=('mafft',))
+def bench_async_batch(size, context):
+    pairs = alignment_pairs_against_hxb2(size)
+    return lambda: asyncio.run(AsyncMafftEngine().align_batch(pairs, context['mafft']))
+
+
+# ---------------------------------------------------------------------------
+# Throwaway PostgreSQL
+# ---------------------------------------------------------------------------
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def throwaway_postgres(pg_bin):
+    """
+    Starts a temporary PostgreSQL cluster and yields its connection parameters; the cluster
+    is stopped and deleted afterwards.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='hiv_pipeline_bench_pg_')
+    data_dir, port = os.path.join(tmp_dir, 'data'), _free_port()
+    initdb, pg_ctl = os.path.join(pg_bin, 'initdb'), os.path.join(pg_bin, 'pg_ctl')
+    try:
+        subprocess.run([initdb, '-D', data_dir, '-U', 'bench', '--auth=trust'], check=True, capture_output=True)
+        subprocess.run([pg_ctl, '-D', data_dir, '-l', os.path.join(tmp_dir, 'logfile'), '-w',
+                        '-o', f"-p {port} -k {tmp_dir} -c listen_addresses=localhost", 'start'],
+                       check=True, capture_output=True)
+        yield {'dbname': 'postgres', 'user': 'bench', 'password': '', 'host': 'localhost', 'port': port}
+    finally:
+        subprocess.run([pg_ctl, '-D', data_dir, '-m', 'fast', 'stop'], capture_output=True)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+# ---------------------------------------------------------------------------
+# Running, storing and comparing results
+# ---------------------------------------------------------------------------
+
+def current_commit():
+    """Short hash of HEAD, with '-dirty' if the tree has uncommitted changes."""
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=CONFIG_DIR, capture_output=True, text=True).stdout.strip()
+    commit = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    return commit + ('-dirty' if git('status', '--porcelain', '--untracked-files=no') else '')
+
+
+def machine_name():
+    return f"{platform.node()}-{platform.machine()}".replace(os.sep, '_')
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, names=None, repeat=3, context=None):
+    """
+    Runs the benchmarks and returns one record per benchmark and size with the min, median,
+    mean and standard deviation of `repeat` timed runs (after one warm-up run).
+    """
+    context = context or {}
+    records = []
+    for name, spec in BENCHMARKS.items():
+        if names and not any(selected in name for selected in names):
+            continue
+        missing = [need for need in spec['needs'] if not context.get(need)]
+        if missing:
+            print(f"skip {name}: needs {', '.join(missing)}")
+            continue
+        for size in sizes:
+            run = spec['setup'](size, context)
+            run()
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                timings.append(time.perf_counter() - start)
+            record = {'benchmark': name, 'size': size, 'repeat': repeat,
+                      'min_seconds': min(timings), 'median_seconds': statistics.median(timings),
+                      'mean_seconds': statistics.mean(timings),
+                      'stdev_seconds': statistics.stdev(timings) if repeat > 1 else 0.0}
+            print(f"{name:45s} {size:>8d}  median {record['median_seconds']:.4f}s  min {record['min_seconds']:.4f}s")
+            records.append(record)
+    return records
+
+
+def save_results(records, results_dir=DEFAULT_RESULTS_DIR, commit=None):
+    """
+    Stores the records as '<results_dir>/<commit>__<machine>.json', merging with earlier runs
+    of the same commit (newer records replace older ones of the same benchmark and size).
+    """
+    commit = commit or current_commit()
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, f"{commit}__{machine_name()}.json")
+    merged = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for record in json.load(f)['results']:
+                merged[(record['benchmark'], record['size'])] = record
+    for record in records:
+        merged[(record['benchmark'], record['size'])] = record
+    with open(path, 'w') as f:
+        json.dump({'commit': commit, 'machine': machine_name(), 'python': platform.python_version(),
+                   'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': list(merged.values())}, f, indent=2)
+    return path
+
+
+def load_results(commit, results_dir=DEFAULT_RESULTS_DIR):
+    path = os.path.join(results_dir, f"{commit}__{machine_name()}.json")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No results for commit {commit} on {machine_name()} in {results_dir}")
+    with open(path) as f:
+        return pd.DataFrame(json.load(f)['results'])
+
+
+def compare_results(base_commit, head_commit, results_dir=DEFAULT_RESULTS_DIR, threshold=REGRESSION_THRESHOLD):
+    """
+    Compares the median timings of two commits on this machine.
+
+    Returns:
+    - pandas.DataFrame: One row per benchmark and size present in both, with 'ratio'
+      (head / base) and 'status' ('regression', 'improvement' or 'same' at the given threshold).
+    """
+    base, head = load_results(base_commit, results_dir), load_results(head_commit, results_dir)
+    comparison = base.merge(head, on=['benchmark', 'size'], suffixes=('_base', '_head'))
+    comparison['ratio'] = (comparison['median_seconds_head'] / comparison['median_seconds_base']).round(3)
+    comparison['status'] = np.select([comparison['ratio'] > 1 + threshold, comparison['ratio'] < 1 - threshold],
+                                     ['regression', 'improvement'], 'same')
+    return comparison[['benchmark', 'size', 'median_seconds_base', 'median_seconds_head', 'ratio', 'status']]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pipeline benchmark suite.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Run benchmarks and store the results of this commit.")
+    run_parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)))
+    run_parser.add_argument('--bench', action='append', help="Run only benchmarks whose name contains this (repeatable).")
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--mafft', help="MAFFT executable for the end-to-end benchmarks ('stand-in' for mafft_stand_in.py).")
+    run_parser.add_argument('--pg-bin', default=os.path.dirname(shutil.which('initdb') or ''),
+                            help="Directory with initdb and pg_ctl for the upload benchmark.")
+    run_parser.add_argument('--results-dir', default=DEFAULT_RESULTS_DIR)
+
+    compare_parser = subparsers.add_parser('compare', help="Compare the stored results of two commits.")
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('head', nargs='?', default=None, help="Defaults to the current commit.")
+    compare_parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    compare_parser.add_argument('--results-dir', default=DEFAULT_RESULTS_DIR)
+
+    subparsers.add_parser('list', help="List the benchmarks.")
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for name, spec in BENCHMARKS.items():
+            print(name + (f"  (needs {', '.join(spec['needs'])})" if spec['needs'] else ''))
+        return
+
+    if args.command == 'compare':
+        comparison = compare_results(args.base, args.head or current_commit(), args.results_dir, args.threshold)
+        print(comparison.to_string(index=False))
+        sys.exit(1 if (comparison['status'] == 'regression').any() else 0)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mafft_executable = MAFFT_STAND_IN if args.mafft == 'stand-in' else args.mafft
+        context = {'mafft': mafft_executable, 'cost_model_path': os.path.join(tmp_dir, 'cost_model.json')}
+        if args.pg_bin and os.path.exists(os.path.join(args.pg_bin, 'initdb')):
+            with throwaway_postgres(args.pg_bin) as pg:
+                context['pg'] = pg
+                records = run_benchmarks(sizes, args.bench, args.repeat, context)
+        else:
+            records = run_benchmarks(sizes, args.bench, args.repeat, context)
+    print(f"Results written to {save_results(records, args.results_dir)}")
+
+
+if __name__ == '__main__':
+    main()
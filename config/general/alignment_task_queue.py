@@ -0,0 +1,268 @@
+import io
+import os
+import time
+import uuid
+import datetime
+import socket
+import logging
+import psycopg2
+import psycopg2.extras
+import pandas as pd
+from run_metrics import increment, observe
+
+# Task states: queued -> running -> done | failed; running goes back to queued when its lease
+# expires or a retryable error is released
+TASK_STATUSES = ('queued', 'running', 'done', 'failed')
+
+
+def encode_frame(df):
+    """
+    Serializes a DataFrame for the payload and result columns: UTF-8 JSON in the Table Schema
+    layout, which keeps the index and column dtypes. Reading it back never runs code stored in
+    the table, as unpickling would. datetime.date values are stored as 'YYYY-MM-DD' strings.
+    """
+    df = df.apply(lambda col: col.map(_date_text) if col.dtype == object else col)
+    return df.to_json(orient='table', date_format='iso').encode()
+
+
+def _date_text(value):
+    # Plain dates would come back as timestamps
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def decode_frame(data):
+    """Reads a DataFrame written by encode_frame."""
+    return pd.read_json(io.StringIO(bytes(data).decode()), orient='table')
+
+
+def connect(database, user, password, host, port):
+    """Opens a connection to the queue database."""
+    return psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
+
+
+def worker_identity():
+    """Lease owner name of this process: host, pid and a random suffix, unique across restarts."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def enqueue_tasks(connection, run_id, stage, query_df, max_attempts=3):
+    """
+    Adds one task per query row, in one statement and one commit.
+
+    Parameters:
+    - connection: psycopg2 connection to the queue database.
+    - run_id (str): Run the tasks belong to; results are collected per run and stage.
+    - stage (str): Stage name the workers look up (see alignment_queue_worker.QUEUE_STAGES).
+    - query_df (DataFrame): Query rows; each row is stored as a one-row DataFrame (see encode_frame).
+    - max_attempts (int): Claims per task before it is failed for good.
+
+    Returns:
+    - int: Number of tasks added.
+    """
+    rows = [(run_id, stage, position, max_attempts, psycopg2.Binary(encode_frame(query_df.iloc[[position]])))
+            for position in range(len(query_df))]
+    if not rows:
+        return 0
+    with connection.cursor() as cursor:
+        psycopg2.extras.execute_values(
+            cursor, "INSERT INTO alignment_tasks (run_id, stage, position, max_attempts, payload) VALUES %s",
+            rows, page_size=1000)
+    connection.commit()
+    increment('db_round_trips', operation='enqueue_tasks', table='alignment_tasks')
+    return len(rows)
+
+
+def requeue_expired_leases(connection):
+    """
+    Returns tasks whose lease expired (their worker died or hung) to the queue, or fails them if
+    they used up their attempts.
+
+    Returns:
+    - int: Number of tasks requeued or failed.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE alignment_tasks
+            SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+                error_class = CASE WHEN attempts >= max_attempts THEN 'LeaseExpired' ELSE error_class END,
+                error_message = CASE WHEN attempts >= max_attempts
+                                     THEN 'Lease of ' || lease_owner || ' expired' ELSE error_message END,
+                finished_at = CASE WHEN attempts >= max_attempts THEN now() ELSE NULL END,
+                lease_owner = NULL, lease_expires_at = NULL
+            WHERE status = 'running' AND lease_expires_at < now()""")
+        count = cursor.rowcount
+    connection.commit()
+    increment('db_round_trips', operation='requeue_expired', table='alignment_tasks')
+    if count:
+        logging.warning(f"Requeued {count} alignment tasks with expired leases")
+        increment('queue_leases_expired', count)
+    return count
+
+
+def claim_tasks(connection, owner, stages, limit=1, lease_seconds=300):
+    """
+    Claims up to limit queued tasks of the given stages for owner.
+
+    FOR UPDATE SKIP LOCKED lets any number of workers claim at once: each skips the rows
+    another worker is claiming instead of waiting for it, so no two workers get the same task.
+
+    Returns:
+    - list: (task_id, run_id, stage, query_row_df, attempts) per claimed task, oldest first.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            WITH next AS (
+                SELECT id FROM alignment_tasks
+                WHERE status = 'queued' AND stage = ANY(%s)
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED)
+            UPDATE alignment_tasks t
+            SET status = 'running', lease_owner = %s, attempts = t.attempts + 1,
+                lease_expires_at = now() + make_interval(secs => %s), heartbeat_at = now()
+            FROM next WHERE t.id = next.id
+            RETURNING t.id, t.run_id, t.stage, t.payload, t.attempts""",
+                       (list(stages), limit, owner, lease_seconds))
+        claimed = sorted(cursor.fetchall())
+    connection.commit()
+    increment('db_round_trips', operation='claim_tasks', table='alignment_tasks')
+    return [(task_id, run_id, stage, decode_frame(payload), attempts)
+            for task_id, run_id, stage, payload, attempts in claimed]
+
+
+def heartbeat(connection, owner, lease_seconds=300):
+    """
+    Extends the leases of all running tasks of owner.
+
+    Returns:
+    - set: Ids of the tasks owner still holds; a task missing from it was requeued after its
+      lease expired and must not be completed by owner.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE alignment_tasks
+            SET lease_expires_at = now() + make_interval(secs => %s), heartbeat_at = now()
+            WHERE lease_owner = %s AND status = 'running'
+            RETURNING id""", (lease_seconds, owner))
+        held = {row[0] for row in cursor.fetchall()}
+    connection.commit()
+    increment('db_round_trips', operation='heartbeat', table='alignment_tasks')
+    return held
+
+
+def complete_task(connection, task_id, owner, result_df):
+    """
+    Stores the result of a task, if owner still holds its lease.
+
+    Returns:
+    - bool: False if the lease was lost (the task was requeued and the result is discarded).
+    """
+    result = None if result_df is None else psycopg2.Binary(encode_frame(result_df))
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE alignment_tasks
+            SET status = 'done', result = %s, finished_at = now(), lease_owner = NULL, lease_expires_at = NULL
+            WHERE id = %s AND lease_owner = %s AND status = 'running'""", (result, task_id, owner))
+        held = cursor.rowcount == 1
+    connection.commit()
+    increment('db_round_trips', operation='complete_task', table='alignment_tasks')
+    if not held:
+        logging.warning(f"Alignment task {task_id}: lease lost before completion, result discarded")
+    return held
+
+
+def fail_task(connection, task_id, owner, error, retry=False):
+    """
+    Records a failed attempt of a task held by owner.
+
+    With retry, the task goes back to the queue unless it used up its attempts; otherwise it
+    is failed for good with the error's class, message and MAFFT stderr.
+
+    Returns:
+    - bool: False if the lease was lost.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE alignment_tasks
+            SET status = CASE WHEN %s AND attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+                finished_at = CASE WHEN %s AND attempts < max_attempts THEN NULL ELSE now() END,
+                error_class = %s, error_message = %s, mafft_stderr = %s,
+                lease_owner = NULL, lease_expires_at = NULL
+            WHERE id = %s AND lease_owner = %s AND status = 'running'""",
+                       (retry, retry, type(error).__name__, str(error), getattr(error, 'stderr', '') or '',
+                        task_id, owner))
+        held = cursor.rowcount == 1
+    connection.commit()
+    increment('db_round_trips', operation='fail_task', table='alignment_tasks')
+    return held
+
+
+def run_progress(connection, run_id):
+    """
+    Returns the number of tasks of a run per status, e.g. {'queued': 10, 'running': 4, 'done': 86}.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT status, count(*) FROM alignment_tasks WHERE run_id = %s GROUP BY status", (run_id,))
+        counts = dict(cursor.fetchall())
+    connection.commit()
+    increment('db_round_trips', operation='run_progress', table='alignment_tasks')
+    return {status: counts.get(status, 0) for status in TASK_STATUSES}
+
+
+def wait_for_run(connection, run_id, poll_seconds=2.0, timeout_seconds=None):
+    """
+    Waits until no task of the run is queued or running, requeueing expired leases meanwhile
+    so a run finishes even when all its workers died (once new workers start).
+
+    Returns:
+    - dict or str: Final run_progress, or an error message on timeout.
+    """
+    start = time.monotonic()
+    while True:
+        requeue_expired_leases(connection)
+        progress = run_progress(connection, run_id)
+        if not progress['queued'] and not progress['running']:
+            observe('queue_run_wait_seconds', time.monotonic() - start)
+            return progress
+        if timeout_seconds is not None and time.monotonic() - start > timeout_seconds:
+            return f"Error: run {run_id} not finished after {timeout_seconds}s: {progress}"
+        time.sleep(poll_seconds)
+
+
+def collect_results(connection, run_id, stage):
+    """
+    Reads the results of a run's stage in query row order.
+
+    Returns:
+    - tuple: (result_df, quarantine_df, stats) like process_sequence_alignment_isolated, with
+      failed tasks as quarantine records (query row plus 'stage', 'error_class', 'error_message',
+      'mafft_stderr' and 'attempts').
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT status, payload, result, error_class, error_message, mafft_stderr, attempts
+            FROM alignment_tasks WHERE run_id = %s AND stage = %s ORDER BY position""", (run_id, stage))
+        rows = cursor.fetchall()
+    connection.commit()
+    increment('db_round_trips', operation='collect_results', table='alignment_tasks')
+
+    results, quarantined = [], []
+    stats = {'succeeded': 0, 'retried': 0, 'retries': 0, 'quarantined': 0}
+    for status, payload, result, error_class, error_message, mafft_stderr, attempts in rows:
+        if status == 'done':
+            stats['succeeded'] += 1
+            if result is not None:
+                results.append(decode_frame(result))
+        elif status == 'failed':
+            stats['quarantined'] += 1
+            quarantined.append(decode_frame(payload).assign(
+                stage=stage, error_class=error_class, error_message=error_message,
+                mafft_stderr=mafft_stderr or '', attempts=attempts))
+        stats['retried'] += int(attempts > 1)
+        stats['retries'] += max(attempts - 1, 0)
+    results = [df for df in results if df is not None and not df.empty]
+    result_df = pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+    quarantine_df = pd.concat(quarantined, ignore_index=True) if quarantined else pd.DataFrame()
+    return result_df, quarantine_df, stats
@@ -1,6 +1,9 @@
 import psycopg2
 import pandas as pd
+from run_metrics import increment
+from profiling_hooks import profiled
 
+@profiled
 def upload_df_to_table(database, user, password, host, port, table_name, df):
     """
     Uploads rows from a Pandas DataFrame to a PostgreSQL table.
@@ -36,6 +39,7 @@ def upload_df_to_table(database, user, password, host, port, table_name, df):
         with psycopg2.connect(dbname=database, user=user, password=password, host=host, port=port) as conn:
             with conn.cursor() as cur:
                 cur.execute(f"SELECT column_name FROM information_schema.columns WHERE table_name = '{table_name}'")
+                increment('db_round_trips', operation='column_lookup', table=table_name)
                 table_columns = [row[0] for row in cur.fetchall()]
 
                 # Remove 'id' and 'mod_date' columns
@@ -70,6 +74,7 @@ def upload_df_to_table(database, user, password, host, port, table_name, df):
                     where_clause = " AND ".join(where_clauses)
                     query = f"SELECT COUNT(*) FROM {table_name} WHERE {where_clause}"
                     cur.execute(query)
+                    increment('db_round_trips', operation='row_exists', table=table_name)
                     count = cur.fetchone()[0]
                     if count > 0:
                         not_to_upload.append(row)
@@ -85,6 +90,8 @@ def upload_df_to_table(database, user, password, host, port, table_name, df):
                     query = f"INSERT INTO {table_name} ({', '.join(to_upload_df.columns)}) VALUES ({values})"
 
                     cur.executemany(query, to_upload_df.values)
+                    # executemany sends one statement per row
+                    increment('db_round_trips', len(to_upload_df), operation='insert', table=table_name)
                     conn.commit()
 
                 return to_upload_df, not_to_upload_df
@@ -2,8 +2,137 @@ from db_server_starter import start_or_connect_postgres
 from file_reading_operations import read_db_tables_from_json
 from path_finder import find_path_of_file_or_dir 
 
+import re
+import json
+import time
+import hashlib
+from datetime import date
 import psycopg2
 import pandas as pd
+from run_metrics import increment, observe
+
+# Records the hash of the applied tables_info.json, so unchanged schemas skip DDL
+SCHEMA_VERSION_TABLE = "schema_version"
+
+# Serializes schema changes of concurrent bootstraps (e.g. several queue workers starting at once)
+SCHEMA_LOCK_KEY = 7345101
+
+# Indexes every database gets, added to the "indexes" of tables_info.json entries (for the
+# columns the table has). Patient and date lookups use btree indexes; the cleaned sequence
+# gets a hash index, which stores a 32-bit fingerprint of the sequence instead of the
+# sequence itself (too long for a btree entry) and serves the equality checks of the upload
+# dedup.
+DEFAULT_TABLE_INDEXES = {
+    "seq": [
+        {"columns": ["pat_id"], "method": "btree"},
+        {"columns": ["seq_sample_date"], "method": "btree"},
+        {"columns": ["seq_cleaned"], "method": "hash"}
+    ]
+}
+
+# Unique keys every database gets, added like DEFAULT_TABLE_INDEXES. A sequence is stored once
+# per patient and sample date, so the ON CONFLICT DO NOTHING of the uploads rejects a row that
+# a concurrent upload inserted after the existence check. The key holds md5(seq), as sequences
+# are too long for a btree entry. A database that already holds such duplicates fails the
+# bootstrap with the duplicated key until they are removed.
+DEFAULT_TABLE_UNIQUE_KEYS = {
+    "seq": [
+        {"columns": ["pat_id", "seq_sample_date", "md5(seq)"], "name": "seq_pat_id_seq_sample_date_seq_key"}
+    ]
+}
+
+# Tables of the pipeline's own modules, created by the bootstrap with the tables of
+# tables_info.json (an entry of the same name there replaces them):
+# - alignment_quarantine: rows that failed alignment (quarantine_recorder)
+# - alignment_tasks: work queue of the alignment queue workers (alignment_task_queue); claiming
+#   scans queued tasks, and collecting and progress checks read one run
+# - hiv_type_ref_region: genomic regions sliced out of the typing alignment
+#   (genomic_region_extractor); seq_name refers to hiv_type_ref_seq.seq_name. Seeded with the
+#   HXB2 (K03455) coordinates of commonly used regions; PR/RT is the drug resistance
+#   genotyping region (PR and RT codons 1-440)
+# - transmission_edge: pairs of sequences within the distance threshold (pairwise_distance_engine)
+PIPELINE_TABLES = {
+    "alignment_quarantine": {
+        "column_dict": {
+            "id": "SERIAL PRIMARY KEY",
+            "stage": "VARCHAR(100)",
+            "query_row": "TEXT",
+            "error_class": "VARCHAR(100)",
+            "error_message": "TEXT",
+            "mafft_stderr": "TEXT",
+            "attempts": "INTEGER",
+            "mod_date": "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
+        }
+    },
+    "alignment_tasks": {
+        "column_dict": {
+            "id": "BIGSERIAL PRIMARY KEY",
+            "run_id": "VARCHAR(64) NOT NULL",
+            "stage": "VARCHAR(100) NOT NULL",
+            "position": "INTEGER NOT NULL",
+            "status": "VARCHAR(20) NOT NULL DEFAULT 'queued'",
+            "attempts": "INTEGER NOT NULL DEFAULT 0",
+            "max_attempts": "INTEGER NOT NULL DEFAULT 3",
+            "lease_owner": "VARCHAR(200)",
+            "lease_expires_at": "TIMESTAMP",
+            "heartbeat_at": "TIMESTAMP",
+            "payload": "BYTEA NOT NULL",
+            "result": "BYTEA",
+            "error_class": "VARCHAR(100)",
+            "error_message": "TEXT",
+            "mafft_stderr": "TEXT",
+            "finished_at": "TIMESTAMP",
+            "mod_date": "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
+        },
+        "indexes": [
+            {"columns": ["stage", "id"], "where": "status = 'queued'", "name": "alignment_tasks_queued_idx"},
+            {"columns": ["lease_expires_at"], "where": "status = 'running'", "name": "alignment_tasks_running_idx"},
+            {"columns": ["run_id", "stage", "position"], "name": "alignment_tasks_run_idx"}
+        ]
+    },
+    "hiv_type_ref_region": {
+        "column_dict": {
+            "id": "SERIAL PRIMARY KEY",
+            "seq_name": "VARCHAR(50)",
+            "region_name": "VARCHAR(50)",
+            "region_start_coord": "INTEGER",
+            "region_end_coord": "INTEGER",
+            "mod_date": "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
+        },
+        "unique_keys": [["seq_name", "region_name"]],
+        "seed_rows": {
+            "columns": ["seq_name", "region_name", "region_start_coord", "region_end_coord"],
+            "values": [
+                ["HXB2", "gag", 790, 2292],
+                ["HXB2", "pol", 2085, 5096],
+                ["HXB2", "PR", 2253, 2549],
+                ["HXB2", "RT", 2550, 4229],
+                ["HXB2", "IN", 4230, 5096],
+                ["HXB2", "PR/RT", 2253, 3869],
+                ["HXB2", "env", 6225, 8795]
+            ]
+        }
+    },
+    "transmission_edge": {
+        "column_dict": {
+            "id": "BIGSERIAL PRIMARY KEY",
+            "pat_id_1": "VARCHAR(100)",
+            "seq_sample_date_1": "DATE",
+            "pat_id_2": "VARCHAR(100)",
+            "seq_sample_date_2": "DATE",
+            "tn93_distance": "DOUBLE PRECISION",
+            "p_distance": "DOUBLE PRECISION",
+            "overlap": "INTEGER",
+            "ambiguity_mode": "VARCHAR(20)",
+            "mod_date": "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
+        },
+        "unique_keys": [["pat_id_1", "seq_sample_date_1", "pat_id_2", "seq_sample_date_2", "ambiguity_mode"]],
+        "indexes": [
+            {"columns": ["pat_id_1"]},
+            {"columns": ["pat_id_2"]}
+        ]
+    }
+}
 
 def create_db(database, user, password, host, port):
     """
@@ -54,9 +183,188 @@ def create_db(database, user, password, host, port):
             connection.close()
             
 
-def create_table(database, user, password, host, port, column_dict, table_name):
+def spec_columns(columns):
+    """
+    Returns the table columns an index or key spec refers to, e.g. ['seq'] for ['md5(seq)'].
+    """
+    return re.findall(r'\b([A-Za-z_]\w*)\b(?!\s*\()', " ".join(columns))
+
+
+def with_default_specs(db_tables_info):
+    """
+    Returns a copy of a tables_info.json document with the PIPELINE_TABLES it does not declare,
+    and with DEFAULT_TABLE_INDEXES and DEFAULT_TABLE_UNIQUE_KEYS added to its tables.
+    """
+    tables = {}
+    for table_name, table_data in {**PIPELINE_TABLES, **db_tables_info["tables"]}.items():
+        table_data = dict(table_data)
+        for spec_key, defaults in (("indexes", DEFAULT_TABLE_INDEXES), ("unique_keys", DEFAULT_TABLE_UNIQUE_KEYS)):
+            specs = list(table_data.get(spec_key, []))
+            for spec in defaults.get(table_name, []):
+                if all(column in table_data["column_dict"] for column in spec_columns(spec["columns"])) \
+                        and spec not in specs:
+                    specs.append(spec)
+            if specs:
+                table_data[spec_key] = specs
+        tables[table_name] = table_data
+    return {**db_tables_info, "tables": tables}
+
+
+def index_name(table_name, columns, suffix):
+    """
+    Default name of an index: table, columns (expressions reduced to identifier characters) and suffix,
+    shortened with a hash to PostgreSQL's 63-character limit.
+    """
+    name = "_".join([table_name] + [re.sub(r'\W+', '_', column).strip('_') for column in columns] + [suffix])
+    if len(name) > 63:
+        name = f"{name[:54]}_{hashlib.md5(name.encode()).hexdigest()[:8]}"
+    return name
+
+
+def partition_ranges(partition_by):
+    """
+    Returns (suffix, start, end) of the range partitions of a "partition_by" spec, one per
+    year or month from its "from" date up to its "to" date.
     """
-    Creates a new table in a PostgreSQL database with the specified columns.
+    interval = partition_by.get("interval", "year")
+    if interval not in ("year", "month"):
+        raise ValueError(f"Unsupported partition interval '{interval}'")
+    current = date.fromisoformat(partition_by["from"]).replace(day=1)
+    if interval == "year":
+        current = current.replace(month=1)
+    end = date.fromisoformat(partition_by["to"])
+    ranges = []
+    while current < end:
+        if interval == "year":
+            following = current.replace(year=current.year + 1)
+            suffix = f"y{current.year}"
+        else:
+            following = current.replace(year=current.year + current.month // 12, month=current.month % 12 + 1)
+            suffix = f"m{current.year}{current.month:02d}"
+        ranges.append((suffix, current.isoformat(), following.isoformat()))
+        current = following
+    return ranges
+
+
+def sql_literal(value):
+    """
+    SQL literal of a JSON value of tables_info.json.
+    """
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def table_ddl(table_name, table_data, existing_kind=None):
+    """
+    Returns the statements that create a table of a tables_info.json entry, or bring an
+    existing one up to it. Every statement is idempotent.
+
+    Besides "column_dict", an entry may declare:
+    - "indexes": [{"columns": [...], "method": "btree", "name": ..., "where": ...}, ...]; columns
+      may be expressions, e.g. "md5(seq_cleaned)".
+    - "unique_keys": [{"columns": [...], "name": ...}, ...] or lists of columns. Created as unique
+      indexes with NULLS NOT DISTINCT, so rows equal in the key columns (NULLs included) are
+      rejected, like the all-column check of the uploads.
+    - "partition_by": {"column": "seq_sample_date", "interval": "year" or "month", "from": "2000-01-01",
+      "to": "2031-01-01"}: range partitions over [from, to) plus a default partition for NULL and
+      out-of-range values. A primary key of a partitioned table becomes a unique index on the key
+      and the partition column, and unique keys must include the partition column. A table that
+      exists unpartitioned is converted (existing_kind 'r'), keeping its rows and ids. Extending the
+      range later needs the default partition to hold no rows of the new range.
+    - "seed_rows": {"columns": [...], "values": [[...], ...]}: rows inserted with ON CONFLICT DO
+      NOTHING, so with a unique key, rows already in the table (or edited there) are kept.
+
+    Parameters:
+    - table_name (str): The name of the table.
+    - table_data (dict): The table's entry in tables_info.json.
+    - existing_kind (str, optional): pg_class.relkind of an existing table ('r' or 'p').
+
+    Returns:
+    - list: SQL statements.
+    """
+    column_dict = table_data["column_dict"]
+    partition_by = table_data.get("partition_by")
+    unique_keys = [key if isinstance(key, dict) else {"columns": key} for key in table_data.get("unique_keys", [])]
+    indexes = list(table_data.get("indexes", []))
+    statements = []
+
+    if partition_by:
+        partition_column = partition_by["column"]
+        if partition_column not in column_dict:
+            raise ValueError(f"Partition column '{partition_column}' is not a column of '{table_name}'")
+        primary_key = [name for name, data_type in column_dict.items() if "PRIMARY KEY" in data_type.upper()]
+        column_dict = {name: re.sub(r'\s*PRIMARY KEY', '', data_type, flags=re.IGNORECASE)
+                       for name, data_type in column_dict.items()}
+        if primary_key:
+            unique_keys.insert(0, {"columns": primary_key + [partition_column], "nulls_distinct": True})
+        for key in unique_keys:
+            if partition_column not in key["columns"]:
+                raise ValueError(f"Unique key {key['columns']} of partitioned table '{table_name}' "
+                                 f"must include '{partition_column}'")
+
+    column_defs_str = ", ".join(f"{column_name} {data_type}" for column_name, data_type in column_dict.items())
+    if partition_by and existing_kind == 'r':
+        # Rebuild as a partitioned table: the old table keeps its name suffix until its rows are copied
+        old_table = f"{table_name}_unpartitioned"
+        statements.append(f"ALTER TABLE {table_name} RENAME TO {old_table};")
+    if partition_by:
+        statements.append(f"CREATE TABLE IF NOT EXISTS {table_name} ({column_defs_str}) "
+                          f"PARTITION BY RANGE ({partition_by['column']});")
+        for suffix, start, end in partition_ranges(partition_by):
+            statements.append(f"CREATE TABLE IF NOT EXISTS {table_name}_{suffix} PARTITION OF {table_name} "
+                              f"FOR VALUES FROM ('{start}') TO ('{end}');")
+        statements.append(f"CREATE TABLE IF NOT EXISTS {table_name}_default PARTITION OF {table_name} DEFAULT;")
+    else:
+        statements.append(f"CREATE TABLE IF NOT EXISTS {table_name} ({column_defs_str});")
+    for column_name, data_type in column_dict.items():
+        if "PRIMARY KEY" not in data_type.upper() and "SERIAL" not in data_type.upper():
+            statements.append(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {column_name} {data_type};")
+    if partition_by and existing_kind == 'r':
+        columns = ", ".join(column_dict)
+        for column_name, data_type in column_dict.items():
+            if "SERIAL" not in data_type.upper():
+                # Columns new in the schema, so the copy can select them
+                statements.append(f"ALTER TABLE {old_table} ADD COLUMN IF NOT EXISTS {column_name} {data_type};")
+        statements.append(f"INSERT INTO {table_name} ({columns}) SELECT {columns} FROM {old_table};")
+        for column_name, data_type in column_dict.items():
+            if "SERIAL" in data_type.upper():
+                statements.append(f"SELECT setval(pg_get_serial_sequence('{table_name}', '{column_name}'), "
+                                  f"COALESCE((SELECT max({column_name}) FROM {table_name}), 0) + 1, false);")
+        statements.append(f"DROP TABLE {old_table};")
+
+    def key_list(columns):
+        # Expressions such as md5(seq_cleaned) are parenthesized
+        return ", ".join(column if re.fullmatch(r'\w+', column) else f"({column})" for column in columns)
+
+    for key in unique_keys:
+        name = key.get("name") or index_name(table_name, key["columns"], "key")
+        nulls = "" if key.get("nulls_distinct") else " NULLS NOT DISTINCT"
+        statements.append(f"CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {table_name} "
+                          f"({key_list(key['columns'])}){nulls};")
+    for index in indexes:
+        method = index.get("method", "btree")
+        name = index.get("name") or index_name(table_name, index["columns"], f"{method}_idx")
+        where = f" WHERE {index['where']}" if index.get("where") else ""
+        statements.append(f"CREATE INDEX IF NOT EXISTS {name} ON {table_name} USING {method} "
+                          f"({key_list(index['columns'])}){where};")
+    if table_data.get("seed_rows"):
+        seed_rows = table_data["seed_rows"]
+        values = ", ".join("(" + ", ".join(sql_literal(value) for value in row) + ")" for row in seed_rows["values"])
+        statements.append(f"INSERT INTO {table_name} ({', '.join(seed_rows['columns'])}) VALUES {values} "
+                          f"ON CONFLICT DO NOTHING;")
+    return statements
+
+
+def create_table(database, user, password, host, port, column_dict, table_name, indexes=None, unique_keys=None,
+                 partition_by=None):
+    """
+    Creates a new table in a PostgreSQL database with the specified columns, indexes, unique keys and
+    partitions (see table_ddl). Missing indexes are also created when the table exists.
 
     Parameters:
     - database (str): The name of the PostgreSQL database.
@@ -66,10 +374,15 @@ def create_table(database, user, password, host, port, column_dict, table_name):
     - port (str): The port number of the database server.
     - table_name (str): The name of the table to be created.
     - column_dict (dict): A dictionary where keys are column names and values are their data types.
+    - indexes (list, optional): Index specs, as in tables_info.json.
+    - unique_keys (list, optional): Unique key specs, as in tables_info.json.
+    - partition_by (dict, optional): Range partitioning spec, as in tables_info.json.
 
     Returns:
     - str: A success message if the table is created, a skip message if the table already exists, or an error message if an exception occurs.
     """
+    table_data = {"column_dict": column_dict, "indexes": indexes or [], "unique_keys": unique_keys or [],
+                  "partition_by": partition_by}
     try:
         # Connect to the PostgreSQL database
         with psycopg2.connect(
@@ -81,37 +394,156 @@ def create_table(database, user, password, host, port, column_dict, table_name):
         ) as connection:
             # Create a cursor
             with connection.cursor() as cursor:
-                # Generate the column definitions string
-                column_defs = [f"{column_name} {data_type}" for column_name, data_type in column_dict.items()]
-                column_defs_str = ", ".join(column_defs)
-
                 # Check if the table exists
                 check_table_query = f"SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = '{table_name}');"
                 cursor.execute(check_table_query)
+                increment('db_round_trips', operation='table_exists', table=table_name)
                 table_exists = cursor.fetchone()[0]
 
                 if table_exists:
+                    if indexes or unique_keys:
+                        # Add the indexes missing from an existing table
+                        cursor.execute("\n".join(statement for statement in table_ddl(table_name, table_data)
+                                                  if statement.startswith("CREATE") and "INDEX" in statement))
+                        increment('db_round_trips', operation='create_indexes', table=table_name)
+                        connection.commit()
                     return f"Table '{table_name}' already exists. Skipping table creation."
                 else:
-                    # Define the SQL command to create the table
-                    create_table_query = f"CREATE TABLE {table_name} ({column_defs_str});"
-
-                    # Execute the SQL command
-                    cursor.execute(create_table_query)
+                    # Execute the SQL commands that create the table, its partitions and indexes
+                    cursor.execute("\n".join(table_ddl(table_name, table_data)))
+                    increment('db_round_trips', operation='create_table', table=table_name)
 
                     # Commit the changes to the database
                     connection.commit()
 
                     return f"Table '{table_name}' created successfully!"
 
-    except psycopg2.Error as error:
+    except (psycopg2.Error, ValueError) as error:
         return f"Error while creating table: {error}"
     
     
+def schema_hash(db_tables_info):
+    """
+    Returns a hash of the table definitions of a tables_info.json document.
+    """
+    canonical = json.dumps(db_tables_info["tables"], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def schema_is_current(connection, schema_digest):
+    """
+    Checks in one query whether the schema with this hash was applied to the database.
+    """
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT 1 FROM {SCHEMA_VERSION_TABLE} WHERE schema_hash = %s;", (schema_digest,))
+            increment('db_round_trips', operation='schema_check', table=SCHEMA_VERSION_TABLE)
+            current = cursor.fetchone() is not None
+        connection.commit()
+        return current
+    except psycopg2.errors.UndefinedTable:
+        # No schema applied yet
+        connection.rollback()
+        return False
+
+
+def schema_ddl(db_tables_info, schema_digest, existing_kinds=None):
+    """
+    Returns the statements that bring a database to the schema of tables_info.json: the
+    tables with their partitions, columns added to existing tables, indexes and unique keys
+    (see table_ddl), and the schema_version record.
+
+    existing_kinds maps the names of existing tables to their pg_class.relkind.
+    """
+    existing_kinds = existing_kinds or {}
+    statements = []
+    for table_name, table_data in db_tables_info["tables"].items():
+        statements.extend(table_ddl(table_name, table_data, existing_kinds.get(table_name)))
+    statements.append(f"CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} (id SERIAL PRIMARY KEY, "
+                      f"schema_hash VARCHAR(64) UNIQUE, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);")
+    statements.append(f"INSERT INTO {SCHEMA_VERSION_TABLE} (schema_hash) VALUES ('{schema_digest}') "
+                      f"ON CONFLICT (schema_hash) DO NOTHING;")
+    return statements
+
+
+def apply_schema(connection, db_tables_info):
+    """
+    Applies the tables of a tables_info.json document (with the defaults of with_default_specs)
+    in one transaction, unless the same schema was applied before.
+
+    Tables that exist keep their data; columns, indexes and unique keys new in the schema are
+    added to them, and tables that became partitioned are converted.
+
+    Parameters:
+    - connection: psycopg2 connection to the pipeline database.
+    - db_tables_info (dict): Contents of tables_info.json.
+
+    Returns:
+    - str: Whether the schema was current or applied.
+    """
+    db_tables_info = with_default_specs(db_tables_info)
+    schema_digest = schema_hash(db_tables_info)
+    if schema_is_current(connection, schema_digest):
+        return f"Schema {schema_digest[:12]} is current."
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT pg_advisory_xact_lock({SCHEMA_LOCK_KEY});")
+        cursor.execute("SELECT relname, relkind FROM pg_class WHERE relname = ANY(%s) AND relkind IN ('r', 'p') "
+                       "AND relnamespace = 'public'::regnamespace;", (list(db_tables_info["tables"]),))
+        existing_kinds = dict(cursor.fetchall())
+        # One round trip; the statements commit or roll back together
+        cursor.execute("\n".join(schema_ddl(db_tables_info, schema_digest, existing_kinds)))
+        increment('db_round_trips', 2, operation='apply_schema', table=SCHEMA_VERSION_TABLE)
+    connection.commit()
+    return f"Schema {schema_digest[:12]} applied."
+
+
+def connect_when_ready(database, user, password, host, port, timeout_seconds=30):
+    """
+    Connects to a database, retrying while a just-started server is still starting up or
+    recovering.
+    """
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        try:
+            return psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
+        except psycopg2.OperationalError as e:
+            if "starting up" not in str(e) and "recovery" not in str(e) or time.monotonic() >= deadline:
+                raise
+            time.sleep(0.1)
+
+
+def bootstrap_schema(database, user, password, host, port):
+    """
+    Applies the tables of tables_info.json (see apply_schema) to a database that exists on a
+    running server, without starting the server or creating the database as db_wrapper does,
+    e.g. for queue workers on other hosts.
+
+    Returns:
+    - str: Whether the schema was current or applied, or an error message.
+    """
+    db_tables_info = read_db_tables_from_json(find_path_of_file_or_dir('bin/database/tables_info.json'))
+    if isinstance(db_tables_info, str):
+        return db_tables_info
+    try:
+        connection = connect_when_ready(database, user, password, host, port)
+        try:
+            return apply_schema(connection, db_tables_info)
+        finally:
+            connection.close()
+    except psycopg2.Error as e:
+        return f"Error: {str(e)}"
+
+
 def db_wrapper(database, user, password, host, port):
     """
-    Wrapper function to install, start or connect to PostgreSQL, and create a new database if it doesn't already exist.
+    Wrapper function to install, start or connect to PostgreSQL, create a new database if it doesn't already exist,
+    and create the tables of tables_info.json.
+
+    A server that already listens is used without calling pg_ctl, and the tables are created
+    in one transaction only when tables_info.json changed since the last run (see apply_schema),
+    so a run against a ready database costs one connection and one query.
     """
+    start = time.perf_counter()
     try:
         pgsql_path = find_path_of_file_or_dir('bin/database')
         db_tables_json_path = find_path_of_file_or_dir('bin/database/tables_info.json')
@@ -121,51 +553,41 @@ def db_wrapper(database, user, password, host, port):
             return "Error: PostgreSQL binary directory not found."
 
         # Start or connect to PostgreSQL server
-        start_result = start_or_connect_postgres(pgsql_path)
+        start_result = start_or_connect_postgres(pgsql_path, host, port)
         if start_result.startswith("Error"):
             return start_result
 
-        # Check if the database already exists
-        connection = psycopg2.connect(
-            database="postgres",
-            user=user,
-            password=password,
-            host=host,
-            port=port
-        )
-        connection.autocommit = True
-        cursor = connection.cursor()
-        cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s;", (database,))
-        if cursor.fetchone() is not None:
-            # Database already exists, check for tables
-            cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public';")
-            existing_tables = [row[0] for row in cursor.fetchall()]
-            
-            # Read table information from JSON file
-            db_tables_info = read_db_tables_from_json(db_tables_json_path)
-            for table_name, table_data in db_tables_info["tables"].items():
-                if table_name not in existing_tables:
-                    # Table does not exist, create it
-                    column_dict = table_data["column_dict"]
-                    create_table(database, user, password, host, port, column_dict, table_name)
-            
-            return f"PostgreSQL server started. Database '{database}' already exists. Tables checked and created if needed."
-        
-        # Create PostgreSQL database
-        create_result = create_db(database, user, password, host, port)
-        if create_result.startswith("Error"):
-            return create_result
-
-        # Database was created, create tables
+        # Read table information from JSON file
         db_tables_info = read_db_tables_from_json(db_tables_json_path)
-        for table_name, table_data in db_tables_info["tables"].items():
-            column_dict = table_data["column_dict"]
-            create_table(database, user, password, host, port, column_dict, table_name)
+        if isinstance(db_tables_info, str):
+            return db_tables_info
+
+        try:
+            connection = connect_when_ready(database, user, password, host, port)
+            created = False
+        except psycopg2.OperationalError as e:
+            if f'"{database}" does not exist' not in str(e):
+                raise
+            # Create PostgreSQL database
+            create_result = create_db(database, user, password, host, port)
+            if create_result.startswith("Error"):
+                return create_result
+            connection = psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
+            created = True
 
-        return f"PostgreSQL installed, server started, and database '{database}' created successfully with tables."
+        try:
+            schema_result = apply_schema(connection, db_tables_info)
+        finally:
+            connection.close()
+
+        if created:
+            return f"{start_result} Database '{database}' created successfully. {schema_result}"
+        return f"{start_result} Database '{database}' already exists. {schema_result}"
 
     except Exception as e:
         return f"Error: {str(e)}"
+    finally:
+        observe('db_bootstrap_seconds', time.perf_counter() - start)
 
     
 def extract_table(database, user, password, host, port, table_name):
@@ -196,11 +618,13 @@ def extract_table(database, user, password, host, port, table_name):
             with connection.cursor() as cursor:
                 # Check if the table exists in the PostgreSQL database
                 cursor.execute("SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = %s);", (table_name,))
+                increment('db_round_trips', operation='table_exists', table=table_name)
                 exists = cursor.fetchone()[0]
 
                 if exists:
                     # Fetch all the records from the specified table
                     cursor.execute(f"SELECT * FROM {table_name};")
+                    increment('db_round_trips', operation='select_all', table=table_name)
                     records = cursor.fetchall()
                     column_names = [desc[0] for desc in cursor.description]
                     df = pd.DataFrame(records, columns=column_names)
@@ -1,17 +1,65 @@
 import os
+import time
+import socket
+import subprocess
 from db_server_installer import install_postgres
 
-def start_or_connect_postgres(pgsql_path):
+
+def postgres_is_listening(host, port, timeout_seconds=0.5):
+    """
+    Checks whether a PostgreSQL server accepts connections on host:port, without logging in.
+
+    Parameters:
+    - host (str): The host address of the database server.
+    - port (str): The port number of the database server.
+    - timeout_seconds (float): Connect timeout of the probe.
+
+    Returns:
+    - bool: True if a connection to the port succeeds.
+    """
+    try:
+        with socket.create_connection((host, int(port)), timeout=timeout_seconds):
+            return True
+    except OSError:
+        return False
+
+
+def wait_for_postgres(host, port, timeout_seconds=30, interval_seconds=0.1):
+    """
+    Waits until postgres_is_listening(host, port) or the timeout passes.
+
+    Returns:
+    - bool: True if the server is listening.
+    """
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        if postgres_is_listening(host, port):
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval_seconds)
+
+
+def start_or_connect_postgres(pgsql_path, host=None, port=None, timeout_seconds=30):
     """
     Starts or connects to the PostgreSQL server.
 
+    With host and port, a server that already listens there is used as is (no pg_ctl call),
+    and after starting the server the function waits until it listens.
+
     Parameters:
     - pgsql_path (str): The path to the PostgreSQL binary directory.
+    - host (str, optional): The host address of the database server.
+    - port (str, optional): The port number of the database server.
+    - timeout_seconds (float): How long to wait for a started server to listen.
 
     Returns:
     - message (str): A message indicating the success or failure of starting or connecting to the PostgreSQL server.
     """
     try:
+        if host is not None and port is not None and postgres_is_listening(host, port):
+            return "PostgreSQL server already running."
+
         # Check if "pgsql" is in the directory specified by pgsql_path
         if "pgsql" in os.listdir(pgsql_path):
             # Add "pgsql" to pgsql_path
@@ -29,8 +77,12 @@ def start_or_connect_postgres(pgsql_path):
                 return install_result
 
         # Start the PostgreSQL server
-        os.system(f"{pgsql_path}/bin/pg_ctl -D {pgsql_path}/data -l {pgsql_path}/logfile start > /dev/null 2>&1")
+        subprocess.run([os.path.join(pgsql_path, "bin", "pg_ctl"), "-D", os.path.join(pgsql_path, "data"),
+                        "-l", os.path.join(pgsql_path, "logfile"), "start"],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
+        if host is not None and port is not None and not wait_for_postgres(host, port, timeout_seconds):
+            return f"Error: PostgreSQL server not listening on {host}:{port} after {timeout_seconds}s"
         return "PostgreSQL server started successfully."
     except Exception as e:
         # Return an error message if an exception occurs
@@ -0,0 +1,244 @@
+import time
+import random
+import logging
+import threading
+import psycopg2
+import psycopg2.extras
+import pandas as pd
+from run_metrics import increment, observe
+
+
+class IncrementalUploadSink:
+    """
+    Uploads rows to a PostgreSQL table while they are being produced.
+
+    put() hands rows to a writer thread, which inserts them in micro-batches of batch_size rows
+    or after flush_interval_seconds, whichever comes first, so insert latency overlaps with the
+    computation that produces the rows. Each batch is one bulk INSERT and one commit on a
+    connection kept open for the life of the sink, so every committed batch is durable in the
+    table even if the run fails later.
+
+    A batch skips rows the table already holds (all uploaded columns equal, NULLs included),
+    like upload_df_to_table, which also makes retrying a batch after a lost connection safe.
+    Rows rejected by a unique key of the table are skipped as well.
+
+    Parameters:
+    - database, user, password, host, port: Connection parameters of the PostgreSQL database.
+    - table_name (str): Table to upload to.
+    - batch_size (int): Rows per insert.
+    - flush_interval_seconds (float): Longest time a row waits before it is written.
+    - max_pending_rows (int, optional): put() blocks while this many rows wait (default 10 batches).
+    - max_retries (int): Retries of a batch after a database error.
+    - keep_columns (list, optional): Columns that are not uploaded but kept in the returned
+      DataFrames, e.g. to tell which input file a row came from.
+    """
+
+    def __init__(self, database, user, password, host, port, table_name='seq', batch_size=500,
+                 flush_interval_seconds=10.0, max_pending_rows=None, max_retries=3, keep_columns=None):
+        self.connection_params = {'dbname': database, 'user': user, 'password': password, 'host': host, 'port': port}
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_pending_rows = max_pending_rows or 10 * batch_size
+        self.max_retries = max_retries
+        self.keep_columns = list(keep_columns or [])
+        self.uploaded = []
+        self.not_uploaded = []
+        self.error = None
+        self._pending = []
+        self._pending_rows = 0
+        self._oldest_pending = None
+        self._closing = False
+        self._flush_requested = False
+        self._conn = None
+        self._columns = None
+        self._condition = threading.Condition()
+        self._writer = threading.Thread(target=self._write_loop, name=f'upload-{table_name}', daemon=True)
+        self._writer.start()
+
+    def put(self, df):
+        """
+        Queues rows for upload. Blocks while max_pending_rows rows are waiting.
+
+        Raises:
+        - RuntimeError: If the sink is closed or an earlier batch failed for good.
+        """
+        if df is None or df.empty:
+            return
+        with self._condition:
+            while self._pending_rows >= self.max_pending_rows and self.error is None:
+                self._condition.wait()
+            if self.error is not None:
+                raise RuntimeError(f"Upload to {self.table_name} failed: {self.error}")
+            if self._closing:
+                raise RuntimeError(f"Upload sink of {self.table_name} is closed")
+            self._pending.append(df)
+            self._pending_rows += len(df)
+            if self._oldest_pending is None:
+                self._oldest_pending = time.monotonic()
+            self._condition.notify_all()
+
+    def flush(self):
+        """Writes all queued rows and waits until they are committed."""
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            while (self._pending_rows or self._flush_requested) and self.error is None:
+                self._condition.wait()
+
+    def close(self):
+        """
+        Writes the remaining rows and closes the connection.
+
+        Returns:
+        - tuple or str: (uploaded_df, not_uploaded_df) over all batches, or an error message.
+        """
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        self._writer.join()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self.error is not None:
+            return f"An error occurred: {self.error}"
+        return (pd.concat(self.uploaded, ignore_index=True) if self.uploaded else pd.DataFrame(),
+                pd.concat(self.not_uploaded, ignore_index=True) if self.not_uploaded else pd.DataFrame())
+
+    def _take_batch(self):
+        # Called with the condition held; returns the next batch to write, or None to stop
+        while True:
+            due = (self._oldest_pending is not None
+                   and time.monotonic() - self._oldest_pending >= self.flush_interval_seconds)
+            if self._pending_rows >= self.batch_size or (self._pending_rows and (due or self._flush_requested or self._closing)):
+                batch = pd.concat(self._pending, ignore_index=True)
+                rest = batch.iloc[self.batch_size:]
+                batch = batch.iloc[:self.batch_size]
+                self._pending = [rest] if not rest.empty else []
+                self._pending_rows = len(rest)
+                self._oldest_pending = time.monotonic() if not rest.empty else None
+                self._condition.notify_all()
+                return batch
+            if self._flush_requested:
+                self._flush_requested = False
+                self._condition.notify_all()
+            if self._closing:
+                return None
+            timeout = None
+            if self._oldest_pending is not None:
+                timeout = max(self.flush_interval_seconds - (time.monotonic() - self._oldest_pending), 0.01)
+            self._condition.wait(timeout)
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                batch = self._take_batch()
+            if batch is None:
+                return
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                logging.error(f"Upload to {self.table_name} failed: {e}")
+                with self._condition:
+                    self.error = e
+                    self._pending, self._pending_rows = [], 0
+                    self._condition.notify_all()
+                return
+
+    def _connect(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg2.connect(**self.connection_params)
+            self._columns = None
+        return self._conn
+
+    def _discard_connection(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+        self._conn = None
+
+    def _table_columns(self, cur):
+        """Uploadable columns of the table with their SQL types (id and mod_date are set by the table)."""
+        if self._columns is None:
+            cur.execute("SELECT a.attname, format_type(a.atttypid, NULL) FROM pg_attribute a "
+                        "WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped ORDER BY a.attnum",
+                        (self.table_name,))
+            increment('db_round_trips', operation='column_lookup', table=self.table_name)
+            self._columns = [(name, sql_type) for name, sql_type in cur.fetchall() if name not in ('id', 'mod_date')]
+        return self._columns
+
+    def _write_batch(self, batch):
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                conn = self._connect()
+                with conn.cursor() as cur:
+                    uploaded_df, not_uploaded_df = self._insert_batch(cur, batch)
+                conn.commit()
+                break
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                # Lost connection: the batch was not committed, and rows already in the table are skipped on retry
+                self._discard_connection()
+                if attempt >= self.max_retries:
+                    raise
+                delay = 2 ** attempt * random.uniform(0.5, 1.5)
+                logging.warning(f"Upload to {self.table_name}: retrying batch in {delay:.1f}s after {e}")
+                increment('upload_batch_retries', table=self.table_name)
+                attempt += 1
+                time.sleep(delay)
+            except psycopg2.Error:
+                if self._conn is not None and not self._conn.closed:
+                    self._conn.rollback()
+                raise
+        observe('upload_batch_seconds', time.perf_counter() - start, table=self.table_name)
+        increment('upload_rows', len(uploaded_df), table=self.table_name, status='inserted')
+        increment('upload_rows', len(not_uploaded_df), table=self.table_name, status='existing')
+        self.uploaded.append(uploaded_df)
+        self.not_uploaded.append(not_uploaded_df)
+
+    def _insert_batch(self, cur, batch):
+        columns = self._table_columns(cur)
+        df = batch.copy()
+        # Add missing columns to the DataFrame with null values
+        for name, _ in columns:
+            if name not in df.columns:
+                df[name] = None
+        names = [name for name, _ in columns]
+        df = df[names].astype(object).where(pd.notnull(df[names]), None)
+
+        # Rows repeated within the batch are uploaded once
+        repeated = df.astype(str).duplicated()
+        unique_df = df[~repeated]
+
+        # One statement: the batch rows that are not in the table yet are inserted and their
+        # positions in the batch returned. Columns without NULLs in the batch are compared with
+        # '=', which (unlike IS NOT DISTINCT FROM) can use the table's indexes, e.g. the hash
+        # index on seq_cleaned. Rows that a unique key of the table rejects are skipped and
+        # reported as not uploaded.
+        column_list = ', '.join(names)
+        has_nulls = unique_df.isnull().any()
+        matches = ' AND '.join(f"t.{name} IS NOT DISTINCT FROM v.{name}" if has_nulls[name] else f"t.{name} = v.{name}"
+                               for name in names)
+        returned = ' AND '.join(f"i.{name} IS NOT DISTINCT FROM n.{name}" if has_nulls[name] else f"i.{name} = n.{name}"
+                                for name in names)
+        template = '(' + ', '.join(['%s'] + [f"%s::{sql_type}" for _, sql_type in columns]) + ')'
+        query = (f"WITH v (batch_row, {column_list}) AS (VALUES %s), "
+                 f"new_rows AS (SELECT * FROM v WHERE NOT EXISTS (SELECT 1 FROM {self.table_name} t WHERE {matches})), "
+                 f"inserted AS (INSERT INTO {self.table_name} ({column_list}) SELECT {column_list} FROM new_rows "
+                 f"ON CONFLICT DO NOTHING RETURNING {column_list}) "
+                 f"SELECT DISTINCT n.batch_row FROM new_rows n JOIN inserted i ON {returned}")
+        rows = [(position, *values) for position, values in zip(range(len(unique_df)), unique_df.itertuples(index=False))]
+        inserted = psycopg2.extras.execute_values(cur, query, rows, template=template, page_size=len(rows), fetch=True)
+        increment('db_round_trips', operation='bulk_insert', table=self.table_name)
+
+        inserted_positions = {row[0] for row in inserted}
+        is_inserted = [position in inserted_positions for position in range(len(unique_df))]
+        uploaded_df = unique_df[is_inserted]
+        not_uploaded_df = pd.concat([unique_df[[not flag for flag in is_inserted]], df[repeated]])
+        if self.keep_columns:
+            kept = batch[[col for col in self.keep_columns if col in batch.columns and col not in names]]
+            uploaded_df, not_uploaded_df = uploaded_df.join(kept), not_uploaded_df.join(kept)
+        return uploaded_df, not_uploaded_df
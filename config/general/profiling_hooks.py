@@ -0,0 +1,268 @@
+"""
+Opt-in profiling of the pipeline's hot functions.
+
+Set HIV_PIPELINE_PROFILE before starting Python (or before the profiled modules are imported):
+- 'cprofile' (or '1'): deterministic profiling with cProfile, one profiler per thread;
+- 'sampling': a background thread samples the stacks of threads inside profiled functions
+  every HIV_PIPELINE_PROFILE_INTERVAL seconds (default 0.005).
+
+A run brackets its work with start_profile_run and finish_profile_run: the first gives the
+run its own directory under HIV_PIPELINE_PROFILE_DIR (default ./profiles) and clears what
+this process profiled before, the second writes this process's profile there and merges
+the directory into one report sorted by cumulative time, so a notebook gets its report when
+the run ends. Processes started during the run inherit its directory and write their
+profile_<pid>.prof (cProfile) or profile_<pid>.samples.json (sampling) there at exit; their
+files can be merged again afterwards:
+
+    python profiling_hooks.py profiles/run_20240501-120000_4242 --output profiles/merged
+
+With the variable unset, `profiled` returns the function itself, so there is no overhead.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import atexit
+import pstats
+import cProfile
+import argparse
+import threading
+import functools
+from collections import Counter
+
+PROFILE_MODE = os.environ.get('HIV_PIPELINE_PROFILE', '').lower()
+if PROFILE_MODE == '1':
+    PROFILE_MODE = 'cprofile'
+PROFILE_DIR = os.environ.get('HIV_PIPELINE_PROFILE_DIR', os.path.join(os.getcwd(), 'profiles'))
+SAMPLING_INTERVAL = float(os.environ.get('HIV_PIPELINE_PROFILE_INTERVAL', '0.005'))
+
+_thread_state = threading.local()
+_profilers = []
+_profilers_lock = threading.Lock()
+_active_threads = set()
+_wrapper_codes = set()
+_samples = {'cumulative': Counter(), 'self': Counter(), 'count': 0}
+_sampler_started = False
+_run_dir = None
+
+
+def _frame_name(code):
+    return f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+
+
+def _sampler_loop():
+    while True:
+        time.sleep(SAMPLING_INTERVAL)
+        frames = sys._current_frames()
+        for thread_id in list(_active_threads):
+            frame = frames.get(thread_id)
+            if frame is None:
+                continue
+            # Only the frames below the profiled call
+            stack = []
+            while frame is not None and frame.f_code not in _wrapper_codes:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if not stack:
+                continue
+            _samples['self'][stack[0]] += 1
+            # Count recursive functions once per sample
+            _samples['cumulative'].update(set(stack))
+            _samples['count'] += 1
+
+
+def _start_sampler():
+    global _sampler_started
+    with _profilers_lock:
+        if not _sampler_started:
+            threading.Thread(target=_sampler_loop, name='profiling-sampler', daemon=True).start()
+            _sampler_started = True
+
+
+def _thread_profiler():
+    profiler = getattr(_thread_state, 'profiler', None)
+    if profiler is None:
+        profiler = cProfile.Profile()
+        _thread_state.profiler = profiler
+        with _profilers_lock:
+            _profilers.append(profiler)
+    return profiler
+
+
+def profiled(func):
+    """
+    Decorator that profiles calls of func when HIV_PIPELINE_PROFILE is set.
+
+    Nested profiled calls in the same thread are covered by the outermost one.
+    """
+    if PROFILE_MODE not in ('cprofile', 'sampling'):
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        depth = getattr(_thread_state, 'depth', 0)
+        if depth:
+            return func(*args, **kwargs)
+        _thread_state.depth = 1
+        try:
+            if PROFILE_MODE == 'cprofile':
+                profiler = _thread_profiler()
+                profiler.enable()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    profiler.disable()
+            _start_sampler()
+            _active_threads.add(threading.get_ident())
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _active_threads.discard(threading.get_ident())
+        finally:
+            _thread_state.depth = 0
+
+    _wrapper_codes.add(wrapper.__code__)
+    return wrapper
+
+
+def _reset_process_profile():
+    with _profilers_lock:
+        for profiler in _profilers:
+            profiler.clear()
+    _samples['cumulative'].clear()
+    _samples['self'].clear()
+    _samples['count'] = 0
+
+
+def start_profile_run(profile_dir=None):
+    """
+    Starts profiling a run in its own directory, '<profile_dir>/run_<YYYYmmdd-HHMMSS>_<pid>'
+    (profile_dir defaults to HIV_PIPELINE_PROFILE_DIR), and clears this process's earlier profile.
+
+    Returns:
+    - str or None: The run directory, or None if profiling is off.
+    """
+    global _run_dir
+    if PROFILE_MODE not in ('cprofile', 'sampling'):
+        return None
+    _reset_process_profile()
+    _run_dir = os.path.join(profile_dir or PROFILE_DIR, f"run_{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}")
+    os.makedirs(_run_dir, exist_ok=True)
+    # Processes started during the run write there
+    os.environ['HIV_PIPELINE_PROFILE_DIR'] = _run_dir
+    return _run_dir
+
+
+def finish_profile_run(limit=50):
+    """
+    Writes this process's profile to the run directory of start_profile_run and merges the
+    directory into '<run directory>/merged'.
+
+    Returns:
+    - list: Paths of the merged reports (see merge_profiles); empty if no run was started.
+    """
+    global _run_dir
+    if _run_dir is None:
+        return []
+    run_dir, _run_dir = _run_dir, None
+    os.environ['HIV_PIPELINE_PROFILE_DIR'] = PROFILE_DIR
+    write_process_profile(run_dir)
+    # Profiled calls after the run are not written again at exit
+    _reset_process_profile()
+    return merge_profiles(run_dir, limit=limit)
+
+
+def write_process_profile(profile_dir=None):
+    """
+    Writes the profile of this process (all threads) to profile_dir, by default the directory
+    of the current run (see start_profile_run) or HIV_PIPELINE_PROFILE_DIR.
+
+    Returns:
+    - str or None: Path of the written file, or None if nothing was profiled.
+    """
+    profile_dir = profile_dir or _run_dir or PROFILE_DIR
+    os.makedirs(profile_dir, exist_ok=True)
+    if PROFILE_MODE == 'cprofile':
+        with _profilers_lock:
+            profilers = [profiler for profiler in _profilers if profiler.getstats()]
+        if not profilers:
+            return None
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        path = os.path.join(profile_dir, f"profile_{os.getpid()}.prof")
+        stats.dump_stats(path)
+        return path
+    if PROFILE_MODE == 'sampling' and _samples['count']:
+        path = os.path.join(profile_dir, f"profile_{os.getpid()}.samples.json")
+        with open(path, 'w') as f:
+            json.dump({'interval': SAMPLING_INTERVAL, 'count': _samples['count'],
+                       'cumulative': dict(_samples['cumulative']), 'self': dict(_samples['self'])}, f)
+        return path
+    return None
+
+
+def merge_profiles(profile_dir=None, output_prefix=None, limit=50):
+    """
+    Merges the per-process profiles in profile_dir into one report sorted by cumulative time.
+
+    Parameters:
+    - profile_dir (str): Directory with profile_<pid>.prof and/or profile_<pid>.samples.json files,
+      usually the directory of one run (see start_profile_run).
+    - output_prefix (str): Path prefix of the merged files. Defaults to '<profile_dir>/merged'.
+    - limit (int): Number of functions in the text report.
+
+    Returns:
+    - list: Paths of the written reports ('.prof' and '.txt' for cProfile, '.samples.txt' for sampling).
+    """
+    profile_dir = profile_dir or PROFILE_DIR
+    output_prefix = output_prefix or os.path.join(profile_dir, 'merged')
+    written = []
+
+    prof_files = sorted(glob.glob(os.path.join(profile_dir, 'profile_*.prof')))
+    if prof_files:
+        stats = pstats.Stats(prof_files[0])
+        for path in prof_files[1:]:
+            stats.add(path)
+        stats.dump_stats(output_prefix + '.prof')
+        with open(output_prefix + '.txt', 'w') as f:
+            f.write(f"Merged from {len(prof_files)} process profile(s)\n")
+            pstats.Stats(output_prefix + '.prof', stream=f).sort_stats('cumulative').print_stats(limit)
+        written += [output_prefix + '.prof', output_prefix + '.txt']
+
+    sample_files = sorted(glob.glob(os.path.join(profile_dir, 'profile_*.samples.json')))
+    if sample_files:
+        cumulative, self_samples, interval = Counter(), Counter(), SAMPLING_INTERVAL
+        for path in sample_files:
+            with open(path) as f:
+                data = json.load(f)
+            cumulative.update(data['cumulative'])
+            self_samples.update(data['self'])
+            interval = data['interval']
+        with open(output_prefix + '.samples.txt', 'w') as f:
+            f.write(f"Merged from {len(sample_files)} process sample file(s), {interval}s per sample\n")
+            f.write(f"{'cumulative_s':>12} {'self_s':>10}  function\n")
+            for name, count in cumulative.most_common(limit):
+                f.write(f"{count * interval:12.3f} {self_samples.get(name, 0) * interval:10.3f}  {name}\n")
+        written.append(output_prefix + '.samples.txt')
+    return written
+
+
+if PROFILE_MODE in ('cprofile', 'sampling'):
+    atexit.register(write_process_profile)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge per-process profiles into one report.")
+    parser.add_argument('profile_dir', nargs='?', default=PROFILE_DIR)
+    parser.add_argument('--output', help="Path prefix of the merged report (default <profile_dir>/merged).")
+    parser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args()
+    for path in merge_profiles(args.profile_dir, args.output, args.limit):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import json
+import pandas as pd
+from data_uploader import upload_df_to_table
+
+QUARANTINE_COLUMNS = ['stage', 'error_class', 'error_message', 'mafft_stderr', 'attempts']
+
+
+def quarantine_df_to_table_rows(quarantine_df):
+    """
+    Converts a quarantine DataFrame (query row columns plus the error columns) into rows of
+    alignment_quarantine, with the query row stored as JSON in 'query_row'.
+
+    Parameters:
+    - quarantine_df (DataFrame): Quarantine output of process_sequence_alignment_isolated.
+
+    Returns:
+    - DataFrame: Columns 'stage', 'query_row', 'error_class', 'error_message', 'mafft_stderr' and 'attempts'.
+    """
+    query_columns = [col for col in quarantine_df.columns if col not in QUARANTINE_COLUMNS]
+    rows_df = quarantine_df[QUARANTINE_COLUMNS].copy()
+    rows_df['query_row'] = [json.dumps(row, default=str, sort_keys=True)
+                            for row in quarantine_df[query_columns].to_dict(orient='records')]
+    rows_df['attempts'] = rows_df['attempts'].astype(int)
+    return rows_df[['stage', 'query_row', 'error_class', 'error_message', 'mafft_stderr', 'attempts']]
+
+
+def upload_quarantine_df(database, user, password, host, port, quarantine_df):
+    """
+    Stores quarantined rows in the alignment_quarantine table (created by the schema bootstrap,
+    see db_operations.PIPELINE_TABLES).
+
+    Parameters:
+    - database (str): The name of the PostgreSQL database.
+    - user (str): The username for accessing the database.
+    - password (str): The password for accessing the database.
+    - host (str): The host address of the database server.
+    - port (str): The port number of the database server.
+    - quarantine_df (DataFrame): Quarantine output of process_sequence_alignment_isolated.
+
+    Returns:
+    - tuple or str: (uploaded_df, not_uploaded_df) as returned by upload_df_to_table, or an error message.
+    """
+    if quarantine_df.empty:
+        return pd.DataFrame(), pd.DataFrame()
+    return upload_df_to_table(database, user, password, host, port, table_name='alignment_quarantine',
+                              df=quarantine_df_to_table_rows(quarantine_df))
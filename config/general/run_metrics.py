@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+import psutil
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+METRIC_PREFIX = "hiv_pipeline"
+
+# Upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class RunMetrics:
+    """
+    Metrics of one pipeline run: stage timers with memory use, counters, gauges and histograms.
+
+    All methods are thread safe. Counters, gauges and histograms take optional labels, e.g.
+    increment('qc_rows_removed', 12, filter='duplicate'). A name belongs to one kind of metric:
+    using it as another kind raises ValueError, since Prometheus rejects a family declared twice.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.run_id = datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.started_at = time.time()
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.metric_types = {}
+        self._lock = threading.Lock()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _register(self, name, metric_type):
+        # Called with the lock held
+        registered = self.metric_types.setdefault(name, metric_type)
+        if registered != metric_type:
+            raise ValueError(f"Metric '{name}' is a {registered}, it cannot also be used as a {metric_type}")
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times a pipeline stage and records its resident memory and, with trace_memory, the
+        peak of Python allocations and the top allocation sites.
+
+        The process peak (ru_maxrss) never goes down, so a stage records the peak at its end
+        ('process_peak_rss_mb') and how much it raised it ('peak_rss_increase_mb'); only the
+        latter is the stage's own.
+        """
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        rss_before = psutil.Process().memory_info().rss
+        peak_before = peak_rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {'stage': name,
+                      'seconds': round(time.perf_counter() - start, 4),
+                      'rss_start_mb': round(rss_before / 2 ** 20, 1),
+                      'rss_end_mb': round(psutil.Process().memory_info().rss / 2 ** 20, 1),
+                      'process_peak_rss_mb': round(peak_rss_bytes() / 2 ** 20, 1),
+                      'peak_rss_increase_mb': round((peak_rss_bytes() - peak_before) / 2 ** 20, 1)}
+            if self.trace_memory:
+                record['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+                record['top_allocations'] = [
+                    {'site': str(stat.traceback), 'size_kb': round(stat.size / 1024, 1), 'count': stat.count}
+                    for stat in tracemalloc.take_snapshot().statistics('lineno')[:5]]
+            with self._lock:
+                self.stages.append(record)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._register(name, 'counter')
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._register(name, 'gauge')
+            self.gauges[key] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._register(name, 'histogram')
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {'buckets': list(buckets), 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0, 'max': value}
+                self.histograms[key] = histogram
+            for i, upper in enumerate(histogram['buckets']):
+                if value <= upper:
+                    histogram['counts'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+            histogram['max'] = max(histogram['max'], value)
+
+    def to_dict(self):
+        """Returns the run report as plain data (for JSON)."""
+        def labelled(items):
+            return [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in items]
+        with self._lock:
+            return {'run_id': self.run_id,
+                    'started_at': datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+                    'wall_seconds': round(time.time() - self.started_at, 3),
+                    'process_peak_rss_mb': round(peak_rss_bytes() / 2 ** 20, 1),
+                    'stages': list(self.stages),
+                    'counters': labelled(self.counters.items()),
+                    'gauges': labelled(self.gauges.items()),
+                    'histograms': labelled((key, dict(histogram)) for key, histogram in self.histograms.items())}
+
+    def to_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        def label_text(labels):
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{key}="{escape_label_value(value)}"' for key, value in labels) + '}'
+
+        lines = []
+        with self._lock:
+            lines.append(f"# TYPE {METRIC_PREFIX}_stage_seconds gauge")
+            lines += [f'{METRIC_PREFIX}_stage_seconds{label_text((("stage", record["stage"]),))} {record["seconds"]}'
+                      for record in self.stages]
+            lines.append(f"# TYPE {METRIC_PREFIX}_stage_peak_rss_increase_megabytes gauge")
+            lines += [f'{METRIC_PREFIX}_stage_peak_rss_increase_megabytes{label_text((("stage", record["stage"]),))} '
+                      f'{record["peak_rss_increase_mb"]}' for record in self.stages]
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {METRIC_PREFIX}_{name}_total counter")
+                lines += [f"{METRIC_PREFIX}_{name}_total{label_text(labels)} {value}"
+                          for (key, labels), value in self.counters.items() if key == name]
+            for name in sorted({name for name, _ in self.gauges}):
+                lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+                lines += [f"{METRIC_PREFIX}_{name}{label_text(labels)} {value}"
+                          for (key, labels), value in self.gauges.items() if key == name]
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {METRIC_PREFIX}_{name} histogram")
+                for (key, labels), histogram in self.histograms.items():
+                    if key != name:
+                        continue
+                    for upper, count in zip(histogram['buckets'], histogram['counts']):
+                        lines.append(f"{METRIC_PREFIX}_{name}_bucket{label_text(labels + (('le', upper),))} {count}")
+                    lines.append(f"{METRIC_PREFIX}_{name}_bucket{label_text(labels + (('le', '+Inf'),))} {histogram['count']}")
+                    lines.append(f"{METRIC_PREFIX}_{name}_sum{label_text(labels)} {histogram['sum']}")
+                    lines.append(f"{METRIC_PREFIX}_{name}_count{label_text(labels)} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label_value(value):
+    """Escapes a label value for the Prometheus text format (backslash, double quote, newline)."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def peak_rss_bytes():
+    """Returns the peak resident memory of this process so far."""
+    if resource is None:
+        return psutil.Process().memory_info().rss
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+# Metrics of the current run, shared by every module of the pipeline
+_current_run = RunMetrics()
+
+
+def start_run_metrics(trace_memory=None):
+    """
+    Starts a new run and returns its RunMetrics. trace_memory defaults to the
+    HIV_PIPELINE_TRACEMALLOC environment variable ('1' to enable).
+    """
+    global _current_run
+    if trace_memory is None:
+        trace_memory = os.environ.get('HIV_PIPELINE_TRACEMALLOC') == '1'
+    _current_run = RunMetrics(trace_memory)
+    return _current_run
+
+
+def current_run_metrics():
+    return _current_run
+
+
+def stage_timer(name):
+    """Context manager timing a stage of the current run."""
+    return _current_run.stage(name)
+
+
+def increment(name, amount=1, **labels):
+    _current_run.increment(name, amount, **labels)
+
+
+def set_gauge(name, value, **labels):
+    _current_run.set_gauge(name, value, **labels)
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    _current_run.observe(name, value, buckets, **labels)
+
+
+def export_run_metrics(output_dir, metrics=None):
+    """
+    Writes the run report as '<output_dir>/run_<run_id>.json' and '<output_dir>/run_<run_id>.prom'.
+
+    Parameters:
+    - output_dir (str): Directory of the reports.
+    - metrics (RunMetrics, optional): Run to export. Defaults to the current run.
+
+    Returns:
+    - tuple or str: Paths of the JSON and Prometheus files, or an error message.
+    """
+    metrics = metrics or _current_run
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        json_path = os.path.join(output_dir, f"run_{metrics.run_id}.json")
+        prom_path = os.path.join(output_dir, f"run_{metrics.run_id}.prom")
+        with open(json_path, 'w') as f:
+            json.dump(metrics.to_dict(), f, indent=2, default=str)
+        with open(prom_path, 'w') as f:
+            f.write(metrics.to_prometheus())
+        return json_path, prom_path
+    except OSError as e:
+        return f"Error writing run metrics: {e}"
@@ -1,6 +1,7 @@
 from file_reading_operations import read_data_file
 from path_finder import find_path_of_file_or_dir 
 import pandas as pd
+import json
 
 
 def create_dic_from_tbl_descr(dataframe):
@@ -257,4 +258,96 @@ def data_upload_and_header_matching():
                 updated_seq_df, filtered_rows = filter_dataframe_by_datatype(seq_df, data_file_dict)
                 return updated_seq_df, filtered_rows
         except Exception as e:
-            print(e)  # Print the error message if an exception occurs during file reading
\ No newline at end of file
+            print(e)  # Print the error message if an exception occurs during file reading
+
+
+def load_header_mapping_profile(profile_path):
+    """
+    Reads a saved header-mapping profile, the non-interactive answers to the prompts of
+    data_upload_and_header_matching.
+
+    A profile is a JSON object with the data file type and the accepted header of each file
+    header; headers mapped to null are dropped, headers that already are accepted headers need
+    no entry:
+
+        {"data_file_type": "seq",
+         "header_map": {"Patient": "pat_id", "Sampling date": "seq_sample_date", "Comment": null}}
+
+    Args:
+        profile_path (str): Path to the profile JSON file.
+
+    Returns:
+        dict or str: The profile, or an error message.
+    """
+    try:
+        with open(profile_path, 'r') as f:
+            profile = json.load(f)
+    except (OSError, ValueError) as e:
+        return f"Error reading header-mapping profile {profile_path}: {e}"
+    if not isinstance(profile, dict) or not isinstance(profile.get('data_file_type'), str):
+        return f"Error: header-mapping profile {profile_path} has no 'data_file_type'"
+    if not isinstance(profile.get('header_map', {}), dict):
+        return f"Error: 'header_map' of header-mapping profile {profile_path} is not an object"
+    profile['data_file_type'] = profile['data_file_type'].strip().lower()
+    profile.setdefault('header_map', {})
+    return profile
+
+
+def apply_header_mapping_profile(df_original, profile, col_descr_df):
+    """
+    Matches the headers of a DataFrame to the accepted headers with a header-mapping profile
+    instead of prompting, as compare_headers_to_dict does interactively.
+
+    Args:
+        df_original (pandas.DataFrame): Original DataFrame with headers to be matched.
+        profile (dict): Output of load_header_mapping_profile.
+        col_descr_df (pandas.DataFrame): DataFrame containing column descriptions, data types, and upload status.
+
+    Returns:
+        tuple or str: The DataFrame with matched headers and the column dictionary of the data
+        file type, or an error message naming the headers that could not be matched.
+    """
+    data_file_dict = create_dic_from_col_descr(col_descr_df, profile['data_file_type'])
+    if not data_file_dict:
+        return f"Error: '{profile['data_file_type']}' is not an acceptable data file type."
+
+    header_map = profile['header_map']
+    dropped = [header for header in df_original.columns if header in header_map and header_map[header] is None]
+    renames = {header: header_map[header] for header in df_original.columns
+               if header in header_map and header_map[header] is not None}
+    df_copy = df_original.drop(columns=dropped).rename(columns=renames)
+
+    unmatched = [header for header in df_copy.columns if header not in data_file_dict]
+    if unmatched:
+        return f"Error: no accepted header for {unmatched}. Add them to the header-mapping profile."
+    duplicated = sorted({header for header in df_copy.columns if list(df_copy.columns).count(header) > 1})
+    if duplicated:
+        return f"Error: several file headers are mapped to {duplicated}."
+    missing = [key for key, value in data_file_dict.items() if value[2] == 'must upload' and key not in df_copy.columns]
+    if missing:
+        return f"Error: the following columns must be in the datafile for the data to be processed: {missing}"
+    return df_copy, data_file_dict
+
+
+def data_file_ingestion(file_path, profile, col_descr_df):
+    """
+    Reads a data file, matches its headers with a header-mapping profile and filters rows by
+    datatype; the non-interactive counterpart of data_upload_and_header_matching.
+
+    Args:
+        file_path (str): Path to the data file.
+        profile (dict): Output of load_header_mapping_profile.
+        col_descr_df (pandas.DataFrame): DataFrame containing column descriptions, data types, and upload status.
+
+    Returns:
+        tuple or str: The DataFrame of valid rows and the DataFrame of rows with invalid data
+        types, or an error message.
+    """
+    seq_df = read_data_file(file_path)
+    if isinstance(seq_df, str):
+        return f"Error reading {file_path}: {seq_df}"
+    match_result = apply_header_mapping_profile(seq_df, profile, col_descr_df)
+    if isinstance(match_result, str):
+        return match_result
+    seq_df, data_file_dict = match_result
+    return filter_dataframe_by_datatype(seq_df, data_file_dict)
@@ -0,0 +1,92 @@
+import os
+import json
+import base64
+import pickle
+import hashlib
+import logging
+import threading
+import pandas as pd
+from alignment_cost_model import worker_key, unwrap_worker
+
+
+def run_fingerprint(ref_seq_df, query_seq_col_name, worker_func, ref_region_df=None):
+    """
+    Returns a hash of everything besides the query row that decides a worker's result:
+    the worker and its bound options, the query column, the reference table and the
+    regions sliced out of the alignment.
+    """
+    digest = hashlib.sha256()
+    digest.update(worker_key(worker_func).encode())
+    digest.update(repr(sorted(getattr(unwrap_worker(worker_func), 'keywords', {}).items(), key=lambda item: item[0])).encode())
+    digest.update(query_seq_col_name.encode())
+    digest.update(pd.util.hash_pandas_object(ref_seq_df.astype(str), index=False).values.tobytes())
+    if ref_region_df is not None:
+        digest.update(pd.util.hash_pandas_object(ref_region_df.astype(str), index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def row_fingerprint(row, run_fp):
+    """
+    Returns the checkpoint key of one query row: its values (index labels excluded) plus the run fingerprint.
+    """
+    values = json.dumps({str(col): str(value) for col, value in row.items()}, sort_keys=True)
+    return hashlib.sha256((run_fp + values).encode()).hexdigest()
+
+
+class AlignmentCheckpoint:
+    """
+    Append-only store of per-row alignment results, one JSON line per completed row.
+
+    Each line holds the row fingerprint and the pickled result DataFrame (or null for rows
+    that gave no result), and is fsynced before the row counts as done, so a crash loses at
+    most the rows that were still running. A half-written last line is cut off on load, so
+    the next record starts on a line of its own.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            self._load()
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _load(self):
+        complete_length = 0
+        with open(self.path, 'rb') as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.endswith(b'\n'):
+                    logging.warning(f"Dropping the half-written last line of checkpoint {self.path}")
+                    break
+                complete_length += len(line)
+                try:
+                    record = json.loads(line)
+                    result = record['result']
+                    self.completed[record['fingerprint']] = (
+                        None if result is None else pickle.loads(base64.b64decode(result)))
+                except (ValueError, KeyError, pickle.UnpicklingError) as e:
+                    logging.warning(f"Skipping unreadable line {line_number} of checkpoint {self.path}: {e}")
+        if complete_length < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(complete_length)
+        logging.info(f"Checkpoint {self.path}: {len(self.completed)} rows already done")
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.completed
+
+    def get(self, fingerprint):
+        return self.completed[fingerprint]
+
+    def record(self, fingerprint, result_df):
+        """
+        Appends the result of one row and makes it durable.
+        """
+        result = None if result_df is None else base64.b64encode(pickle.dumps(result_df)).decode()
+        line = json.dumps({'fingerprint': fingerprint, 'result': result}) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.completed[fingerprint] = result_df
@@ -0,0 +1,138 @@
+import os
+import json
+import logging
+import threading
+import numpy as np
+from qc import sequence_lengths
+
+DEFAULT_COST_MODEL_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'hiv_pipeline', 'alignment_cost_model.json')
+
+# Seconds per million alignment cells before any timing has been recorded
+PRIOR_SECONDS_PER_MEGACELL = 0.02
+# Weight kept by older observations at each update, so the model follows hardware changes
+DECAY = 0.995
+
+_model_lock = threading.Lock()
+
+
+def unwrap_worker(worker_func):
+    """Returns the worker behind wrappers that set __wrapped__ (e.g. the fault-isolation wrapper)."""
+    while hasattr(worker_func, '__wrapped__'):
+        worker_func = worker_func.__wrapped__
+    return worker_func
+
+
+def worker_key(worker_func):
+    """Name under which timings of worker_func are recorded (unwraps functools.partial)."""
+    worker_func = unwrap_worker(worker_func)
+    return getattr(getattr(worker_func, 'func', worker_func), '__name__', str(worker_func))
+
+
+def alignment_work(query_df, ref_seq_df, query_seq_col_name):
+    """
+    Estimates the work of each query row in millions of alignment cells.
+
+    Every row is aligned against each reference, so the work is the query length times
+    the total reference length. The '<column>_len' column is used when QC provided it
+    (e.g. seq_cleaned_len), otherwise the length is computed.
+
+    Returns:
+    - numpy.ndarray: Work per row of query_df, in query_df order.
+    """
+    len_col = f"{query_seq_col_name}_len"
+    if len_col in query_df.columns:
+        query_lens = query_df[len_col].to_numpy(dtype=float)
+    else:
+        query_lens = np.asarray(sequence_lengths(query_df[query_seq_col_name]), dtype=float)
+    # 'ref_seq' in hiv_subtype_con_ref_seq, 'pol_ref_seq' in hiv_type_ref_seq
+    ref_cols = [col for col in getattr(ref_seq_df, 'columns', []) if str(col).endswith('ref_seq')]
+    ref_total_len = float(sum(ref_seq_df[col].str.len().sum() for col in ref_cols)) if ref_cols else 1.0
+    return query_lens * ref_total_len / 1e6
+
+
+def load_cost_model(path=None):
+    """
+    Loads the cost model: per worker, decayed sums for a least-squares fit of seconds on work.
+    """
+    path = path or DEFAULT_COST_MODEL_PATH
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable cost model {path}: {e}")
+        return {}
+
+
+def predict_task_seconds(cost_model, key, work):
+    """
+    Predicts the seconds per task from its work with the fitted line of `key`.
+
+    Falls back to PRIOR_SECONDS_PER_MEGACELL while fewer than 10 tasks of very different
+    size have been timed.
+    """
+    stats = cost_model.get(key)
+    work = np.asarray(work, dtype=float)
+    if stats and stats['n'] >= 10:
+        denominator = stats['n'] * stats['sxx'] - stats['sx'] ** 2
+        if denominator > 1e-12:
+            slope = (stats['n'] * stats['sxy'] - stats['sx'] * stats['sy']) / denominator
+            intercept = (stats['sy'] - slope * stats['sx']) / stats['n']
+            if slope > 0:
+                return np.maximum(intercept + slope * work, 0.0)
+        return np.full(work.shape, stats['sy'] / stats['n'])
+    return work * PRIOR_SECONDS_PER_MEGACELL
+
+
+def update_cost_model(key, work, actual_seconds, path=None):
+    """
+    Adds the timings of a run to the cost model of `key` and saves it.
+
+    Parameters:
+    - key (str): Worker name (see worker_key).
+    - work (array-like): Work per task (see alignment_work).
+    - actual_seconds (array-like): Measured seconds per task.
+    - path (str, optional): Cost model file. Defaults to DEFAULT_COST_MODEL_PATH.
+    """
+    path = path or DEFAULT_COST_MODEL_PATH
+    with _model_lock:
+        cost_model = load_cost_model(path)
+        stats = cost_model.get(key, {'n': 0.0, 'sx': 0.0, 'sy': 0.0, 'sxx': 0.0, 'sxy': 0.0})
+        for x, y in zip(work, actual_seconds):
+            for name in stats:
+                stats[name] *= DECAY
+            stats['n'] += 1
+            stats['sx'] += x
+            stats['sy'] += y
+            stats['sxx'] += x * x
+            stats['sxy'] += x * y
+        cost_model[key] = stats
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(cost_model, f, indent=2)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            logging.warning(f"Could not save cost model {path}: {e}")
+
+
+def longest_first_order(predicted_seconds):
+    """
+    Returns task positions sorted by decreasing predicted cost (longest processing time first).
+    """
+    return np.argsort(-np.asarray(predicted_seconds, dtype=float), kind='stable')
+
+
+def summarize_predictions(predicted_seconds, actual_seconds):
+    """
+    Returns a one-line summary of predicted against measured task times, for the run log.
+    """
+    predicted = np.asarray(predicted_seconds, dtype=float)
+    actual = np.asarray(actual_seconds, dtype=float)
+    if len(actual) < 2 or actual.std() == 0 or predicted.std() == 0:
+        correlation = float('nan')
+    else:
+        correlation = float(np.corrcoef(predicted, actual)[0, 1])
+    return (f"predicted {predicted.sum():.1f}s / measured {actual.sum():.1f}s of task time, "
+            f"correlation {correlation:.2f}, median abs error {np.median(np.abs(predicted - actual)):.2f}s")
@@ -0,0 +1,367 @@
+"""
+Alignment worker for the PostgreSQL task queue (alignment_tasks).
+
+Any number of workers, on any hosts that reach the pipeline database, claim per-row typing
+and subtyping tasks, run them and write the results back:
+
+    python alignment_queue_worker.py --database swe_db --user postgres --password ... \
+        --host db-host --port 5432 --mafft /usr/local/bin/mafft
+
+The notebook (or any coordinator) queues a stage with process_sequence_alignment_distributed,
+which returns when the workers have finished it, in the format of
+process_sequence_alignment_isolated.
+
+Each worker holds a lease on the tasks it runs and renews it with a heartbeat; a task whose
+worker dies is requeued once its lease expires and runs again elsewhere, up to max_attempts
+claims. Retryable errors (see is_retryable_error) release the task back to the queue, other
+errors fail it; failed tasks come back as quarantine records.
+
+A dropped database connection does not stop a worker: it reconnects and carries on, and a
+result it cannot write back is left to the lease expiry like the task of a dead worker. A
+worker whose leases could not be renewed for a whole lease stops, as its tasks may already
+run elsewhere.
+"""
+
+import sys
+import time
+import uuid
+import signal
+import logging
+import argparse
+import threading
+import psycopg2
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import config_paths  # config/general modules, when run as a script
+from hiv_typing_alignment_worker import perform_hiv_typing
+from hiv_subtyping_alignment_worker import perform_hiv_subtyping
+from alignment_resource_planner import plan_alignment_resources
+from parallel_alignment_processor import is_retryable_error, worker_options, DEFAULT_MAFFT_TIMEOUT_SECONDS
+from async_mafft_engine import MAFFT_ENGINES
+from db_operations import extract_table, bootstrap_schema
+from alignment_task_queue import (connect, worker_identity, enqueue_tasks,
+                                  requeue_expired_leases, claim_tasks, heartbeat, complete_task, fail_task,
+                                  wait_for_run, collect_results)
+from run_metrics import observe, increment
+
+# Errors of a dropped or unusable connection; the worker reconnects after them
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+# Tries of writing a task result back before leaving the task to its lease expiry
+WRITE_BACK_ATTEMPTS = 3
+# Wait before the first retry of a failed heartbeat; doubled for each further retry
+HEARTBEAT_RETRY_SECONDS = 1.0
+
+# Stage name -> (worker, reference table, query column), as the notebook runs them
+QUEUE_STAGES = {
+    'hiv_typing': (perform_hiv_typing, 'hiv_type_ref_seq', 'seq_cleaned'),
+    'hiv1_subtyping': (perform_hiv_subtyping, 'hiv_subtype_con_ref_seq', 'extracted_pol_query_seq_cleaned'),
+}
+
+# Stage name -> worker option -> table passed as that option
+STAGE_OPTION_TABLES = {
+    'hiv_typing': {'ref_region_df': 'hiv_type_ref_region'},
+}
+
+
+class AlignmentQueueWorker:
+    """
+    Claims and runs alignment tasks until stopped or idle.
+
+    Parameters:
+    - database, user, password, host, port: Connection parameters of the queue database.
+    - mafft_executable (str): Path to the MAFFT executable.
+    - stages (list, optional): Stages to run (keys of QUEUE_STAGES). Defaults to all.
+    - concurrency (int, optional): Tasks run at once. Defaults to the planned pool width of this host.
+    - lease_seconds (float): Lease length; a task not renewed for this long is requeued.
+    - heartbeat_seconds (float, optional): Interval of lease renewal. Defaults to a fifth of the lease.
+    - poll_seconds (float): Wait between claims while the queue is empty.
+    - idle_exit_seconds (float, optional): Exit after the queue has been empty this long.
+    - max_tasks (int, optional): Exit after claiming this many tasks.
+    - timeout_seconds (float): Per-alignment MAFFT timeout.
+    - mafft_engine (str): 'subprocess' or 'async' (see async_mafft_engine.mafft_alignment_function).
+    """
+
+    def __init__(self, database, user, password, host, port, mafft_executable, stages=None, concurrency=None,
+                 lease_seconds=300, heartbeat_seconds=None, poll_seconds=2.0, idle_exit_seconds=None, max_tasks=None,
+                 timeout_seconds=DEFAULT_MAFFT_TIMEOUT_SECONDS, mafft_engine='subprocess'):
+        self.connection_params = (database, user, password, host, port)
+        self.mafft_executable = mafft_executable
+        self.stages = list(stages or QUEUE_STAGES)
+        unknown = [stage for stage in self.stages if stage not in QUEUE_STAGES]
+        if unknown:
+            raise ValueError(f"Unknown stages: {unknown}")
+        plan = plan_alignment_resources(concurrency or 10 ** 6)
+        self.concurrency = concurrency or plan['pool_width']
+        self.mafft_threads = plan['mafft_threads']
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds or lease_seconds / 5
+        self.poll_seconds = poll_seconds
+        self.idle_exit_seconds = idle_exit_seconds
+        self.max_tasks = max_tasks
+        self.timeout_seconds = timeout_seconds
+        self.mafft_engine = mafft_engine
+        self.owner = worker_identity()
+        self.stats = {'claimed': 0, 'succeeded': 0, 'released': 0, 'failed': 0, 'lost': 0}
+        self.leases_lost = False
+        self._stop = threading.Event()
+        self._db_lock = threading.Lock()
+        self._connection = None
+        self._ref_tables = {}
+        self._option_tables = {}
+
+    def stop(self):
+        """Stops claiming; running tasks are finished and written back."""
+        self._stop.set()
+
+    def run(self):
+        """
+        Runs tasks until stop() is called, the queue stays empty for idle_exit_seconds,
+        max_tasks tasks were claimed or the heartbeat could not renew the leases for
+        lease_seconds (leases_lost is then set).
+
+        Returns:
+        - dict: Tasks claimed, succeeded, released for retry, failed and lost (lease expired).
+        """
+        self._connection = connect(*self.connection_params)
+        heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name='queue-heartbeat', daemon=True)
+        heartbeat_thread.start()
+        logging.info(f"Queue worker {self.owner}: {self.concurrency} tasks at once, stages {self.stages}")
+        idle_since = time.monotonic()
+        in_flight = set()
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                while True:
+                    free = self.concurrency - len(in_flight)
+                    if self.max_tasks is not None:
+                        free = min(free, self.max_tasks - self.stats['claimed'])
+                    tasks = []
+                    if free > 0 and not self._stop.is_set():
+                        try:
+                            tasks = self._queue_call(claim_tasks, self.owner, self.stages, free, self.lease_seconds)
+                        except CONNECTION_ERRORS as e:
+                            # Tasks claimed before the connection dropped are requeued when their lease expires
+                            logging.warning(f"Queue worker {self.owner}: claiming failed, reconnecting: {e}")
+                            self._stop.wait(self.poll_seconds)
+                        self.stats['claimed'] += len(tasks)
+                        in_flight.update(executor.submit(self._run_task, *task) for task in tasks)
+                    if in_flight:
+                        idle_since = time.monotonic()
+                        # Slots left free because the queue ran dry are offered again after poll_seconds
+                        queue_drained = 0 < free and len(tasks) < free and not self._stop.is_set()
+                        done, in_flight = wait(in_flight, timeout=self.poll_seconds if queue_drained else None,
+                                               return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    elif (self._stop.is_set()
+                          or (self.max_tasks is not None and self.stats['claimed'] >= self.max_tasks)
+                          or (self.idle_exit_seconds is not None
+                              and time.monotonic() - idle_since >= self.idle_exit_seconds)):
+                        break
+                    else:
+                        self._stop.wait(self.poll_seconds)
+        finally:
+            self._stop.set()
+            heartbeat_thread.join()
+            self._close_connection()
+        logging.info(f"Queue worker {self.owner} finished: {self.stats}")
+        return self.stats
+
+    def _queue_call(self, func, *args):
+        """
+        Runs func(connection, *args) on the worker's queue connection, opening a new connection
+        if the last one was dropped. A connection error closes the connection and is raised.
+        """
+        with self._db_lock:
+            try:
+                if self._connection is None:
+                    self._connection = connect(*self.connection_params)
+                return func(self._connection, *args)
+            except CONNECTION_ERRORS:
+                self._close_connection()
+                raise
+
+    def _close_connection(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except CONNECTION_ERRORS:
+                pass
+            self._connection = None
+
+    def _write_back(self, func, task_id, *args):
+        """
+        Runs complete_task or fail_task for a task, reconnecting after connection errors.
+
+        Returns:
+        - bool: Whether the worker still held the task; False also if the database stayed
+          unreachable, in which case the task is requeued when its lease expires.
+        """
+        for attempt in range(1, WRITE_BACK_ATTEMPTS + 1):
+            try:
+                return self._queue_call(func, task_id, self.owner, *args)
+            except CONNECTION_ERRORS as e:
+                logging.warning(f"Queue worker {self.owner}: writing back task {task_id} failed "
+                                f"(attempt {attempt} of {WRITE_BACK_ATTEMPTS}): {e}")
+                if attempt < WRITE_BACK_ATTEMPTS:
+                    time.sleep(self.poll_seconds)
+        return False
+
+    def _reference_table(self, stage):
+        if stage not in self._ref_tables:
+            ref_seq_df = extract_table(*self.connection_params, QUEUE_STAGES[stage][1])
+            if isinstance(ref_seq_df, str):
+                raise ValueError(ref_seq_df)
+            self._ref_tables[stage] = ref_seq_df
+        return self._ref_tables[stage]
+
+    def _stage_option_tables(self, stage):
+        """Worker options of a stage read from tables (see STAGE_OPTION_TABLES), read once."""
+        options = {}
+        for option, table_name in STAGE_OPTION_TABLES.get(stage, {}).items():
+            if table_name not in self._option_tables:
+                table_df = extract_table(*self.connection_params, table_name)
+                if isinstance(table_df, str):
+                    raise ValueError(table_df)
+                self._option_tables[table_name] = table_df
+            options[option] = self._option_tables[table_name]
+        return options
+
+    def _run_task(self, task_id, run_id, stage, query_row_df, attempts):
+        worker_func, _, query_seq_col_name = QUEUE_STAGES[stage]
+        start = time.perf_counter()
+        try:
+            options = worker_options(worker_func, mafft_threads=self.mafft_threads, mafft_timeout=self.timeout_seconds,
+                                     mafft_engine=self.mafft_engine, **self._stage_option_tables(stage))
+            result = worker_func(query_row_df, self._reference_table(stage), query_seq_col_name, self.mafft_executable,
+                                 **options)
+        except Exception as e:
+            retry = is_retryable_error(e)
+            logging.error(f"{stage}: task {task_id} of run {run_id} (attempt {attempts}) "
+                          f"{'released for retry' if retry else 'failed'}: {type(e).__name__}: {e}")
+            held = self._write_back(fail_task, task_id, e, retry)
+            with self._db_lock:
+                self.stats['lost' if not held else 'released' if retry else 'failed'] += 1
+            increment('queue_tasks', stage=stage, status='lost' if not held else 'released' if retry else 'failed')
+            return
+        held = self._write_back(complete_task, task_id, result)
+        with self._db_lock:
+            self.stats['succeeded' if held else 'lost'] += 1
+        increment('queue_tasks', stage=stage, status='done' if held else 'lost')
+        observe('queue_task_seconds', time.perf_counter() - start, stage=stage)
+
+    def _heartbeat_loop(self):
+        # Own connection, so renewals are not queued behind claims and results. A failed renewal
+        # (connecting included) is retried on a new connection with backoff. Leases not renewed
+        # for lease_seconds expire and their tasks go to other workers, so the worker stops then.
+        connection = None
+        last_renewal = time.monotonic()
+        delay = self.heartbeat_seconds
+        try:
+            while not self._stop.wait(delay):
+                try:
+                    if connection is None:
+                        connection = connect(*self.connection_params)
+                    heartbeat(connection, self.owner, self.lease_seconds)
+                    requeue_expired_leases(connection)
+                    last_renewal = time.monotonic()
+                    delay = self.heartbeat_seconds
+                except Exception as e:
+                    if connection is not None:
+                        try:
+                            connection.close()
+                        except CONNECTION_ERRORS:
+                            pass
+                        connection = None
+                    left = last_renewal + self.lease_seconds - time.monotonic()
+                    if left <= 0:
+                        logging.error(f"Queue worker {self.owner}: leases not renewed for {self.lease_seconds}s, "
+                                      f"stopping: {e}")
+                        self.leases_lost = True
+                        self.stop()
+                        return
+                    # First retry soon, then doubling up to the heartbeat interval
+                    delay = min(HEARTBEAT_RETRY_SECONDS if delay >= self.heartbeat_seconds else 2 * delay,
+                                self.heartbeat_seconds, left)
+                    logging.warning(f"Queue worker {self.owner}: heartbeat failed, retrying in {delay:.1f}s: {e}")
+        finally:
+            if connection is not None:
+                connection.close()
+
+
+def process_sequence_alignment_distributed(database, user, password, host, port, query_df, stage, run_id=None,
+                                           max_attempts=3, poll_seconds=2.0, timeout_seconds=None):
+    """
+    Runs one alignment stage on the queue workers.
+
+    Queues one task per row of query_df, waits until the workers have finished all of them
+    and reads back the results. The alignment_tasks table comes with the schema bootstrap
+    (db_wrapper or bootstrap_schema).
+
+    Args:
+    - database, user, password, host, port: Connection parameters of the pipeline database.
+    - query_df (pandas.DataFrame): Query rows.
+    - stage (str): 'hiv_typing' or 'hiv1_subtyping' (see QUEUE_STAGES).
+    - run_id (str, optional): Id of the run in alignment_tasks. Defaults to a new one.
+    - max_attempts (int): Claims per task before it is quarantined.
+    - poll_seconds (float): Interval of progress checks.
+    - timeout_seconds (float, optional): Give up waiting after this long.
+
+    Returns:
+    - tuple or str: (result_df, quarantine_df, stats) as process_sequence_alignment_isolated
+      returns them, or an error message.
+    """
+    if stage not in QUEUE_STAGES:
+        return f"Error: unknown stage '{stage}'"
+    run_id = run_id or uuid.uuid4().hex
+    try:
+        connection = connect(database, user, password, host, port)
+        try:
+            queued = enqueue_tasks(connection, run_id, stage, query_df, max_attempts)
+            logging.info(f"Queued {queued} {stage} tasks as run {run_id}")
+            progress = wait_for_run(connection, run_id, poll_seconds, timeout_seconds)
+            if isinstance(progress, str):
+                return progress
+            return collect_results(connection, run_id, stage)
+        finally:
+            connection.close()
+    except Exception as e:
+        return f"Error in distributed {stage}: {e}"
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Run alignment tasks from the PostgreSQL task queue.")
+    parser.add_argument('--database', required=True)
+    parser.add_argument('--user', required=True)
+    parser.add_argument('--password', default='')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default='5432')
+    parser.add_argument('--mafft', required=True, help="Path to the MAFFT executable.")
+    parser.add_argument('--stages', nargs='+', choices=sorted(QUEUE_STAGES), help="Stages to run (default: all).")
+    parser.add_argument('--concurrency', type=int, help="Tasks at once (default: planned from the CPUs).")
+    parser.add_argument('--lease-seconds', type=float, default=300)
+    parser.add_argument('--heartbeat-seconds', type=float)
+    parser.add_argument('--poll-seconds', type=float, default=2.0)
+    parser.add_argument('--idle-exit-seconds', type=float, help="Exit when the queue has been empty this long.")
+    parser.add_argument('--max-tasks', type=int)
+    parser.add_argument('--timeout-seconds', type=float, default=DEFAULT_MAFFT_TIMEOUT_SECONDS)
+    parser.add_argument('--mafft-engine', choices=MAFFT_ENGINES, default='subprocess',
+                        help="Run MAFFT as a blocking subprocess per alignment or on the shared asyncio engine.")
+    options = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    # Workers may start before the coordinator has bootstrapped the database
+    schema_result = bootstrap_schema(options.database, options.user, options.password, options.host, options.port)
+    if schema_result.startswith("Error"):
+        logging.error(schema_result)
+        return 1
+    worker = AlignmentQueueWorker(options.database, options.user, options.password, options.host, options.port,
+                                  options.mafft, options.stages, options.concurrency, options.lease_seconds,
+                                  options.heartbeat_seconds, options.poll_seconds, options.idle_exit_seconds,
+                                  options.max_tasks, options.timeout_seconds, options.mafft_engine)
+    # SIGTERM (e.g. from a scheduler) finishes the running tasks instead of abandoning their leases
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    print(worker.run())
+    return int(worker.leases_lost)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+import os
+import math
+import time
+import logging
+import threading
+import psutil
+
+# Rough peak memory of one pairwise MAFFT process on pol-length input
+MAFFT_MEMORY_MB = 150
+
+
+def read_cgroup_cpu_limit():
+    """
+    Reads the CPU quota of the container (cgroup v2 or v1).
+
+    Returns:
+    - float or None: Number of CPUs the quota allows, or None if there is no quota.
+    """
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def read_cgroup_memory_available():
+    """
+    Reads the memory still available under the container's memory limit (cgroup v2 or v1).
+
+    Returns:
+    - int or None: Bytes left before the limit, or None if there is no limit.
+    """
+    for limit_path, usage_path in [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        try:
+            with open(limit_path) as f:
+                limit = f.read().strip()
+            with open(usage_path) as f:
+                usage = int(f.read())
+        except (OSError, ValueError):
+            continue
+        # cgroup v1 reports "no limit" as a huge number
+        if limit == 'max' or int(limit) >= 2 ** 60:
+            return None
+        return max(int(limit) - usage, 0)
+    return None
+
+
+def available_cpu_count():
+    """
+    Returns the number of CPUs this process may use: the CPU affinity set, capped by the cgroup quota.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = psutil.cpu_count(logical=True) or 1
+    quota = read_cgroup_cpu_limit()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return max(cpus, 1)
+
+
+def available_memory_bytes():
+    """
+    Returns the memory available to this process: system available memory, capped by the cgroup limit.
+    """
+    available = psutil.virtual_memory().available
+    cgroup_available = read_cgroup_memory_available()
+    if cgroup_available is not None:
+        available = min(available, cgroup_available)
+    return available
+
+
+def plan_alignment_resources(n_tasks, mafft_memory_mb=MAFFT_MEMORY_MB):
+    """
+    Splits the CPU budget between alignment worker threads and MAFFT's own threads.
+
+    Each worker thread mostly waits on one MAFFT process, so one core per concurrent
+    MAFFT process is the target. When there are fewer tasks than cores, the spare cores go
+    to MAFFT's --thread option instead. The pool is also capped by how many MAFFT processes
+    fit in the available memory.
+
+    Parameters:
+    - n_tasks (int): Number of alignment tasks in the run.
+    - mafft_memory_mb (int): Expected peak memory of one MAFFT process.
+
+    Returns:
+    - dict: 'cpu_budget', 'pool_width' (initial concurrency), 'max_pool_width' (upper bound
+      for the adaptive limiter),
+      'mafft_threads' and 'available_memory_mb'.
+    """
+    cpu_budget = available_cpu_count()
+    available_memory_mb = available_memory_bytes() // (1024 * 1024)
+    memory_cap = max(1, int(available_memory_mb // mafft_memory_mb))
+    n_tasks = max(n_tasks, 1)
+
+    mafft_threads = max(1, cpu_budget // n_tasks) if n_tasks < cpu_budget else 1
+    pool_width = max(1, min(cpu_budget // mafft_threads, memory_cap, n_tasks))
+    # Headroom for the limiter to probe, e.g. when MAFFT processes wait on I/O
+    max_pool_width = max(pool_width, min(2 * cpu_budget // mafft_threads, memory_cap, n_tasks))
+    return {'cpu_budget': cpu_budget,
+            'pool_width': pool_width,
+            'max_pool_width': max_pool_width,
+            'mafft_threads': mafft_threads,
+            'available_memory_mb': int(available_memory_mb)}
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits how many alignments run at once and tunes the limit while the run progresses.
+
+    After every `window` completed tasks the window is compared with the previous one
+    (additive increase, multiplicative decrease). Throughput and latency are measured per unit
+    of work, so a window of long sequences is not mistaken for congestion:
+    - throughput up by more than 5% and tasks still queued: allow one more concurrent task;
+    - latency per unit of work up by more than 25% without a throughput gain (oversubscription),
+      or memory below the reserve: cut the limit by a quarter.
+    """
+
+    def __init__(self, initial_limit, max_limit, window=None, memory_reserve_mb=MAFFT_MEMORY_MB):
+        self.limit = max(1, min(initial_limit, max_limit))
+        self.max_limit = max(1, max_limit)
+        self.window = window or max(4, 2 * self.limit)
+        self.memory_reserve_mb = memory_reserve_mb
+        self.active = 0
+        self.queued = 0
+        self.completed = 0
+        self.busy_seconds = 0.0
+        self.limit_history = [self.limit]
+        self._condition = threading.Condition()
+        self._window_start = time.perf_counter()
+        self._window_latencies = []
+        self._window_work = 0.0
+        self._last_throughput = None
+        self._last_unit_latency = None
+
+    def set_queue_depth(self, queued):
+        with self._condition:
+            self.queued = queued
+
+    def acquire(self):
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+            self.queued = max(self.queued - 1, 0)
+
+    def release(self, latency_seconds, work=1.0):
+        with self._condition:
+            self.active -= 1
+            self.completed += 1
+            self.busy_seconds += latency_seconds
+            self._window_latencies.append(latency_seconds)
+            self._window_work += work
+            if len(self._window_latencies) >= self.window:
+                self._adjust()
+            self._condition.notify_all()
+
+    def _adjust(self):
+        now = time.perf_counter()
+        window_work = max(self._window_work, 1e-9)
+        throughput = window_work / max(now - self._window_start, 1e-9)
+        unit_latency = sum(self._window_latencies) / window_work
+        new_limit = self.limit
+        if available_memory_bytes() // (1024 * 1024) < self.memory_reserve_mb:
+            new_limit = max(1, int(self.limit * 0.75))
+        elif self._last_throughput is not None:
+            if throughput > self._last_throughput * 1.05 and self.queued > self.limit:
+                new_limit = min(self.max_limit, self.limit + 1)
+            elif unit_latency > self._last_unit_latency * 1.25 and throughput <= self._last_throughput:
+                new_limit = max(1, int(self.limit * 0.75))
+        if new_limit != self.limit:
+            logging.info(f"Alignment concurrency {self.limit} -> {new_limit} "
+                         f"(throughput {throughput:.2f}/s, mean latency {sum(self._window_latencies) / len(self._window_latencies):.2f}s, "
+                         f"queued {self.queued})")
+            self.limit = new_limit
+            self.limit_history.append(new_limit)
+        self._last_throughput = throughput
+        self._last_unit_latency = unit_latency
+        self._window_start = now
+        self._window_latencies = []
+        self._window_work = 0.0
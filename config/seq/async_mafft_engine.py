@@ -0,0 +1,280 @@
+"""
+Asyncio engine for MAFFT alignments.
+
+One event loop drives all MAFFT processes: each call writes its FASTA input to the child's
+stdin and reads stdout and stderr as they arrive, a semaphore caps the number of live
+processes, and a timeout or cancellation kills the child. Waiting costs no thread per call,
+so QC of the next batch and database writes of the previous one can run in the same loop
+(see run_overlapped_batches).
+
+    engine = AsyncMafftEngine(max_concurrency=8, timeout_seconds=600)
+    results = asyncio.run(engine.align_batch(pairs, mafft_executable))
+
+Threaded code can keep calling perform_mafft_alignment_async, which has the signature of
+mafft_caller.perform_mafft_alignment and runs the call on a shared background loop. The typing
+and subtyping workers use it with mafft_engine='async' (see mafft_alignment_function).
+"""
+
+import os
+import time
+import signal
+import asyncio
+import logging
+import threading
+from mafft_caller import MafftError, pairwise_alignment_command, parse_pairwise_alignment_output, perform_mafft_alignment
+from alignment_resource_planner import available_cpu_count
+
+from run_metrics import observe, increment
+
+# Bytes written to MAFFT's stdin (or read from its stdout) per step
+STREAM_CHUNK_SIZE = 64 * 1024
+MAFFT_ENGINES = ('subprocess', 'async')
+
+
+class AsyncMafftEngine:
+    """
+    Runs MAFFT processes from an event loop with bounded concurrency.
+
+    Parameters:
+    - max_concurrency (int, optional): Maximum number of MAFFT processes at once. Defaults to the
+      CPUs available to this process.
+    - timeout_seconds (float, optional): Timeout of calls that do not give their own (None for no timeout).
+    """
+
+    def __init__(self, max_concurrency=None, timeout_seconds=None):
+        self.max_concurrency = max_concurrency or available_cpu_count()
+        self.timeout_seconds = timeout_seconds
+        self.running = 0
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # Created lazily so it belongs to the loop the engine is used in
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def run(self, mafft_command, input_data=None, timeout=None):
+        """
+        Runs a MAFFT command, streaming input_data to its stdin, killed after timeout seconds
+        (default: the engine's timeout_seconds).
+
+        Returns:
+        - str: MAFFT's stdout.
+
+        Raises:
+        - MafftError: If MAFFT times out or exits with an error (transient for timeouts and kills).
+        - asyncio.CancelledError: If the call is cancelled; the MAFFT process is killed first.
+        """
+        timeout = timeout if timeout is not None else self.timeout_seconds
+        async with self.semaphore:
+            start = time.perf_counter()
+            process = await asyncio.create_subprocess_exec(
+                *mafft_command, stdin=asyncio.subprocess.PIPE if input_data is not None else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=os.name == 'posix')
+            self.running += 1
+            stdout_chunks, stderr_chunks = [], []
+            try:
+                await asyncio.wait_for(asyncio.gather(self._write(process, input_data),
+                                                      self._read(process.stdout, stdout_chunks),
+                                                      self._read(process.stderr, stderr_chunks),
+                                                      process.wait()),
+                                       timeout)
+            except asyncio.TimeoutError:
+                await self._kill(process)
+                increment('mafft_calls', status='timeout')
+                raise MafftError(f"MAFFT timed out after {timeout}s", b''.join(stderr_chunks).decode(errors='replace'),
+                                 None, transient=True)
+            except BaseException:
+                # Cancelled (or the pipe broke): never leave MAFFT running
+                await self._kill(process)
+                raise
+            finally:
+                self.running -= 1
+
+        stdout, stderr = b''.join(stdout_chunks).decode(), b''.join(stderr_chunks).decode(errors='replace')
+        observe('mafft_call_seconds', time.perf_counter() - start)
+        increment('mafft_calls', status='ok' if process.returncode == 0 else 'error')
+        if process.returncode != 0:
+            raise MafftError("Error running MAFFT: " + stderr, stderr, process.returncode,
+                             transient=process.returncode < 0)
+        return stdout
+
+    @staticmethod
+    async def _write(process, input_data):
+        if input_data is None:
+            return
+        data = input_data.encode()
+        try:
+            for offset in range(0, len(data), STREAM_CHUNK_SIZE):
+                process.stdin.write(data[offset:offset + STREAM_CHUNK_SIZE])
+                await process.stdin.drain()
+            process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # MAFFT exited before reading all input; its exit status and stderr tell why
+            pass
+
+    @staticmethod
+    async def _read(stream, chunks):
+        while True:
+            chunk = await stream.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            chunks.append(chunk)
+
+    @staticmethod
+    async def _kill(process):
+        # mafft is a shell script: kill its whole process group, or its children keep the pipes open
+        try:
+            if os.name == 'posix':
+                os.killpg(process.pid, signal.SIGKILL)
+            elif process.returncode is None:
+                process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+    async def align(self, ref_seq, query_seq, mafft_executable, strategy='auto', threads=None, timeout=None):
+        """
+        Aligns a query to a reference, with threads as MAFFT's --thread option.
+
+        Returns:
+        - tuple: Aligned reference and query sequences.
+
+        Raises:
+        - ValueError: For empty sequences or an unknown strategy.
+        - MafftError: If MAFFT fails.
+        """
+        if not ref_seq or not query_seq:
+            raise ValueError("Invalid input sequences")
+        stdout = await self.run(pairwise_alignment_command(mafft_executable, strategy, threads),
+                                f">reference\n{ref_seq}\n>query\n{query_seq}", timeout)
+        return parse_pairwise_alignment_output(stdout)
+
+    async def align_batch(self, pairs, mafft_executable, strategy='auto', threads=None):
+        """
+        Aligns (ref_seq, query_seq) pairs concurrently, at most max_concurrency at a time.
+
+        Returns:
+        - list: Per pair, in input order, the (aligned_ref_seq, aligned_query_seq) tuple or the
+          exception the alignment raised.
+        """
+        tasks = [asyncio.ensure_future(self.align(ref_seq, query_seq, mafft_executable, strategy, threads))
+                 for ref_seq, query_seq in pairs]
+        try:
+            return await asyncio.gather(*tasks, return_exceptions=True)
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+
+async def run_overlapped_batches(batches, prepare_func, align_func, finish_func, executor=None):
+    """
+    Runs batches through prepare -> align -> finish, overlapping the stages of consecutive batches.
+
+    While the alignments of batch i are in flight, batch i + 1 is prepared (e.g. QC) and the
+    results of batch i - 1 are finished (e.g. written to the database). prepare_func and
+    finish_func are blocking functions run in the executor; align_func is a coroutine function.
+
+    Parameters:
+    - batches (iterable): Input batches.
+    - prepare_func (callable): batch -> prepared batch.
+    - align_func (coroutine function): prepared batch -> aligned batch.
+    - finish_func (callable): aligned batch -> result.
+    - executor (Executor, optional): Executor of the blocking stages (default: the loop's).
+
+    Returns:
+    - list: The results of finish_func, in batch order.
+    """
+    loop = asyncio.get_running_loop()
+    results = []
+    finishing = None
+    iterator = iter(batches)
+    batch = next(iterator, None)
+    preparing = loop.run_in_executor(executor, prepare_func, batch) if batch is not None else None
+    while preparing is not None:
+        prepared = await preparing
+        batch = next(iterator, None)
+        preparing = loop.run_in_executor(executor, prepare_func, batch) if batch is not None else None
+        aligned = await align_func(prepared)
+        if finishing is not None:
+            results.append(await finishing)
+        finishing = loop.run_in_executor(executor, finish_func, aligned)
+    if finishing is not None:
+        results.append(await finishing)
+    return results
+
+
+# Shared background loop for the synchronous wrapper
+_engine = None
+_engine_loop = None
+_engine_lock = threading.Lock()
+
+
+def set_async_mafft_concurrency(max_concurrency):
+    """
+    Sets the process limit of the shared engine used by perform_mafft_alignment_async.
+    Takes effect for the next engine, so call it before the first alignment of a run.
+    """
+    global _engine
+    with _engine_lock:
+        _engine = AsyncMafftEngine(max_concurrency)
+
+
+def shared_engine():
+    """
+    Returns the shared engine and its event loop, starting the loop thread on first use.
+    """
+    global _engine, _engine_loop
+    with _engine_lock:
+        if _engine_loop is None:
+            _engine_loop = asyncio.new_event_loop()
+            threading.Thread(target=_engine_loop.run_forever, name='async-mafft-engine', daemon=True).start()
+        if _engine is None:
+            _engine = AsyncMafftEngine()
+        return _engine, _engine_loop
+
+
+def perform_mafft_alignment_async(ref_seq, query_seq, mafft_executable, strategy='auto', raise_errors=False, threads=None,
+                                  timeout=None):
+    """
+    Perform sequence alignment using MAFFT on the shared asyncio engine.
+
+    Same arguments and return values as mafft_caller.perform_mafft_alignment; the MAFFT
+    processes of all calling threads share the engine's concurrency limit.
+
+    Returns:
+        Tuple[str, str] or str: Aligned reference and query sequences, or an error message.
+    """
+    engine, loop = shared_engine()
+    future = asyncio.run_coroutine_threadsafe(engine.align(ref_seq, query_seq, mafft_executable, strategy, threads, timeout),
+                                              loop)
+    try:
+        return future.result()
+    except Exception as e:
+        if raise_errors:
+            raise
+        logging.error(f"An error occurred: {str(e)}")
+        return "An unexpected error occurred during sequence alignment."
+    except BaseException:
+        # e.g. KeyboardInterrupt in the calling thread: stop the MAFFT process too
+        future.cancel()
+        raise
+
+
+def mafft_alignment_function(mafft_engine='subprocess'):
+    """
+    Returns the pairwise alignment function of a MAFFT engine: mafft_caller.perform_mafft_alignment
+    for 'subprocess' (a blocking subprocess call per alignment), perform_mafft_alignment_async
+    for 'async' (the shared asyncio engine).
+
+    Raises:
+    - ValueError: If mafft_engine is not one of MAFFT_ENGINES.
+    """
+    if mafft_engine == 'subprocess':
+        return perform_mafft_alignment
+    if mafft_engine == 'async':
+        return perform_mafft_alignment_async
+    raise ValueError(f"Unknown MAFFT engine: {mafft_engine}, expected one of {MAFFT_ENGINES}")
@@ -0,0 +1,14 @@
+"""
+Puts config/general on sys.path, for the config/seq modules that import from it.
+
+The notebook imports this module after changing into config/seq, and so does every script
+run from config/seq, before its other imports; the modules themselves do not touch sys.path.
+"""
+
+import os
+import sys
+
+GENERAL_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'general'))
+
+if GENERAL_DIR not in sys.path:
+    sys.path.append(GENERAL_DIR)
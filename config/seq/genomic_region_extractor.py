@@ -0,0 +1,78 @@
+import re
+import numpy as np
+
+def region_column_prefix(region_name):
+    """
+    Turn a region name into a column prefix, e.g. 'PR/RT' -> 'pr_rt'.
+    """
+    return re.sub(r'[^0-9a-z]+', '_', str(region_name).lower()).strip('_')
+
+
+def extracting_seqs_within_regions(ref_seq, query_seq, regions):
+    """
+    Extracts subsequences for several reference-coordinate regions from one pairwise alignment.
+
+    The reference coordinate of every alignment column is computed once, so each extra region
+    costs two binary searches instead of another walk over the alignment (or another alignment).
+    Each region gives the same result as extracting_seq_within_pol_region would.
+
+    Parameters:
+    - ref_seq (str): Aligned reference DNA sequence.
+    - query_seq (str): Aligned query DNA sequence.
+    - regions (iterable): (region_name, ref_start_coord, ref_end_coord) tuples, 1-based and inclusive.
+
+    Returns:
+    - dict: region_name -> (extracted ref sequence, extracted query sequence, start position in query, end position in query).
+    """
+    if len(ref_seq) != len(query_seq):
+        return "ref_seq and query_seq must have the same length."
+
+    aln_len = len(ref_seq)
+    # Reference coordinate reached at each alignment column
+    ref_pos = np.cumsum(np.frombuffer(ref_seq.encode(), dtype=np.uint8) != ord('-'))
+
+    extracted = {}
+    for region_name, start_coord, end_coord in regions:
+        start_idx = int(np.searchsorted(ref_pos, start_coord))
+        if start_idx < aln_len and ref_pos[start_idx] == start_coord:
+            end_idx = int(np.searchsorted(ref_pos, end_coord))
+            if end_idx < start_idx or end_idx >= aln_len or ref_pos[end_idx] != end_coord:
+                end_idx = aln_len - 1
+            query_start_coord, query_end_coord = start_idx + 1, end_idx + 1
+            extracted_ref_seq = ref_seq[start_idx:end_idx + 1]
+        else:
+            # Region start not covered by the alignment
+            query_start_coord = query_end_coord = aln_len
+            extracted_ref_seq = ""
+        extracted[region_name] = (extracted_ref_seq, query_seq[query_start_coord - 1:query_end_coord],
+                                  query_start_coord, query_end_coord)
+    return extracted
+
+
+def extract_region_columns(aligned_ref_seq, aligned_query_seq, ref_region_df):
+    """
+    Builds the per-region output columns for one query from its reference alignment.
+
+    Parameters:
+    - aligned_ref_seq : str
+        Aligned reference sequence.
+    - aligned_query_seq : str
+        Aligned query sequence.
+    - ref_region_df : DataFrame
+        Rows of hiv_type_ref_region for the reference that was aligned to.
+
+    Returns:
+    - dict
+        '<region>_query_seq', '<region>_query_seq_start_coord' and '<region>_query_seq_end_coord'
+        for every region, each wrapped in a one-element list (ready for pd.DataFrame).
+    """
+    regions = [(region_column_prefix(row['region_name']), int(row['region_start_coord']), int(row['region_end_coord']))
+               for _, row in ref_region_df.iterrows()]
+    extracted = extracting_seqs_within_regions(aligned_ref_seq, aligned_query_seq, regions)
+
+    region_columns = {}
+    for prefix, (_, region_query_seq, query_start_coord, query_end_coord) in extracted.items():
+        region_columns[f"{prefix}_query_seq"] = [region_query_seq]
+        region_columns[f"{prefix}_query_seq_start_coord"] = [query_start_coord]
+        region_columns[f"{prefix}_query_seq_end_coord"] = [query_end_coord]
+    return region_columns
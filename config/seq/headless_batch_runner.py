@@ -0,0 +1,282 @@
+"""
+Headless batch runner: the pipeline of seq.ipynb for many input files, without prompts.
+
+    python headless_batch_runner.py --database swe_db --user postgres --password ... \
+        --host localhost --port 5432 --profile site_profile.json --report-dir reports \
+        submissions/ 'extra/*.csv'
+
+Headers are matched with a saved header-mapping profile (see
+user_prompter.load_header_mapping_profile) instead of input() prompts. Ingestion, datatype
+validation and QC run for several files at once in worker processes; the QC'd rows of all
+files then go through one typing and one subtyping worker pool (so long and short files share
+the cores), and the known-subtype rows are uploaded through one IncrementalUploadSink. Every
+input file gets its own JSON report in the report directory.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import config_paths  # config/general modules, when run as a script
+from qc import process_sequences, categorize_hiv_typing, categorize_hiv1_subtyping, QC_FILTERS
+from hiv_typing_alignment_worker import perform_hiv_typing
+from subtype_reference_profile import SUBTYPING_MODES, subtyping_worker_for_mode, compare_with_reference_profile
+from parallel_alignment_processor import process_sequence_alignment_isolated
+from alignment_resource_planner import available_cpu_count
+from db_operations import db_wrapper, extract_table
+from file_reading_operations import read_data_file
+from path_finder import find_path_of_file_or_dir
+from user_prompter import load_header_mapping_profile, data_file_ingestion
+from incremental_uploader import IncrementalUploadSink
+from quarantine_recorder import upload_quarantine_df
+from run_metrics import start_run_metrics, stage_timer, export_run_metrics
+
+# Extensions read_data_file accepts
+SUPPORTED_EXTENSIONS = ('.csv', '.txt', '.tab', '.tsv', '.xlsx')
+
+# Column that tags each row with its input file through typing, subtyping and upload
+SOURCE_FILE_COLUMN = 'source_file'
+
+
+def resolve_input_files(inputs):
+    """
+    Expands directories (their supported files, not recursive) and glob patterns into a
+    sorted list of files, each listed once.
+    """
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = [os.path.join(item, name) for name in os.listdir(item)]
+        else:
+            candidates = glob.glob(item) or [item]
+        files.extend(sorted(path for path in candidates
+                            if os.path.isfile(path) and path.lower().endswith(SUPPORTED_EXTENSIONS)))
+    return list(dict.fromkeys(os.path.abspath(path) for path in files))
+
+
+def ingest_and_qc(file_path, profile, col_descr_df):
+    """
+    Reads, validates and QCs one input file. Runs in a worker process.
+
+    Returns:
+    - dict: 'file', 'error' (None if the file was processed), 'rows_read', 'rows_invalid'
+      (failed datatype validation), 'qc_removed' (rows removed per QC filter), 'post_qc_df'
+      and 'seconds'.
+    """
+    start = time.perf_counter()
+    report = {'file': file_path, 'error': None, 'rows_read': 0, 'rows_invalid': 0, 'qc_removed': {},
+              'post_qc_df': pd.DataFrame()}
+    try:
+        ingestion_result = data_file_ingestion(file_path, profile, col_descr_df)
+        if isinstance(ingestion_result, str):
+            report['error'] = ingestion_result
+        else:
+            seq_df, invalid_rows = ingestion_result
+            report['rows_read'] = len(seq_df) + len(invalid_rows)
+            report['rows_invalid'] = len(invalid_rows)
+            if seq_df.empty:
+                report['error'] = "No valid rows."
+            else:
+                results, post_qc_df = process_sequences(seq_df)
+                report['qc_removed'] = {qc_filter: len(results[f"{qc_filter}_df"]) for qc_filter, _ in QC_FILTERS}
+                report['post_qc_df'] = post_qc_df
+    except Exception as e:
+        report['error'] = f"{type(e).__name__}: {e}"
+    report['seconds'] = time.perf_counter() - start
+    return report
+
+
+def _count_by_file(df):
+    if df is None or df.empty or SOURCE_FILE_COLUMN not in df.columns:
+        return {}
+    return df[SOURCE_FILE_COLUMN].value_counts().to_dict()
+
+
+def write_file_reports(reports, report_dir):
+    """
+    Writes one '<file name>.report.json' per input file to report_dir.
+
+    Returns:
+    - list: Paths of the reports.
+    """
+    os.makedirs(report_dir, exist_ok=True)
+    paths = []
+    for report in reports:
+        name = os.path.basename(report['file'])
+        path = os.path.join(report_dir, f"{name}.report.json")
+        if path in paths:
+            # Same file name in two input directories
+            path = os.path.join(report_dir, f"{name}.{len(paths)}.report.json")
+        with open(path, 'w') as f:
+            json.dump({key: value for key, value in report.items() if key != 'post_qc_df'}, f, indent=2, default=str)
+        paths.append(path)
+    return paths
+
+
+def run_batch(database, user, password, host, port, input_files, profile, mafft_executable, report_dir,
+              ingest_workers=None, checkpoint_dir=None, subtyping_mode='pairwise'):
+    """
+    Runs ingestion, QC, typing, subtyping and upload for a batch of input files.
+
+    Args:
+    - database, user, password, host, port: Connection parameters of the pipeline database.
+    - input_files (list): Paths of the input files.
+    - profile (dict): Header-mapping profile (output of load_header_mapping_profile).
+    - mafft_executable (str): Path to the MAFFT executable.
+    - report_dir (str): Directory of the per-file reports.
+    - ingest_workers (int, optional): Processes for ingestion and QC. Defaults to the available CPUs.
+    - checkpoint_dir (str, optional): Directory of the typing and subtyping checkpoints of the batch.
+    - subtyping_mode (str): 'pairwise', 'profile' or 'compare' (see subtype_reference_profile.SUBTYPING_MODES).
+      With 'compare' the agreement of the profile calls is written to 'subtyping_comparison.csv' in report_dir.
+
+    Returns:
+    - list or str: The per-file reports, or an error message for failures that stop the whole batch.
+    """
+    subtyping_worker = subtyping_worker_for_mode(subtyping_mode)
+    if isinstance(subtyping_worker, str):
+        return subtyping_worker
+    col_descr_df = read_data_file(find_path_of_file_or_dir('assets/col_description.xlsx'))
+    if isinstance(col_descr_df, str):
+        return f"Error reading col_description.xlsx: {col_descr_df}"
+
+    reports = []
+    with stage_timer('ingestion_and_qc'):
+        with ProcessPoolExecutor(max_workers=min(ingest_workers or available_cpu_count(), len(input_files))) as executor:
+            futures = [executor.submit(ingest_and_qc, path, profile, col_descr_df) for path in input_files]
+            for future in as_completed(futures):
+                report = future.result()
+                logging.info(f"{report['file']}: {report['error'] or 'ingested'} in {report['seconds']:.1f}s")
+                reports.append(report)
+    reports.sort(key=lambda report: input_files.index(report['file']))
+
+    post_qc_frames = [report['post_qc_df'].assign(**{SOURCE_FILE_COLUMN: report['file']})
+                      for report in reports if not report['post_qc_df'].empty]
+    for report in reports:
+        report['post_qc'] = len(report['post_qc_df'])
+    if not post_qc_frames:
+        write_file_reports(reports, report_dir)
+        return reports
+    post_qc_df = pd.concat(post_qc_frames, ignore_index=True)
+
+    with stage_timer('extract_reference_tables'):
+        hiv_type_ref_seq_table = extract_table(database, user, password, host, port, 'hiv_type_ref_seq')
+        hiv_type_ref_region_table = extract_table(database, user, password, host, port, 'hiv_type_ref_region')
+        hiv_subtype_con_ref_seq_table = extract_table(database, user, password, host, port, 'hiv_subtype_con_ref_seq')
+    for table in (hiv_type_ref_seq_table, hiv_type_ref_region_table, hiv_subtype_con_ref_seq_table):
+        if isinstance(table, str):
+            return table
+
+    with stage_timer('hiv_typing'):
+        typing_result = process_sequence_alignment_isolated(
+            post_qc_df, hiv_type_ref_seq_table, 'seq_cleaned', perform_hiv_typing, mafft_executable,
+            checkpoint_path=os.path.join(checkpoint_dir, 'hiv_typing.jsonl') if checkpoint_dir else None,
+            ref_region_df=hiv_type_ref_region_table)
+    if isinstance(typing_result, str):
+        return typing_result
+    typed_df, typing_quarantine_df, _ = typing_result
+    upload_quarantine_df(database, user, password, host, port, typing_quarantine_df)
+    hiv1_df = categorize_hiv_typing(typed_df)['hiv1_df'] if not typed_df.empty else pd.DataFrame()
+
+    upload_sink = IncrementalUploadSink(database, user, password, host, port, 'seq', keep_columns=[SOURCE_FILE_COLUMN])
+    subtyped_df, subtyping_quarantine_df = pd.DataFrame(), pd.DataFrame()
+    if not hiv1_df.empty:
+        with stage_timer('hiv1_subtyping'):
+            subtyping_result = process_sequence_alignment_isolated(
+                hiv1_df, hiv_subtype_con_ref_seq_table, 'extracted_pol_query_seq_cleaned', subtyping_worker,
+                mafft_executable,
+                checkpoint_path=os.path.join(checkpoint_dir, 'hiv1_subtyping.jsonl') if checkpoint_dir else None,
+                result_callback=lambda df: upload_sink.put(categorize_hiv1_subtyping(df)[1]))
+        if isinstance(subtyping_result, str):
+            upload_sink.close()
+            return subtyping_result
+        subtyped_df, subtyping_quarantine_df, _ = subtyping_result
+        upload_quarantine_df(database, user, password, host, port, subtyping_quarantine_df)
+        if subtyping_mode == 'compare':
+            with stage_timer('subtyping_mode_comparison'):
+                comparison_result = compare_with_reference_profile(hiv1_df, hiv_subtype_con_ref_seq_table, subtyped_df,
+                                                                   mafft_executable)
+            if isinstance(comparison_result, str):
+                logging.error(comparison_result)
+            else:
+                os.makedirs(report_dir, exist_ok=True)
+                comparison_result[0].to_csv(os.path.join(report_dir, 'subtyping_comparison.csv'), index=False)
+    with stage_timer('upload_seq'):
+        upload_results = upload_sink.close()
+    if isinstance(upload_results, str):
+        return upload_results
+    uploaded_df, not_uploaded_df = upload_results
+    known_df = categorize_hiv1_subtyping(subtyped_df)[1] if not subtyped_df.empty else pd.DataFrame()
+
+    counts = {'typed': _count_by_file(typed_df),
+              'typing_quarantined': _count_by_file(typing_quarantine_df),
+              'hiv1': _count_by_file(hiv1_df),
+              'subtyped': _count_by_file(subtyped_df),
+              'subtyping_quarantined': _count_by_file(subtyping_quarantine_df),
+              'known_subtype': _count_by_file(known_df),
+              'uploaded': _count_by_file(uploaded_df),
+              'not_uploaded': _count_by_file(not_uploaded_df)}
+    for report in reports:
+        report.update({key: by_file.get(report['file'], 0) for key, by_file in counts.items()})
+    write_file_reports(reports, report_dir)
+    return reports
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Run the sequence pipeline on a batch of input files without prompts.")
+    parser.add_argument('inputs', nargs='+', help="Input files, directories or glob patterns.")
+    parser.add_argument('--profile', required=True, help="Header-mapping profile (JSON).")
+    parser.add_argument('--report-dir', required=True, help="Directory of the per-file reports.")
+    parser.add_argument('--database', required=True)
+    parser.add_argument('--user', required=True)
+    parser.add_argument('--password', default='')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default='5432')
+    parser.add_argument('--mafft', help="Path to the MAFFT executable (default: install and activate MAFFT).")
+    parser.add_argument('--ingest-workers', type=int, help="Processes for ingestion and QC (default: CPUs).")
+    parser.add_argument('--checkpoint-dir', help="Directory of the typing and subtyping checkpoints.")
+    parser.add_argument('--subtyping-mode', choices=SUBTYPING_MODES, default='pairwise',
+                        help="Pairwise alignments per reference, one profile alignment per query, or both compared.")
+    options = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    input_files = resolve_input_files(options.inputs)
+    if not input_files:
+        logging.error(f"No input files found in {options.inputs}")
+        return 1
+    profile = load_header_mapping_profile(options.profile)
+    if isinstance(profile, str):
+        logging.error(profile)
+        return 1
+
+    start_run_metrics()
+    db_result = db_wrapper(options.database, options.user, options.password, options.host, options.port)
+    if db_result.startswith("Error"):
+        logging.error(db_result)
+        return 1
+    mafft_executable = options.mafft
+    if mafft_executable is None:
+        # Imported here: the installer changes the working directory when imported
+        from mafft_mac_installer import install_and_activate_mafft
+        mafft_executable = install_and_activate_mafft()
+
+    reports = run_batch(options.database, options.user, options.password, options.host, options.port, input_files,
+                        profile, mafft_executable, options.report_dir, options.ingest_workers, options.checkpoint_dir,
+                        options.subtyping_mode)
+    export_result = export_run_metrics(options.report_dir)
+    if isinstance(reports, str):
+        logging.error(reports)
+        return 1
+    for report in reports:
+        print(f"{os.path.basename(report['file'])}: "
+              f"{report['error'] or str(report.get('uploaded', 0)) + ' rows uploaded'}")
+    print(export_result if isinstance(export_result, str) else f"Run report written to {export_result[0]}")
+    return int(any(report['error'] for report in reports))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,11 @@
 import pandas as pd   
 import numpy as np
-from mafft_caller import perform_mafft_alignment
+from async_mafft_engine import mafft_alignment_function
 from similarity_calculator import calculate_similarity_between_aligned_seqs
 from end_characters_cleaner import remove_consecutive_ends_n_and_hyphens_repeatedly
 from hypermutation_calculator import analyze_mutations
+from mafft_strategy_selector import resolve_mafft_strategy
+from recombination_scanner import scan_mosaic
 
 
 def identify_unidentified_hiv_subtypes(alignment_result_df):
@@ -104,7 +106,8 @@ def aggregate_duplicate_rows(subtyped_df):
     return result_df
 
 
-def perform_hiv_subtyping(quary_row_df, ref_seq_df, quary_seq_col_nam, mafft_executable):
+def perform_hiv_subtyping(quary_row_df, ref_seq_df, quary_seq_col_nam, mafft_executable, mafft_strategy='auto', batch_size=1,
+                          mafft_threads=None, mafft_timeout=None, mafft_engine='subprocess'):
     """
     This function aligns a query sequence against multiple reference sequences, calculates 
     alignment scores, and similarity percentages. It also performs HIV subtyping based on the 
@@ -119,13 +122,43 @@ def perform_hiv_subtyping(quary_row_df, ref_seq_df, quary_seq_col_nam, mafft_exe
         DataFrame containing the reference sequences with known subtypes.
     - quary_seq_col_nam : str
         Column name in quary_row_df containing the query sequence.
+    - mafft_strategy : str or callable, optional
+        MAFFT strategy ('auto', 'progressive', 'iterative', 'adaptive' or a chooser function,
+        see resolve_mafft_strategy). The strategy used is recorded in 'hiv1_subtype_mafft_strategy'.
+    - batch_size : int, optional
+        Number of rows in the run, for the 'adaptive' strategy.
+    - mafft_threads, mafft_timeout : optional
+        MAFFT's --thread option and per-call timeout (see perform_mafft_alignment).
+    - mafft_engine : str, optional
+        'subprocess' or 'async' (the shared asyncio engine), see mafft_alignment_function.
+        batch_size, mafft_threads, mafft_timeout and mafft_engine are passed by the alignment
+        dispatchers (see parallel_alignment_processor.worker_options).
 
     Returns:
     - DataFrame
         DataFrame with alignment results including extracted sequences, alignment scores, similarity percentages,
         identified subtypes, and hypermutation analysis results.
     """
+    result_df = align_hiv1_subtype_references(quary_row_df, ref_seq_df, quary_seq_col_nam, mafft_executable, mafft_strategy,
+                                              batch_size, mafft_threads, mafft_timeout, mafft_engine)
+    return finalize_hiv_subtyping(result_df)
+
+
+def align_hiv1_subtype_references(quary_row_df, ref_seq_df, quary_seq_col_nam, mafft_executable, mafft_strategy='auto',
+                                  batch_size=1, mafft_threads=None, mafft_timeout=None, mafft_engine='subprocess'):
+    """
+    Aligns a query sequence against each consensus reference: the alignment part of
+    perform_hiv_subtyping, before finalize_hiv_subtyping.
+
+    Parameters: as perform_hiv_subtyping.
+
+    Returns:
+    - DataFrame
+        One row per consensus reference: the query row plus the alignment, its score and
+        similarity, the reference subtype and the cleaned aligned query.
+    """
     query_seq = quary_row_df[quary_seq_col_nam].tolist()[0]
+    perform_mafft_alignment = mafft_alignment_function(mafft_engine)
     # Create an empty list to store DataFrames
     result_list = []
 
@@ -134,7 +167,9 @@ def perform_hiv_subtyping(quary_row_df, ref_seq_df, quary_seq_col_nam, mafft_exe
         ref_seq = ref_row['ref_seq']
         hiv1_subtype_lanl = ref_row['hiv1_subtype_lanl']
 
-        aligned_ref_seq, aligned_query_seq = perform_mafft_alignment(ref_seq, query_seq, mafft_executable)
+        strategy = resolve_mafft_strategy(mafft_strategy, ref_seq, query_seq, batch_size)
+        aligned_ref_seq, aligned_query_seq = perform_mafft_alignment(ref_seq, query_seq, mafft_executable, strategy, raise_errors=True,
+                                                                     threads=mafft_threads, timeout=mafft_timeout)
         alignment_score, similarity_percentage = calculate_similarity_between_aligned_seqs(aligned_ref_seq, aligned_query_seq)
 
         hiv1_aligned_query_seq_cleaned = remove_consecutive_ends_n_and_hyphens_repeatedly(aligned_query_seq)
@@ -148,6 +183,7 @@ def perform_hiv_subtyping(quary_row_df, ref_seq_df, quary_seq_col_nam, mafft_exe
             'hiv1_subtype_similarity_percentage': [similarity_percentage],
             'hiv1_subtype_lanl': [hiv1_subtype_lanl],
             'hiv1_subtype_lanl_anomaly': [''],
+            'hiv1_subtype_mafft_strategy': [strategy],
             'hiv1_hypermut_p_value':[np.nan],
             'hiv1_aligned_query_seq_cleaned': [hiv1_aligned_query_seq_cleaned],
             "hiv1_aligned_query_seq_cleaned_len": [hiv1_aligned_query_seq_cleaned_len]})
@@ -155,8 +191,28 @@ def perform_hiv_subtyping(quary_row_df, ref_seq_df, quary_seq_col_nam, mafft_exe
         quary_row_alignment_df = pd.concat([quary_row_df.reset_index(drop=True), alignment_df], axis=1)
         result_list.append(quary_row_alignment_df)
 
-    result_df = pd.concat(result_list, ignore_index=True)
-    
+    return pd.concat(result_list, ignore_index=True)
+
+
+def finalize_hiv_subtyping(result_df):
+    """
+    Turns the per-reference alignment rows of one query into its subtyping result: scans the
+    alignments for a mosaic ('hiv1_mosaic', see scan_mosaic), assigns 'UI'/'UN', calculates
+    hypermutation for the kept rows and aggregates duplicate rows.
+
+    Parameters:
+    - result_df : DataFrame
+        One row per consensus reference, as built by perform_hiv_subtyping.
+
+    Returns:
+    - DataFrame
+        The subtyping result for the query.
+    """
+    # Windowed best-subtype scan over the alignments already made, e.g. to confirm a 'UI' recombinant
+    result_df = result_df.assign(hiv1_mosaic=scan_mosaic(result_df['hiv1_aligned_ref_seq'].tolist(),
+                                                         result_df['hiv1_aligned_query_seq'].tolist(),
+                                                         result_df['hiv1_subtype_lanl'].tolist()))
+
     # Assign 'UI' and 'UK, and return either if Assigned. Otherwsie, return highest hiv1_subtype_similarity_percentage row
     identify_unidentified_result_df = identify_unidentified_hiv_subtypes(result_df)
 
@@ -1,10 +1,13 @@
 import pandas as pd   
-from mafft_caller import perform_mafft_alignment
+from async_mafft_engine import mafft_alignment_function
 from pol_region_coordinates_finder import extracting_seq_within_pol_region
 from similarity_calculator import calculate_similarity_between_aligned_seqs
 from end_characters_cleaner import remove_consecutive_ends_n_and_hyphens_repeatedly
+from genomic_region_extractor import extract_region_columns
+from mafft_strategy_selector import resolve_mafft_strategy
 
-def perform_hiv_typing(quary_row_df, ref_seq_df, quary_seq_col_nam, mafft_executable):
+def perform_hiv_typing(quary_row_df, ref_seq_df, quary_seq_col_nam, mafft_executable, ref_region_df=None, mafft_strategy='auto',
+                       batch_size=1, mafft_threads=None, mafft_timeout=None, mafft_engine='subprocess'):
     """
     This function aligns a query sequence against two reference sequences (HXB2 and SIVMM239), 
     calculates similarity percentages, determines the HIV type based on a similarity threshold, 
@@ -21,13 +24,30 @@ def perform_hiv_typing(quary_row_df, ref_seq_df, quary_seq_col_nam, mafft_execut
         Column name in quary_row_df containing the query sequence.
     - mafft_executable : str
         Path to the MAFFT executable.
+    - ref_region_df : DataFrame, optional
+        Rows of hiv_type_ref_region. The HXB2 regions are sliced out of the HXB2 typing
+        alignment, so extra regions (gag, env, PR/RT, ...) cost no extra alignment. Passed
+        by the alignment dispatchers (ref_region_df of process_sequence_alignment_parallel).
+    - mafft_strategy : str or callable, optional
+        MAFFT strategy ('auto', 'progressive', 'iterative', 'adaptive' or a chooser function,
+        see resolve_mafft_strategy). The strategy used is recorded in 'hiv_type_mafft_strategy'.
+    - batch_size : int, optional
+        Number of rows in the run, for the 'adaptive' strategy.
+    - mafft_threads, mafft_timeout : optional
+        MAFFT's --thread option and per-call timeout (see perform_mafft_alignment).
+    - mafft_engine : str, optional
+        'subprocess' or 'async' (the shared asyncio engine), see mafft_alignment_function.
+        batch_size, mafft_threads, mafft_timeout and mafft_engine are passed by the alignment
+        dispatchers (see parallel_alignment_processor.worker_options).
 
     Returns:
     - DataFrame
         DataFrame with alignment results including extracted sequences, alignment scores,
-        similarity percentages, and HIV type classification.
+        similarity percentages, and HIV type classification, plus '<region>_query_seq',
+        '<region>_query_seq_start_coord' and '<region>_query_seq_end_coord' for each HXB2 region.
     """    
     SIMILARITY_THRESHOLD = 75
+    perform_mafft_alignment = mafft_alignment_function(mafft_engine)
     # Extracting reference sequences
     hxb2_row = ref_seq_df[ref_seq_df['seq_name'] == 'HXB2']
     sivmm239_row = ref_seq_df[ref_seq_df['seq_name'] == 'SIVMM239']
@@ -40,10 +60,18 @@ def perform_hiv_typing(quary_row_df, ref_seq_df, quary_seq_col_nam, mafft_execut
     # 1st alignment using HXB2 as reference
     hxb2_pol_start_coord = hxb2_row['hiv_typing_pol_start_coord'].tolist()[0]
     hxb2_pol_end_coord = hxb2_row['hiv_typing_pol_end_coord'].tolist()[0]  
-    aligned_ref_seq, aligned_query_seq = perform_mafft_alignment(hxb2_ref_seq, query_seq, mafft_executable)
+    strategy = resolve_mafft_strategy(mafft_strategy, hxb2_ref_seq, query_seq, batch_size)
+    aligned_ref_seq, aligned_query_seq = perform_mafft_alignment(hxb2_ref_seq, query_seq, mafft_executable, strategy, raise_errors=True,
+                                                                 threads=mafft_threads, timeout=mafft_timeout)
     extracted_pol_ref_seq, extracted_pol_query_seq, query_pol_start_coord, query_pol_end_coord = extracting_seq_within_pol_region(aligned_ref_seq, aligned_query_seq, hxb2_pol_start_coord, hxb2_pol_end_coord)
     alignment_score, similarity_percentage = calculate_similarity_between_aligned_seqs(extracted_pol_ref_seq, extracted_pol_query_seq)
 
+    # Slice every requested HXB2 region out of the same alignment
+    region_columns = {}
+    if ref_region_df is not None:
+        region_columns = extract_region_columns(aligned_ref_seq, aligned_query_seq,
+                                                ref_region_df[ref_region_df['seq_name'] == 'HXB2'])
+
     # Determining HIV type based on similarity threshold
     if similarity_percentage >= SIMILARITY_THRESHOLD:
         hiv_type_lanl = "HIV-1"
@@ -51,7 +79,9 @@ def perform_hiv_typing(quary_row_df, ref_seq_df, quary_seq_col_nam, mafft_execut
         # 2nd alignment using SIVMM239 as reference
         sivmm239_pol_start_coord = sivmm239_row['hiv_typing_pol_start_coord'].tolist()[0]
         sivmm239_pol_end_coord = sivmm239_row['hiv_typing_pol_end_coord'].tolist()[0] 
-        aligned_ref_seq, aligned_query_seq = perform_mafft_alignment(sivmm239_ref_seq, query_seq, mafft_executable)
+        strategy = resolve_mafft_strategy(mafft_strategy, sivmm239_ref_seq, query_seq, batch_size)
+        aligned_ref_seq, aligned_query_seq = perform_mafft_alignment(sivmm239_ref_seq, query_seq, mafft_executable, strategy, raise_errors=True,
+                                                                     threads=mafft_threads, timeout=mafft_timeout)
         extracted_pol_ref_seq, extracted_pol_query_seq, query_pol_start_coord, query_pol_end_coord = extracting_seq_within_pol_region(aligned_ref_seq, aligned_query_seq, sivmm239_pol_start_coord, sivmm239_pol_end_coord)
         alignment_score, similarity_percentage = calculate_similarity_between_aligned_seqs(extracted_pol_ref_seq, extracted_pol_query_seq)
 
@@ -75,8 +105,10 @@ def perform_hiv_typing(quary_row_df, ref_seq_df, quary_seq_col_nam, mafft_execut
                              "hiv_type_alignment_score": [alignment_score],
                              "hiv_type_similarity_percentage": [similarity_percentage],
                              "hiv_type_lanl": [hiv_type_lanl],
+                             "hiv_type_mafft_strategy": [strategy],
                              "extracted_pol_query_seq_cleaned": [extracted_pol_query_seq_cleaned],
-                             "extracted_pol_query_seq_cleaned_len": [extracted_pol_query_seq_cleaned_len]})
+                             "extracted_pol_query_seq_cleaned_len": [extracted_pol_query_seq_cleaned_len],
+                             **region_columns})
     
     # Concatenate the result with the original DataFrame
     result_df = pd.concat([quary_row_df.reset_index(drop=True), df_entry], axis=1)
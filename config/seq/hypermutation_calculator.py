@@ -1,5 +1,6 @@
 # Dependences:
 from scipy.stats import fisher_exact
+from profiling_hooks import profiled
 
 MUT_PROBS = {'a': 1, 'r': 1/2, 'm': 1/2, 'w': 1/2, 'h': 1/3, 'v': 1/3, 'd': 1/3, 'n': 1/4}
 
@@ -102,6 +103,7 @@ def control_pattern_finder(query_seq, ref_seq, mut_probs):
     
     return aYNRC_to_g_mut_prob_sum, aYNRC_to_g_count
 
+@profiled
 def analyze_mutations(query_seq, ref_seq):
     
     """
@@ -0,0 +1,479 @@
+"""
+Persistent MinHash/LSH index of the pol sequences in the database, for finding the historical
+sequences a new sequence may be close to without computing all distances.
+
+Each sequence is reduced to the set of its k-mers (k-mers with an ambiguity, N or gap are
+left out) and a MinHash signature of num_perm minima; two signatures agree at a position with
+probability equal to the Jaccard similarity of the k-mer sets. The signature is cut into bands
+of num_perm / bands values, and two sequences are candidates if they agree on a whole band.
+At genetic distance d, about (1 - d)^k of the k-mers survive, so the Jaccard similarity is
+about s = (1 - d)^k / (2 - (1 - d)^k) and a pair is found with probability
+1 - (1 - s^rows)^bands (see candidate_probability). With the defaults (k=16, 128 values,
+32 bands of 4) pairs at 1.5% are found ~99% of the time and pairs at 6% ~8% of the time.
+
+On disk the index is a directory with index.json (parameters and segment list) and one
+segment_NNNNN.npz (keys and signatures) per insert, so an insert writes only its own rows.
+In memory, the rows of each band are kept sorted by band key; inserted rows are merged into
+them when the index is next queried, so a sync of many batches sorts only its new rows, once.
+Sequences without any k-mer are not indexed.
+
+Usage (each command first adds the new rows of the seq table to the index):
+    python lsh_candidate_index.py --database swe_db --user postgres --index-dir lsh_index sync
+    python lsh_candidate_index.py ... query new_rows.csv --output close_pairs.csv
+    python lsh_candidate_index.py ... recall --sample-size 200
+"""
+
+import sys
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import psycopg2
+import config_paths  # config/general modules, when run as a script
+from pairwise_distance_engine import (hxb2_frame_matrix, pair_counts, cross_pair_counts, tn93_distance, p_distance,
+                                      DEFAULT_DISTANCE_THRESHOLD, DEFAULT_MIN_OVERLAP)
+from run_metrics import increment, observe
+from db_operations import extract_table
+
+_BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for _code, _base in enumerate('acgt'):
+    _BASE_CODES[ord(_base)] = _BASE_CODES[ord(_base.upper())] = _code
+_EMPTY = np.uint32(0xFFFFFFFF)
+
+
+def _mix64(values):
+    """splitmix64 finalizer: a well-mixed 64-bit hash of each value (wraps modulo 2^64)."""
+    values = values.astype(np.uint64)
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def kmer_hashes(sequence, kmer_size=16):
+    """
+    Returns the 64-bit hashes of the distinct k-mers of sequence that contain only a, c, g and t.
+    """
+    codes = _BASE_CODES[np.frombuffer(str(sequence).encode('ascii', 'replace'), dtype=np.uint8)]
+    n_kmers = len(codes) - kmer_size + 1
+    if n_kmers <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    invalid = np.concatenate([[0], np.cumsum(codes == 255)])
+    valid = invalid[kmer_size:] - invalid[:n_kmers] == 0
+    values = np.zeros(n_kmers, dtype=np.uint64)
+    for offset in range(kmer_size):
+        values = (values << np.uint64(2)) | (codes[offset:offset + n_kmers] & 3).astype(np.uint64)
+    return np.unique(_mix64(values[valid]))
+
+
+def minhash_signatures(sequences, kmer_size=16, num_perm=128, seed=1):
+    """
+    MinHash signatures of sequences.
+
+    Returns:
+    - ndarray: uint32 array (len(sequences), num_perm); rows of sequences without k-mers are all 0xFFFFFFFF.
+    """
+    salts = np.random.default_rng(seed).integers(0, 2 ** 63, size=num_perm, dtype=np.int64).astype(np.uint64)
+    signatures = np.full((len(sequences), num_perm), _EMPTY, dtype=np.uint32)
+    for row, sequence in enumerate(sequences):
+        hashes = kmer_hashes(sequence, kmer_size)
+        if len(hashes):
+            minima = _mix64(hashes[:, None] ^ salts[None, :]).min(axis=0)
+            signatures[row] = (minima >> np.uint64(32)).astype(np.uint32)
+    return signatures
+
+
+def expected_jaccard(distance, kmer_size=16):
+    """Approximate Jaccard similarity of the k-mer sets of two sequences at a genetic distance."""
+    shared = (1 - distance) ** kmer_size
+    return shared / (2 - shared)
+
+
+def candidate_probability(jaccard, bands=32, rows=4):
+    """Probability that two sequences with the given k-mer Jaccard similarity share a band."""
+    return 1 - (1 - jaccard ** rows) ** bands
+
+
+def _band_keys(signatures, bands):
+    """One 64-bit key per band of each signature."""
+    rows = signatures.shape[1] // bands
+    keys = np.zeros((len(signatures), bands), dtype=np.uint64)
+    for offset in range(rows):
+        keys = _mix64(keys ^ signatures[:, offset::rows][:, :bands].astype(np.uint64))
+    return keys
+
+
+class MinHashLSHIndex:
+    """
+    MinHash/LSH index of sequences under integer keys (the seq table id), stored in a directory.
+
+    Opening a directory that holds an index loads it, with its stored parameters; otherwise the
+    given parameters are used for a new index, written on the first insert.
+
+    Parameters:
+    - path (str): Directory of the index.
+    - kmer_size (int): k-mer length (at most 32).
+    - num_perm (int): Signature length.
+    - bands (int): LSH bands; num_perm must be a multiple of it.
+    - seed (int): Seed of the hash functions; signatures are only comparable with the same seed.
+    """
+
+    def __init__(self, path, kmer_size=16, num_perm=128, bands=32, seed=1):
+        self.path = path
+        self.params = {'kmer_size': kmer_size, 'num_perm': num_perm, 'bands': bands, 'seed': seed}
+        self.segments = []
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._signatures = np.zeros((0, num_perm), dtype=np.uint32)
+        # (keys, signatures) inserted since the band arrays were last merged
+        self._pending = []
+        manifest_path = os.path.join(path, 'index.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            self.params = manifest['params']
+            self.segments = manifest['segments']
+            loaded = [np.load(os.path.join(path, segment)) for segment in self.segments]
+            if loaded:
+                self._keys = np.concatenate([segment['keys'] for segment in loaded])
+                self._signatures = np.concatenate([segment['signatures'] for segment in loaded])
+        if self.params['num_perm'] % self.params['bands'] or self.params['kmer_size'] > 32:
+            raise ValueError(f"Invalid index parameters {self.params}: num_perm must be a multiple of bands "
+                             f"and kmer_size at most 32")
+        self._key_set = set(self._keys.tolist())
+        self._order, self._sorted_band_keys = self._sort_bands(self._signatures)
+
+    def __len__(self):
+        return len(self._keys) + sum(len(keys) for keys, _ in self._pending)
+
+    @property
+    def keys(self):
+        """Keys of the indexed sequences, in insertion order."""
+        self._merge_pending()
+        return self._keys
+
+    @property
+    def signatures(self):
+        """Signatures of the indexed sequences, in the order of keys."""
+        self._merge_pending()
+        return self._signatures
+
+    @property
+    def last_key(self):
+        """Largest key in the index (0 if empty), where a database sync resumes."""
+        return max((int(keys.max()) for keys in [self._keys, *(keys for keys, _ in self._pending)] if len(keys)),
+                   default=0)
+
+    def _sort_bands(self, signatures):
+        """Per band, the row order sorting the band keys of signatures (stable) and the sorted keys."""
+        band_keys = _band_keys(signatures, self.params['bands'])
+        order = np.argsort(band_keys, axis=0, kind='stable')
+        return order, np.take_along_axis(band_keys, order, axis=0)
+
+    def _merge_pending(self):
+        """
+        Adds the rows inserted since the last merge to keys, signatures and the sorted band
+        arrays. Only the new rows are sorted; they are merged in after the existing rows of equal
+        band key, which gives the same arrays as sorting all rows.
+        """
+        if not self._pending:
+            return
+        keys = np.concatenate([keys for keys, _ in self._pending])
+        signatures = np.concatenate([signatures for _, signatures in self._pending])
+        self._pending = []
+        new_order, new_sorted = self._sort_bands(signatures)
+        new_order += len(self._keys)
+        bands = self.params['bands']
+        order = np.empty((len(self._keys) + len(keys), bands), dtype=self._order.dtype)
+        sorted_band_keys = np.empty(order.shape, dtype=np.uint64)
+        for band in range(bands):
+            at = np.searchsorted(self._sorted_band_keys[:, band], new_sorted[:, band], side='right')
+            order[:, band] = np.insert(self._order[:, band], at, new_order[:, band])
+            sorted_band_keys[:, band] = np.insert(self._sorted_band_keys[:, band], at, new_sorted[:, band])
+        self._order, self._sorted_band_keys = order, sorted_band_keys
+        self._keys = np.concatenate([self._keys, keys])
+        self._signatures = np.concatenate([self._signatures, signatures])
+
+    def signatures_of(self, sequences):
+        return minhash_signatures(sequences, self.params['kmer_size'], self.params['num_perm'], self.params['seed'])
+
+    def insert(self, keys, sequences):
+        """
+        Adds sequences under their keys and writes them as a new segment. Keys already in the
+        index and sequences without k-mers are skipped. The new rows are merged into the band
+        arrays on the next query.
+
+        Returns:
+        - int: Number of sequences added.
+        """
+        start = time.perf_counter()
+        keys = np.asarray(keys, dtype=np.int64)
+        is_new = np.array([key not in self._key_set for key in keys.tolist()], dtype=bool)
+        # A key repeated within the call is added once
+        is_new &= ~pd.Series(keys).duplicated().to_numpy()
+        keys, sequences = keys[is_new], [sequence for sequence, new in zip(sequences, is_new) if new]
+        signatures = self.signatures_of(sequences)
+        indexed = (signatures != _EMPTY).any(axis=1)
+        keys, signatures = keys[indexed], signatures[indexed]
+        if not len(keys):
+            return 0
+
+        os.makedirs(self.path, exist_ok=True)
+        segment = f"segment_{len(self.segments) + 1:05d}.npz"
+        np.savez(os.path.join(self.path, segment), keys=keys, signatures=signatures)
+        manifest_path = os.path.join(self.path, 'index.json')
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump({'params': self.params, 'segments': self.segments + [segment]}, f, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+        self.segments.append(segment)
+        self._pending.append((keys, signatures))
+        self._key_set.update(keys.tolist())
+        observe('lsh_insert_seconds', time.perf_counter() - start)
+        increment('lsh_indexed_sequences', len(keys))
+        return len(keys)
+
+    def query(self, sequences, min_shared_bands=1):
+        """
+        Finds the indexed sequences that share at least min_shared_bands bands with each sequence.
+
+        Returns:
+        - DataFrame: 'query_position' (position in sequences), 'key' and 'shared_bands', one row
+          per candidate pair.
+        """
+        start = time.perf_counter()
+        self._merge_pending()
+        band_keys = _band_keys(self.signatures_of(sequences), self.params['bands'])
+        queries, positions = [], []
+        for band in range(self.params['bands']):
+            lower = np.searchsorted(self._sorted_band_keys[:, band], band_keys[:, band], side='left')
+            upper = np.searchsorted(self._sorted_band_keys[:, band], band_keys[:, band], side='right')
+            counts = upper - lower
+            queries.append(np.repeat(np.arange(len(sequences)), counts))
+            # Positions lower..upper - 1 of every query, in one array
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            positions.append(self._order[np.repeat(lower, counts) + offsets, band])
+        pairs_df = pd.DataFrame({'query_position': np.concatenate(queries) if queries else [],
+                                 'key': self._keys[np.concatenate(positions)] if positions else []})
+        candidates_df = pairs_df.groupby(['query_position', 'key']).size().rename('shared_bands').reset_index()
+        candidates_df = candidates_df[candidates_df['shared_bands'] >= min_shared_bands].reset_index(drop=True)
+        observe('lsh_query_seconds', time.perf_counter() - start)
+        increment('lsh_candidates', len(candidates_df))
+        return candidates_df
+
+
+def sync_index_with_database(index, database, user, password, host, port, table_name='seq',
+                             seq_col='extracted_pol_query_seq_cleaned', batch_size=5000):
+    """
+    Adds the rows of table_name with an id above index.last_key to the index, reading them
+    with a server-side cursor in batches of batch_size rows, one segment per batch.
+
+    Returns:
+    - int or str: Number of sequences added, or an error message.
+    """
+    added = 0
+    try:
+        with psycopg2.connect(database=database, user=user, password=password, host=host, port=port) as connection:
+            with connection.cursor(name='lsh_index_sync') as cursor:
+                cursor.itersize = batch_size
+                cursor.execute(f"SELECT id, {seq_col} FROM {table_name} WHERE id > %s AND {seq_col} IS NOT NULL "
+                               f"ORDER BY id", (index.last_key,))
+                increment('db_round_trips', operation='lsh_sync', table=table_name)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    added += index.insert([row[0] for row in rows], [row[1] for row in rows])
+    except psycopg2.Error as e:
+        return f"Error syncing the index with {table_name}: {e}"
+    return added
+
+
+def candidate_distances(query_df, reference_df, candidates_df, key_col='id', threshold=DEFAULT_DISTANCE_THRESHOLD,
+                        ambiguity='resolve', min_overlap=DEFAULT_MIN_OVERLAP):
+    """
+    Exact TN93 and p-distances of candidate pairs, in the HXB2 pol frame (see pairwise_distance_engine).
+
+    Parameters:
+    - query_df (DataFrame): The queried rows, in query order, with their typing alignment columns.
+    - reference_df (DataFrame): Indexed rows with key_col and their typing alignment columns.
+    - candidates_df (DataFrame): Output of MinHashLSHIndex.query.
+    - key_col (str): Column of reference_df holding the index keys.
+    - threshold (float, optional): Largest TN93 distance kept; None keeps all pairs.
+    - ambiguity (str): Ambiguity mode of pairwise_distance_engine.
+    - min_overlap (int): Fewest compared positions for a pair to be kept.
+
+    Returns:
+    - DataFrame or str: candidates_df rows with 'tn93_distance', 'p_distance' and 'overlap', or an error message.
+    """
+    combined_df = pd.concat([query_df.assign(_source='query', _row=range(len(query_df))),
+                             reference_df.assign(_source='reference', _row=range(len(reference_df)))],
+                            ignore_index=True)
+    frame_result = hxb2_frame_matrix(combined_df)
+    if isinstance(frame_result, str):
+        return frame_result
+    masks, frame_df, _ = frame_result
+    frame_rows = {(source, row): position for position, (source, row) in enumerate(zip(frame_df['_source'], frame_df['_row']))}
+    reference_rows = dict(zip(reference_df[key_col], range(len(reference_df))))
+    first = candidates_df['query_position'].map(lambda position: frame_rows.get(('query', position)))
+    second = candidates_df['key'].map(lambda key: frame_rows.get(('reference', reference_rows.get(key))))
+    usable = first.notna() & second.notna()
+    result_df = candidates_df[usable].reset_index(drop=True)
+    counts = pair_counts(masks, first[usable].astype(int), second[usable].astype(int), ambiguity)
+    result_df['tn93_distance'] = tn93_distance(counts)
+    result_df['p_distance'] = p_distance(counts)
+    result_df['overlap'] = np.rint(counts.sum(axis=(0, 1))).astype(int)
+    keep = result_df['overlap'] >= min_overlap
+    if threshold is not None:
+        keep &= result_df['tn93_distance'] <= threshold
+    return result_df[keep].reset_index(drop=True)
+
+
+def find_close_historical_sequences(index, database, user, password, host, port, new_df, table_name='seq',
+                                    seq_col='extracted_pol_query_seq_cleaned', threshold=DEFAULT_DISTANCE_THRESHOLD,
+                                    ambiguity='resolve', min_overlap=DEFAULT_MIN_OVERLAP):
+    """
+    Finds the historical sequences within threshold of each new sequence: candidates from the
+    index, then exact distances against the typing alignments of the candidates only.
+
+    Parameters:
+    - index (MinHashLSHIndex): Index of table_name.
+    - database, user, password, host, port: Connection parameters of the PostgreSQL database.
+    - new_df (DataFrame): New rows with seq_col and their typing alignment columns.
+    - table_name, seq_col: Indexed table and sequence column.
+    - threshold, ambiguity, min_overlap: See candidate_distances.
+
+    Returns:
+    - DataFrame or str: One row per close pair ('query_position', 'key' = the historical id,
+      'shared_bands', 'tn93_distance', 'p_distance', 'overlap'), or an error message.
+    """
+    candidates_df = index.query(new_df[seq_col].tolist())
+    if candidates_df.empty:
+        return candidates_df
+    try:
+        with psycopg2.connect(database=database, user=user, password=password, host=host, port=port) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT id, extracted_pol_ref_seq, extracted_pol_query_seq FROM {table_name} "
+                               f"WHERE id = ANY(%s)", (candidates_df['key'].unique().tolist(),))
+                increment('db_round_trips', operation='lsh_candidates', table=table_name)
+                reference_df = pd.DataFrame(cursor.fetchall(), columns=[desc[0] for desc in cursor.description])
+    except psycopg2.Error as e:
+        return f"Error reading the candidate sequences: {e}"
+    return candidate_distances(new_df.reset_index(drop=True), reference_df, candidates_df, 'id', threshold, ambiguity,
+                               min_overlap)
+
+
+def recall_check(index, query_df, reference_df, key_col='id', seq_col='extracted_pol_query_seq_cleaned',
+                 threshold=DEFAULT_DISTANCE_THRESHOLD, ambiguity='resolve', min_overlap=DEFAULT_MIN_OVERLAP,
+                 sample_size=100, seed=0, block_size=2048):
+    """
+    Measures the recall of the index against brute force: for a sample of query_df, the pairs
+    within threshold among all of reference_df, and how many of them the index returns.
+
+    Parameters:
+    - index (MinHashLSHIndex): Index holding reference_df under key_col.
+    - query_df (DataFrame): Rows to query, with seq_col and their typing alignment columns.
+    - reference_df (DataFrame): The indexed rows, with key_col and their typing alignment columns.
+    - threshold, ambiguity, min_overlap: See candidate_distances.
+    - sample_size (int): Query rows checked.
+    - seed (int): Seed of the sample.
+    - block_size (int): Reference rows compared at once.
+
+    Returns:
+    - dict or str: 'queries', 'true_pairs', 'found_pairs', 'recall' (1.0 if there are no true
+      pairs), 'candidates_per_query' and 'candidate_fraction' (share of reference_df each query
+      has to compare exactly); or an error message.
+    """
+    sample_df = query_df.sample(n=min(sample_size, len(query_df)), random_state=seed).reset_index(drop=True)
+    combined_df = pd.concat([sample_df.assign(_source='query', _row=range(len(sample_df))),
+                             reference_df.assign(_source='reference', _row=range(len(reference_df)))],
+                            ignore_index=True)
+    frame_result = hxb2_frame_matrix(combined_df)
+    if isinstance(frame_result, str):
+        return frame_result
+    masks, frame_df, _ = frame_result
+    is_query = (frame_df['_source'] == 'query').to_numpy()
+    query_positions = frame_df.loc[is_query, '_row'].to_numpy()
+    reference_keys = reference_df[key_col].to_numpy()[frame_df.loc[~is_query, '_row'].to_numpy()]
+    query_masks, reference_masks = masks[is_query], masks[~is_query]
+
+    true_pairs = []
+    for start in range(0, len(reference_masks), block_size):
+        counts = cross_pair_counts(query_masks, reference_masks[start:start + block_size], ambiguity)
+        total = counts.sum(axis=(0, 1))
+        mismatches = total - (counts[0, 0] + counts[1, 1] + counts[2, 2] + counts[3, 3])
+        rows, cols = np.nonzero((total >= min_overlap) & (mismatches <= threshold * total))
+        keep = tn93_distance(counts[:, :, rows, cols]) <= threshold
+        true_pairs.append(pd.DataFrame({'query_position': query_positions[rows[keep]],
+                                        'key': reference_keys[start + cols[keep]]}))
+    true_df = pd.concat(true_pairs, ignore_index=True) if true_pairs else pd.DataFrame(columns=['query_position', 'key'])
+    candidates_df = index.query(sample_df[seq_col].tolist())
+    found = true_df.merge(candidates_df, on=['query_position', 'key'], how='inner')
+    return {'queries': len(sample_df),
+            'true_pairs': len(true_df),
+            'found_pairs': len(found),
+            'recall': len(found) / len(true_df) if len(true_df) else 1.0,
+            'candidates_per_query': len(candidates_df) / max(len(sample_df), 1),
+            'candidate_fraction': len(candidates_df) / max(len(sample_df) * len(reference_df), 1)}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Sync, query and check the MinHash/LSH index of the seq table.")
+    parser.add_argument('--database', required=True)
+    parser.add_argument('--user', required=True)
+    parser.add_argument('--password', default='')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default='5432')
+    parser.add_argument('--index-dir', required=True, help="Directory of the index (created on the first sync).")
+    parser.add_argument('--table', default='seq')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_DISTANCE_THRESHOLD)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('sync', help="Add the new rows of the table to the index.")
+    query_parser = subparsers.add_parser('query', help="Find the historical sequences close to new rows.")
+    query_parser.add_argument('new_rows', help="CSV/TSV with extracted_pol_query_seq_cleaned and the typing "
+                                               "alignment columns (extracted_pol_ref_seq, extracted_pol_query_seq).")
+    query_parser.add_argument('--output', help="Write the close pairs to this CSV file.")
+    recall_parser = subparsers.add_parser('recall', help="Compare the index with a brute-force search of the table.")
+    recall_parser.add_argument('--sample-size', type=int, default=100)
+    recall_parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args(args)
+    connection = (options.database, options.user, options.password, options.host, options.port)
+
+    index = MinHashLSHIndex(options.index_dir)
+    added = sync_index_with_database(index, *connection, table_name=options.table)
+    if isinstance(added, str):
+        print(added)
+        return 1
+    print(f"Index {options.index_dir}: {added} sequences added, {len(index)} indexed")
+
+    if options.command == 'query':
+        new_df = pd.read_csv(options.new_rows, sep=None, engine='python', keep_default_na=False)
+        pairs_df = find_close_historical_sequences(index, *connection, new_df, table_name=options.table,
+                                                   threshold=options.threshold)
+        if isinstance(pairs_df, str):
+            print(pairs_df)
+            return 1
+        print(f"{len(pairs_df)} close pairs for {pairs_df['query_position'].nunique() if len(pairs_df) else 0} "
+              f"of {len(new_df)} new sequences")
+        if options.output:
+            pairs_df.to_csv(options.output, index=False)
+
+    elif options.command == 'recall':
+        reference_df = extract_table(*connection, options.table)
+        if isinstance(reference_df, str):
+            print(reference_df)
+            return 1
+        reference_df = reference_df[reference_df['extracted_pol_query_seq_cleaned'].notna()]
+        # Sampled rows are left out of the brute-force side, so a sequence does not count as its own pair
+        sample_df = reference_df.sample(n=min(options.sample_size, len(reference_df)), random_state=options.seed)
+        recall = recall_check(index, sample_df, reference_df.drop(sample_df.index), threshold=options.threshold,
+                              sample_size=len(sample_df), seed=options.seed)
+        print(recall)
+        if isinstance(recall, str):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,123 @@
+import os
+import time
+import signal
 import subprocess
 import logging
+import tempfile
+from run_metrics import observe, increment
+from profiling_hooks import profiled
 
-def perform_mafft_alignment(ref_seq, query_seq, mafft_executable):
+# MAFFT options for each alignment strategy
+MAFFT_STRATEGY_OPTIONS = {
+    # Let MAFFT pick; for two sequences this is usually the slow L-INS-i mode
+    'auto': ["--auto"],
+    # FFT-NS-2: fast progressive alignment, no refinement
+    'progressive': ["--retree", "2", "--maxiterate", "0"],
+    # L-INS-i: iterative refinement with local pairwise scores
+    'iterative': ["--localpair", "--maxiterate", "1000"],
+}
+
+
+class MafftError(RuntimeError):
+    """
+    MAFFT failed on an input.
+
+    Attributes:
+        stderr (str): What MAFFT wrote to stderr.
+        returncode (int or None): MAFFT's exit status (negative if killed by a signal).
+        transient (bool): True for failures a retry may fix (timeouts, killed processes).
+    """
+
+    def __init__(self, message, stderr='', returncode=None, transient=False):
+        super().__init__(message)
+        self.stderr = stderr
+        self.returncode = returncode
+        self.transient = transient
+
+
+def run_mafft(mafft_command, input_data=None, timeout=None):
+    """
+    Run a MAFFT command.
+
+    Args:
+        mafft_command (list): The command.
+        input_data (str, optional): Text written to MAFFT's stdin.
+        timeout (float, optional): Seconds after which MAFFT is killed; None waits indefinitely.
+
+    Returns:
+        str: MAFFT's stdout.
+
+    Raises:
+        MafftError: If MAFFT times out or exits with an error.
+    """
+    start = time.perf_counter()
+    # MAFFT is a shell script; its own session lets a timeout kill the whole process group
+    process = subprocess.Popen(mafft_command, stdin=subprocess.PIPE if input_data is not None else subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                               start_new_session=os.name == 'posix')
+    try:
+        stdout, stderr = process.communicate(input_data, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        if os.name == 'posix':
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+        _, stderr = process.communicate()
+        increment('mafft_calls', status='timeout')
+        raise MafftError(f"MAFFT timed out after {timeout}s", stderr or '', None, transient=True)
+    observe('mafft_call_seconds', time.perf_counter() - start)
+    increment('mafft_calls', status='ok' if process.returncode == 0 else 'error')
+    if process.returncode != 0:
+        # A negative return code means MAFFT was killed (e.g. out of memory), which may not happen again
+        raise MafftError("Error running MAFFT: " + stderr, stderr, process.returncode,
+                         transient=process.returncode < 0)
+    return stdout
+
+
+def mafft_thread_options(threads=None):
+    """Return the --thread option for a thread budget (None for MAFFT's default)."""
+    return ["--thread", str(threads)] if threads else []
+
+
+def pairwise_alignment_command(mafft_executable, strategy='auto', threads=None):
+    """
+    Build the MAFFT command aligning the two sequences of a FASTA text read from stdin,
+    with threads as MAFFT's --thread option.
+
+    Raises:
+        ValueError: If the strategy is not a key of MAFFT_STRATEGY_OPTIONS.
+    """
+    if strategy not in MAFFT_STRATEGY_OPTIONS:
+        raise ValueError(f"Unknown MAFFT strategy: {strategy}")
+    return [mafft_executable, *MAFFT_STRATEGY_OPTIONS[strategy], *mafft_thread_options(threads), "--text", "--quiet", "-"]
+
+
+def parse_pairwise_alignment_output(stdout):
+    """
+    Extract the aligned '>reference' and '>query' sequences from MAFFT output.
+
+    Raises:
+        MafftError: If either sequence is missing from the output.
+    """
+    aligned_output = stdout.strip().split('\n')
+
+    # Check for errors in parsing MAFFT output
+    if '>reference' not in aligned_output or '>query' not in aligned_output:
+        raise MafftError("Error parsing MAFFT output.")
+
+    # Extract aligned sequences
+    aligned_ref_seq_index = aligned_output.index('>reference')
+    aligned_query_seq_index = aligned_output.index('>query')
+
+    aligned_ref_seq = ''.join(aligned_output[aligned_ref_seq_index + 1:aligned_query_seq_index])
+    aligned_query_seq = ''.join(aligned_output[aligned_query_seq_index + 1:])
+
+    return aligned_ref_seq, aligned_query_seq
+
+
+@profiled
+def perform_mafft_alignment(ref_seq, query_seq, mafft_executable, strategy='auto', raise_errors=False, threads=None,
+                            timeout=None):
     """
     Perform sequence alignment using MAFFT.
 
@@ -9,6 +125,11 @@ def perform_mafft_alignment(ref_seq, query_seq, mafft_executable):
         ref_seq (str): The reference sequence.
         query_seq (str): The query sequence.
         mafft_executable (str): Path to the MAFFT executable.
+        strategy (str): Key of MAFFT_STRATEGY_OPTIONS ('auto', 'progressive' or 'iterative').
+        raise_errors (bool): Raise the error (MafftError for MAFFT failures, with its stderr)
+            instead of returning an error message.
+        threads (int, optional): MAFFT's --thread option (None for MAFFT's default).
+        timeout (float, optional): Seconds after which MAFFT is killed (None for no timeout).
 
     Returns:
         Tuple[str, str] or str: Aligned reference and query sequences, or an error message.
@@ -19,35 +140,111 @@ def perform_mafft_alignment(ref_seq, query_seq, mafft_executable):
             raise ValueError("Invalid input sequences")
 
         # MAFFT command and input data
-        mafft_command = [mafft_executable, "--auto", "--text", "--quiet", "-"]
+        mafft_command = pairwise_alignment_command(mafft_executable, strategy, threads)
         input_data = f">reference\n{ref_seq}\n>query\n{query_seq}"
 
-        # Run MAFFT and capture output
-        process = subprocess.run(mafft_command, input=input_data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        # Run MAFFT and capture output (raises MafftError on errors in MAFFT execution)
+        stdout = run_mafft(mafft_command, input_data, timeout)
+
+        return parse_pairwise_alignment_output(stdout)
+
+    except Exception as e:
+        if raise_errors:
+            raise
+        # Log the exception for debugging purposes
+        logging.error(f"An error occurred: {str(e)}")
+        # Provide a generic error message
+        return "An unexpected error occurred during sequence alignment."
+
 
-        # Check for errors in MAFFT execution
-        if process.returncode != 0:
-            raise RuntimeError("Error running MAFFT: " + process.stderr)
 
-        # Parse MAFFT output
-        aligned_output = process.stdout.strip().split('\n')
+def parse_fasta_text(fasta_text):
+    """
+    Parse FASTA text (e.g. MAFFT output) into an ordered list of (name, sequence) tuples.
 
-        # Check for errors in parsing MAFFT output
-        if '>reference' not in aligned_output or '>query' not in aligned_output:
-            raise RuntimeError("Error parsing MAFFT output.")
+    Args:
+        fasta_text (str): FASTA formatted text.
 
-        # Extract aligned sequences
-        aligned_ref_seq_index = aligned_output.index('>reference')
-        aligned_query_seq_index = aligned_output.index('>query')
+    Returns:
+        list: (name, sequence) tuples in file order.
+    """
+    records = []
+    for line in fasta_text.strip().split('\n'):
+        line = line.strip()
+        if line.startswith('>'):
+            records.append([line[1:], []])
+        elif line and records:
+            records[-1][1].append(line)
+    return [(name, ''.join(chunks)) for name, chunks in records]
 
-        aligned_ref_seq = ''.join(aligned_output[aligned_ref_seq_index + 1:aligned_query_seq_index])
-        aligned_query_seq = ''.join(aligned_output[aligned_query_seq_index + 1:])
 
-        return aligned_ref_seq, aligned_query_seq
+def perform_mafft_msa(named_seqs, mafft_executable, threads=None, timeout=None):
+    """
+    Perform a multiple sequence alignment of several sequences using MAFFT.
+
+    Args:
+        named_seqs (list): (name, sequence) tuples to align.
+        mafft_executable (str): Path to the MAFFT executable.
+        threads, timeout: As in perform_mafft_alignment.
+
+    Returns:
+        list or str: (name, aligned sequence) tuples in input order, or an error message.
+    """
+    try:
+        if len(named_seqs) < 2 or any(not seq for _, seq in named_seqs):
+            raise ValueError("Invalid input sequences")
+
+        # Use positional names so MAFFT never has to deal with arbitrary headers
+        mafft_command = [mafft_executable, "--auto", *mafft_thread_options(threads), "--text", "--quiet", "-"]
+        input_data = '\n'.join(f">s{i}\n{seq}" for i, (_, seq) in enumerate(named_seqs))
+        aligned = dict(parse_fasta_text(run_mafft(mafft_command, input_data, timeout)))
+        if len(aligned) != len(named_seqs):
+            raise MafftError("Error parsing MAFFT output.")
+        return [(name, aligned[f"s{i}"]) for i, (name, _) in enumerate(named_seqs)]
 
     except Exception as e:
-        # Log the exception for debugging purposes
         logging.error(f"An error occurred: {str(e)}")
-        # Provide a generic error message
-        return "An unexpected error occurred during sequence alignment."
+        return "An unexpected error occurred during multiple sequence alignment."
+
+
+def perform_mafft_profile_addition(aligned_seqs, query_seq, mafft_executable, raise_errors=False, threads=None,
+                                   timeout=None):
+    """
+    Add a query sequence to an existing alignment using 'mafft --add'.
 
+    Args:
+        aligned_seqs (list): (name, aligned sequence) tuples of the existing alignment.
+        query_seq (str): The query sequence.
+        mafft_executable (str): Path to the MAFFT executable.
+        raise_errors (bool): Raise the error instead of returning an error message.
+        threads, timeout: As in perform_mafft_alignment.
+
+    Returns:
+        Tuple[list, str] or str: The (name, aligned sequence) tuples of the existing alignment
+        (gaps may be inserted for query insertions) and the aligned query, or an error message.
+    """
+    try:
+        if not aligned_seqs or not query_seq:
+            raise ValueError("Invalid input sequences")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            msa_path = os.path.join(tmp_dir, "reference.fasta")
+            query_path = os.path.join(tmp_dir, "query.fasta")
+            with open(msa_path, 'w') as f:
+                f.write('\n'.join(f">s{i}\n{seq}" for i, (_, seq) in enumerate(aligned_seqs)))
+            with open(query_path, 'w') as f:
+                f.write(f">query\n{query_seq}\n")
+
+            mafft_command = [mafft_executable, "--add", query_path, *mafft_thread_options(threads), "--text", "--quiet", msa_path]
+            stdout = run_mafft(mafft_command, timeout=timeout)
+
+        aligned = dict(parse_fasta_text(stdout))
+        if 'query' not in aligned or len(aligned) != len(aligned_seqs) + 1:
+            raise MafftError("Error parsing MAFFT output.")
+        return [(name, aligned[f"s{i}"]) for i, (name, _) in enumerate(aligned_seqs)], aligned['query']
+
+    except Exception as e:
+        if raise_errors:
+            raise
+        logging.error(f"An error occurred: {str(e)}")
+        return "An unexpected error occurred during profile alignment."
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Deterministic, fast stand-in for the MAFFT executable, for load tests and benchmarks.
+
+It accepts the command lines that mafft_caller builds, so its path can be given wherever a
+MAFFT executable is expected:
+
+    mafft_stand_in.py [strategy options] [--thread N] --text --quiet -          (FASTA on stdin)
+    mafft_stand_in.py --add query.fasta [--keeplength] --text --quiet msa.fasta
+
+Every sequence after the first (or every --add sequence) is placed against the first sequence
+(or, with --add, the column consensus of the existing alignment) by chaining exact k-mer
+matches, scored so that a change of diagonal (a gap) costs more than a mismatch. Spans between
+matches on different diagonals are chained again with shorter k-mers, and the bases between
+matches are aligned ungapped on either side of one gap placed where most bases match. Query
+insertions become gap columns in all other rows.
+This is not a real aligner; it gives alignments of the right shape and roughly the right
+identity at a cost linear in the sequence length, and identical output for identical input.
+
+Setting HIV_PIPELINE_MAFFT_STAND_IN_SECONDS_PER_MCELL adds a sleep of that many seconds per
+million alignment cells (query length x reference length), to mimic the cost profile of MAFFT
+when benchmarking scheduling.
+"""
+
+import os
+import sys
+import time
+from collections import Counter
+
+# Strategy options are accepted and ignored; the value is the number of arguments they take
+IGNORED_OPTIONS = {'--auto': 0, '--localpair': 0, '--globalpair': 0, '--genafpair': 0, '--6merge': 0,
+                   '--nuc': 0, '--text': 0, '--quiet': 0, '--reorder': 0, '--inputorder': 0,
+                   '--retree': 1, '--maxiterate': 1, '--thread': 1, '--op': 1, '--ep': 1}
+ANCHOR_KMER_SIZES = (12, 8)
+# Chain scores: one per base of an anchor, minus the gap penalties for a change of diagonal.
+# Bases between anchors (mostly matches, some mismatches) score nothing, so a mismatch is
+# always preferred over a gap, and a long stretch with few exact k-mers does not cost the
+# chain its anchors. The extension penalty is small, like MAFFT's (--ep 0.123 to --op 1.53),
+# so the anchors past a long indel are kept.
+GAP_OPEN_PENALTY = 6
+GAP_EXTEND_PENALTY = 0.1
+CHAIN_LOOKBACK = 32
+LINE_WIDTH = 60
+
+
+def read_fasta(text):
+    records = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('>'):
+            records.append([line[1:], []])
+        elif line and records:
+            records[-1][1].append(line)
+    return [(name, ''.join(chunks).lower()) for name, chunks in records]
+
+
+def kmer_anchors(query, ref, k, max_hits=4):
+    """Returns (query_pos, ref_pos) of exact k-mer matches, skipping k-mers repeated in ref."""
+    index = {}
+    for i in range(len(ref) - k + 1):
+        index.setdefault(ref[i:i + k], []).append(i)
+    anchors = []
+    for i in range(len(query) - k + 1):
+        hits = index.get(query[i:i + k])
+        if hits and len(hits) <= max_hits:
+            anchors.extend((i, j) for j in hits)
+    return anchors
+
+
+def link_score(previous, anchor, k):
+    """
+    Score of following anchor `previous` by `anchor` in a chain: the bases `anchor` adds,
+    minus GAP_OPEN_PENALTY + GAP_EXTEND_PENALTY per gap position if they are on different
+    diagonals.
+    """
+    (previous_query, previous_ref), (query_pos, ref_pos) = previous, anchor
+    added = k - max(0, previous_query + k - query_pos, previous_ref + k - ref_pos)
+    shift = abs((ref_pos - query_pos) - (previous_ref - previous_query))
+    return added - (GAP_OPEN_PENALTY + GAP_EXTEND_PENALTY * shift if shift else 0)
+
+
+def chain_anchors(anchors, k):
+    """
+    Highest-scoring chain of anchors increasing in both query and reference position (see
+    link_score), expanded to base-level matches (query_pos, ref_pos).
+
+    An anchor overlapping the previous anchor of its diagonal extends it; any other anchor is
+    linked to the best of that anchor and the CHAIN_LOOKBACK anchors before it.
+    """
+    anchors = sorted(set(anchors))
+    scores, previous, last_on_diagonal = [], [], {}
+    for n, (query_pos, ref_pos) in enumerate(anchors):
+        diagonal = ref_pos - query_pos
+        same_diagonal = last_on_diagonal.get(diagonal)
+        if same_diagonal is not None and query_pos - anchors[same_diagonal][0] <= k:
+            candidates = [same_diagonal]
+        else:
+            candidates = range(max(n - CHAIN_LOOKBACK, 0), n)
+            if same_diagonal is not None:
+                candidates = [*candidates, same_diagonal]
+        best_score, best_previous = k, -1
+        for m in candidates:
+            if anchors[m][0] < query_pos and anchors[m][1] < ref_pos:
+                score = scores[m] + link_score(anchors[m], anchors[n], k)
+                if score > best_score:
+                    best_score, best_previous = score, m
+        scores.append(best_score)
+        previous.append(best_previous)
+        last_on_diagonal[diagonal] = n
+
+    chain, n = [], max(range(len(anchors)), key=scores.__getitem__) if anchors else -1
+    while n >= 0:
+        chain.append(anchors[n])
+        n = previous[n]
+    chain.reverse()
+
+    matches = []
+    for query_pos, ref_pos in chain:
+        for offset in range(k):
+            if not matches or (query_pos + offset > matches[-1][0] and ref_pos + offset > matches[-1][1]):
+                matches.append((query_pos + offset, ref_pos + offset))
+    return matches
+
+
+def place_query(query, ref):
+    """
+    Places query against ref.
+
+    Returns:
+    - tuple: (columns, insertions) where columns[i] is the query character aligned to ref
+      column i ('-' for none) and insertions[i] the query bases inserted before column i
+      (len(ref) + 1 entries).
+    """
+    matches = []
+    for k in ANCHOR_KMER_SIZES:
+        anchors = kmer_anchors(query, ref, k)
+        if k != ANCHOR_KMER_SIZES[0] and anchors:
+            # Short k-mers collide by chance; keep the hits near the dominant diagonal
+            diagonal = Counter(ref_pos - query_pos for query_pos, ref_pos in anchors).most_common(1)[0][0]
+            anchors = [anchor for anchor in anchors if abs(anchor[1] - anchor[0] - diagonal) <= 50]
+        matches = chain_anchors(anchors, k)
+        if len(matches) >= 2 * k:
+            break
+    matches = refine_indel_spans(query, ref, matches)
+    if not matches:
+        # No shared k-mers: ungapped placement at the start
+        matches = [(i, i) for i in range(min(len(query), len(ref)))]
+
+    columns, insertions = ['-'] * len(ref), [''] * (len(ref) + 1)
+    first_query, first_ref = matches[0]
+    lead = min(first_query, first_ref)
+    insertions[first_ref - lead] = query[:first_query - lead]
+    for i in range(lead):
+        columns[first_ref - lead + i] = query[first_query - lead + i]
+
+    last = len(matches) - 1
+    for n, ((query_pos, ref_pos), (next_query, next_ref)) in enumerate(zip(matches, matches[1:] + [(len(query), len(ref))])):
+        columns[ref_pos] = query[query_pos]
+        query_gap, ref_gap = next_query - query_pos - 1, next_ref - ref_pos - 1
+        shared = min(query_gap, ref_gap)
+        # Bases before the gap follow this match, the ones after it lead up to the next match
+        left = shared if n == last or query_gap == ref_gap else gap_split(query, ref, query_pos + 1, ref_pos + 1,
+                                                                         next_query, next_ref)
+        right = shared - left
+        for i in range(left):
+            columns[ref_pos + 1 + i] = query[query_pos + 1 + i]
+        for i in range(1, right + 1):
+            columns[next_ref - i] = query[next_query - i]
+        if query_gap > shared:
+            insertions[ref_pos + 1 + left] += query[query_pos + 1 + left:next_query - right]
+    return columns, insertions
+
+
+def refine_indel_spans(query, ref, matches, k=ANCHOR_KMER_SIZES[-1]):
+    """
+    Adds matches between consecutive matches on different diagonals, chained from the shorter
+    k-mers of the bases between them, so indels close together are placed one by one.
+    """
+    refined = matches[:1]
+    for (query_pos, ref_pos), (next_query, next_ref) in zip(matches, matches[1:]):
+        if next_ref - next_query != ref_pos - query_pos and min(next_query - query_pos, next_ref - ref_pos) > k:
+            span_matches = chain_anchors(kmer_anchors(query[query_pos + 1:next_query], ref[ref_pos + 1:next_ref], k), k)
+            refined.extend((query_pos + 1 + span_query, ref_pos + 1 + span_ref) for span_query, span_ref in span_matches)
+        refined.append((next_query, next_ref))
+    return refined
+
+
+def gap_split(query, ref, query_start, ref_start, query_end, ref_end):
+    """
+    Where to put the gap between two matches: the number of bases aligned on the diagonal of
+    the first match before it (the rest are aligned on the diagonal of the second), chosen to
+    match the most bases, the latest on ties.
+    """
+    shared = min(query_end - query_start, ref_end - ref_start)
+    left_matches = [0]
+    for i in range(shared):
+        left_matches.append(left_matches[-1] + (query[query_start + i] == ref[ref_start + i]))
+    right_matches = [0]
+    for i in range(1, shared + 1):
+        right_matches.append(right_matches[-1] + (query[query_end - i] == ref[ref_end - i]))
+    return max(range(shared + 1), key=lambda left: (left_matches[left] + right_matches[shared - left], left))
+
+
+def column_consensus(aligned_rows):
+    """Most common non-gap character of each column (ties broken alphabetically)."""
+    consensus = []
+    for column in zip(*aligned_rows):
+        counts = Counter(char for char in column if char != '-')
+        consensus.append(min(counts, key=lambda char: (-counts[char], char)) if counts else 'n')
+    return ''.join(consensus)
+
+
+def merge_placements(fixed_rows, placements, keeplength=False):
+    """
+    Renders the fixed rows and the placed queries as one alignment, opening gap columns in
+    the fixed rows for query insertions (or dropping the insertions with keeplength).
+    """
+    width = len(fixed_rows[0][1])
+    widest = [0] * (width + 1) if keeplength else [max(len(insertions[i]) for _, (_, insertions) in placements)
+                                                  for i in range(width + 1)]
+    rendered = []
+    for name, row in fixed_rows:
+        rendered.append((name, ''.join('-' * widest[i] + row[i] for i in range(width)) + '-' * widest[width]))
+    for name, (columns, insertions) in placements:
+        parts = []
+        for i in range(width + 1):
+            if widest[i]:
+                parts.append(insertions[i].ljust(widest[i], '-'))
+            if i < width:
+                parts.append(columns[i])
+        rendered.append((name, ''.join(parts)))
+    return rendered
+
+
+def parse_arguments(args):
+    options = {'add': None, 'keeplength': False, 'input': None}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '--add':
+            options['add'] = args[i + 1]
+            i += 2
+        elif arg == '--keeplength':
+            options['keeplength'] = True
+            i += 1
+        elif arg in IGNORED_OPTIONS:
+            i += 1 + IGNORED_OPTIONS[arg]
+        elif arg.startswith('--'):
+            raise ValueError(f"Unknown option: {arg}")
+        else:
+            options['input'] = arg
+            i += 1
+    if options['input'] is None:
+        raise ValueError("No input file given")
+    return options
+
+
+def main(args=None):
+    try:
+        options = parse_arguments(sys.argv[1:] if args is None else args)
+        if options['input'] == '-':
+            records = read_fasta(sys.stdin.read())
+        else:
+            with open(options['input']) as f:
+                records = read_fasta(f.read())
+        if options['add']:
+            with open(options['add']) as f:
+                queries = read_fasta(f.read())
+            fixed_rows = records
+            anchor = column_consensus([row for _, row in records])
+        else:
+            fixed_rows, queries = records[:1], records[1:]
+            anchor = records[0][1] if records else ''
+        if not fixed_rows or not anchor or any(not seq for _, seq in queries):
+            raise ValueError("Invalid input sequences")
+        if fixed_rows and len({len(row) for _, row in fixed_rows}) > 1:
+            raise ValueError("Sequences in the existing alignment differ in length")
+    except (ValueError, IndexError, OSError) as e:
+        sys.stderr.write(f"mafft_stand_in: {e}\n")
+        return 1
+
+    placements = [(name, place_query(seq.replace('-', ''), anchor)) for name, seq in queries]
+    seconds_per_mcell = float(os.environ.get('HIV_PIPELINE_MAFFT_STAND_IN_SECONDS_PER_MCELL', '0') or 0)
+    if seconds_per_mcell:
+        time.sleep(seconds_per_mcell * len(anchor) * sum(len(seq) for _, seq in queries) / 1e6)
+
+    output = []
+    for name, seq in merge_placements(fixed_rows, placements, options['keeplength']):
+        output.append(f">{name}")
+        output.extend(seq[i:i + LINE_WIDTH] for i in range(0, len(seq), LINE_WIDTH))
+    sys.stdout.write('\n'.join(output) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""
+Calibration of the MAFFT alignment strategies.
+
+Runs typing and subtyping on a sample of sequences once per strategy and reports how often
+the calls disagree and how much time each strategy takes, so the default strategy can be
+chosen on numbers.
+
+Usage:
+    python mafft_strategy_calibrator.py --query-file seqs.csv --type-ref-file hiv_type_ref_seq.csv \
+        --subtype-ref-file hiv_subtype_con_ref_seq.csv --mafft /path/to/mafft --sample-size 200
+"""
+
+import sys
+import argparse
+import time
+from functools import partial
+import pandas as pd
+import config_paths  # config/general modules, when run as a script
+from qc import process_sequences, categorize_hiv_typing
+from hiv_typing_alignment_worker import perform_hiv_typing
+from hiv_subtyping_alignment_worker import perform_hiv_subtyping
+from parallel_alignment_processor import process_sequence_alignment_isolated
+
+
+def _reduce_calls(df, call_col, similarity_col):
+    """One call and one similarity per sampled row (aggregated duplicates hold lists)."""
+    reduced = df[['calibration_row']].copy()
+    reduced[call_col] = df[call_col].apply(lambda x: '/'.join(sorted(map(str, set(x)))) if isinstance(x, list) else x)
+    reduced[similarity_col] = df[similarity_col].apply(lambda x: max(x) if isinstance(x, list) else x)
+    return reduced.drop_duplicates('calibration_row')
+
+
+def _discordance(results, baseline, call_col, similarity_col):
+    """Per-strategy discordance of call_col against the baseline strategy."""
+    baseline_df = _reduce_calls(results[baseline], call_col, similarity_col)
+    rows = {}
+    for strategy, result_df in results.items():
+        merged = baseline_df.merge(_reduce_calls(result_df, call_col, similarity_col),
+                                   on='calibration_row', suffixes=('_baseline', ''))
+        discordant = merged[f'{call_col}_baseline'].astype(str) != merged[call_col].astype(str)
+        delta = (merged[similarity_col] - merged[f'{similarity_col}_baseline']).abs()
+        rows[strategy] = {'compared_rows': len(merged),
+                          'discordant_rows': int(discordant.sum()),
+                          'discordance_percentage': round(discordant.mean() * 100, 2) if len(merged) else 0.0,
+                          'mean_abs_similarity_delta': round(delta.mean(), 3) if len(merged) else 0.0}
+    return rows
+
+
+def calibrate_mafft_strategies(query_df, hiv_type_ref_seq_df, hiv_subtype_con_ref_seq_df, mafft_executable,
+                               sample_size=100, strategies=('iterative', 'progressive'), random_state=0):
+    """
+    Runs typing and subtyping on a sample with each MAFFT strategy and compares the results.
+
+    The first strategy is the baseline. Subtyping is run on the HIV-1 rows of the baseline
+    typing so every strategy subtypes the same sequences. Rows whose alignment fails are
+    retried and quarantined as in process_sequence_alignment_isolated; they are left out of
+    the comparison and counted in 'quarantined_rows'.
+
+    Args:
+        query_df (pandas.DataFrame): Post-QC sequences (with 'seq_cleaned').
+        hiv_type_ref_seq_df (pandas.DataFrame): hiv_type_ref_seq table.
+        hiv_subtype_con_ref_seq_df (pandas.DataFrame): hiv_subtype_con_ref_seq table.
+        mafft_executable (str): Path to the MAFFT executable.
+        sample_size (int): Number of sequences to sample.
+        strategies (tuple): MAFFT strategies to compare, baseline first.
+        random_state (int): Seed of the sample.
+
+    Returns:
+        pandas.DataFrame or str: One row per stage and strategy with 'seconds', 'time_saved_percentage'
+        (against the baseline), 'quarantined_rows', 'discordant_rows', 'discordance_percentage' and
+        'mean_abs_similarity_delta', or an error message.
+    """
+    sample_df = query_df.sample(n=min(sample_size, len(query_df)), random_state=random_state).copy()
+    sample_df['calibration_row'] = range(len(sample_df))
+    baseline = strategies[0]
+
+    def run(stage, query_df, ref_seq_df, query_seq_col_name, worker_func, results, seconds, quarantined):
+        for strategy in strategies:
+            start = time.perf_counter()
+            result = process_sequence_alignment_isolated(query_df, ref_seq_df, query_seq_col_name,
+                                                         partial(worker_func, mafft_strategy=strategy), mafft_executable)
+            if isinstance(result, str):
+                return f"Error in {stage} with the {strategy} strategy: {result}"
+            results[strategy], quarantine_df, _ = result
+            seconds[strategy] = time.perf_counter() - start
+            quarantined[strategy] = len(quarantine_df)
+            if results[strategy].empty:
+                return f"Error in {stage} with the {strategy} strategy: no row could be aligned"
+        return None
+
+    typing_results, typing_seconds, typing_quarantined = {}, {}, {}
+    error = run('typing', sample_df, hiv_type_ref_seq_df, 'seq_cleaned', perform_hiv_typing,
+                typing_results, typing_seconds, typing_quarantined)
+    if error:
+        return error
+
+    hiv1_df = categorize_hiv_typing(typing_results[baseline])['hiv1_df']
+    subtyping_results, subtyping_seconds, subtyping_quarantined = {}, {}, {}
+    if not hiv1_df.empty:
+        error = run('subtyping', hiv1_df, hiv_subtype_con_ref_seq_df, 'extracted_pol_query_seq_cleaned',
+                    perform_hiv_subtyping, subtyping_results, subtyping_seconds, subtyping_quarantined)
+        if error:
+            return error
+
+    report = []
+    for stage, results, seconds, quarantined, call_col, similarity_col in [
+            ('typing', typing_results, typing_seconds, typing_quarantined,
+             'hiv_type_lanl', 'hiv_type_similarity_percentage'),
+            ('subtyping', subtyping_results, subtyping_seconds, subtyping_quarantined,
+             'hiv1_subtype_lanl', 'hiv1_subtype_similarity_percentage')]:
+        if hiv1_df.empty and stage == 'subtyping':
+            continue
+        discordance = _discordance(results, baseline, call_col, similarity_col)
+        for strategy in strategies:
+            report.append({'stage': stage,
+                           'strategy': strategy,
+                           'seconds': round(seconds[strategy], 2),
+                           'time_saved_percentage': round((1 - seconds[strategy] / seconds[baseline]) * 100, 1) if seconds[baseline] else 0.0,
+                           'quarantined_rows': quarantined[strategy],
+                           **discordance[strategy]})
+    return pd.DataFrame(report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare MAFFT strategies on a sample of sequences.")
+    parser.add_argument('--query-file', required=True, help="CSV/TSV of sequences (raw uploads are run through QC).")
+    parser.add_argument('--type-ref-file', required=True, help="CSV/TSV export of hiv_type_ref_seq.")
+    parser.add_argument('--subtype-ref-file', required=True, help="CSV/TSV export of hiv_subtype_con_ref_seq.")
+    parser.add_argument('--mafft', required=True, help="Path to the MAFFT executable.")
+    parser.add_argument('--sample-size', type=int, default=100)
+    parser.add_argument('--strategies', default='iterative,progressive', help="Comma separated, baseline first.")
+    parser.add_argument('--output', help="Write the report to this CSV file.")
+    args = parser.parse_args()
+
+    def read_table(path):
+        return pd.read_csv(path, sep=None, engine='python', keep_default_na=False)
+
+    query_df = read_table(args.query_file)
+    if 'seq_cleaned' not in query_df.columns:
+        _, query_df = process_sequences(query_df)
+
+    report = calibrate_mafft_strategies(query_df, read_table(args.type_ref_file), read_table(args.subtype_ref_file),
+                                        args.mafft, args.sample_size, tuple(args.strategies.split(',')))
+    if isinstance(report, str):
+        print(report)
+        return 1
+    print(report.to_string(index=False))
+    if args.output:
+        report.to_csv(args.output, index=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+import re
+
+# Thresholds of the adaptive strategy. Check them with mafft_strategy_calibrator before changing.
+LARGE_BATCH_SIZE = 10000       # batches at least this large always use the progressive mode
+SMALL_BATCH_SIZE = 100         # batches smaller than this always get refinement
+AMBIGUITY_FRACTION = 0.05      # queries with at least this fraction of ambiguity codes get refinement
+SHORT_SEQ_LEN = 1000           # alignments this short are cheap enough to always refine
+
+
+def ambiguity_fraction(seq):
+    """
+    Returns the fraction of IUPAC ambiguity codes (including 'n') in a sequence, ignoring gaps.
+    """
+    residues = seq.replace('-', '')
+    if not residues:
+        return 0.0
+    return len(re.findall(r'[^acgt]', residues.lower())) / len(residues)
+
+
+def choose_mafft_strategy(ref_seq, query_seq, batch_size=1):
+    """
+    Chooses the MAFFT strategy for one pairwise alignment.
+
+    Batches of at least LARGE_BATCH_SIZE queries always use the faster progressive mode, and
+    batches smaller than SMALL_BATCH_SIZE always keep iterative refinement. In between,
+    refinement is kept for short or ambiguity-rich queries and the others go progressive. How
+    often the two modes disagree is measured by mafft_strategy_calibrator.
+
+    Parameters:
+    - ref_seq (str): The reference sequence.
+    - query_seq (str): The query sequence.
+    - batch_size (int): Number of queries in the run.
+
+    Returns:
+    - str: 'progressive' or 'iterative'.
+    """
+    if batch_size >= LARGE_BATCH_SIZE:
+        return 'progressive'
+    if batch_size < SMALL_BATCH_SIZE:
+        return 'iterative'
+    if ambiguity_fraction(query_seq) >= AMBIGUITY_FRACTION:
+        return 'iterative'
+    if max(len(ref_seq), len(query_seq)) <= SHORT_SEQ_LEN:
+        return 'iterative'
+    return 'progressive'
+
+
+def resolve_mafft_strategy(mafft_strategy, ref_seq, query_seq, batch_size=1):
+    """
+    Turns the mafft_strategy argument of the alignment workers into a MAFFT strategy name.
+
+    Parameters:
+    - mafft_strategy (str or callable): A key of MAFFT_STRATEGY_OPTIONS, 'adaptive', or a
+      function (ref_seq, query_seq) -> strategy.
+    - ref_seq (str): The reference sequence.
+    - query_seq (str): The query sequence.
+    - batch_size (int): Number of queries in the run, used by 'adaptive'.
+
+    Returns:
+    - str: The strategy to pass to perform_mafft_alignment.
+    """
+    if callable(mafft_strategy):
+        return mafft_strategy(ref_seq, query_seq)
+    if mafft_strategy == 'adaptive':
+        return choose_mafft_strategy(ref_seq, query_seq, batch_size)
+    return mafft_strategy
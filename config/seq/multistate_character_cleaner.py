@@ -7,6 +7,9 @@ Created on Tues 11/1/2023
 """
 
 import re
+from profiling_hooks import profiled
+
+@profiled
 def replacing_multistate_characters_with_n(seq_unc):
 
     #---------
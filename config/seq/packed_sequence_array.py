@@ -0,0 +1,346 @@
+"""
+Packed nucleotide storage for the working sequence tables.
+
+Sequences are stored 4 bits per symbol (15 IUPAC codes plus the gap '-') in one
+contiguous uint8 buffer, with an int64 offsets array marking where each sequence
+starts and ends. A column of 1,500 nt pol sequences costs ~750 bytes per row instead
+of ~1,550 bytes for a Python str, and there is no per-object overhead.
+
+Notes:
+- Sequences are stored lowercase, matching process_sequences.
+- Characters outside the IUPAC alphabet (stray letters, whitespace, digits) are rare,
+  so they are kept in a small side table of (position, character) pairs and restored
+  on decode. QC therefore gives the same results on packed and str columns.
+  Non-ASCII characters are stored as '?'.
+- The array registers itself with pandas as the 'packed_seq' dtype, so
+  df['seq'].astype('packed_seq') works once this module is imported.
+"""
+
+import numpy as np
+import pandas as pd
+from pandas.api.extensions import ExtensionArray, ExtensionDtype, register_extension_dtype
+
+# Code of each symbol is its index in this string
+PACKED_ALPHABET = 'acgtrymkswbdhvn-'
+N_CODE = PACKED_ALPHABET.index('n')
+
+_ENCODE_TABLE = np.full(256, N_CODE, dtype=np.uint8)
+_IN_ALPHABET = np.zeros(256, dtype=bool)
+for _code, _symbol in enumerate(PACKED_ALPHABET):
+    _ENCODE_TABLE[ord(_symbol)] = _code
+    _IN_ALPHABET[ord(_symbol)] = True
+_DECODE_TABLE = np.frombuffer(PACKED_ALPHABET.encode('ascii'), dtype=np.uint8)
+
+
+def _is_missing(value):
+    return value is None or value is pd.NA or (isinstance(value, float) and np.isnan(value))
+
+
+def _pack_codes(codes):
+    """Pack an array of 4-bit codes two per byte (high nibble first)."""
+    if len(codes) % 2:
+        codes = np.append(codes, np.uint8(0))
+    return (codes[0::2] << 4) | codes[1::2]
+
+
+def _offsets_from_lengths(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+@register_extension_dtype
+class PackedSequenceDtype(ExtensionDtype):
+    """pandas dtype for PackedSequenceArray columns."""
+    name = 'packed_seq'
+    type = str
+    kind = 'O'
+    na_value = np.nan
+
+    @classmethod
+    def construct_array_type(cls):
+        return PackedSequenceArray
+
+
+class PackedSequenceArray(ExtensionArray):
+    """
+    Array of nucleotide sequences packed 4 bits per symbol.
+
+    Parameters:
+    - packed : np.ndarray[uint8]
+        Two codes per byte, high nibble first.
+    - offsets : np.ndarray[int64]
+        len(array) + 1 symbol offsets; sequence i spans offsets[i]:offsets[i + 1].
+    - mask : np.ndarray[bool]
+        True where the value is missing.
+    - exception_pos : np.ndarray[int64]
+        Sorted buffer positions holding a character outside PACKED_ALPHABET.
+    - exception_chars : np.ndarray[uint8]
+        The original (lowercased ASCII) character at each exception position.
+    """
+
+    def __init__(self, packed, offsets, mask, exception_pos=None, exception_chars=None):
+        self._packed = packed
+        self._offsets = offsets
+        self._mask = mask
+        self._exception_pos = np.empty(0, dtype=np.int64) if exception_pos is None else exception_pos
+        self._exception_chars = np.empty(0, dtype=np.uint8) if exception_chars is None else exception_chars
+
+    # ----- construction -----
+
+    @classmethod
+    def _from_sequence(cls, scalars, *, dtype=None, copy=False):
+        if isinstance(scalars, cls):
+            return scalars.copy() if copy else scalars
+        cleaned = []
+        mask = []
+        for value in scalars:
+            missing = _is_missing(value)
+            cleaned.append('' if missing else str(value).lower())
+            mask.append(missing)
+
+        lengths = np.fromiter((len(seq) for seq in cleaned), dtype=np.int64, count=len(cleaned))
+        raw = np.frombuffer(''.join(cleaned).encode('ascii', errors='replace'), dtype=np.uint8)
+        exception_pos = np.flatnonzero(~_IN_ALPHABET[raw])
+        return cls(_pack_codes(_ENCODE_TABLE[raw]), _offsets_from_lengths(lengths), np.array(mask, dtype=bool),
+                   exception_pos, raw[exception_pos].copy())
+
+    @classmethod
+    def _from_factorized(cls, values, original):
+        return cls._from_sequence(values)
+
+    @classmethod
+    def _concat_same_type(cls, to_concat):
+        to_concat = list(to_concat)
+        if not to_concat:
+            return cls._from_sequence([])
+        shifts = np.cumsum([0] + [arr._offsets[-1] for arr in to_concat[:-1]])
+        return cls(_pack_codes(np.concatenate([arr._unpacked_codes() for arr in to_concat])),
+                   _offsets_from_lengths(np.concatenate([arr.lengths() for arr in to_concat])),
+                   np.concatenate([arr._mask for arr in to_concat]),
+                   np.concatenate([arr._exception_pos + shift for arr, shift in zip(to_concat, shifts)]),
+                   np.concatenate([arr._exception_chars for arr in to_concat]))
+
+    # ----- internals -----
+
+    def _unpacked_codes(self, start=0, stop=None):
+        """Return one code per byte for symbols start:stop of the buffer."""
+        stop = self._offsets[-1] if stop is None else stop
+        if stop <= start:
+            return np.empty(0, dtype=np.uint8)
+        byte_start, byte_stop = start // 2, (stop + 1) // 2
+        chunk = self._packed[byte_start:byte_stop]
+        codes = np.empty(2 * len(chunk), dtype=np.uint8)
+        codes[0::2] = chunk >> 4
+        codes[1::2] = chunk & 0x0F
+        return codes[start - 2 * byte_start:stop - 2 * byte_start]
+
+    def _decoded_bytes(self, start=0, stop=None):
+        """Return the ASCII bytes of symbols start:stop, exceptions restored."""
+        stop = self._offsets[-1] if stop is None else stop
+        decoded = _DECODE_TABLE[self._unpacked_codes(start, stop)]
+        if len(self._exception_pos):
+            lo, hi = np.searchsorted(self._exception_pos, [start, stop])
+            decoded[self._exception_pos[lo:hi] - start] = self._exception_chars[lo:hi]
+        return decoded
+
+    def _select(self, starts, lengths, mask):
+        """Build a new array whose sequence i is symbols starts[i]:starts[i] + lengths[i]."""
+        total = int(lengths.sum())
+        # Output position j reads buffer position starts[row] + (j - output start of row)
+        out_starts = np.cumsum(lengths) - lengths
+        source = np.repeat(starts - out_starts, lengths) + np.arange(total)
+        exception_pos = exception_chars = None
+        if len(self._exception_pos) and total:
+            hit = np.isin(source, self._exception_pos)
+            exception_pos = np.flatnonzero(hit)
+            exception_chars = self._exception_chars[np.searchsorted(self._exception_pos, source[hit])]
+        codes = self._unpacked_codes()[source] if total else np.empty(0, dtype=np.uint8)
+        return type(self)(_pack_codes(codes), _offsets_from_lengths(lengths), mask, exception_pos, exception_chars)
+
+    def _gather(self, indices):
+        """Build a new array from row positions (all assumed valid)."""
+        return self._select(self._offsets[:-1][indices], self.lengths()[indices], self._mask[indices].copy())
+
+    # ----- ExtensionArray interface -----
+
+    @property
+    def dtype(self):
+        return PackedSequenceDtype()
+
+    @property
+    def nbytes(self):
+        return (self._packed.nbytes + self._offsets.nbytes + self._mask.nbytes
+                + self._exception_pos.nbytes + self._exception_chars.nbytes)
+
+    def __len__(self):
+        return len(self._mask)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            if item < 0:
+                item += len(self)
+            if self._mask[item]:
+                return self.dtype.na_value
+            return self.decode(item)
+        if isinstance(item, slice):
+            return self._gather(np.arange(len(self))[item])
+        item = pd.api.indexers.check_array_indexer(self, item)
+        if item.dtype == bool:
+            item = np.flatnonzero(item)
+        return self._gather(item)
+
+    def __iter__(self):
+        return iter(self.to_numpy())
+
+    def __array__(self, dtype=None, copy=None):
+        return self.to_numpy(dtype=dtype)
+
+    def __eq__(self, other):
+        if isinstance(other, (pd.Series, pd.Index, pd.DataFrame)):
+            return NotImplemented
+        if isinstance(other, str):
+            # Only decode the sequences whose length already matches
+            result = (self.lengths() == len(other)) & ~self._mask
+            if other:
+                for i in np.flatnonzero(result):
+                    result[i] = self.decode(i) == other
+            return result
+        other = np.asarray(other, dtype=object)
+        return np.array([not m and a == b for a, b, m in zip(self.to_numpy(), other, self._mask)], dtype=bool)
+
+    def isna(self):
+        return self._mask.copy()
+
+    def take(self, indices, allow_fill=False, fill_value=None):
+        indices = np.asarray(indices, dtype=np.int64)
+        if allow_fill:
+            missing = indices == -1
+            if (indices < -1).any():
+                raise ValueError("Invalid take indices for PackedSequenceArray.")
+            if not missing.any():
+                return self.take(indices)
+            if fill_value is not None and not _is_missing(fill_value):
+                values = self.take(np.where(missing, 0, indices)).to_numpy() if len(self) else np.empty(len(indices), dtype=object)
+                values[missing] = fill_value
+                return self._from_sequence(values)
+            if len(self) == 0:
+                if not missing.all():
+                    raise IndexError("Cannot take from an empty PackedSequenceArray.")
+                return self._from_sequence([None] * len(indices))
+            result = self._gather(np.where(missing, 0, indices))
+            result._mask = result._mask | missing
+            return result
+        if len(indices) and (indices.max() >= len(self) or indices.min() < -len(self)):
+            raise IndexError("Index out of bounds for PackedSequenceArray.")
+        return self._gather(np.where(indices < 0, indices + len(self), indices))
+
+    def copy(self):
+        return type(self)(self._packed.copy(), self._offsets.copy(), self._mask.copy(),
+                          self._exception_pos.copy(), self._exception_chars.copy())
+
+    def astype(self, dtype, copy=True):
+        if isinstance(dtype, PackedSequenceDtype) or dtype == PackedSequenceDtype.name:
+            return self.copy() if copy else self
+        return super().astype(dtype, copy=copy)
+
+    def to_numpy(self, dtype=None, copy=False, na_value=None):
+        """Decode every sequence into an object array of str."""
+        decoded = self._decoded_bytes().tobytes().decode('ascii')
+        offsets = self._offsets
+        result = np.empty(len(self), dtype=object)
+        for i in range(len(self)):
+            result[i] = decoded[offsets[i]:offsets[i + 1]]
+        result[self._mask] = self.dtype.na_value if na_value is None else na_value
+        if dtype is not None and dtype != object:
+            result = result.astype(dtype)
+        return result
+
+    # ----- sequence operations -----
+
+    def decode(self, i):
+        """Return sequence i as a str."""
+        return self._decoded_bytes(self._offsets[i], self._offsets[i + 1]).tobytes().decode('ascii')
+
+    def lengths(self):
+        """Return the length of every sequence (0 for missing values)."""
+        return np.diff(self._offsets)
+
+    def count_symbols(self, symbols):
+        """
+        Count, per sequence, the symbols that are in `symbols` (e.g. 'n' or 'acgt').
+
+        Returns:
+        - np.ndarray[int64]
+        """
+        wanted = np.zeros(16, dtype=bool)
+        wanted[[PACKED_ALPHABET.index(symbol) for symbol in symbols.lower()]] = True
+        hits = wanted[self._unpacked_codes()]
+        # Exception characters are stored with the 'n' code but are not 'n'
+        hits[self._exception_pos] = False
+        cumulative = _offsets_from_lengths(hits)
+        return cumulative[self._offsets[1:]] - cumulative[self._offsets[:-1]]
+
+    def str_slice(self, start=None, stop=None):
+        """
+        Slice every sequence the way str slicing would (seq[start:stop]), without decoding.
+        """
+        lengths = self.lengths()
+
+        def resolve(bound, default):
+            if bound is None:
+                return default
+            bound = np.full(len(lengths), bound, dtype=np.int64)
+            bound = np.where(bound < 0, bound + lengths, bound)
+            return np.clip(bound, 0, lengths)
+
+        new_starts = resolve(start, np.zeros(len(lengths), dtype=np.int64))
+        new_stops = np.maximum(resolve(stop, lengths), new_starts)
+        return self._select(self._offsets[:-1] + new_starts, new_stops - new_starts, self._mask.copy())
+
+    def map_sequences(self, func, chunk_size=10000):
+        """
+        Apply a str -> str function to every sequence and return a packed result.
+
+        Works in chunks so only chunk_size decoded sequences are alive at any time.
+        """
+        chunks = []
+        for start in range(0, len(self), chunk_size):
+            decoded = self[start:start + chunk_size].to_numpy()
+            chunks.append(self._from_sequence([value if _is_missing(value) else func(value) for value in decoded]))
+        return self._concat_same_type(chunks) if chunks else self.copy()
+
+
+def is_packed_sequence_column(series):
+    """Return True if a pandas Series holds a PackedSequenceArray."""
+    return isinstance(series.dtype, PackedSequenceDtype)
+
+
+def pack_sequence_columns(df, columns=('seq', 'seq_cleaned', 'extracted_pol_query_seq', 'extracted_pol_query_seq_cleaned')):
+    """
+    Convert sequence columns of a DataFrame to the packed representation.
+
+    Parameters:
+    - df : DataFrame
+        Table holding sequence columns as str.
+    - columns : iterable of str
+        Columns to pack; columns missing from df are ignored.
+
+    Returns:
+    - DataFrame
+        Copy of df with the columns packed.
+    """
+    df = df.copy()
+    for col in columns:
+        if col in df.columns and not is_packed_sequence_column(df[col]):
+            df[col] = pd.Series(PackedSequenceArray._from_sequence(df[col].tolist()), index=df.index)
+    return df
+
+
+def unpack_sequence_columns(df):
+    """Convert every packed sequence column of a DataFrame back to str (object dtype)."""
+    df = df.copy()
+    for col in df.columns:
+        if is_packed_sequence_column(df[col]):
+            df[col] = df[col].astype(object)
+    return df
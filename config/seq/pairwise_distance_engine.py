@@ -0,0 +1,440 @@
+"""
+Pairwise genetic distances (TN93 and p-distance) between pol sequences, for transmission clustering.
+
+Every sequence is first placed in the HXB2 pol frame: the columns of its typing alignment
+where HXB2 has a gap (insertions relative to HXB2) are dropped, so position k of every
+sequence is HXB2 pol position k and no further alignment is needed. Ends the query does not
+cover become 'n' (missing data), while gaps inside the sequence stay deletions.
+
+Ambiguity codes are handled like HIV-TRACE's tn93:
+- 'resolve': an ambiguity consistent with the other sequence's nucleotide counts as that
+  nucleotide (a match); otherwise all its resolutions are averaged. A sequence with more than
+  resolve_fraction ambiguous positions is averaged instead, so it cannot look close to
+  everything.
+- 'average': every ambiguity is averaged over all its resolutions.
+- 'skip': positions with an ambiguity in either sequence are not counted.
+- 'gapmm': like 'average', and a gap against a nucleotide counts as N against it.
+Positions with N or a gap in either sequence are not counted (except for 'gapmm').
+
+The distances come from the 4x4 nucleotide pair counts of every pair. For a block of sequences
+I against a block J, all 16 counts of all |I| x |J| pairs are one matrix product of their base
+profiles (weight 1/k for each of the k bases a symbol allows), which is exactly the 'average'
+count; 'resolve' corrects it with sparse products over the few ambiguous positions. TN93 is
+never smaller than the p-distance, so it is only evaluated for the pairs whose p-distance is
+within the threshold. Memory is the uint8 frame matrix (one byte per position, ~150 MB for 50k
+sequences) plus a few block-sized buffers per worker, independent of the number of pairs.
+"""
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from alignment_resource_planner import available_cpu_count
+from incremental_uploader import IncrementalUploadSink
+from run_metrics import increment, observe
+
+# Columns identifying a sequence in the edges ('<column>_1' and '<column>_2')
+EDGE_ID_COLUMNS = ('pat_id', 'seq_sample_date')
+
+# HIV-TRACE defaults
+DEFAULT_DISTANCE_THRESHOLD = 0.015
+DEFAULT_MIN_OVERLAP = 500
+DEFAULT_RESOLVE_FRACTION = 0.015
+AMBIGUITY_MODES = ('resolve', 'average', 'skip', 'gapmm')
+
+# Nucleotides (a, c, g, t = bits 0-3) each symbol stands for. The gap is 0 and every symbol not
+# listed is N (15).
+GAP_MASK, N_MASK = 0, 15
+_SYMBOL_BASES = {'a': 'a', 'c': 'c', 'g': 'g', 't': 't', 'u': 't', 'r': 'ag', 'y': 'ct', 'm': 'ac', 'k': 'gt',
+                 's': 'cg', 'w': 'at', 'b': 'cgt', 'd': 'agt', 'h': 'act', 'v': 'acg'}
+SYMBOL_MASKS = np.full(256, N_MASK, dtype=np.uint8)
+SYMBOL_MASKS[ord('-')] = GAP_MASK
+for _symbol, _bases in _SYMBOL_BASES.items():
+    for _char in (_symbol, _symbol.upper()):
+        SYMBOL_MASKS[ord(_char)] = sum(1 << 'acgt'.index(base) for base in _bases)
+
+_MASK_BASES = [[base for base in range(4) if mask >> base & 1] for mask in range(16)]
+# Masks of the two- and three-base ambiguity codes
+PARTIAL_MASKS = [mask for mask in range(16) if len(_MASK_BASES[mask]) in (2, 3)]
+
+# Weight of each base in a symbol: 1/k for the k bases it allows; N and the gap have none
+_AVERAGE_PROFILE = np.zeros((16, 4), dtype=np.float32)
+for _mask in range(1, N_MASK):
+    _AVERAGE_PROFILE[_mask, _MASK_BASES[_mask]] = 1.0 / len(_MASK_BASES[_mask])
+_SKIP_PROFILE = np.where(np.isin(np.arange(16), PARTIAL_MASKS)[:, None], 0, _AVERAGE_PROFILE).astype(np.float32)
+
+
+def _pair_weights(mask_1, mask_2, ambiguity):
+    """4x4 weights that one position with symbols mask_1 and mask_2 adds to the pair counts."""
+    if ambiguity == 'gapmm' and (mask_1 == GAP_MASK) != (mask_2 == GAP_MASK):
+        # A gap against a nucleotide is N against it; against N it is skipped like N
+        if N_MASK in (mask_1, mask_2):
+            return np.zeros((4, 4))
+        mask_1, mask_2 = mask_1 or N_MASK, mask_2 or N_MASK
+        return np.outer(np.full(4, 0.25) if mask_1 == N_MASK else _AVERAGE_PROFILE[mask_1],
+                        np.full(4, 0.25) if mask_2 == N_MASK else _AVERAGE_PROFILE[mask_2])
+    if {mask_1, mask_2} & {GAP_MASK, N_MASK}:
+        return np.zeros((4, 4))
+    if ambiguity == 'skip':
+        return np.outer(_SKIP_PROFILE[mask_1], _SKIP_PROFILE[mask_2])
+    common = _MASK_BASES[mask_1 & mask_2]
+    if ambiguity == 'resolve' and common:
+        weights = np.zeros((4, 4))
+        weights[common, common] = 1.0 / len(common)
+        return weights
+    return np.outer(_AVERAGE_PROFILE[mask_1], _AVERAGE_PROFILE[mask_2])
+
+
+# PAIR_WEIGHTS[mode][mask_1, mask_2] is the (4, 4) weight of one position; rows are the first
+# sequence's base, columns the second's
+PAIR_WEIGHTS = {mode: np.array([[_pair_weights(mask_1, mask_2, mode) for mask_2 in range(16)] for mask_1 in range(16)])
+                for mode in AMBIGUITY_MODES}
+# What 'resolve' changes relative to 'average', non-zero only where an ambiguity meets a
+# consistent symbol
+_RESOLVE_CORRECTIONS = {(mask_1, mask_2): [(a, b, np.float32(delta[a, b])) for a, b in zip(*np.nonzero(delta))]
+                        for mask_1 in range(16) for mask_2 in range(16)
+                        for delta in [PAIR_WEIGHTS['resolve'][mask_1, mask_2] - PAIR_WEIGHTS['average'][mask_1, mask_2]]
+                        if np.any(delta)}
+
+
+def project_to_hxb2_frame(extracted_pol_ref_seq, extracted_pol_query_seq, frame_length=None):
+    """
+    Places an aligned pol query in the HXB2 pol frame.
+
+    Parameters:
+    - extracted_pol_ref_seq (str): Aligned HXB2 pol sequence from the typing alignment.
+    - extracted_pol_query_seq (str): The query aligned to it.
+    - frame_length (int, optional): Length of the frame; shorter projections are padded with 'n'.
+
+    Returns:
+    - str: The query at the HXB2 positions, lowercase, with uncovered ends as 'n'.
+    """
+    ref = np.frombuffer(extracted_pol_ref_seq.encode('ascii', 'replace'), dtype=np.uint8)
+    query = np.frombuffer(extracted_pol_query_seq.lower().encode('ascii', 'replace'), dtype=np.uint8)
+    projected = query[ref != ord('-')].copy()
+    covered = np.flatnonzero((projected != ord('-')) & (projected != ord('n')))
+    if len(covered) == 0:
+        projected[:] = ord('n')
+    else:
+        projected[:covered[0]] = ord('n')
+        projected[covered[-1] + 1:] = ord('n')
+    frame = projected.tobytes().decode('ascii')
+    if frame_length is not None:
+        frame = frame[:frame_length].ljust(frame_length, 'n')
+    return frame
+
+
+def hxb2_frame_matrix(df, ref_col='extracted_pol_ref_seq', query_col='extracted_pol_query_seq', frame_length=None):
+    """
+    Builds the symbol mask matrix of the typed sequences of df in the HXB2 pol frame.
+
+    Parameters:
+    - df (DataFrame): Typed (or subtyped) rows with their typing alignment columns.
+    - ref_col, query_col (str): Columns of the aligned HXB2 pol and query sequences.
+    - frame_length (int, optional): Length of the frame. Defaults to the longest projection.
+
+    Returns:
+    - tuple or str: (masks, frame_df, dropped_df): masks is a uint8 array (len(frame_df), frame_length)
+      of SYMBOL_MASKS codes, frame_df the rows it holds and dropped_df the rows without a usable
+      alignment; or an error message.
+    """
+    missing_cols = [col for col in (ref_col, query_col) if col not in df.columns]
+    if missing_cols:
+        return f"Error: columns {missing_cols} not found; distances need the HXB2 typing alignment."
+    usable = np.array([isinstance(ref, str) and isinstance(query, str) and len(ref) == len(query) and len(ref) > 0
+                       for ref, query in zip(df[ref_col], df[query_col])], dtype=bool)
+    frames = [project_to_hxb2_frame(ref, query)
+              for ref, query in zip(df.loc[usable, ref_col], df.loc[usable, query_col])]
+    frame_length = frame_length or max((len(frame) for frame in frames), default=0)
+    masks = np.full((len(frames), frame_length), N_MASK, dtype=np.uint8)
+    for row, frame in enumerate(frames):
+        codes = SYMBOL_MASKS[np.frombuffer(frame[:frame_length].encode('ascii'), dtype=np.uint8)]
+        masks[row, :len(codes)] = codes
+    # Sequences with nothing to compare (all N or gaps) are dropped as well
+    informative = ((masks != N_MASK) & (masks != GAP_MASK)).any(axis=1)
+    usable[np.flatnonzero(usable)[~informative]] = False
+    return masks[informative], df[usable].reset_index(drop=True), df[~usable].reset_index(drop=True)
+
+
+def ambiguity_fractions(masks):
+    """Fraction of each sequence's non-N, non-gap positions that are two- or three-base ambiguities."""
+    partial = np.isin(masks, PARTIAL_MASKS).sum(axis=1)
+    informative = ((masks != N_MASK) & (masks != GAP_MASK)).sum(axis=1)
+    return partial / np.maximum(informative, 1)
+
+
+def tn93_distance(counts):
+    """
+    Tamura-Nei 1993 distances from nucleotide pair counts.
+
+    Parameters:
+    - counts (ndarray): Shape (4, 4, ...); counts[a, b] is the (weighted) number of positions with
+      base a (a, c, g, t) in the first sequence and b in the second.
+
+    Returns:
+    - ndarray: Distances, inf where the formula is undefined (saturated or no overlap).
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    total = counts.sum(axis=(0, 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        freq = (counts.sum(axis=0) + counts.sum(axis=1)) / (2 * total)
+        p1 = (counts[0, 2] + counts[2, 0]) / total
+        p2 = (counts[1, 3] + counts[3, 1]) / total
+        q = 1 - np.trace(counts) / total - p1 - p2
+        g_r, g_y = freq[0] + freq[2], freq[1] + freq[3]
+        k_ag, k_ct = freq[0] * freq[2], freq[1] * freq[3]
+
+        def ratio(numerator, denominator):
+            # Terms of absent bases vanish (their numerator is 0 as well)
+            return np.where(denominator > 0, numerator / denominator, 0.0)
+
+        term_ag = np.where(k_ag > 0, -2 * ratio(k_ag, g_r) * np.log(1 - ratio(g_r * p1, 2 * k_ag) - ratio(q, 2 * g_r)), 0.0)
+        term_ct = np.where(k_ct > 0, -2 * ratio(k_ct, g_y) * np.log(1 - ratio(g_y * p2, 2 * k_ct) - ratio(q, 2 * g_y)), 0.0)
+        term_q = np.where(g_r * g_y > 0,
+                          -2 * (g_r * g_y - ratio(k_ag * g_y, g_r) - ratio(k_ct * g_r, g_y)) * np.log(1 - ratio(q, 2 * g_r * g_y)),
+                          0.0)
+        distance = term_ag + term_ct + term_q
+    return np.where(np.isfinite(distance) & (total > 0), distance, np.inf)
+
+
+def p_distance(counts):
+    """Proportion of differing positions from nucleotide pair counts (see tn93_distance); inf without overlap."""
+    counts = np.asarray(counts, dtype=np.float64)
+    total = counts.sum(axis=(0, 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, 1 - np.trace(counts) / total, np.inf)
+
+
+def pair_counts(masks, first, second, ambiguity='resolve', resolve_fraction=DEFAULT_RESOLVE_FRACTION, chunk_size=256):
+    """
+    Nucleotide pair counts of explicit pairs of sequences, e.g. candidate pairs from an index.
+
+    Parameters:
+    - masks (ndarray): Symbol mask matrix (see hxb2_frame_matrix).
+    - first, second (array-like): Row numbers of the two sequences of each pair.
+    - ambiguity (str): One of AMBIGUITY_MODES.
+    - resolve_fraction (float): Largest ambiguity fraction of a sequence resolved in 'resolve' mode.
+    - chunk_size (int): Pairs counted at once.
+
+    Returns:
+    - ndarray: Counts of shape (4, 4, number of pairs).
+    """
+    first, second = np.asarray(first, dtype=np.int64), np.asarray(second, dtype=np.int64)
+    weights = PAIR_WEIGHTS[ambiguity].reshape(256, 16)
+    average_weights = PAIR_WEIGHTS['average'].reshape(256, 16)
+    if ambiguity == 'resolve':
+        eligible = ambiguity_fractions(masks) <= resolve_fraction
+    counts = np.zeros((len(first), 16))
+    for start in range(0, len(first), chunk_size):
+        i, j = first[start:start + chunk_size], second[start:start + chunk_size]
+        # Histogram of the 256 symbol combinations per pair, then their weights
+        combinations = masks[i].astype(np.int64) * 16 + masks[j] + 256 * np.arange(len(i))[:, None]
+        histogram = np.bincount(combinations.ravel(), minlength=256 * len(i)).reshape(len(i), 256)
+        chunk_counts = histogram @ weights
+        if ambiguity == 'resolve':
+            averaged = ~(eligible[i] & eligible[j])
+            chunk_counts[averaged] = histogram[averaged] @ average_weights
+        counts[start:start + chunk_size] = chunk_counts
+    return counts.T.reshape(4, 4, len(first))
+
+
+def _prepare_block(masks, eligible, ambiguity):
+    """Per-block operands: base profiles, gap indicators ('gapmm') and ambiguity indicators ('resolve')."""
+    profile_table = _SKIP_PROFILE if ambiguity == 'skip' else _AVERAGE_PROFILE
+    # Row 4 * s + b is the weight of base b along sequence s
+    block = {'size': len(masks),
+             'profile': np.ascontiguousarray(profile_table[masks].transpose(0, 2, 1).reshape(4 * len(masks), -1))}
+    if ambiguity == 'gapmm':
+        block['gaps'] = (masks == GAP_MASK).astype(np.float32)
+    if ambiguity == 'resolve':
+        # Only sequences under the ambiguity fraction are resolved
+        resolvable = np.where(eligible[:, None], masks, N_MASK)
+        block['bases'] = np.ascontiguousarray(
+            (resolvable[:, None, :] == (1 << np.arange(4))[None, :, None]).astype(np.float32).reshape(4 * len(masks), -1))
+        block['partial'] = {}
+        for mask in PARTIAL_MASKS:
+            rows, cols = np.nonzero(resolvable == mask)
+            if len(rows):
+                block['partial'][mask] = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                                                           shape=masks.shape)
+    return block
+
+
+def _block_counts(block_i, block_j, ambiguity):
+    """Pair counts of all pairs of two blocks, shape (4, 4, |I|, |J|)."""
+    n_i, n_j = block_i['size'], block_j['size']
+    counts = (block_i['profile'] @ block_j['profile'].T).reshape(n_i, 4, n_j, 4).transpose(1, 3, 0, 2)
+    if ambiguity == 'gapmm':
+        gap_vs = (block_i['gaps'] @ block_j['profile'].T).reshape(n_i, n_j, 4).transpose(2, 0, 1)
+        vs_gap = (block_i['profile'] @ block_j['gaps'].T).reshape(n_i, 4, n_j).transpose(1, 0, 2)
+        counts += 0.25 * gap_vs[None, :, :, :] + 0.25 * vs_gap[:, None, :, :]
+    if ambiguity == 'resolve':
+        # Ambiguities of I against the bases of J, the bases of I against ambiguities of J, and
+        # ambiguities against ambiguities
+        for mask, indicator in block_i['partial'].items():
+            matches = np.asarray(indicator @ block_j['bases'].T).reshape(n_i, n_j, 4)
+            for base in _MASK_BASES[mask]:
+                for a, b, delta in _RESOLVE_CORRECTIONS[mask, 1 << base]:
+                    counts[a, b] += delta * matches[:, :, base]
+        for mask, indicator in block_j['partial'].items():
+            matches = np.asarray(indicator @ block_i['bases'].T).reshape(n_j, n_i, 4)
+            for base in _MASK_BASES[mask]:
+                for a, b, delta in _RESOLVE_CORRECTIONS[1 << base, mask]:
+                    counts[a, b] += delta * matches[:, :, base].T
+        for mask_i, indicator_i in block_i['partial'].items():
+            for mask_j, indicator_j in block_j['partial'].items():
+                if (mask_i, mask_j) in _RESOLVE_CORRECTIONS:
+                    matches = (indicator_i @ indicator_j.T).toarray()
+                    for a, b, delta in _RESOLVE_CORRECTIONS[mask_i, mask_j]:
+                        counts[a, b] += delta * matches
+    return counts
+
+
+def cross_pair_counts(masks_i, masks_j, ambiguity='resolve', resolve_fraction=DEFAULT_RESOLVE_FRACTION):
+    """
+    Nucleotide pair counts of every sequence of masks_i against every sequence of masks_j, as one block.
+
+    Returns:
+    - ndarray: float32 counts of shape (4, 4, len(masks_i), len(masks_j)).
+    """
+    block_i = _prepare_block(masks_i, ambiguity_fractions(masks_i) <= resolve_fraction, ambiguity)
+    block_j = _prepare_block(masks_j, ambiguity_fractions(masks_j) <= resolve_fraction, ambiguity)
+    return _block_counts(block_i, block_j, ambiguity)
+
+
+def compute_pairwise_distances(masks, edge_callback, threshold=DEFAULT_DISTANCE_THRESHOLD, ambiguity='resolve',
+                               resolve_fraction=DEFAULT_RESOLVE_FRACTION, min_overlap=DEFAULT_MIN_OVERLAP,
+                               block_size=512, workers=None):
+    """
+    Computes TN93 and p-distances between all pairs of sequences and reports the pairs within the threshold.
+
+    The pairs are processed in blocks of block_size x block_size; each row block is a task of a
+    thread pool (the matrix products and array operations release the GIL). With several workers,
+    limit the BLAS threads per product (e.g. OPENBLAS_NUM_THREADS=1) so they do not oversubscribe
+    the cores.
+
+    Parameters:
+    - masks (ndarray): Symbol mask matrix (see hxb2_frame_matrix).
+    - edge_callback (callable): Called as edge_callback(first, second, tn93, p, overlap) with arrays
+      of the edges of each block pair, first < second; calls are serialized.
+    - threshold (float): Largest TN93 distance reported.
+    - ambiguity (str): One of AMBIGUITY_MODES.
+    - resolve_fraction (float): Largest ambiguity fraction of a sequence resolved in 'resolve' mode.
+    - min_overlap (int): Fewest compared positions for a pair to be reported.
+    - block_size (int): Sequences per block; memory per worker grows with its square.
+    - workers (int, optional): Threads. Defaults to the available CPUs.
+
+    Returns:
+    - dict: 'sequences', 'pairs', 'edges' and 'seconds'.
+    """
+    if ambiguity not in AMBIGUITY_MODES:
+        raise ValueError(f"Unknown ambiguity mode '{ambiguity}'; expected one of {AMBIGUITY_MODES}")
+    start = time.perf_counter()
+    eligible = ambiguity_fractions(masks) <= resolve_fraction
+    starts = list(range(0, len(masks), block_size))
+    callback_lock = threading.Lock()
+    edge_counts = []
+
+    def process_row_block(start_i):
+        block_i = _prepare_block(masks[start_i:start_i + block_size], eligible[start_i:start_i + block_size], ambiguity)
+        edges = 0
+        for start_j in starts[starts.index(start_i):]:
+            block_start = time.perf_counter()
+            block_j = block_i if start_j == start_i else _prepare_block(
+                masks[start_j:start_j + block_size], eligible[start_j:start_j + block_size], ambiguity)
+            counts = _block_counts(block_i, block_j, ambiguity)
+            total = counts.sum(axis=(0, 1))
+            mismatches = total - (counts[0, 0] + counts[1, 1] + counts[2, 2] + counts[3, 3])
+            # TN93 >= p-distance, so only pairs within the threshold in p-distance can be edges
+            candidate = (total >= min_overlap) & (mismatches <= threshold * total)
+            if start_j == start_i:
+                candidate = np.triu(candidate, k=1)
+            rows, cols = np.nonzero(candidate)
+            pair_count_values = counts[:, :, rows, cols]
+            tn93 = tn93_distance(pair_count_values)
+            keep = tn93 <= threshold
+            if keep.any():
+                with callback_lock:
+                    edge_callback(rows[keep] + start_i, cols[keep] + start_j, tn93[keep],
+                                  p_distance(pair_count_values[:, :, keep]), np.rint(total[rows, cols][keep]).astype(int))
+            edges += int(keep.sum())
+            observe('distance_block_seconds', time.perf_counter() - block_start)
+        return edges
+
+    with ThreadPoolExecutor(max_workers=workers or available_cpu_count()) as executor:
+        edge_counts = list(executor.map(process_row_block, starts))
+    pairs = len(masks) * (len(masks) - 1) // 2
+    increment('distance_pairs', pairs)
+    increment('distance_edges', sum(edge_counts))
+    return {'sequences': len(masks), 'pairs': pairs, 'edges': sum(edge_counts), 'seconds': time.perf_counter() - start}
+
+
+def compute_transmission_edges(df, id_columns=EDGE_ID_COLUMNS, threshold=DEFAULT_DISTANCE_THRESHOLD, ambiguity='resolve',
+                               resolve_fraction=DEFAULT_RESOLVE_FRACTION, min_overlap=DEFAULT_MIN_OVERLAP,
+                               frame_length=None, block_size=512, workers=None, edge_callback=None):
+    """
+    Computes the transmission network edges (pairs within the TN93 threshold) of typed sequences.
+
+    Parameters:
+    - df (DataFrame): Post-subtyping rows (e.g. known_hiv1_subtypes) with their typing alignment columns.
+    - id_columns (tuple): Columns identifying a sequence; edges have '<column>_1' and '<column>_2'.
+    - threshold, ambiguity, resolve_fraction, min_overlap, block_size, workers: See compute_pairwise_distances.
+    - frame_length (int, optional): Length of the HXB2 pol frame (see hxb2_frame_matrix).
+    - edge_callback (callable, optional): Called with the edge DataFrame of each block pair instead of
+      collecting the edges, e.g. IncrementalUploadSink.put.
+
+    Returns:
+    - tuple or str: (edges_df, dropped_df, stats): the edges (empty with edge_callback), the rows
+      without a usable alignment and the stats of compute_pairwise_distances; or an error message.
+    """
+    frame_result = hxb2_frame_matrix(df, frame_length=frame_length)
+    if isinstance(frame_result, str):
+        return frame_result
+    masks, frame_df, dropped_df = frame_result
+    ids_df = frame_df[list(id_columns)]
+    collected = []
+
+    def to_edge_df(first, second, tn93, p, overlap):
+        edge_df = pd.concat([ids_df.iloc[first].add_suffix('_1').reset_index(drop=True),
+                             ids_df.iloc[second].add_suffix('_2').reset_index(drop=True)], axis=1)
+        edge_df['tn93_distance'], edge_df['p_distance'], edge_df['overlap'] = tn93, p, overlap
+        edge_df['ambiguity_mode'] = ambiguity
+        if edge_callback is None:
+            collected.append(edge_df)
+        else:
+            edge_callback(edge_df)
+
+    try:
+        stats = compute_pairwise_distances(masks, to_edge_df, threshold, ambiguity, resolve_fraction, min_overlap,
+                                           block_size, workers)
+    except Exception as e:
+        return f"Error computing pairwise distances: {e}"
+    edges_df = pd.concat(collected, ignore_index=True) if collected else pd.DataFrame()
+    return edges_df, dropped_df, stats
+
+
+def upload_transmission_edges(database, user, password, host, port, df, **engine_options):
+    """
+    Computes the transmission network edges of df and uploads them to the transmission_edge table
+    while they are computed. The table comes with the schema bootstrap (see
+    db_operations.PIPELINE_TABLES).
+
+    Parameters:
+    - database, user, password, host, port: Connection parameters of the PostgreSQL database.
+    - df (DataFrame): Post-subtyping rows with their typing alignment columns.
+    - engine_options: Options of compute_transmission_edges.
+
+    Returns:
+    - tuple or str: (uploaded_df, not_uploaded_df, dropped_df, stats), or an error message.
+    """
+    upload_sink = IncrementalUploadSink(database, user, password, host, port, 'transmission_edge', batch_size=5000)
+    edge_result = compute_transmission_edges(df, edge_callback=upload_sink.put, **engine_options)
+    upload_results = upload_sink.close()
+    if isinstance(edge_result, str):
+        return edge_result
+    if isinstance(upload_results, str):
+        return upload_results
+    _, dropped_df, stats = edge_result
+    return (*upload_results, dropped_df, stats)
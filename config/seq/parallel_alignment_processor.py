@@ -1,55 +1,291 @@
+import time
+import inspect
+import random
+import logging
+import threading
 import psutil
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import pandas as pd   
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import pandas as pd
+from mafft_caller import MafftError
+from alignment_resource_planner import plan_alignment_resources, AdaptiveConcurrencyLimiter
+from alignment_cost_model import (alignment_work, load_cost_model, predict_task_seconds, update_cost_model,
+                                  longest_first_order, summarize_predictions, worker_key, unwrap_worker)
+from alignment_checkpoint import AlignmentCheckpoint, run_fingerprint, row_fingerprint
+from run_metrics import observe, increment, set_gauge
+
+# Histogram buckets of the alignment queue depth
+QUEUE_DEPTH_BUCKETS = (0, 1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+
+# Per-alignment timeout used by process_sequence_alignment_isolated
+DEFAULT_MAFFT_TIMEOUT_SECONDS = 600
+
+
+class RowQuarantined(Exception):
+    """Raised by a worker to give up on one row without failing the stage (see process_sequence_alignment_isolated)."""
+
+
+def worker_options(worker_func, **options):
+    """
+    Returns the run options (e.g. batch_size, mafft_threads, mafft_timeout, mafft_engine) that
+    worker_func takes as keyword arguments and does not have bound with functools.partial. The
+    dispatchers pass them on every call, so concurrent runs never share MAFFT settings.
+    """
+    worker_func = unwrap_worker(worker_func)
+    target = getattr(worker_func, 'func', worker_func)
+    try:
+        parameters = inspect.signature(target).parameters
+    except (TypeError, ValueError):
+        return {}
+    bound = getattr(worker_func, 'keywords', {})
+    return {name: value for name, value in options.items() if name in parameters and name not in bound}
+
 
 def process_sequence_alignment_parallel(query_df, ref_seq_df, query_seq_col_name, worker_func,
-                                        mafft_executable):
+                                        mafft_executable, resource_plan=None, cost_model_path=None,
+                                        checkpoint_path=None, result_callback=None, timeout_seconds=None,
+                                        mafft_engine='subprocess', ref_region_df=None):
     """
     Process sequence alignment in parallel using ThreadPoolExecutor.
 
+    The CPU budget (affinity and cgroup quota) is split between the worker pool and MAFFT's
+    --thread option, and every query row is its own task. How many tasks run at once starts
+    at the planned pool width and is tuned during the run from per-alignment latency and the
+    number of rows still queued (see AdaptiveConcurrencyLimiter).
+
+    Rows are submitted to the shared queue longest-first, by the cost predicted from the
+    query and reference lengths, so long sequences do not end up at the tail of the run.
+    Predicted and measured task times are logged and added to the cost model.
+
+    With checkpoint_path, every finished row is appended to that checkpoint file, and rows
+    already in it (same row values, reference table and worker options) are not run again,
+    so an interrupted run resumes where it stopped.
+
+    With result_callback, each row's result is passed on as soon as the row is done (rows
+    resumed from the checkpoint included), e.g. to an IncrementalUploadSink.
+
     Args:
     - query_df (pandas.DataFrame): DataFrame containing query sequences.
     - ref_seq_df (pandas.DataFrame): DataFrame containing reference sequences.
     - query_seq_col_name (str): Name of the column containing query sequences.
+    - resource_plan (dict, optional): Output of plan_alignment_resources, to override the detected budget.
+    - cost_model_path (str, optional): Cost model file. Defaults to DEFAULT_COST_MODEL_PATH.
+    - checkpoint_path (str, optional): Checkpoint file (JSON lines) to resume from and append to.
+    - result_callback (callable, optional): Called with each non-empty row result, from the worker threads.
+    - timeout_seconds (float, optional): Timeout of one MAFFT call (None for no timeout).
+    - mafft_engine (str, optional): 'subprocess' or 'async', for workers that take it (see
+      async_mafft_engine.mafft_alignment_function).
+    - ref_region_df (pandas.DataFrame, optional): The hiv_type_ref_region table, for workers that
+      take it (perform_hiv_typing slices these regions out of its alignment).
 
     Returns:
     - pandas.DataFrame or str: Result DataFrame if successful, error message if failed.
     """
+    checkpoint = AlignmentCheckpoint(checkpoint_path) if checkpoint_path else None
+    fingerprints = [None] * len(query_df)
+    pending_positions = list(range(len(query_df)))
+    if checkpoint is not None:
+        run_fp = run_fingerprint(ref_seq_df, query_seq_col_name, worker_func, ref_region_df)
+        fingerprints = [row_fingerprint(row, run_fp) for _, row in query_df.iterrows()]
+        pending_positions = [position for position, fingerprint in enumerate(fingerprints) if fingerprint not in checkpoint]
+        logging.info(f"Resuming from checkpoint: {len(query_df) - len(pending_positions)} of {len(query_df)} rows already done")
+
     try:
-        # Attempt to retrieve the number of physical CPU cores
-        num_physical_cores = psutil.cpu_count(logical=False)
-        if num_physical_cores is None:
-            # Fallback to a default if the number of physical cores cannot be determined
-            num_physical_cores = 1
-        total_threads = max(2 * num_physical_cores, 1)  # Ensure at least 1 thread is used
+        plan = resource_plan or plan_alignment_resources(len(pending_positions))
     except Exception as e:
         # Directly return the error message without proceeding to processing
         return f"Error getting system cores: {e}"
 
-    with ThreadPoolExecutor(max_workers=total_threads) as executor:
-        
-        futures = []
-        def process_chunk(chunk):
-            result_df = []
-            for _, row in chunk.iterrows():
-                query_row_df = pd.DataFrame(row).transpose()
-                result = worker_func(query_row_df, ref_seq_df, query_seq_col_name, mafft_executable)
-                if result is not None and not result.empty:
-                    result_df.append(result)
-            if result_df:
-                return pd.concat(result_df, ignore_index=True)
-            else:
-                return pd.DataFrame()
-        chunks = np.array_split(query_df, total_threads) if len(query_df) > 2 else [query_df]
-
-        for chunk in chunks:
-            future = executor.submit(process_chunk, chunk)
-            futures.append(future)
-
-        results = []
-        for future in as_completed(futures):
-            results.append(future.result())
+    options = worker_options(worker_func, batch_size=len(query_df), mafft_threads=plan['mafft_threads'],
+                             mafft_timeout=timeout_seconds, mafft_engine=mafft_engine, ref_region_df=ref_region_df)
+    limiter = AdaptiveConcurrencyLimiter(plan['pool_width'], plan['max_pool_width'])
+    limiter.set_queue_depth(len(pending_positions))
+    logging.info(f"Alignment of {len(pending_positions)} rows: cpu budget {plan['cpu_budget']}, pool width {plan['pool_width']} "
+                 f"(max {plan['max_pool_width']}), mafft threads {plan['mafft_threads']}, "
+                 f"available memory {plan['available_memory_mb']} MB")
+
+    key = worker_key(worker_func)
+    work = alignment_work(query_df, ref_seq_df, query_seq_col_name)
+    predicted_seconds = predict_task_seconds(load_cost_model(cost_model_path), key, work)
+    actual_seconds = np.zeros(len(query_df))
+
+    def process_row(position, row):
+        limiter.acquire()
+        start = time.perf_counter()
+        try:
+            query_row_df = pd.DataFrame(row).transpose()
+            try:
+                result = worker_func(query_row_df, ref_seq_df, query_seq_col_name, mafft_executable, **options)
+            except RowQuarantined:
+                # Not checkpointed, so a rerun tries the row again
+                return None
+            if checkpoint is not None:
+                checkpoint.record(fingerprints[position], result)
+            if result_callback is not None and result is not None and not result.empty:
+                result_callback(result)
+            return result
+        finally:
+            actual_seconds[position] = time.perf_counter() - start
+            limiter.release(actual_seconds[position], work[position])
+            observe('alignment_task_seconds', actual_seconds[position], stage=key)
+            observe('alignment_queue_depth', limiter.queued, QUEUE_DEPTH_BUCKETS, stage=key)
+            set_gauge('alignment_queue_depth_current', limiter.queued, stage=key)
+
+    if result_callback is not None and checkpoint is not None:
+        for position in set(range(len(query_df))) - set(pending_positions):
+            result = checkpoint.get(fingerprints[position])
+            if result is not None and not result.empty:
+                result_callback(result)
+
+    psutil.cpu_percent(interval=None)
+    run_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=plan['max_pool_width']) as executor:
+        order = longest_first_order(predicted_seconds[pending_positions])
+        futures = {pending_positions[i]: executor.submit(process_row, pending_positions[i], query_df.iloc[pending_positions[i]])
+                   for i in order}
+        # Collect in query_df order so the output does not depend on the schedule
+        results = [futures[position].result() if position in futures else checkpoint.get(fingerprints[position])
+                   for position in range(len(query_df))]
+    wall_seconds = time.perf_counter() - run_start
+
+    if pending_positions:
+        logging.info(f"Alignment cost model ({key}): "
+                     f"{summarize_predictions(predicted_seconds[pending_positions], actual_seconds[pending_positions])}")
+        update_cost_model(key, work[pending_positions], actual_seconds[pending_positions], cost_model_path)
+
+    logging.info(f"Alignment finished in {wall_seconds:.1f}s: mean latency "
+                 f"{limiter.busy_seconds / max(limiter.completed, 1):.2f}s, "
+                 f"pool utilisation {limiter.busy_seconds / max(wall_seconds * plan['max_pool_width'], 1e-9):.0%}, "
+                 f"cpu {psutil.cpu_percent(interval=None):.0f}%, concurrency limits {limiter.limit_history}")
 
+    increment('alignment_rows_in', len(query_df), stage=key)
+    increment('alignment_rows_resumed', len(query_df) - len(pending_positions), stage=key)
+    results = [result for result in results if result is not None and not result.empty]
+    if not results:
+        return pd.DataFrame()
     # Return the concatenated results as a single DataFrame
-    return pd.concat(results, ignore_index=True)
+    result_df = pd.concat(results, ignore_index=True)
+    increment('alignment_rows_out', len(result_df), stage=key)
+    return result_df
+
+
+def is_retryable_error(error):
+    """
+    Returns True for failures a retry may fix: MAFFT timeouts and killed MAFFT processes,
+    and OS errors such as failing to start a process under load.
+    """
+    if isinstance(error, MafftError):
+        return error.transient
+    return isinstance(error, OSError)
+
+
+def quarantine_row(query_row_df, stage, error, attempts):
+    """
+    Returns the quarantine record of a failed query row: the row plus 'stage', 'error_class',
+    'error_message', 'mafft_stderr' and 'attempts'.
+    """
+    return query_row_df.assign(stage=stage,
+                               error_class=type(error).__name__,
+                               error_message=str(error),
+                               mafft_stderr=getattr(error, 'stderr', ''),
+                               attempts=attempts)
+
+
+def isolate_worker(worker_func, stats, quarantined, max_retries=2, retry_backoff_seconds=1.0, stage=None):
+    """
+    Wraps a worker so that a failing row is retried or quarantined instead of failing the stage.
+
+    A retryable error (see is_retryable_error) is retried up to max_retries times with
+    exponential backoff and jitter. A row that still fails, or fails with any other error, is
+    appended to quarantined (see quarantine_row) and RowQuarantined is raised.
+
+    Args:
+    - worker_func (callable): Worker with the (query_row_df, ref_seq_df, query_seq_col_name, mafft_executable) signature
+      and optional keyword options (see worker_options).
+    - stats (dict): Counters 'succeeded', 'retried', 'retries' and 'quarantined', updated in place.
+    - quarantined (list): Receives the quarantine records.
+    - stage (str, optional): Stage name in logs, metrics and quarantine records. Defaults to worker_key(worker_func).
+
+    Returns:
+    - callable: The isolated worker, with the same signature; keyword options are passed on.
+    """
+    stage = stage or worker_key(worker_func)
+    lock = threading.Lock()
+
+    def isolated_worker(query_row_df, ref_seq_df, query_seq_col_name, mafft_executable, **options):
+        attempt = 0
+        while True:
+            try:
+                result = worker_func(query_row_df, ref_seq_df, query_seq_col_name, mafft_executable, **options)
+                with lock:
+                    stats['succeeded'] += 1
+                    stats['retried'] += int(attempt > 0)
+                return result
+            except Exception as e:
+                if is_retryable_error(e) and attempt < max_retries:
+                    delay = retry_backoff_seconds * 2 ** attempt * random.uniform(0.5, 1.5)
+                    logging.warning(f"{stage}: retrying row after {type(e).__name__} in {delay:.1f}s: {e}")
+                    attempt += 1
+                    increment('alignment_retries', stage=stage)
+                    with lock:
+                        stats['retries'] += 1
+                    time.sleep(delay)
+                    continue
+                logging.error(f"{stage}: quarantining row after {attempt + 1} attempt(s): {type(e).__name__}: {e}")
+                increment('alignment_rows_quarantined', stage=stage, error_class=type(e).__name__)
+                with lock:
+                    stats['quarantined'] += 1
+                    stats['retried'] += int(attempt > 0)
+                    quarantined.append(quarantine_row(query_row_df, stage, e, attempt + 1))
+                raise RowQuarantined() from e
+
+    isolated_worker.__wrapped__ = worker_func
+    return isolated_worker
+
+
+def process_sequence_alignment_isolated(query_df, ref_seq_df, query_seq_col_name, worker_func, mafft_executable,
+                                        timeout_seconds=DEFAULT_MAFFT_TIMEOUT_SECONDS, max_retries=2,
+                                        retry_backoff_seconds=1.0, **kwargs):
+    """
+    Runs process_sequence_alignment_parallel with per-row fault isolation.
+
+    Each MAFFT call is killed after timeout_seconds. A row whose worker fails with a retryable
+    error (see is_retryable_error) is retried up to max_retries times with exponential backoff
+    and jitter; a row that still fails, or fails with any other error, is quarantined and the
+    other rows finish normally. Quarantined rows are not checkpointed, so a resumed run
+    (checkpoint_path in kwargs) tries them again.
+
+    Args:
+    - query_df (pandas.DataFrame): DataFrame containing query sequences.
+    - ref_seq_df (pandas.DataFrame): DataFrame containing reference sequences.
+    - query_seq_col_name (str): Name of the column containing query sequences.
+    - worker_func (callable): perform_hiv_typing, perform_hiv_subtyping or a partial of them.
+    - mafft_executable (str): Path to the MAFFT executable.
+    - timeout_seconds (float): Timeout of one MAFFT call (None for no timeout).
+    - max_retries (int): Retries of a row after a retryable error.
+    - retry_backoff_seconds (float): Delay before the first retry; doubled for each further retry.
+    - kwargs: Passed on to process_sequence_alignment_parallel.
+
+    Returns:
+    - tuple or str: (result_df, quarantine_df, stats), or an error message if the stage could not run.
+      quarantine_df holds the failed query rows with 'stage', 'error_class', 'error_message',
+      'mafft_stderr' and 'attempts'. stats counts 'rows', 'succeeded', 'retried' (rows that needed
+      at least one retry), 'retries' and 'quarantined'.
+    """
+    stats = {'rows': len(query_df), 'succeeded': 0, 'retried': 0, 'retries': 0, 'quarantined': 0}
+    quarantined = []
+    stage = worker_key(worker_func)
+    isolated_worker = isolate_worker(worker_func, stats, quarantined, max_retries, retry_backoff_seconds)
+
+    result_df = process_sequence_alignment_parallel(query_df, ref_seq_df, query_seq_col_name, isolated_worker,
+                                                    mafft_executable, timeout_seconds=timeout_seconds, **kwargs)
+    if isinstance(result_df, str):
+        return result_df
+
+    quarantine_df = pd.concat(quarantined, ignore_index=True) if quarantined else pd.DataFrame(
+        columns=[*query_df.columns, 'stage', 'error_class', 'error_message', 'mafft_stderr', 'attempts'])
+    # Rows already in the checkpoint did not run in this call
+    stats['resumed'] = stats['rows'] - stats['succeeded'] - stats['quarantined']
+    logging.info(f"{stage}: {stats['succeeded']} succeeded ({stats['retried']} after retries, {stats['retries']} retries), "
+                 f"{stats['quarantined']} quarantined, {stats['resumed']} resumed from checkpoint")
+    return result_df, quarantine_df, stats
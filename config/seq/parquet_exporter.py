@@ -0,0 +1,195 @@
+"""
+Exports the outputs of every pipeline stage to Parquet datasets.
+
+Layout: '<root_dir>/<dataset>/run_date=YYYY-MM-DD[/<partition>=<value>]/part-<run_id>-<n>.parquet',
+so a rerun on the same day adds files instead of replacing them and readers can prune by run
+date and subtype (or QC filter, typing category) from the paths alone:
+
+    read_parquet_dataset(root_dir, 'known_hiv1_subtypes', columns=['pat_id', 'hiv1_mosaic'],
+                         filters=[('subtype', '=', 'C')])
+
+Schemas are stable across runs: identifier and date columns are always strings, counts and
+coordinates nullable int64, the per-reference columns that aggregate_duplicate_rows turns into
+lists are always lists (single values wrapped), other object columns strings. String columns
+are dictionary-encoded, except the sequence columns: every sequence is distinct, so a
+dictionary would only add an index. Files are zstd-compressed.
+"""
+
+import os
+import json
+import uuid
+import datetime
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from qc import QC_FILTERS, hiv1_subtype_label
+from run_metrics import increment, stage_timer
+
+PARQUET_COMPRESSION = 'zstd'
+
+# Columns whose type does not follow from one run's values
+STRING_COLUMNS = ['pat_id', 'seq_sample_date']
+INT_COLUMNS = ['extracted_pol_query_seq_start_coord', 'extracted_pol_query_seq_end_coord',
+               'hiv_type_alignment_score', 'extracted_pol_query_seq_cleaned_len']
+# Columns aggregate_duplicate_rows makes lists of, with their item types
+LIST_COLUMNS = {'hiv1_ref_seq_name': pa.string(),
+                'hiv1_aligned_ref_seq': pa.string(),
+                'hiv1_aligned_query_seq': pa.string(),
+                'hiv1_subtype_alignment_score': pa.int64(),
+                'hiv1_subtype_similarity_percentage': pa.float64(),
+                'hiv1_subtype_lanl': pa.string(),
+                'hiv1_hypermut_p_value': pa.float64(),
+                'hiv1_aligned_query_seq_cleaned': pa.string(),
+                'hiv1_aligned_query_seq_cleaned_len': pa.int64()}
+
+
+def is_sequence_column(name):
+    """Sequence columns ('seq', 'seq_cleaned', '*_seq', '*_seq_cleaned') are stored without a dictionary."""
+    return name in ('seq', 'seq_cleaned') or name.endswith('_seq') or name.endswith('_seq_cleaned')
+
+
+def _string_value(value):
+    if value is None or (not isinstance(value, (list, tuple, dict)) and pd.isna(value)):
+        return None
+    if isinstance(value, (list, tuple, dict)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+
+def _list_value(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return None if value is None or pd.isna(value) else [value]
+
+
+def arrow_table(df):
+    """
+    Converts a stage output to an Arrow table with the stable schema described in the module docstring.
+    """
+    arrays, fields = [], []
+    for name in df.columns:
+        series = df[name]
+        if name in LIST_COLUMNS:
+            array = pa.array([_list_value(value) for value in series], type=pa.list_(LIST_COLUMNS[name]))
+        elif name in INT_COLUMNS:
+            array = pa.array(pd.to_numeric(series, errors='coerce').astype('Int64'), type=pa.int64(), from_pandas=True)
+        elif name not in STRING_COLUMNS and pd.api.types.is_bool_dtype(series):
+            array = pa.array(series, type=pa.bool_(), from_pandas=True)
+        elif name not in STRING_COLUMNS and pd.api.types.is_integer_dtype(series):
+            array = pa.array(series, type=pa.int64(), from_pandas=True)
+        elif name not in STRING_COLUMNS and pd.api.types.is_float_dtype(series):
+            array = pa.array(series, type=pa.float64(), from_pandas=True)
+        elif name not in STRING_COLUMNS and pd.api.types.is_datetime64_any_dtype(series):
+            array = pa.array(series, type=pa.timestamp('us'), from_pandas=True)
+        else:
+            array = pa.array([_string_value(value) for value in series], type=pa.string())
+            if not is_sequence_column(name):
+                array = array.dictionary_encode()
+        arrays.append(array)
+        fields.append(pa.field(str(name), array.type))
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+def subtype_partition_values(df):
+    """Subtype partition of subtyped rows (see qc.hiv1_subtype_label)."""
+    anomalies = df['hiv1_subtype_lanl_anomaly'] if 'hiv1_subtype_lanl_anomaly' in df.columns else [None] * len(df)
+    return [hiv1_subtype_label(subtype, anomaly) for subtype, anomaly in zip(df['hiv1_subtype_lanl'], anomalies)]
+
+
+def category_frame(results, category_col, prefix='', suffix='_df'):
+    """
+    Stacks the DataFrames of a categorized results dict ('hiv1_df', ... of categorize_hiv_typing;
+    'subtype_B', ... of categorize_hiv1_subtyping) with their key, minus prefix and suffix, in category_col.
+    """
+    frames = [df.assign(**{category_col: key[len(prefix):len(key) - len(suffix)]})
+              for key, df in results.items()
+              if key.startswith(prefix) and key.endswith(suffix) and isinstance(df, pd.DataFrame) and not df.empty]
+    return pd.concat(frames, ignore_index=True) if frames else None
+
+
+def write_parquet_dataset(df, root_dir, dataset, run_date, run_id, partition_col=None):
+    """
+    Writes df to '<root_dir>/<dataset>', partitioned by run_date and, if given, partition_col.
+
+    Returns:
+    - int: Rows written.
+    """
+    if df is None or df.empty:
+        return 0
+    table = arrow_table(df.reset_index(drop=True))
+    table = table.append_column('run_date', pa.array([run_date] * len(df), type=pa.string()))
+    partition_cols = ['run_date']
+    if partition_col:
+        # Partition values end up in the directory names
+        table = table.set_column(table.schema.get_field_index(partition_col), partition_col,
+                                 pa.array([_string_value(value) or 'unknown' for value in df[partition_col]],
+                                          type=pa.string()))
+        partition_cols.append(partition_col)
+    pq.write_to_dataset(table, root_path=os.path.join(root_dir, dataset), partition_cols=partition_cols,
+                        basename_template=f"part-{run_id}-{{i}}.parquet", existing_data_behavior='overwrite_or_ignore',
+                        compression=PARQUET_COMPRESSION)
+    increment('parquet_rows', len(df), dataset=dataset)
+    return len(df)
+
+
+def export_pipeline_outputs(root_dir, run_date=None, run_id=None, qc_results=None, post_qc_df=None, typed_df=None,
+                            typing_results=None, subtyped_df=None, subtyping_results=None, known_df=None):
+    """
+    Exports the outputs of process_sequence_data to Parquet datasets under root_dir.
+
+    Datasets (each partitioned by run_date, plus the partition given):
+    - qc_rejected (qc_filter): the rows each QC filter removed.
+    - post_qc, typed: the rows after QC and after typing.
+    - typing_categories (typing_category): the DataFrames of categorize_hiv_typing.
+    - hiv1_subtyped (subtype): the rows after subtyping, including 'UI' and 'UN'.
+    - hiv1_subtype_splits (subtype): the per-subtype DataFrames of categorize_hiv1_subtyping.
+    - known_hiv1_subtypes (subtype): the known-subtype rows.
+
+    Parameters:
+    - root_dir (str): Root directory of the datasets.
+    - run_date (str, optional): 'YYYY-MM-DD' partition of this run. Defaults to today.
+    - run_id (str, optional): Tag of this run's files. Defaults to a random id.
+    - The remaining parameters are the stage outputs; missing ones are skipped.
+
+    Returns:
+    - dict or str: Rows written per dataset, or an error message.
+    """
+    run_date = run_date or datetime.date.today().isoformat()
+    run_id = run_id or uuid.uuid4().hex[:8]
+    datasets = []
+    if qc_results is not None:
+        qc_rejected = [results_df.assign(qc_filter=qc_filter) for qc_filter, _ in QC_FILTERS
+                       for results_df in [qc_results.get(f"{qc_filter}_df")] if results_df is not None and not results_df.empty]
+        datasets.append(('qc_rejected', pd.concat(qc_rejected, ignore_index=True) if qc_rejected else None, 'qc_filter'))
+    datasets.append(('post_qc', post_qc_df, None))
+    datasets.append(('typed', typed_df, None))
+    if typing_results is not None:
+        datasets.append(('typing_categories', category_frame(typing_results, 'typing_category'), 'typing_category'))
+    if subtyped_df is not None and not subtyped_df.empty:
+        datasets.append(('hiv1_subtyped', subtyped_df.assign(subtype=subtype_partition_values(subtyped_df)), 'subtype'))
+    if subtyping_results is not None:
+        datasets.append(('hiv1_subtype_splits', category_frame(subtyping_results, 'subtype', prefix='subtype_', suffix=''),
+                         'subtype'))
+    if known_df is not None and not known_df.empty:
+        datasets.append(('known_hiv1_subtypes', known_df.assign(subtype=subtype_partition_values(known_df)), 'subtype'))
+
+    written = {}
+    try:
+        with stage_timer('parquet_export'):
+            for dataset, df, partition_col in datasets:
+                written[dataset] = write_parquet_dataset(df, root_dir, dataset, run_date, run_id, partition_col)
+    except (pa.ArrowException, OSError) as e:
+        return f"Error exporting {dataset} to Parquet: {e}"
+    return written
+
+
+def read_parquet_dataset(root_dir, dataset, columns=None, filters=None):
+    """
+    Reads an exported dataset memory-mapped, with only the given columns and the partitions
+    matching filters (e.g. [('run_date', '=', '2024-05-01'), ('subtype', 'in', ['B', 'C'])]).
+
+    Returns:
+    - DataFrame: Dictionary-encoded columns come back as categoricals.
+    """
+    return pq.read_table(os.path.join(root_dir, dataset), columns=columns, filters=filters,
+                         memory_map=True).to_pandas()
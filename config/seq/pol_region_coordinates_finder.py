@@ -1,3 +1,6 @@
+from profiling_hooks import profiled
+
+@profiled
 def extracting_seq_within_pol_region(ref_seq, query_seq, ref_seq_pol_start_coord, ref_seq_pol_end_coord):
     """
     Extracts subsequences from reference and query sequences based on pol region start and end coordinates.
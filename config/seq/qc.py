@@ -1,6 +1,36 @@
 import re
+import numpy as np
+import pandas as pd
 from end_characters_cleaner import remove_consecutive_ends_n_and_hyphens_repeatedly
 from multistate_character_cleaner import replacing_multistate_characters_with_n 
+from packed_sequence_array import is_packed_sequence_column
+from run_metrics import increment
+
+
+def apply_to_sequences(seq_col, func):
+    """
+    Apply a str -> str function to a sequence column, keeping packed columns packed.
+
+    Parameters:
+    - seq_col (pandas.Series): Sequence column, either str or 'packed_seq' dtype.
+    - func (callable): Function applied to each sequence.
+
+    Returns:
+    - pandas.Series: Transformed column with the same dtype as seq_col.
+    """
+    if is_packed_sequence_column(seq_col):
+        return pd.Series(seq_col.array.map_sequences(func), index=seq_col.index, name=seq_col.name)
+    return seq_col.apply(func)
+
+
+def sequence_lengths(seq_col):
+    """
+    Return the length of each sequence in a str or 'packed_seq' column.
+    """
+    if is_packed_sequence_column(seq_col):
+        return pd.Series(seq_col.array.lengths(), index=seq_col.index, name=seq_col.name)
+    return seq_col.apply(len)
+
 
 def remove_empty_or_none_sequences(seq_table):
     """
@@ -53,7 +83,11 @@ def remove_n_only_sequences(seq_table):
         - n_only (pandas.DataFrame): DataFrame containing the rows with 'n' only sequences.
     """
     # Create a mask to identify rows with sequences consisting of 'n' characters
-    mask = seq_table['seq'].apply(lambda x: x == 'n' * len(x))
+    if is_packed_sequence_column(seq_table['seq']):
+        packed = seq_table['seq'].array
+        mask = pd.Series(packed.count_symbols('n') == packed.lengths(), index=seq_table.index)
+    else:
+        mask = seq_table['seq'].apply(lambda x: x == 'n' * len(x))
     # Identify rows with 'n' only sequences
     n_only_sequences = seq_table[mask]
     # Drop rows that meet the condition
@@ -80,8 +114,15 @@ def remove_low_acgt_ratio_sequences(seq_table):
 
     # Calculate the ratios for each base (a, c, g, t) and add them as new columns
     bases = ['a', 'c', 'g', 't']
-    for base in bases:
-        seq_table[f'{base}_ratio'] = seq_table['seq_cleaned'].apply(lambda x: base_ratio(x, base))
+    if is_packed_sequence_column(seq_table['seq_cleaned']):
+        # Count bases straight from the packed buffer instead of decoding every sequence
+        packed = seq_table['seq_cleaned'].array
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for base in bases:
+                seq_table[f'{base}_ratio'] = packed.count_symbols(base) / packed.lengths()
+    else:
+        for base in bases:
+            seq_table[f'{base}_ratio'] = seq_table['seq_cleaned'].apply(lambda x: base_ratio(x, base))
 
     # Calculate the 'acgt_ratio' and add it as a new column
     seq_table['acgt_ratio'] = seq_table[['a_ratio', 'c_ratio', 'g_ratio', 't_ratio']].sum(axis=1)
@@ -133,6 +174,24 @@ def remove_short_sequences(seq_table, col_name, seq_len):
     seq_table_cleaned = seq_table[~mask]
     return seq_table_cleaned, short_sequences
 
+# Filters of process_sequences in order, with their description in the statements
+QC_FILTERS = [
+    ('empty', "Empty or None sequences"),
+    ('duplicate', "Duplicate sequences"),
+    ('n_only', "'N' only sequences"),
+    ('low_acgt_ratio', "Low ACGT ratio sequences"),
+    ('short', "Short sequences (< 583 nt)"),
+]
+
+
+def count_qc_filter(qc_filter, rows_in, rows_out):
+    """
+    Record the rows going into and out of a QC filter in the run metrics.
+    """
+    increment('qc_rows_in', rows_in, filter=qc_filter)
+    increment('qc_rows_out', rows_out, filter=qc_filter)
+
+
 def process_sequences(seq_table):
     """
     Process a DataFrame with sequences, removing empty, 'n' only sequences,
@@ -145,73 +204,95 @@ def process_sequences(seq_table):
     - dict: A dictionary with statements as keys and resulting DataFrames or details as values.
     """
 
-    # Lowercase all sequences
-    seq_table['seq'] = seq_table['seq'].str.lower()
+    # Lowercase all sequences (packed sequences are stored lowercase already)
+    if not is_packed_sequence_column(seq_table['seq']):
+        seq_table['seq'] = seq_table['seq'].str.lower()
     
-    results = {}
+    removed = {}
     original_count = len(seq_table)
 
     # Remove empty or None sequences
-    seq_table, empty_rows = remove_empty_or_none_sequences(seq_table)
-    empty_count = len(empty_rows)
-    results["empty_statement"] = f"Empty or None sequences removed: {empty_count} rows, remaining {len(seq_table)} rows."
-    results["empty_df"] = empty_rows
+    seq_table, removed['empty'] = remove_empty_or_none_sequences(seq_table)
+    count_qc_filter('empty', len(seq_table) + len(removed['empty']), len(seq_table))
 
     # Find and remove duplicates
-    seq_table, duplicate_rows = find_and_remove_duplicates(seq_table)
-    duplicates_count = len(duplicate_rows)
-    results["duplicate_statement"] = f"Duplicate sequences removed: {duplicates_count} rows, remaining {len(seq_table)} rows."
-    results["duplicate_df"] = duplicate_rows
+    seq_table, removed['duplicate'] = find_and_remove_duplicates(seq_table)
+    count_qc_filter('duplicate', len(seq_table) + len(removed['duplicate']), len(seq_table))
     
     # Remove 'n' only sequences
-    seq_table, n_only_sequences = remove_n_only_sequences(seq_table)
-    n_only_count = len(n_only_sequences)
-    results["n_only_statement"] = f"'N' only sequences removed: {n_only_count} rows, remaining {len(seq_table)} rows."
-    results["n_only_df"] = n_only_sequences
+    seq_table, removed['n_only'] = remove_n_only_sequences(seq_table)
+    count_qc_filter('n_only', len(seq_table) + len(removed['n_only']), len(seq_table))
     
     # Remove consecutive 'n' and/or '-' from either end repeatedly
-    seq_table['seq_cleaned'] = seq_table['seq'].apply(remove_consecutive_ends_n_and_hyphens_repeatedly)
+    seq_table['seq_cleaned'] = apply_to_sequences(seq_table['seq'], remove_consecutive_ends_n_and_hyphens_repeatedly)
 
     # Remove sequences with low ACGT ratio
-    seq_table, low_acgt_ratio_sequences = remove_low_acgt_ratio_sequences(seq_table)
-    low_acgt_count = len(low_acgt_ratio_sequences)
-    results["low_acgt_ratio_statement"] = f"Low ACGT ratio sequences removed: {low_acgt_count} rows, remaining {len(seq_table)} rows."
-    results["low_acgt_ratio_df"] = low_acgt_ratio_sequences
+    seq_table, removed['low_acgt_ratio'] = remove_low_acgt_ratio_sequences(seq_table)
+    count_qc_filter('low_acgt_ratio', len(seq_table) + len(removed['low_acgt_ratio']), len(seq_table))
 
     # Call seq_poly_cleaner to replace all non-acgt and abnormal IUPAC characters to 'n' 
-    seq_table['seq_cleaned'] = seq_table['seq_cleaned'].apply(replacing_multistate_characters_with_n)
+    seq_table['seq_cleaned'] = apply_to_sequences(seq_table['seq_cleaned'], replacing_multistate_characters_with_n)
 
     # Remove consecutive 'n' and/or '-' from either end repeatedly
-    seq_table['seq_cleaned'] = seq_table['seq_cleaned'].apply(remove_consecutive_ends_n_and_hyphens_repeatedly)
+    seq_table['seq_cleaned'] = apply_to_sequences(seq_table['seq_cleaned'], remove_consecutive_ends_n_and_hyphens_repeatedly)
     
     # Remove consecutive internal n's >= 30 nucleotides
-    seq_table['seq_cleaned'] = seq_table['seq_cleaned'].apply(remove_consecutive_internal_ns)
+    seq_table['seq_cleaned'] = apply_to_sequences(seq_table['seq_cleaned'], remove_consecutive_internal_ns)
 
     # Add a new column with the length of each string
-    seq_table['seq_cleaned_len'] = seq_table['seq_cleaned'].apply(len)
+    seq_table['seq_cleaned_len'] = sequence_lengths(seq_table['seq_cleaned'])
     
     # Remove sequences with length < 583 nucleotides 
-    seq_table, short_sequences = remove_short_sequences(seq_table, 'seq_cleaned_len', 583)
-    short_count = len(short_sequences)
-    results["short_statement"] = f"Short sequences (< 583 nt) removed: {short_count} rows, remaining {len(seq_table)} rows."
-    results["short_df"] = short_sequences
+    seq_table, removed['short'] = remove_short_sequences(seq_table, 'seq_cleaned_len', 583)
+    count_qc_filter('short', len(seq_table) + len(removed['short']), len(seq_table))
 
-    final_count = len(seq_table)
-    rows_removed = original_count - final_count
+    return qc_results(original_count, removed), seq_table
+
+
+def qc_results(original_count, removed):
+    """
+    Builds the results dictionary of process_sequences.
+
+    Parameters:
+    - original_count (int): Number of rows before QC.
+    - removed (dict): DataFrame of the rows removed by each filter, keyed as in QC_FILTERS.
+
+    Returns:
+    - dict: '<filter>_statement' and '<filter>_df' for each filter, and 'summary'.
+    """
+    results = {}
+    remaining = original_count
+    for qc_filter, statement in QC_FILTERS:
+        remaining -= len(removed[qc_filter])
+        results[f"{qc_filter}_statement"] = f"{statement} removed: {len(removed[qc_filter])} rows, remaining {remaining} rows."
+        results[f"{qc_filter}_df"] = removed[qc_filter]
 
     summary_statement = (
         f"\nInitial dataset contained {original_count} rows.",
-        f"\nEmpty or None sequences: {empty_count}."
-        f"\nDuplicate sequences: {duplicates_count}."
-        f"\n'N' only sequences: {n_only_count}."
-        f"\nLow ACGT ratio sequences: {low_acgt_count}."
-        f"\nShort sequences (< 583 nt): {short_count}.",
-        f"\n{rows_removed} rows removed in total.",
-        f"\nFinal dataset contains {final_count} rows."
+        ''.join(f"\n{statement}: {len(removed[qc_filter])}." for qc_filter, statement in QC_FILTERS),
+        f"\n{original_count - remaining} rows removed in total.",
+        f"\nFinal dataset contains {remaining} rows."
     )
  
     results["summary"] = '\n'.join(summary_statement)
-    return results, seq_table
+    return results
+
+
+def merge_qc_results(chunk_results):
+    """
+    Combines the results dictionaries of process_sequences run on separate chunks of one
+    table into the dictionary a single run would have given. Exact duplicates must not be
+    split across chunks (see streaming_pipeline.qc_chunks).
+
+    Parameters:
+    - chunk_results (list): (results, original_count) of each chunk.
+
+    Returns:
+    - dict: Results dictionary as returned by process_sequences.
+    """
+    removed = {qc_filter: pd.concat([results[f"{qc_filter}_df"] for results, _ in chunk_results]).sort_index()
+               for qc_filter, _ in QC_FILTERS}
+    return qc_results(sum(count for _, count in chunk_results), removed)
 
 
 def categorize_hiv_typing(hiv_typing_df):
@@ -300,3 +381,15 @@ def categorize_hiv1_subtyping(hiv_subtyping_df):
     
     return results, hiv_subtyping_df
 
+
+def hiv1_subtype_label(subtype, anomaly=None):
+    """
+    Single label of a subtyped row, as used to split outputs by subtype: the 'UI'/'UN' anomaly
+    if set, else hiv1_subtype_lanl (subtypes of rows aggregated into lists joined with '+'),
+    'unknown' if there is none.
+    """
+    if isinstance(anomaly, str) and anomaly:
+        return anomaly
+    if isinstance(subtype, (list, tuple)):
+        return '+'.join(dict.fromkeys(str(value) for value in subtype))
+    return 'unknown' if subtype is None or pd.isna(subtype) else str(subtype)
@@ -0,0 +1,96 @@
+import numpy as np
+from profiling_hooks import profiled
+
+MOSAIC_WINDOW = 400      # query positions per window
+MOSAIC_STEP = 50         # query positions between window starts
+MOSAIC_MIN_MARGIN = 0.02  # similarity lead over the best other subtype for a window to be assigned
+
+
+def query_position_matches(aligned_ref_seq, aligned_query_seq):
+    """
+    Projects a pairwise alignment onto the positions of the query.
+
+    Args:
+        aligned_ref_seq (str): Aligned reference sequence.
+        aligned_query_seq (str): Aligned query sequence.
+
+    Returns:
+        tuple: Two bool arrays over the query positions (alignment columns where the query has no
+        gap): whether the reference has the same base, and whether the position is compared
+        (query a, c, g or t against a reference base).
+    """
+    ref = np.frombuffer(aligned_ref_seq.lower().encode('ascii', 'replace'), dtype=np.uint8)
+    query = np.frombuffer(aligned_query_seq.lower().encode('ascii', 'replace'), dtype=np.uint8)
+    on_query = query != ord('-')
+    ref, query = ref[on_query], query[on_query]
+    compared = np.isin(query, np.frombuffer(b'acgt', dtype=np.uint8)) & (ref != ord('-'))
+    return compared & (ref == query), compared
+
+
+@profiled
+def scan_mosaic(aligned_ref_seqs, aligned_query_seqs, subtypes, window=MOSAIC_WINDOW, step=MOSAIC_STEP,
+                min_margin=MOSAIC_MIN_MARGIN):
+    """
+    Sliding-window best-subtype scan of a query over its existing pairwise alignments to the
+    consensus references, with breakpoints where the best subtype changes.
+
+    Window similarities come from cumulative match counts along the query, so each window costs
+    two subtractions per reference. A window is assigned to the subtype of its most similar
+    reference only if that reference leads every reference of another subtype by min_margin
+    and half the window is compared; other windows stay unassigned and do not break segments.
+    A breakpoint lies halfway between the centers of the last window of one segment and the
+    first window of the next.
+
+    Args:
+        aligned_ref_seqs (list): Aligned reference sequences, one pairwise alignment per reference.
+        aligned_query_seqs (list): The query as aligned to each reference.
+        subtypes (list): Subtype of each reference.
+        window (int): Query positions per window.
+        step (int): Query positions between window starts.
+        min_margin (float): Required similarity lead (fraction) over the best other subtype.
+
+    Returns:
+        str: Segments as 'subtype:start-end' in 1-based query positions joined by '|', e.g.
+        'B:1-1210|C:1211-2950'; '' if the query is shorter than a window or no window is assigned.
+    """
+    projections = [query_position_matches(ref, query) for ref, query in zip(aligned_ref_seqs, aligned_query_seqs)]
+    query_length = len(projections[0][0]) if projections else 0
+    if query_length < window or any(len(matches) != query_length for matches, _ in projections):
+        return ''
+
+    # Cumulative matches and compared positions, with a leading 0
+    cum_matches = np.zeros((len(projections), query_length + 1), dtype=np.int32)
+    cum_compared = np.zeros((len(projections), query_length + 1), dtype=np.int32)
+    cum_matches[:, 1:] = np.cumsum([matches for matches, _ in projections], axis=1)
+    cum_compared[:, 1:] = np.cumsum([compared for _, compared in projections], axis=1)
+
+    starts = np.arange(0, query_length - window + 1, step)
+    if starts[-1] != query_length - window:
+        starts = np.append(starts, query_length - window)
+    ends = starts + window
+    compared = cum_compared[:, ends] - cum_compared[:, starts]
+    similarity = (cum_matches[:, ends] - cum_matches[:, starts]) / np.maximum(compared, 1)
+
+    # Best reference similarity per subtype and window
+    subtypes = np.asarray(subtypes, dtype=object)
+    subtype_names = list(dict.fromkeys(subtypes))
+    subtype_similarity = np.array([similarity[subtypes == name].max(axis=0) for name in subtype_names])
+    order = np.argsort(-subtype_similarity, axis=0)
+    best = order[0]
+    lead = (subtype_similarity[best, np.arange(len(starts))]
+            - (subtype_similarity[order[1], np.arange(len(starts))] if len(subtype_names) > 1 else 0))
+    assigned = (lead >= min_margin) & (compared.max(axis=0) >= window / 2)
+
+    segments = []
+    centers = starts + window / 2
+    for window_index in np.flatnonzero(assigned):
+        name = subtype_names[best[window_index]]
+        if segments and segments[-1][0] == name:
+            segments[-1][2] = window_index
+        else:
+            segments.append([name, window_index, window_index])
+    if not segments:
+        return ''
+    bounds = [0] + [int((centers[previous[2]] + centers[current[1]]) // 2)
+                    for previous, current in zip(segments, segments[1:])] + [query_length]
+    return '|'.join(f"{name}:{bounds[index] + 1}-{bounds[index + 1]}" for index, (name, _, _) in enumerate(segments))
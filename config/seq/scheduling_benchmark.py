@@ -0,0 +1,97 @@
+"""
+Benchmark of the alignment schedulers on a skewed-length dataset.
+
+Compares the old scheduler (np.array_split into equal-row chunks, one chunk per thread) with
+process_sequence_alignment_parallel (longest-first per-row dispatch). The worker sleeps in
+proportion to the query length instead of running MAFFT, so the comparison only measures
+scheduling: makespan and the tail of the row completion times.
+
+Usage:
+    python scheduling_benchmark.py --rows 400 --workers 8
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import config_paths  # config/general modules, when run as a script
+from parallel_alignment_processor import process_sequence_alignment_parallel
+
+
+def skewed_length_dataset(n_rows, long_fraction=0.05, short_len=300, long_len=9000, random_state=0):
+    """
+    Returns query and reference tables where a few queries are much longer than the rest.
+    """
+    rng = np.random.default_rng(random_state)
+    lengths = np.where(rng.random(n_rows) < long_fraction, long_len, short_len)
+    lengths = (lengths * rng.uniform(0.8, 1.2, n_rows)).astype(int)
+    query_df = pd.DataFrame({'seq_cleaned': ['a' * length for length in lengths]})
+    query_df['seq_cleaned_len'] = lengths
+    ref_seq_df = pd.DataFrame({'seq_name': ['ref'], 'ref_seq': ['a' * 3000]})
+    return query_df, ref_seq_df
+
+
+def _timed_sleep_worker(seconds_per_kb, run_start, completions):
+    def worker(query_row_df, ref_seq_df, query_seq_col_name, mafft_executable):
+        time.sleep(len(query_row_df[query_seq_col_name].iloc[0]) / 1000 * seconds_per_kb)
+        completions.append(time.perf_counter() - run_start[0])
+        return query_row_df
+    return worker
+
+
+def _run_equal_chunks(query_df, ref_seq_df, col, worker_func, n_workers):
+    """The scheduler used before cost-aware dispatch: equal-row chunks, one per thread."""
+    def process_chunk(chunk):
+        for _, row in chunk.iterrows():
+            worker_func(pd.DataFrame(row).transpose(), ref_seq_df, col, None)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(process_chunk, chunk) for chunk in np.array_split(query_df, n_workers)]
+        for future in as_completed(futures):
+            future.result()
+
+
+def benchmark_scheduling(n_rows=400, n_workers=8, seconds_per_kb=0.05, random_state=0):
+    """
+    Runs both schedulers on the same skewed dataset.
+
+    Returns:
+    - pandas.DataFrame: One row per scheduler with 'makespan_seconds', 'p50_completion_seconds'
+      and 'p95_completion_seconds'.
+    """
+    query_df, ref_seq_df = skewed_length_dataset(n_rows, random_state=random_state)
+    plan = {'cpu_budget': n_workers, 'pool_width': n_workers, 'max_pool_width': n_workers,
+            'mafft_threads': 1, 'available_memory_mb': 0}
+
+    report = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cost_model_path = os.path.join(tmp_dir, 'cost_model.json')
+        for scheduler in ['equal_chunks', 'longest_first']:
+            completions, run_start = [], [time.perf_counter()]
+            worker = _timed_sleep_worker(seconds_per_kb, run_start, completions)
+            if scheduler == 'equal_chunks':
+                _run_equal_chunks(query_df, ref_seq_df, 'seq_cleaned', worker, n_workers)
+            else:
+                process_sequence_alignment_parallel(query_df, ref_seq_df, 'seq_cleaned', worker, None,
+                                                    resource_plan=plan, cost_model_path=cost_model_path)
+            makespan = time.perf_counter() - run_start[0]
+            report.append({'scheduler': scheduler,
+                           'makespan_seconds': round(makespan, 3),
+                           'p50_completion_seconds': round(float(np.percentile(completions, 50)), 3),
+                           'p95_completion_seconds': round(float(np.percentile(completions, 95)), 3)})
+    return pd.DataFrame(report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare equal-chunk and longest-first alignment scheduling.")
+    parser.add_argument('--rows', type=int, default=400)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--seconds-per-kb', type=float, default=0.05, help="Simulated alignment time per kb of query.")
+    args = parser.parse_args()
+    print(benchmark_scheduling(args.rows, args.workers, args.seconds_per_kb).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+"""
+Streams sequences from result DataFrames or the database into FASTA or relaxed-PHYLIP files
+for tree builders.
+
+    export_database_sequences(database, user, password, host, port, 'trees/pol_{subtype}.phy.gz',
+                              seq_col='aligned_pol', file_format='phylip', split_by_subtype=True)
+
+Rows are read one at a time (from DataFrames, or from a server-side cursor in batches) and
+written straight to the open file of their output, so memory use does not grow with the
+number of sequences. A relaxed-PHYLIP file starts with the sequence count, which is only
+known at the end: its records go to a temporary body file first and are copied behind the
+header line on close. Files are written under a '.tmp' name and renamed when complete, and
+are gzipped if their path ends with '.gz'.
+
+Sequence columns:
+- 'seq_cleaned', 'extracted_pol_query_seq_cleaned' (or any other column): written as stored.
+- 'aligned_pol': the pol sequence aligned in the HXB2 frame (see subtype_msa_store.msa_row),
+  built from extracted_pol_ref_seq and extracted_pol_query_seq; all rows have the same length,
+  as PHYLIP requires.
+
+Headers are built from a template of row columns, e.g. '{pat_id}|{date}|{subtype}', where
+'date' stands for seq_sample_date and 'subtype' for the label of qc.hiv1_subtype_label.
+Whitespace and the Newick characters ',:;()[]' in headers are replaced by '_'.
+"""
+
+import os
+import re
+import gzip
+import shutil
+import string
+import pandas as pd
+import psycopg2
+from qc import hiv1_subtype_label
+from subtype_msa_store import msa_row
+from pairwise_distance_engine import project_to_hxb2_frame
+from run_metrics import increment, stage_timer
+
+DEFAULT_HEADER_TEMPLATE = '{pat_id}|{date}|{subtype}'
+FILE_FORMATS = ('fasta', 'phylip')
+ALIGNED_POL = 'aligned_pol'
+# Template fields that are not column names, with the columns they are built from
+HEADER_FIELD_COLUMNS = {'date': ('seq_sample_date',),
+                        'subtype': ('hiv1_subtype_lanl', 'hiv1_subtype_lanl_anomaly')}
+ALIGNED_POL_COLUMNS = ('extracted_pol_ref_seq', 'extracted_pol_query_seq')
+
+_UNSAFE_HEADER_CHARACTERS = re.compile(r'[\s,:;()\[\]]')
+
+
+def _open(path, mode, compress):
+    return gzip.open(path, mode) if compress else open(path, mode)
+
+
+def template_fields(header_template):
+    """Field names of a header template, e.g. ['pat_id', 'date', 'subtype']."""
+    return [field for _, field, _, _ in string.Formatter().parse(header_template) if field]
+
+
+def source_columns(seq_col, header_template, split_by_subtype=False):
+    """Columns a row needs for seq_col, header_template and the subtype split."""
+    columns = list(ALIGNED_POL_COLUMNS) if seq_col == ALIGNED_POL else [seq_col]
+    if split_by_subtype:
+        columns.extend(HEADER_FIELD_COLUMNS['subtype'])
+    for field in template_fields(header_template):
+        columns.extend(HEADER_FIELD_COLUMNS.get(field, (field,)))
+    return list(dict.fromkeys(columns))
+
+
+def format_header(header_template, row):
+    """Header of a row (dict of column values)."""
+    values = {}
+    for field in template_fields(header_template):
+        if field == 'subtype':
+            value = hiv1_subtype_label(row.get('hiv1_subtype_lanl'), row.get('hiv1_subtype_lanl_anomaly'))
+        else:
+            value = row.get(HEADER_FIELD_COLUMNS.get(field, (field,))[0])
+        values[field] = '' if value is None or (not isinstance(value, (list, tuple)) and pd.isna(value)) else value
+    return _UNSAFE_HEADER_CHARACTERS.sub('_', header_template.format(**values))
+
+
+class SequenceFileWriter:
+    """
+    One FASTA or relaxed-PHYLIP output file, written record by record.
+
+    Parameters:
+    - path (str): Output file; gzipped if it ends with '.gz'.
+    - file_format (str): 'fasta' or 'phylip'.
+    - line_width (int, optional): FASTA sequence line width; None writes each sequence on one line.
+    """
+
+    def __init__(self, path, file_format='fasta', line_width=None):
+        self.path = path
+        self.file_format = file_format
+        self.line_width = line_width
+        self.count = 0
+        self.length = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # PHYLIP records wait in an uncompressed body file until the count is known
+        self._write_path = path + ('.body.tmp' if file_format == 'phylip' else '.tmp')
+        self._file = _open(self._write_path, 'wt', path.endswith('.gz') and file_format == 'fasta')
+
+    def write(self, header, sequence):
+        """Writes one record; raises ValueError if a PHYLIP sequence differs in length from the first."""
+        if self.file_format == 'phylip':
+            if self.length is None:
+                self.length = len(sequence)
+            elif len(sequence) != self.length:
+                raise ValueError(f"{header} has {len(sequence)} sites, {self.path} has {self.length}; "
+                                 f"PHYLIP needs aligned sequences (e.g. seq_col='{ALIGNED_POL}').")
+            self._file.write(f"{header} {sequence}\n")
+        elif self.line_width:
+            lines = '\n'.join(sequence[start:start + self.line_width]
+                              for start in range(0, len(sequence), self.line_width))
+            self._file.write(f">{header}\n{lines}\n")
+        else:
+            self._file.write(f">{header}\n{sequence}\n")
+        self.count += 1
+
+    def close(self):
+        """Completes the file and moves it into place. Returns the number of records."""
+        self._file.close()
+        if self.file_format == 'phylip':
+            with _open(self.path + '.tmp', 'wt', self.path.endswith('.gz')) as f, open(self._write_path, 'r') as body:
+                f.write(f"{self.count} {self.length or 0}\n")
+                shutil.copyfileobj(body, f)
+            os.remove(self._write_path)
+        os.replace(self.path + '.tmp', self.path)
+        return self.count
+
+    def abort(self):
+        """Closes and removes the partial file."""
+        self._file.close()
+        for path in {self._write_path, self.path + '.tmp'}:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def write_sequence_files(rows, output_path, seq_col='extracted_pol_query_seq_cleaned',
+                         header_template=DEFAULT_HEADER_TEMPLATE, file_format='fasta', split_by_subtype=False,
+                         frame_length=None, line_width=None):
+    """
+    Writes the sequences of rows to one file, or one file per subtype.
+
+    Parameters:
+    - rows (iterable): Dicts with the columns of source_columns(seq_col, header_template, split_by_subtype).
+    - output_path (str): Output file; with split_by_subtype it must contain '{subtype}'
+      (e.g. 'pol_{subtype}.fasta.gz'). Ends with '.gz' for gzip.
+    - seq_col (str): Column written, or 'aligned_pol'.
+    - header_template (str): Header template (see the module docstring).
+    - file_format (str): 'fasta' or 'phylip'.
+    - split_by_subtype (bool): One file per qc.hiv1_subtype_label.
+    - frame_length (int, optional): Columns of 'aligned_pol'. Defaults to the HXB2 frame
+      length of the first row.
+    - line_width (int, optional): FASTA sequence line width.
+
+    Returns:
+    - dict or str: 'files' (path -> sequences written) and 'skipped' (rows without a sequence),
+      or an error message. Nothing is left behind on error.
+    """
+    if file_format not in FILE_FORMATS:
+        return f"Error: unknown file format '{file_format}', expected one of {FILE_FORMATS}."
+    if split_by_subtype and '{subtype}' not in output_path:
+        return f"Error: output path '{output_path}' needs a '{{subtype}}' placeholder to split by subtype."
+
+    writers = {}
+    skipped = 0
+    try:
+        for row in rows:
+            if seq_col == ALIGNED_POL:
+                ref, query = row.get('extracted_pol_ref_seq'), row.get('extracted_pol_query_seq')
+                if not (isinstance(ref, str) and isinstance(query, str) and ref and len(ref) == len(query)):
+                    skipped += 1
+                    continue
+                if frame_length is None:
+                    frame_length = len(project_to_hxb2_frame(ref, query))
+                sequence = msa_row(ref, query, frame_length)[0]
+            else:
+                sequence = row.get(seq_col)
+            if not isinstance(sequence, str) or not sequence:
+                skipped += 1
+                continue
+            path = output_path
+            if split_by_subtype:
+                subtype = hiv1_subtype_label(row.get('hiv1_subtype_lanl'), row.get('hiv1_subtype_lanl_anomaly'))
+                path = output_path.replace('{subtype}', re.sub(r'[^0-9A-Za-z_+]+', '_', subtype))
+            if path not in writers:
+                writers[path] = SequenceFileWriter(path, file_format, line_width)
+            writers[path].write(format_header(header_template, row), sequence)
+        files = {path: writer.close() for path, writer in writers.items()}
+    except (ValueError, KeyError, OSError, psycopg2.Error) as e:
+        for writer in writers.values():
+            writer.abort()
+        return f"Error writing {output_path}: {e}"
+    increment('sequence_file_records', sum(files.values()), format=file_format)
+    return {'files': files, 'skipped': skipped}
+
+
+def iter_dataframe_rows(dfs, columns):
+    """
+    Yields the rows of a DataFrame, or of each DataFrame of an iterable, as dicts of columns
+    (missing columns are None). Packed sequence columns are decoded one row at a time.
+    """
+    for df in [dfs] if hasattr(dfs, 'columns') else dfs:
+        present = [col for col in columns if col in df.columns]
+        for values in zip(*(df[col] for col in present)) if present else ():
+            row = dict.fromkeys(columns)
+            row.update(zip(present, values))
+            yield row
+
+
+def iter_database_rows(database, user, password, host, port, columns, table_name='seq', where=None, params=None,
+                       batch_size=5000):
+    """
+    Yields the rows of table_name (optionally filtered by a WHERE clause with %s params) as
+    dicts of columns, read with a server-side cursor in batches of batch_size rows.
+    """
+    query = f"SELECT {', '.join(columns)} FROM {table_name}" + (f" WHERE {where}" if where else '') + " ORDER BY id"
+    with psycopg2.connect(database=database, user=user, password=password, host=host, port=port) as connection:
+        with connection.cursor(name='sequence_file_export') as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(query, params)
+            increment('db_round_trips', operation='sequence_file_export', table=table_name)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(zip(columns, row))
+
+
+def export_dataframe_sequences(dfs, output_path, seq_col='extracted_pol_query_seq_cleaned',
+                               header_template=DEFAULT_HEADER_TEMPLATE, file_format='fasta', split_by_subtype=False,
+                               frame_length=None, line_width=None):
+    """
+    Writes the sequences of result DataFrames (e.g. known_hiv1_subtypes) to FASTA or PHYLIP.
+    dfs is a DataFrame or an iterable of DataFrames; see write_sequence_files for the rest.
+    """
+    with stage_timer('sequence_file_export'):
+        return write_sequence_files(iter_dataframe_rows(dfs, source_columns(seq_col, header_template, split_by_subtype)), output_path,
+                                    seq_col, header_template, file_format, split_by_subtype, frame_length, line_width)
+
+
+def export_database_sequences(database, user, password, host, port, output_path,
+                              seq_col='extracted_pol_query_seq_cleaned', header_template=DEFAULT_HEADER_TEMPLATE,
+                              file_format='fasta', split_by_subtype=False, table_name='seq', where=None, params=None,
+                              frame_length=None, line_width=None, batch_size=5000):
+    """
+    Writes the sequences of table_name to FASTA or PHYLIP, streamed from a server-side cursor.
+    where and params filter the rows (e.g. where="seq_sample_date >= %s", params=('2020-01-01',));
+    see write_sequence_files for the rest.
+    """
+    columns = source_columns(seq_col, header_template, split_by_subtype)
+    with stage_timer('sequence_file_export'):
+        return write_sequence_files(iter_database_rows(database, user, password, host, port, columns, table_name,
+                                                       where, params, batch_size),
+                                    output_path, seq_col, header_template, file_format, split_by_subtype,
+                                    frame_length, line_width)
@@ -1,5 +1,7 @@
 from end_characters_cleaner import remove_consecutive_ends_n_and_hyphens_repeatedly
+from profiling_hooks import profiled
 
+@profiled
 def calculate_similarity_between_aligned_seqs(aligned_ref_seq, aligned_query_seq):
     """
     Calculates the similarity between two aligned DNA sequences.
@@ -0,0 +1,358 @@
+"""
+Streaming version of the sequence processing stages.
+
+    QC -> HIV typing -> HIV-1 filter -> HIV-1 subtyping -> hypermutation -> upload
+
+Each stage has its own worker threads and a bounded queue in front of it, so a row moves to
+the next stage as soon as it is ready instead of waiting for the whole table (subtyping
+starts while typing still runs, and no stage waits for the stragglers of the one before).
+A full queue blocks the stage that feeds it, which keeps the rows in flight, and so memory,
+bounded. Typing and subtyping share one concurrency limiter, so while both run their MAFFT
+processes together stay within the planned pool width. The categorized outputs of
+categorize_hiv_typing and categorize_hiv1_subtyping are rebuilt from the finished rows at the
+end.
+"""
+
+import math
+import queue
+import time
+import logging
+import threading
+import pandas as pd
+from qc import process_sequences, merge_qc_results, categorize_hiv_typing, categorize_hiv1_subtyping
+from packed_sequence_array import is_packed_sequence_column
+from hiv_typing_alignment_worker import perform_hiv_typing
+from hiv_subtyping_alignment_worker import align_hiv1_subtype_references, finalize_hiv_subtyping
+from alignment_resource_planner import plan_alignment_resources, AdaptiveConcurrencyLimiter
+from alignment_cost_model import alignment_work
+from parallel_alignment_processor import (isolate_worker, quarantine_row, RowQuarantined, worker_options,
+                                          DEFAULT_MAFFT_TIMEOUT_SECONDS)
+from run_metrics import observe, set_gauge
+
+# Marks the end of a stage's input
+_END = object()
+
+
+class StreamStage:
+    """
+    One stage of a stage graph.
+
+    Parameters:
+    - name (str): Stage name in logs and metrics.
+    - func (callable): item -> iterable of output items (none to drop the item).
+    - workers (int): Threads running func.
+    - flush (callable, optional): Called once after the last item; returns remaining output items
+      (e.g. the last partial batch).
+    """
+
+    def __init__(self, name, func, workers=1, flush=None):
+        self.name = name
+        self.func = func
+        self.workers = max(int(workers), 1)
+        self.flush = flush
+
+
+def run_stage_graph(source, stages, queue_size=64):
+    """
+    Runs the items of source through a chain of stages connected by bounded queues.
+
+    Parameters:
+    - source (iterable): Input items of the first stage.
+    - stages (list): StreamStage objects, in order.
+    - queue_size (int): Capacity of the queue in front of each stage.
+
+    Returns:
+    - list: Output items of the last stage, in completion order.
+
+    Raises:
+    - Exception: The first error raised by a stage function; the other stages stop.
+    """
+    queues = [queue.Queue(queue_size) for _ in stages]
+    outputs, errors = [], []
+    stop = threading.Event()
+    lock = threading.Lock()
+    remaining_workers = [stage.workers for stage in stages]
+
+    def put(index, item):
+        # Blocks while the queue is full (backpressure), unless the graph is stopping
+        while not stop.is_set():
+            try:
+                queues[index].put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def emit(index, items):
+        for item in items:
+            if index + 1 == len(stages):
+                with lock:
+                    outputs.append(item)
+            elif not put(index + 1, item):
+                return False
+        return True
+
+    def fail(error):
+        with lock:
+            errors.append(error)
+        stop.set()
+
+    def feed():
+        try:
+            for item in source:
+                if not put(0, item):
+                    return
+        except Exception as e:
+            fail(e)
+            return
+        for _ in range(stages[0].workers):
+            put(0, _END)
+
+    def work(index):
+        stage = stages[index]
+        while True:
+            try:
+                item = queues[index].get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return
+                continue
+            set_gauge('stream_queue_depth', queues[index].qsize(), stage=stage.name)
+            if item is _END:
+                break
+            start = time.perf_counter()
+            try:
+                if not emit(index, stage.func(item)):
+                    return
+            except Exception as e:
+                logging.error(f"Stage {stage.name} failed: {type(e).__name__}: {e}")
+                fail(e)
+                return
+            observe('stream_stage_seconds', time.perf_counter() - start, stage=stage.name)
+
+        # The last worker of a stage flushes it and ends the next stage
+        with lock:
+            remaining_workers[index] -= 1
+            last = remaining_workers[index] == 0
+        if not last:
+            return
+        try:
+            if stage.flush is not None and not emit(index, stage.flush()):
+                return
+        except Exception as e:
+            fail(e)
+            return
+        if index + 1 < len(stages):
+            for _ in range(stages[index + 1].workers):
+                put(index + 1, _END)
+
+    threads = [threading.Thread(target=feed, name='stream-source', daemon=True)]
+    for index, stage in enumerate(stages):
+        threads += [threading.Thread(target=work, args=(index,), name=f"stream-{stage.name}-{n}", daemon=True)
+                    for n in range(stage.workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return outputs
+
+
+def qc_chunks(seq_df, chunk_size):
+    """
+    Splits the uploaded rows into chunks of about chunk_size rows for QC. Rows are assigned by a
+    hash of their values as the duplicate filter of process_sequences compares them ('seq'
+    lowercased), so duplicates land in the same chunk and the filter gives the same result as on
+    the whole table.
+    """
+    n_chunks = max(math.ceil(len(seq_df) / chunk_size), 1)
+    keys = seq_df.astype(str)
+    if 'seq' in seq_df.columns and not is_packed_sequence_column(seq_df['seq']):
+        keys['seq'] = keys['seq'].str.lower()
+    buckets = pd.util.hash_pandas_object(keys, index=False) % n_chunks
+    for bucket in range(n_chunks):
+        chunk = seq_df[(buckets == bucket).to_numpy()]
+        if not chunk.empty:
+            yield chunk
+
+
+def _ordered_concat(items):
+    """Concatenates (position, DataFrame) items in position order."""
+    frames = [df for _, df in sorted(items, key=lambda item: item[0]) if df is not None and not df.empty]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def stream_sequence_data(seq_df, hiv_type_ref_seq_df, hiv_subtype_con_ref_seq_df, mafft_executable, upload_sink=None,
+                         qc_chunk_size=500, queue_size=None, typing_workers=None,
+                         subtyping_workers=None, hypermutation_workers=1, timeout_seconds=DEFAULT_MAFFT_TIMEOUT_SECONDS,
+                         max_retries=2, retry_backoff_seconds=1.0, mafft_engine='subprocess', ref_region_df=None,
+                         mafft_strategy='auto'):
+    """
+    Runs QC, typing, subtyping, hypermutation and upload as a streaming stage graph.
+
+    Rows whose typing or subtyping fails are retried and quarantined as in
+    process_sequence_alignment_isolated.
+
+    Args:
+    - seq_df (pandas.DataFrame): Uploaded rows (output of data_upload_and_header_matching).
+    - hiv_type_ref_seq_df (pandas.DataFrame): The hiv_type_ref_seq table.
+    - hiv_subtype_con_ref_seq_df (pandas.DataFrame): The hiv_subtype_con_ref_seq table.
+    - mafft_executable (str): Path to the MAFFT executable.
+    - upload_sink (IncrementalUploadSink, optional): Receives the known-subtype rows as they finish
+      and is closed at the end. Without it nothing is uploaded.
+    - qc_chunk_size (int): Rows per QC chunk.
+    - queue_size (int, optional): Capacity of each queue. Defaults to 4 rows per alignment worker.
+    - typing_workers, subtyping_workers (int, optional): Alignment threads per stage. Default to the
+      planned maximum pool width (see plan_alignment_resources) each. How many alignments run at
+      once is decided by one AdaptiveConcurrencyLimiter shared by both stages, so a stage can use
+      the whole width while the other is idle but together they never exceed it.
+    - hypermutation_workers (int): Threads of the hypermutation stage.
+    - timeout_seconds, max_retries, retry_backoff_seconds: As in process_sequence_alignment_isolated.
+    - mafft_engine (str): 'subprocess' or 'async' (see async_mafft_engine.mafft_alignment_function).
+    - ref_region_df (pandas.DataFrame, optional): The hiv_type_ref_region table; typing adds the
+      columns of these regions (see perform_hiv_typing).
+    - mafft_strategy (str): MAFFT strategy of typing and subtyping, e.g. 'adaptive' (see
+      mafft_strategy_selector.resolve_mafft_strategy).
+
+    Returns:
+    - dict or str: 'qc_results', 'post_qc_df', 'typed_df', 'categorized_hiv_typing_results',
+      'subtyped_df', 'categorized_hiv1_subtyping_results', 'known_hiv1_subtypes', 'uploaded_df',
+      'not_uploaded_df', 'quarantine_df' and 'stats' (rows in and out of each stage and
+      quarantined rows), or an error message.
+    """
+    if not seq_df.index.is_unique:
+        seq_df = seq_df.reset_index(drop=True)
+    try:
+        plan = plan_alignment_resources(len(seq_df))
+    except Exception as e:
+        return f"Error getting system cores: {e}"
+    typing_workers = typing_workers or plan['max_pool_width']
+    subtyping_workers = subtyping_workers or plan['max_pool_width']
+    limiter = AdaptiveConcurrencyLimiter(plan['pool_width'], plan['max_pool_width'])
+    limiter.set_queue_depth(len(seq_df))
+    queue_size = queue_size or 4 * max(typing_workers, subtyping_workers)
+
+    qc_parts, typed, hiv1, aligned, subtyped, quarantined = [], [], [], [], [], []
+    typing_stats = {'succeeded': 0, 'retried': 0, 'retries': 0, 'quarantined': 0}
+    subtyping_stats = {'succeeded': 0, 'retried': 0, 'retries': 0, 'quarantined': 0}
+    isolated_typing = isolate_worker(perform_hiv_typing, typing_stats, quarantined, max_retries, retry_backoff_seconds)
+    isolated_subtyping = isolate_worker(align_hiv1_subtype_references, subtyping_stats, quarantined, max_retries,
+                                        retry_backoff_seconds, stage='perform_hiv_subtyping')
+    typing_options = worker_options(perform_hiv_typing, batch_size=len(seq_df), mafft_threads=plan['mafft_threads'],
+                                    mafft_timeout=timeout_seconds, mafft_engine=mafft_engine,
+                                    ref_region_df=ref_region_df, mafft_strategy=mafft_strategy)
+    subtyping_options = worker_options(align_hiv1_subtype_references, batch_size=len(seq_df),
+                                       mafft_threads=plan['mafft_threads'], mafft_timeout=timeout_seconds,
+                                       mafft_engine=mafft_engine, mafft_strategy=mafft_strategy)
+
+    def limited(isolated_worker, row_df, ref_seq_df, query_seq_col_name, options):
+        # Alignments of both stages take their slot from the shared limiter
+        work = alignment_work(row_df, ref_seq_df, query_seq_col_name)[0]
+        limiter.acquire()
+        start = time.perf_counter()
+        try:
+            return isolated_worker(row_df, ref_seq_df, query_seq_col_name, mafft_executable, **options)
+        finally:
+            limiter.release(time.perf_counter() - start, work)
+
+    def qc(chunk):
+        results, post_qc_df = process_sequences(chunk.copy())
+        qc_parts.append((results, len(chunk), post_qc_df))
+        return [(position, post_qc_df.loc[[position]]) for position in post_qc_df.index]
+
+    def typing(item):
+        position, row_df = item
+        try:
+            typed_df = limited(isolated_typing, row_df, hiv_type_ref_seq_df, 'seq_cleaned', typing_options)
+        except RowQuarantined:
+            return []
+        typed.append((position, typed_df))
+        return [(position, typed_df)]
+
+    def hiv1_filter(item):
+        position, typed_df = item
+        hiv1_df = categorize_hiv_typing(typed_df)['hiv1_df']
+        if hiv1_df.empty:
+            return []
+        hiv1.append(position)
+        return [(position, hiv1_df)]
+
+    def subtyping(item):
+        position, hiv1_df = item
+        try:
+            alignment_df = limited(isolated_subtyping, hiv1_df, hiv_subtype_con_ref_seq_df,
+                                   'extracted_pol_query_seq_cleaned', subtyping_options)
+        except RowQuarantined:
+            return []
+        aligned.append(position)
+        return [(position, hiv1_df, alignment_df)]
+
+    def hypermutation(item):
+        position, hiv1_df, alignment_df = item
+        try:
+            subtyped_df = finalize_hiv_subtyping(alignment_df)
+        except Exception as e:
+            logging.error(f"hypermutation: quarantining row: {type(e).__name__}: {e}")
+            quarantined.append(quarantine_row(hiv1_df, 'perform_hiv_subtyping', e, 1))
+            return []
+        subtyped.append((position, subtyped_df))
+        return [(position, subtyped_df)]
+
+    def upload(item):
+        _, known_df = categorize_hiv1_subtyping(item[1])
+        if upload_sink is not None:
+            upload_sink.put(known_df)
+        return [item]
+
+    def flush_uploads():
+        if upload_sink is not None:
+            upload_sink.flush()
+        return []
+
+    stages = [StreamStage('qc', qc),
+              StreamStage('hiv_typing', typing, typing_workers),
+              StreamStage('hiv1_filter', hiv1_filter),
+              StreamStage('hiv1_subtyping', subtyping, subtyping_workers),
+              StreamStage('hypermutation', hypermutation, hypermutation_workers),
+              StreamStage('upload', upload, flush=flush_uploads)]
+
+    try:
+        run_stage_graph(qc_chunks(seq_df, qc_chunk_size), stages, queue_size)
+    except Exception as e:
+        if upload_sink is not None:
+            upload_sink.close()
+        return f"Error in streaming pipeline: {e}"
+
+    uploaded_df, not_uploaded_df = pd.DataFrame(), pd.DataFrame()
+    if upload_sink is not None:
+        upload_results = upload_sink.close()
+        if isinstance(upload_results, str):
+            return upload_results
+        uploaded_df, not_uploaded_df = upload_results
+
+    # Rebuild the whole-table outputs from the finished rows
+    qc_results = merge_qc_results([(results, count) for results, count, _ in qc_parts])
+    post_qc_df = pd.concat([df for _, _, df in qc_parts]).sort_index() if qc_parts else pd.DataFrame()
+    typed_df = _ordered_concat(typed)
+    subtyped_df = _ordered_concat(subtyped)
+    categorized_hiv_typing_results = categorize_hiv_typing(typed_df) if not typed_df.empty else None
+    categorized_hiv1_subtyping_results, known_hiv1_subtypes = (categorize_hiv1_subtyping(subtyped_df)
+                                                               if not subtyped_df.empty else (None, pd.DataFrame()))
+    stats = {'rows': len(seq_df), 'post_qc': len(post_qc_df), 'typed': len(typed), 'hiv1': len(hiv1),
+             'subtyped': len(subtyped), 'known_subtype': len(known_hiv1_subtypes),
+             'typing_quarantined': typing_stats['quarantined'], 'typing_retries': typing_stats['retries'],
+             'subtyping_quarantined': len(aligned) - len(subtyped) + subtyping_stats['quarantined'],
+             'subtyping_retries': subtyping_stats['retries']}
+    logging.info(f"Streaming pipeline: {stats}, concurrency limits {limiter.limit_history}")
+    return {'qc_results': qc_results,
+            'post_qc_df': post_qc_df,
+            'typed_df': typed_df,
+            'categorized_hiv_typing_results': categorized_hiv_typing_results,
+            'subtyped_df': subtyped_df,
+            'categorized_hiv1_subtyping_results': categorized_hiv1_subtyping_results,
+            'known_hiv1_subtypes': known_hiv1_subtypes,
+            'uploaded_df': uploaded_df,
+            'not_uploaded_df': not_uploaded_df,
+            'quarantine_df': pd.concat(quarantined, ignore_index=True) if quarantined else pd.DataFrame(),
+            'stats': stats}
@@ -0,0 +1,265 @@
+"""
+Versioned per-subtype multiple sequence alignments of pol, updated incrementally.
+
+The alignment is anchored to HXB2: its columns are the HXB2 pol positions, and a sequence is
+added by projecting its typing alignment onto them (see pairwise_distance_engine.
+project_to_hxb2_frame). Adding sequences therefore never moves existing columns, needs no
+MAFFT call, and costs time proportional to the new sequences only. As with
+'mafft --add --keeplength', insertions relative to HXB2 are left out; the number of dropped
+insertion columns is recorded per update.
+
+Layout of '<root_dir>/<subtype>/':
+- manifest.json: frame length, current version, segments, removals and the history of updates.
+- segment_NNNNN.fasta.gz: the rows added by version NNNNN, with segment_NNNNN.ids listing
+  their ids.
+- tombstones_NNNNN.ids: the ids removed by version NNNNN. A removal hides the rows of the id
+  added before it, so a retracted sequence can be added again later.
+Segment and tombstone files only count once the manifest lists them, and the manifest is
+written last, so files left by a crashed update are ignored and overwritten by the next one.
+Every version can be exported as a snapshot.
+"""
+
+import os
+import re
+import gzip
+import json
+import datetime
+import numpy as np
+from pairwise_distance_engine import project_to_hxb2_frame
+
+# Columns joined with '|' into the id of a sequence in the alignment
+MSA_ID_COLUMNS = ('pat_id', 'seq_sample_date')
+
+
+def sequence_ids(df, id_columns=MSA_ID_COLUMNS):
+    """Returns the alignment id of each row, e.g. '1234|2021-05-03'."""
+    return df[list(id_columns)].astype(str).agg('|'.join, axis=1).tolist()
+
+
+def msa_row(extracted_pol_ref_seq, extracted_pol_query_seq, frame_length):
+    """
+    Returns the aligned row of a sequence in the HXB2 pol frame, with uncovered ends as gaps,
+    and the number of insertion columns (relative to HXB2) left out.
+    """
+    frame = project_to_hxb2_frame(extracted_pol_ref_seq, extracted_pol_query_seq, frame_length)
+    core = frame.strip('n')
+    leading = len(frame) - len(frame.lstrip('n'))
+    row = '-' * leading + core + '-' * (len(frame) - leading - len(core))
+    ref = np.frombuffer(extracted_pol_ref_seq.encode('ascii', 'replace'), dtype=np.uint8)
+    query = np.frombuffer(extracted_pol_query_seq.encode('ascii', 'replace'), dtype=np.uint8)
+    insertions = int(((ref == ord('-')) & (query != ord('-'))).sum())
+    return row, insertions
+
+
+def _subtype_dir_name(subtype):
+    return re.sub(r'[^0-9A-Za-z_]+', '_', str(subtype))
+
+
+class SubtypeMSAStore:
+    """
+    Versioned HXB2-anchored alignment of one subtype's pol sequences, stored in a directory.
+
+    Parameters:
+    - root_dir (str): Directory holding one sub-directory per subtype.
+    - subtype (str): hiv1_subtype_lanl of the alignment.
+    - frame_length (int, optional): Number of columns of a new alignment. Defaults to the
+      projection length of the first added sequence; an existing alignment keeps its own.
+    """
+
+    def __init__(self, root_dir, subtype, frame_length=None):
+        self.subtype = subtype
+        self.path = os.path.join(root_dir, _subtype_dir_name(subtype))
+        self.manifest_path = os.path.join(self.path, 'manifest.json')
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'subtype': subtype, 'frame_length': frame_length, 'version': 0, 'segments': [],
+                             'removals': [], 'history': []}
+
+    @property
+    def version(self):
+        return self.manifest['version']
+
+    def _write_manifest(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def _tombstones(self):
+        """id -> sorted versions at which it was removed."""
+        removals = {}
+        for removal in self.manifest['removals']:
+            for seq_id in self._read_ids(removal['ids']):
+                removals.setdefault(seq_id, []).append(removal['version'])
+        return {seq_id: sorted(versions) for seq_id, versions in removals.items()}
+
+    def _read_ids(self, file_name):
+        with open(os.path.join(self.path, file_name), 'r') as f:
+            return f.read().split('\n')[:-1]
+
+    def _write_ids(self, file_name, ids):
+        with open(os.path.join(self.path, file_name), 'w') as f:
+            f.write(''.join(f"{seq_id}\n" for seq_id in ids))
+
+    def _is_visible(self, seq_id, added_version, version, tombstones):
+        return not any(added_version < removed <= version for removed in tombstones.get(seq_id, ()))
+
+    def live_ids(self, version=None):
+        """Ids of the sequences in the alignment at version (default: the current one)."""
+        version = self.version if version is None else version
+        tombstones = self._tombstones()
+        live = set()
+        for segment in self.manifest['segments']:
+            if segment['version'] <= version:
+                live.update(seq_id for seq_id in self._read_ids(segment['ids'])
+                            if self._is_visible(seq_id, segment['version'], version, tombstones))
+        return live
+
+    def add(self, df, id_columns=MSA_ID_COLUMNS, ref_col='extracted_pol_ref_seq', query_col='extracted_pol_query_seq'):
+        """
+        Adds the rows of df that are not in the alignment yet as a new version.
+
+        Parameters:
+        - df (DataFrame): Rows of this subtype with their typing alignment columns.
+        - id_columns (tuple): Columns making up the sequence ids.
+        - ref_col, query_col (str): Columns of the aligned HXB2 pol and query sequences.
+
+        Returns:
+        - dict: 'version', 'added', 'already_present', 'unusable' (no alignment or nothing
+          covered) and 'insertion_columns_dropped'.
+        """
+        stats = {'version': self.version, 'added': 0, 'already_present': 0, 'unusable': 0,
+                 'insertion_columns_dropped': 0}
+        live = self.live_ids()
+        new_version = self.version + 1
+        segment_name = f"segment_{new_version:05d}"
+        ids, rows = [], []
+        for seq_id, ref, query in zip(sequence_ids(df, id_columns), df[ref_col], df[query_col]):
+            if seq_id in live:
+                stats['already_present'] += 1
+                continue
+            if not (isinstance(ref, str) and isinstance(query, str) and len(ref) == len(query) and ref):
+                stats['unusable'] += 1
+                continue
+            if self.manifest['frame_length'] is None:
+                self.manifest['frame_length'] = len(project_to_hxb2_frame(ref, query))
+            row, insertions = msa_row(ref, query, self.manifest['frame_length'])
+            if row.strip('-') == '':
+                stats['unusable'] += 1
+                continue
+            live.add(seq_id)
+            ids.append(seq_id)
+            rows.append(row)
+            stats['insertion_columns_dropped'] += insertions
+        if not ids:
+            return stats
+
+        os.makedirs(self.path, exist_ok=True)
+        with gzip.open(os.path.join(self.path, f"{segment_name}.fasta.gz"), 'wt') as f:
+            for seq_id, row in zip(ids, rows):
+                f.write(f">{seq_id}\n{row}\n")
+        self._write_ids(f"{segment_name}.ids", ids)
+        self.manifest['segments'].append({'version': new_version, 'fasta': f"{segment_name}.fasta.gz",
+                                          'ids': f"{segment_name}.ids", 'rows': len(ids)})
+        self._commit_version('add', len(ids))
+        stats.update(version=new_version, added=len(ids))
+        return stats
+
+    def remove(self, seq_ids):
+        """
+        Removes (retracts) sequences from the alignment as a new version.
+
+        Returns:
+        - dict: 'version' and 'removed' (ids that were in the alignment).
+        """
+        live = self.live_ids()
+        removed = sorted(set(seq_ids) & live)
+        if not removed:
+            return {'version': self.version, 'removed': 0}
+        new_version = self.version + 1
+        os.makedirs(self.path, exist_ok=True)
+        self._write_ids(f"tombstones_{new_version:05d}.ids", removed)
+        self.manifest['removals'].append({'version': new_version, 'ids': f"tombstones_{new_version:05d}.ids"})
+        self._commit_version('remove', len(removed))
+        return {'version': new_version, 'removed': len(removed)}
+
+    def _commit_version(self, operation, count):
+        self.manifest['version'] += 1
+        self.manifest['history'].append({'version': self.manifest['version'], 'operation': operation, 'count': count,
+                                         'date': datetime.datetime.now().isoformat(timespec='seconds')})
+        # The manifest is written last: a crash before it leaves the previous version intact
+        self._write_manifest()
+
+    def iter_rows(self, version=None):
+        """Yields (id, aligned row) of the alignment at version (default: the current one), oldest first."""
+        version = self.version if version is None else version
+        tombstones = self._tombstones()
+        for segment in self.manifest['segments']:
+            if segment['version'] > version:
+                break
+            with gzip.open(os.path.join(self.path, segment['fasta']), 'rt') as f:
+                for header, row in zip(f, f):
+                    seq_id = header[1:].rstrip('\n')
+                    if self._is_visible(seq_id, segment['version'], version, tombstones):
+                        yield seq_id, row.rstrip('\n')
+
+    def export_snapshot(self, output_path, version=None):
+        """
+        Writes the alignment at version (default: the current one) as FASTA, gzipped if
+        output_path ends with '.gz'.
+
+        Returns:
+        - int or str: Number of sequences written, or an error message.
+        """
+        version = self.version if version is None else version
+        if not 0 <= version <= self.version:
+            return f"Error: version {version} of the {self.subtype} alignment does not exist (current: {self.version})."
+        opener = gzip.open if output_path.endswith('.gz') else open
+        count = 0
+        with opener(output_path + '.tmp', 'wt') as f:
+            for seq_id, row in self.iter_rows(version):
+                f.write(f">{seq_id}\n{row}\n")
+                count += 1
+        os.replace(output_path + '.tmp', output_path)
+        return count
+
+
+def update_subtype_msas(root_dir, known_hiv1_subtypes, subtype_col='hiv1_subtype_lanl', id_columns=MSA_ID_COLUMNS):
+    """
+    Adds known-subtype rows to the alignment of their subtype.
+
+    Rows whose subtype is not a single value (duplicate samples aggregated into lists) are skipped.
+
+    Parameters:
+    - root_dir (str): Directory of the alignments.
+    - known_hiv1_subtypes (DataFrame): Output of categorize_hiv1_subtyping, with the typing alignment columns.
+
+    Returns:
+    - dict: subtype -> stats of SubtypeMSAStore.add.
+    """
+    single = known_hiv1_subtypes[subtype_col].map(lambda subtype: isinstance(subtype, str))
+    results = {}
+    for subtype, subtype_df in known_hiv1_subtypes[single].groupby(subtype_col):
+        results[subtype] = SubtypeMSAStore(root_dir, subtype).add(subtype_df, id_columns)
+    return results
+
+
+def retract_sequences(root_dir, seq_ids):
+    """
+    Removes sequences (by alignment id) from every subtype alignment under root_dir.
+
+    Returns:
+    - dict: subtype -> stats of SubtypeMSAStore.remove, for the alignments that held any of them.
+    """
+    results = {}
+    for name in sorted(os.listdir(root_dir)) if os.path.isdir(root_dir) else []:
+        manifest_path = os.path.join(root_dir, name, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                subtype = json.load(f)['subtype']
+            removed = SubtypeMSAStore(root_dir, subtype).remove(seq_ids)
+            if removed['removed']:
+                results[subtype] = removed
+    return results
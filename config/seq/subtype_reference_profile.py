@@ -0,0 +1,275 @@
+import os
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+from mafft_caller import perform_mafft_msa, perform_mafft_profile_addition, parse_fasta_text
+from end_characters_cleaner import remove_consecutive_ends_n_and_hyphens_repeatedly
+from hiv_subtyping_alignment_worker import perform_hiv_subtyping, finalize_hiv_subtyping
+from parallel_alignment_processor import process_sequence_alignment_isolated
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'hiv_pipeline')
+
+# 'pairwise': one MAFFT call per reference (perform_hiv_subtyping); 'profile': one 'mafft --add'
+# per query (perform_hiv_subtyping_with_reference_profile); 'compare': pairwise results, plus a
+# profile run of the same queries compared with them (see compare_subtyping_modes)
+SUBTYPING_MODES = ('pairwise', 'profile', 'compare')
+
+_msa_cache = {}
+_msa_cache_lock = threading.Lock()
+
+
+def reference_table_version(ref_seq_df):
+    """
+    Returns a short content hash of the consensus reference table.
+
+    The hash covers seq_name, hiv1_subtype_lanl and ref_seq of every row, so any edit to
+    hiv_subtype_con_ref_seq gives a new version and a new cached reference MSA.
+    """
+    digest = hashlib.sha256()
+    for _, row in ref_seq_df.sort_values('seq_name').iterrows():
+        digest.update(f"{row['seq_name']}\t{row['hiv1_subtype_lanl']}\t{row['ref_seq']}\n".encode())
+    return digest.hexdigest()[:16]
+
+
+def load_or_build_subtype_reference_msa(ref_seq_df, mafft_executable, cache_dir=None, mafft_threads=None):
+    """
+    Returns the multiple sequence alignment of the consensus references, building it once.
+
+    The alignment is written to '<cache_dir>/subtype_ref_msa_<version>.fasta', where version is
+    reference_table_version(ref_seq_df), and kept in memory for the rest of the run. Worker threads
+    share one copy; only the first caller runs MAFFT.
+
+    Parameters:
+    - ref_seq_df : DataFrame
+        hiv_subtype_con_ref_seq table ('seq_name', 'ref_seq', 'hiv1_subtype_lanl').
+    - mafft_executable : str
+        Path to the MAFFT executable.
+    - cache_dir : str, optional
+        Directory of the cached alignments. Defaults to ~/.cache/hiv_pipeline.
+    - mafft_threads : int, optional
+        MAFFT's --thread option for building the alignment.
+
+    Returns:
+    - list or str
+        (seq_name, aligned ref_seq) tuples in ref_seq_df order, or an error message.
+    """
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    msa_path = os.path.join(cache_dir, f"subtype_ref_msa_{reference_table_version(ref_seq_df)}.fasta")
+
+    with _msa_cache_lock:
+        if msa_path in _msa_cache:
+            return _msa_cache[msa_path]
+
+        if os.path.exists(msa_path):
+            with open(msa_path, 'r') as f:
+                reference_msa = parse_fasta_text(f.read())
+        else:
+            reference_msa = perform_mafft_msa(list(zip(ref_seq_df['seq_name'], ref_seq_df['ref_seq'])), mafft_executable,
+                                              threads=mafft_threads)
+            if isinstance(reference_msa, str):
+                return reference_msa
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write then rename so a crash never leaves a truncated alignment behind
+            with open(msa_path + '.tmp', 'w') as f:
+                f.write('\n'.join(f">{name}\n{seq}" for name, seq in reference_msa) + '\n')
+            os.replace(msa_path + '.tmp', msa_path)
+
+        _msa_cache[msa_path] = reference_msa
+        return reference_msa
+
+
+def score_query_against_reference_msa(aligned_ref_seqs, aligned_query_seq):
+    """
+    Scores an aligned query against every row of a reference MSA at once.
+
+    For each reference, columns where both the reference and the query are gaps are dropped,
+    which gives the same pairwise alignment (and the same score and similarity) that
+    calculate_similarity_between_aligned_seqs would see for a pairwise MAFFT run.
+
+    Parameters:
+    - aligned_ref_seqs : list of str
+        Aligned reference sequences (all the same length as aligned_query_seq).
+    - aligned_query_seq : str
+        The query aligned into the reference MSA.
+
+    Returns:
+    - tuple
+        (alignment_scores, similarity_percentages, pairwise_ref_seqs, pairwise_query_seqs)
+    """
+    ref_matrix = np.frombuffer(''.join(aligned_ref_seqs).encode(), dtype=np.uint8).reshape(len(aligned_ref_seqs), -1)
+    query = np.frombuffer(aligned_query_seq.encode(), dtype=np.uint8)
+    gap = ord('-')
+
+    ref_gap = ref_matrix == gap
+    keep = ~(ref_gap & (query == gap))
+    alignment_scores = ((ref_matrix == query) & ~ref_gap).sum(axis=1)
+
+    # Columns kept by remove_consecutive_ends_n_and_hyphens_repeatedly on the query
+    informative = np.flatnonzero((query != gap) & (query != ord('n')))
+    if len(informative) == 0:
+        similarity_percentages = np.zeros(len(aligned_ref_seqs))
+    else:
+        cleaned_lengths = keep[:, informative[0]:informative[-1] + 1].sum(axis=1)
+        similarity_percentages = np.round(alignment_scores / cleaned_lengths * 100, 1)
+
+    pairwise_ref_seqs = [ref_matrix[i, keep[i]].tobytes().decode() for i in range(len(aligned_ref_seqs))]
+    pairwise_query_seqs = [query[keep[i]].tobytes().decode() for i in range(len(aligned_ref_seqs))]
+    return alignment_scores, similarity_percentages, pairwise_ref_seqs, pairwise_query_seqs
+
+
+def perform_hiv_subtyping_with_reference_profile(quary_row_df, ref_seq_df, quary_seq_col_nam, mafft_executable, cache_dir=None,
+                                                 mafft_threads=None, mafft_timeout=None):
+    """
+    Drop-in alternative to perform_hiv_subtyping that runs one MAFFT call per query.
+
+    The consensus references are aligned once into a cached reference MSA (see
+    load_or_build_subtype_reference_msa); the query is added to that profile with 'mafft --add'
+    and scored against every reference column-wise. The output has the same columns as
+    perform_hiv_subtyping.
+
+    Parameters:
+    - quary_row_df : DataFrame
+        DataFrame containing the query sequence to be aligned.
+    - ref_seq_df : DataFrame
+        DataFrame containing the reference sequences with known subtypes.
+    - quary_seq_col_nam : str
+        Column name in quary_row_df containing the query sequence.
+    - mafft_executable : str
+        Path to the MAFFT executable.
+    - cache_dir : str, optional
+        Directory of the cached reference MSA.
+    - mafft_threads, mafft_timeout : optional
+        MAFFT's --thread option and per-call timeout (see perform_mafft_alignment).
+
+    Returns:
+    - DataFrame
+        DataFrame with alignment results including extracted sequences, alignment scores, similarity percentages,
+        identified subtypes, and hypermutation analysis results.
+    """
+    query_seq = quary_row_df[quary_seq_col_nam].tolist()[0]
+
+    reference_msa = load_or_build_subtype_reference_msa(ref_seq_df, mafft_executable, cache_dir, mafft_threads)
+    if isinstance(reference_msa, str):
+        raise RuntimeError(reference_msa)
+    aligned_refs, aligned_query_seq = perform_mafft_profile_addition(reference_msa, query_seq, mafft_executable,
+                                                                     raise_errors=True, threads=mafft_threads,
+                                                                     timeout=mafft_timeout)
+
+    alignment_scores, similarity_percentages, pairwise_ref_seqs, pairwise_query_seqs = score_query_against_reference_msa(
+        [seq for _, seq in aligned_refs], aligned_query_seq)
+
+    # The cleaned query only depends on the query residues, so it is the same for every reference
+    hiv1_aligned_query_seq_cleaned = remove_consecutive_ends_n_and_hyphens_repeatedly(aligned_query_seq).replace('-', '')
+    subtype_by_name = dict(zip(ref_seq_df['seq_name'], ref_seq_df['hiv1_subtype_lanl']))
+    n_refs = len(aligned_refs)
+
+    alignment_df = pd.DataFrame({
+        'hiv1_ref_seq_name': [name for name, _ in aligned_refs],
+        'hiv1_aligned_ref_seq': pairwise_ref_seqs,
+        'hiv1_aligned_query_seq': pairwise_query_seqs,
+        'hiv1_subtype_alignment_score': alignment_scores,
+        'hiv1_subtype_similarity_percentage': similarity_percentages,
+        'hiv1_subtype_lanl': [subtype_by_name[name] for name, _ in aligned_refs],
+        'hiv1_subtype_lanl_anomaly': [''] * n_refs,
+        'hiv1_subtype_mafft_strategy': ['profile'] * n_refs,
+        'hiv1_hypermut_p_value': [np.nan] * n_refs,
+        'hiv1_aligned_query_seq_cleaned': [hiv1_aligned_query_seq_cleaned] * n_refs,
+        'hiv1_aligned_query_seq_cleaned_len': [len(hiv1_aligned_query_seq_cleaned)] * n_refs})
+
+    query_rows_df = pd.concat([quary_row_df.reset_index(drop=True)] * n_refs, ignore_index=True)
+    result_df = pd.concat([query_rows_df, alignment_df], axis=1)
+    return finalize_hiv_subtyping(result_df)
+
+
+def compare_subtyping_modes(pairwise_df, profile_df, key_cols=('pat_id', 'seq_sample_date')):
+    """
+    Compares subtyping results of the pairwise path and the reference-profile path.
+
+    Rows aggregated by aggregate_duplicate_rows hold lists; their subtype calls are joined
+    ('B/C') and the highest similarity is used.
+
+    Parameters:
+    - pairwise_df : DataFrame
+        Output of perform_hiv_subtyping.
+    - profile_df : DataFrame
+        Output of perform_hiv_subtyping_with_reference_profile for the same queries.
+    - key_cols : tuple
+        Columns identifying a query.
+
+    Returns:
+    - tuple
+        (summary_df, comparison_df): per-subtype agreement of 'hiv1_subtype_lanl' and similarity
+        deltas (pairwise subtype as the grouping, plus an 'ALL' row), and the per-query comparison.
+    """
+    def reduce(df):
+        reduced = df[list(key_cols)].copy()
+        reduced['hiv1_subtype_lanl'] = df['hiv1_subtype_lanl'].apply(
+            lambda x: '/'.join(sorted(set(x))) if isinstance(x, list) else x)
+        reduced['hiv1_subtype_similarity_percentage'] = df['hiv1_subtype_similarity_percentage'].apply(
+            lambda x: max(x) if isinstance(x, list) else x)
+        return reduced
+
+    comparison_df = reduce(pairwise_df).merge(reduce(profile_df), on=list(key_cols), suffixes=('_pairwise', '_profile'))
+    comparison_df['subtype_agrees'] = comparison_df['hiv1_subtype_lanl_pairwise'] == comparison_df['hiv1_subtype_lanl_profile']
+    comparison_df['similarity_delta'] = (comparison_df['hiv1_subtype_similarity_percentage_profile']
+                                         - comparison_df['hiv1_subtype_similarity_percentage_pairwise'])
+
+    aggregations = {
+        'sequences': ('subtype_agrees', 'size'),
+        'agreement_percentage': ('subtype_agrees', lambda x: round(x.mean() * 100, 1)),
+        'mean_similarity_delta': ('similarity_delta', lambda x: round(x.mean(), 2)),
+        'max_abs_similarity_delta': ('similarity_delta', lambda x: round(x.abs().max(), 2))}
+    summary_df = pd.concat([
+        comparison_df.groupby('hiv1_subtype_lanl_pairwise').agg(**aggregations),
+        comparison_df.assign(hiv1_subtype_lanl_pairwise='ALL').groupby('hiv1_subtype_lanl_pairwise').agg(**aggregations)])
+    summary_df['sequences'] = summary_df['sequences'].astype(int)
+    summary_df.index.name = 'hiv1_subtype_lanl'
+    return summary_df.reset_index(), comparison_df
+
+
+def subtyping_worker_for_mode(subtyping_mode):
+    """
+    Returns the subtyping worker of a subtyping mode (see SUBTYPING_MODES): perform_hiv_subtyping
+    for 'pairwise' and 'compare', perform_hiv_subtyping_with_reference_profile for 'profile'.
+
+    Returns:
+    - callable or str: The worker, or an error message for an unknown mode.
+    """
+    if subtyping_mode not in SUBTYPING_MODES:
+        return f"Error: unknown subtyping mode '{subtyping_mode}', expected one of {', '.join(SUBTYPING_MODES)}"
+    if subtyping_mode == 'profile':
+        return perform_hiv_subtyping_with_reference_profile
+    return perform_hiv_subtyping
+
+
+def compare_with_reference_profile(hiv1_df, ref_seq_df, pairwise_df, mafft_executable, **alignment_options):
+    """
+    Subtypes hiv1_df again with the reference-profile worker and compares the calls with the
+    pairwise results (the 'compare' subtyping mode).
+
+    Parameters:
+    - hiv1_df : DataFrame
+        The HIV-1 rows that were subtyped.
+    - ref_seq_df : DataFrame
+        The hiv_subtype_con_ref_seq table.
+    - pairwise_df : DataFrame
+        Subtyping result of perform_hiv_subtyping for hiv1_df.
+    - mafft_executable : str
+        Path to the MAFFT executable.
+    - alignment_options
+        Passed on to process_sequence_alignment_isolated (e.g. timeout_seconds).
+
+    Returns:
+    - tuple or str
+        (summary_df, comparison_df) as returned by compare_subtyping_modes, or an error message.
+    """
+    profile_result = process_sequence_alignment_isolated(hiv1_df, ref_seq_df, 'extracted_pol_query_seq_cleaned',
+                                                         perform_hiv_subtyping_with_reference_profile, mafft_executable,
+                                                         **alignment_options)
+    if isinstance(profile_result, str):
+        return profile_result
+    profile_df = profile_result[0]
+    if pairwise_df.empty or profile_df.empty:
+        return "Error: no subtyped rows to compare"
+    return compare_subtyping_modes(pairwise_df, profile_df)
@@ -0,0 +1,333 @@
+"""
+Synthetic query corpus for load tests of typing and subtyping.
+
+Queries are cut from the references of hiv_type_ref_seq (SIVMM239, for HIV-2-like queries)
+and hiv_subtype_con_ref_seq (HIV-1), and then made realistic with controlled divergence,
+indels, IUPAC ambiguity runs, N blocks, APOBEC G->A hypermutation, recombinant breakpoints,
+duplicates and a skewed length distribution. The output is an upload file (pat_id,
+seq_sample_date, seq) with an optional ground truth file next to it:
+
+    python synthetic_corpus_generator.py corpus.csv --rows 1000000 --truth corpus_truth.csv \\
+        --type-ref hiv_type_ref_seq.csv --subtype-ref hiv_subtype_con_ref_seq.csv
+
+The reference tables are read from CSV exports of the two tables, from the database
+(--database etc.), or, with neither, generated (synthetic_reference_tables) so no real sequences
+are needed. The same seed always gives the same corpus.
+"""
+
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+import config_paths  # config/general modules, when run as a script
+from file_reading_operations import read_data_file
+
+# Knobs of the generated corpus; override any of them with generate_synthetic_queries(..., **profile)
+DEFAULT_CORPUS_PROFILE = {
+    'median_length': 1200,          # median query length (lognormal)
+    'length_sigma': 0.45,           # spread of the lognormal length distribution
+    'min_length': 150,
+    'divergence': (0.01, 0.08),     # per-site substitution rate, uniform in this range per query
+    'indel_rate': 0.002,            # indel events per base
+    'inframe_indel_fraction': 0.8,  # indels whose length is a multiple of 3
+    'hypermutated_fraction': 0.03,  # queries with APOBEC G->A hypermutation
+    'hypermutation_rate': 0.3,      # fraction of GG/GA-context G's mutated in those queries
+    'recombinant_fraction': 0.05,   # HIV-1 queries built from two subtypes
+    'hiv2_fraction': 0.01,          # queries from SIVMM239 instead of the HIV-1 consensus references
+    'ambiguity_fraction': 0.15,     # queries with IUPAC ambiguity runs
+    'n_block_fraction': 0.05,       # queries with a block of N's
+    'end_padding_fraction': 0.1,    # queries with leading/trailing N's and gaps
+    'uppercase_fraction': 0.5,
+    'duplicate_fraction': 0.03,     # exact repeats of an earlier row (pat_id, date and sequence)
+    'samples_per_patient': 1.5,     # mean number of samples per pat_id
+    'date_range': ('2000-01-01', '2024-12-31'),
+}
+
+AMBIGUITY_CODES = np.frombuffer(b'rykmswbdhv', dtype=np.uint8)
+BASES = np.frombuffer(b'acgt', dtype=np.uint8)
+HIV1_SUBTYPES = ['A1', 'A2', 'B', 'C', 'D', 'F1', 'F2', 'G', 'H', 'J', 'K', '01_AE', '02_AG']
+TRUTH_COLUMNS = ['synthetic_source', 'synthetic_breakpoint', 'synthetic_divergence', 'synthetic_hypermutated']
+
+# HXB2 pol region, and the slice of the genome used as synthetic pol reference
+HXB2_POL_START, HXB2_POL_END = 2085, 5096
+SYNTHETIC_REGION_START, SYNTHETIC_REGION_END = 1800, 5400
+
+
+def _random_bases(rng, length):
+    return BASES[rng.integers(0, 4, length)]
+
+
+def _substitute(seq, rate, rng):
+    seq = seq.copy()
+    positions = np.flatnonzero(rng.random(len(seq)) < rate)
+    # Shift by 1-3 so a substitution always changes the base
+    base_index = np.searchsorted(BASES, seq[positions])
+    seq[positions] = BASES[(base_index + rng.integers(1, 4, len(positions))) % 4]
+    return seq
+
+
+def synthetic_reference_tables(seed=0):
+    """
+    Generates stand-ins for hiv_type_ref_seq and hiv_subtype_con_ref_seq: an HXB2-like random
+    pol region, SIVMM239 at ~45% divergence and one consensus per HIV-1 subtype at 8-15%.
+
+    Returns:
+    - tuple: (type_ref_df, subtype_ref_df) with the columns the typing and subtyping workers use.
+    """
+    rng = np.random.default_rng(seed)
+    hxb2 = _random_bases(rng, SYNTHETIC_REGION_END - SYNTHETIC_REGION_START)
+    siv = _substitute(hxb2, 0.45, rng)
+    pol_start = HXB2_POL_START - SYNTHETIC_REGION_START + 1
+    pol_end = HXB2_POL_END - SYNTHETIC_REGION_START + 1
+    type_ref_df = pd.DataFrame({'seq_name': ['HXB2', 'SIVMM239'],
+                                'pol_ref_seq': [hxb2.tobytes().decode(), siv.tobytes().decode()],
+                                'hiv_typing_pol_start_coord': [pol_start, pol_start],
+                                'hiv_typing_pol_end_coord': [pol_end, pol_end]})
+    consensus = [_substitute(hxb2, rng.uniform(0.08, 0.15), rng).tobytes().decode() for _ in HIV1_SUBTYPES]
+    subtype_ref_df = pd.DataFrame({'seq_name': [f"CON_{subtype}" for subtype in HIV1_SUBTYPES],
+                                   'hiv1_subtype_lanl': HIV1_SUBTYPES,
+                                   'ref_seq': consensus})
+    return type_ref_df, subtype_ref_df
+
+
+def _apply_indels(seq, profile, rng):
+    n_events = rng.poisson(profile['indel_rate'] * len(seq))
+    for _ in range(n_events):
+        length = int(rng.geometric(0.5))
+        if rng.random() < profile['inframe_indel_fraction']:
+            length *= 3
+        position = int(rng.integers(0, max(len(seq) - length, 1)))
+        if rng.random() < 0.5:
+            seq = np.concatenate([seq[:position], _random_bases(rng, length), seq[position:]])
+        else:
+            seq = np.concatenate([seq[:position], seq[position + length:]])
+    return seq
+
+
+def _hypermutate(seq, rate, rng):
+    """APOBEC3G/F G->A in GG and GA context (the G followed by a purine)."""
+    seq = seq.copy()
+    context = np.flatnonzero((seq[:-1] == ord('g')) & ((seq[1:] == ord('g')) | (seq[1:] == ord('a'))))
+    seq[context[rng.random(len(context)) < rate]] = ord('a')
+    return seq
+
+
+def _add_artifacts(seq, profile, rng):
+    if rng.random() < profile['ambiguity_fraction']:
+        seq = seq.copy()
+        for _ in range(int(rng.integers(1, 4))):
+            length = int(rng.integers(1, 6))
+            position = int(rng.integers(0, max(len(seq) - length, 1)))
+            seq[position:position + length] = AMBIGUITY_CODES[rng.integers(0, len(AMBIGUITY_CODES), length)]
+    if rng.random() < profile['n_block_fraction']:
+        seq = seq.copy()
+        length = int(rng.integers(20, 200))
+        position = int(rng.integers(0, max(len(seq) - length, 1)))
+        seq[position:position + length] = ord('n')
+    text = seq.tobytes().decode()
+    if rng.random() < profile['end_padding_fraction']:
+        text = ('n' * int(rng.integers(0, 30)) + '-' * int(rng.integers(0, 5)) + text
+                + '-' * int(rng.integers(0, 5)) + 'n' * int(rng.integers(0, 30)))
+    return text.upper() if rng.random() < profile['uppercase_fraction'] else text
+
+
+def _query_window(ref_length, profile, rng):
+    length = int(np.clip(rng.lognormal(np.log(profile['median_length']), profile['length_sigma']),
+                         profile['min_length'], ref_length))
+    start = int(rng.integers(0, ref_length - length + 1))
+    return start, length
+
+
+def _synthetic_query(hiv1_refs, hiv2_ref, profile, rng):
+    """Returns the query sequence and its ground truth."""
+    truth = {'synthetic_breakpoint': None, 'synthetic_hypermutated': False}
+    if hiv2_ref is not None and rng.random() < profile['hiv2_fraction']:
+        start, length = _query_window(len(hiv2_ref), profile, rng)
+        seq = hiv2_ref[start:start + length]
+        truth['synthetic_source'] = 'SIVMM239'
+    else:
+        first = int(rng.integers(0, len(hiv1_refs)))
+        name, ref = hiv1_refs[first]
+        start, length = _query_window(len(ref), profile, rng)
+        seq = ref[start:start + length]
+        truth['synthetic_source'] = name
+        if len(hiv1_refs) > 1 and rng.random() < profile['recombinant_fraction']:
+            second = (first + int(rng.integers(1, len(hiv1_refs)))) % len(hiv1_refs)
+            other_name, other_ref = hiv1_refs[second]
+            breakpoint = int(rng.integers(length // 5, 4 * length // 5 + 1))
+            # Same relative position in the second reference (consensus lengths differ slightly)
+            scale = len(other_ref) / len(ref)
+            other_start, other_end = int((start + breakpoint) * scale), int((start + length) * scale)
+            seq = np.concatenate([seq[:breakpoint], other_ref[other_start:other_end]])
+            truth['synthetic_source'] = f"{name}/{other_name}"
+            truth['synthetic_breakpoint'] = breakpoint
+
+    divergence = rng.uniform(*profile['divergence'])
+    seq = _apply_indels(_substitute(seq, divergence, rng), profile, rng)
+    if rng.random() < profile['hypermutated_fraction']:
+        seq = _hypermutate(seq, profile['hypermutation_rate'], rng)
+        truth['synthetic_hypermutated'] = True
+    truth['synthetic_divergence'] = round(divergence, 4)
+    return _add_artifacts(seq, profile, rng), truth
+
+
+def generate_synthetic_queries(type_ref_df, subtype_ref_df, n_rows, seed=0, chunk_size=100000, **profile):
+    """
+    Generates synthetic query rows in chunks.
+
+    Parameters:
+    - type_ref_df (DataFrame): hiv_type_ref_seq (SIVMM239 'pol_ref_seq' is used for HIV-2-like queries).
+    - subtype_ref_df (DataFrame): hiv_subtype_con_ref_seq ('seq_name' and 'ref_seq').
+    - n_rows (int): Number of rows.
+    - seed (int): Random seed; the same seed gives the same rows.
+    - chunk_size (int): Rows per yielded DataFrame, so millions of rows never sit in memory at once.
+    - profile: Overrides of DEFAULT_CORPUS_PROFILE.
+
+    Yields:
+    - DataFrame: Columns 'pat_id', 'seq_sample_date' (YYYY-MM-DD), 'seq' and the ground truth
+      columns in TRUTH_COLUMNS.
+    """
+    unknown = set(profile) - set(DEFAULT_CORPUS_PROFILE)
+    if unknown:
+        raise ValueError(f"Unknown corpus profile settings: {', '.join(sorted(unknown))}")
+    profile = {**DEFAULT_CORPUS_PROFILE, **profile}
+    rng = np.random.default_rng(seed)
+
+    def as_bases(seq):
+        return np.frombuffer(str(seq).lower().replace('-', '').encode(), dtype=np.uint8)
+
+    hiv1_refs = [(name, as_bases(seq)) for name, seq in zip(subtype_ref_df['seq_name'], subtype_ref_df['ref_seq'])]
+    siv_rows = type_ref_df[type_ref_df['seq_name'] == 'SIVMM239']
+    hiv2_ref = as_bases(siv_rows['pol_ref_seq'].iloc[0]) if not siv_rows.empty else None
+    n_patients = max(int(n_rows / profile['samples_per_patient']), 1)
+    first_day, last_day = (pd.Timestamp(date) for date in profile['date_range'])
+    n_days = (last_day - first_day).days + 1
+
+    produced, previous = 0, []
+    while produced < n_rows:
+        rows = []
+        for _ in range(min(chunk_size, n_rows - produced)):
+            if previous and rng.random() < profile['duplicate_fraction']:
+                rows.append(dict(previous[int(rng.integers(0, len(previous)))]))
+                continue
+            seq, truth = _synthetic_query(hiv1_refs, hiv2_ref, profile, rng)
+            row = {'pat_id': int(rng.integers(1, n_patients + 1)),
+                   'seq_sample_date': (first_day + pd.Timedelta(days=int(rng.integers(0, n_days)))).strftime('%Y-%m-%d'),
+                   'seq': seq, **truth}
+            rows.append(row)
+            # Duplicates are drawn from a bounded window of recent rows
+            previous.append(row)
+            if len(previous) > 1000:
+                previous.pop(0)
+        produced += len(rows)
+        yield pd.DataFrame(rows, columns=['pat_id', 'seq_sample_date', 'seq'] + TRUTH_COLUMNS).astype(
+            {'synthetic_breakpoint': 'Int64'})
+
+
+def write_synthetic_corpus(path, chunks, truth_path=None):
+    """
+    Writes generated chunks as an upload file; the format follows the extension like
+    read_data_file ('.csv', tab-delimited '.txt'/'.tsv'/'.tab', or '.xlsx').
+
+    Parameters:
+    - path (str): Upload file to write.
+    - chunks (iterable): DataFrames from generate_synthetic_queries.
+    - truth_path (str, optional): CSV of the ground truth per row (row number in the upload file,
+      pat_id, seq_sample_date and TRUTH_COLUMNS).
+
+    Returns:
+    - int or str: Number of rows written, or an error message.
+    """
+    if path.endswith('.csv'):
+        separator = ','
+    elif path.endswith(('.txt', '.tsv', '.tab')):
+        separator = '\t'
+    elif path.endswith('.xlsx'):
+        separator = None
+    else:
+        return "Invalid file format. Only CSV, tab-delimited TXT/TSV/TAB, and Excel files are supported."
+
+    try:
+        if separator is None:
+            # Excel files are written in one go and are limited to 1,048,576 rows
+            df = pd.concat(list(chunks), ignore_index=True)
+            if len(df) >= 1048576:
+                return "Too many rows for an Excel file; use CSV or TSV."
+            df[['pat_id', 'seq_sample_date', 'seq']].to_excel(path, index=False)
+            if truth_path:
+                df.drop(columns='seq').rename_axis('row').to_csv(truth_path)
+            return len(df)
+
+        written = 0
+        for n, chunk in enumerate(chunks):
+            mode, header = ('w', True) if n == 0 else ('a', False)
+            chunk[['pat_id', 'seq_sample_date', 'seq']].to_csv(path, sep=separator, index=False, mode=mode, header=header)
+            if truth_path:
+                chunk.index = pd.RangeIndex(written, written + len(chunk), name='row')
+                chunk.drop(columns='seq').to_csv(truth_path, mode=mode, header=header)
+            written += len(chunk)
+        return written
+    except (OSError, ImportError) as e:
+        return f"Error writing synthetic corpus: {e}"
+
+
+def load_reference_tables(type_ref_path=None, subtype_ref_path=None, db_params=None, seed=0):
+    """
+    Returns (type_ref_df, subtype_ref_df) from the database, from exported table files or,
+    without either, from synthetic_reference_tables; or an error message.
+    """
+    if db_params:
+        from db_operations import extract_table
+        tables = [extract_table(*db_params, table_name) for table_name in ('hiv_type_ref_seq', 'hiv_subtype_con_ref_seq')]
+    elif type_ref_path and subtype_ref_path:
+        tables = [read_data_file(type_ref_path), read_data_file(subtype_ref_path)]
+    else:
+        return synthetic_reference_tables(seed)
+    for table in tables:
+        if isinstance(table, str):
+            return table
+    return tuple(tables)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic HIV sequence upload file.")
+    parser.add_argument('output', help="Upload file (.csv, .tsv/.txt/.tab or .xlsx).")
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--truth', help="Also write the ground truth of every row to this CSV.")
+    parser.add_argument('--type-ref', help="Exported hiv_type_ref_seq table.")
+    parser.add_argument('--subtype-ref', help="Exported hiv_subtype_con_ref_seq table.")
+    parser.add_argument('--database')
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default='5432')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help="Override a DEFAULT_CORPUS_PROFILE setting, e.g. --set hiv2_fraction=0.05.")
+    args = parser.parse_args()
+
+    profile = {}
+    for setting in args.set:
+        key, _, value = setting.partition('=')
+        default = DEFAULT_CORPUS_PROFILE.get(key)
+        if isinstance(default, tuple):
+            profile[key] = tuple(type(default[0])(part) for part in value.split(','))
+        elif default is not None:
+            profile[key] = type(default)(value)
+        else:
+            profile[key] = value
+
+    db_params = (args.database, args.user, args.password, args.host, args.port) if args.database else None
+    tables = load_reference_tables(args.type_ref, args.subtype_ref, db_params, args.seed)
+    if isinstance(tables, str):
+        sys.exit(tables)
+    chunks = generate_synthetic_queries(*tables, n_rows=args.rows, seed=args.seed, **profile)
+    result = write_synthetic_corpus(args.output, chunks, args.truth)
+    if isinstance(result, str):
+        sys.exit(result)
+    print(f"Wrote {result} rows to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
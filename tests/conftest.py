@@ -0,0 +1,6 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path[:0] = [os.path.join(ROOT, 'config', 'seq'), os.path.join(ROOT, 'config', 'general'),
+                os.path.join(ROOT, 'config', 'benchmark')]
@@ -0,0 +1,30 @@
+import pandas as pd
+from alignment_checkpoint import AlignmentCheckpoint
+
+
+def test_records_survive_reload(tmp_path):
+    path = str(tmp_path / 'typing.jsonl')
+    checkpoint = AlignmentCheckpoint(path)
+    checkpoint.record('a', pd.DataFrame({'pat_id': ['1']}))
+    checkpoint.record('b', None)
+
+    reloaded = AlignmentCheckpoint(path)
+    assert 'a' in reloaded and 'b' in reloaded
+    assert reloaded.get('a')['pat_id'].tolist() == ['1']
+    assert reloaded.get('b') is None
+
+
+def test_record_after_half_written_line_is_kept(tmp_path):
+    path = str(tmp_path / 'typing.jsonl')
+    AlignmentCheckpoint(path).record('a', pd.DataFrame({'pat_id': ['1']}))
+    # A crash in the middle of a write leaves a line without its newline
+    with open(path, 'a') as f:
+        f.write('{"fingerprint": "b", "res')
+
+    resumed = AlignmentCheckpoint(path)
+    assert 'b' not in resumed
+    resumed.record('c', pd.DataFrame({'pat_id': ['3']}))
+
+    reloaded = AlignmentCheckpoint(path)
+    assert 'a' in reloaded and 'c' in reloaded and 'b' not in reloaded
+    assert reloaded.get('c')['pat_id'].tolist() == ['3']
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+from alignment_cost_model import (alignment_work, predict_task_seconds, update_cost_model, load_cost_model,
+                                  longest_first_order, PRIOR_SECONDS_PER_MEGACELL)
+from parallel_alignment_processor import process_sequence_alignment_parallel
+
+
+def test_cost_model_learns_a_line_after_ten_tasks(tmp_path):
+    path = str(tmp_path / 'cost_model.json')
+    work = np.linspace(0.5, 5.0, 9)
+    update_cost_model('worker', work, 0.3 + 2 * work, path)
+    # Too few tasks: the prior
+    np.testing.assert_allclose(predict_task_seconds(load_cost_model(path), 'worker', [1.0]), [PRIOR_SECONDS_PER_MEGACELL])
+    update_cost_model('worker', [3.0, 6.0], [6.3, 12.3], path)
+    np.testing.assert_allclose(predict_task_seconds(load_cost_model(path), 'worker', [1.0, 10.0]), [2.3, 20.3])
+    assert 'other' not in load_cost_model(path)
+
+
+def test_work_uses_the_length_column_when_qc_provided_it():
+    ref_seq_df = pd.DataFrame({'pol_ref_seq': ['a' * 1000, 'a' * 500]})
+    query_df = pd.DataFrame({'seq_cleaned': ['acgt', 'acgtacgt']})
+    np.testing.assert_allclose(alignment_work(query_df, ref_seq_df, 'seq_cleaned'), [0.006, 0.012])
+    query_df['seq_cleaned_len'] = [2000, 1000]
+    np.testing.assert_allclose(alignment_work(query_df, ref_seq_df, 'seq_cleaned'), [3.0, 1.5])
+
+
+def test_rows_run_longest_first_and_come_back_in_query_order(tmp_path):
+    started = []
+
+    def worker(query_row_df, ref_seq_df, query_seq_col_name, mafft_executable):
+        started.append(query_row_df['pat_id'].iloc[0])
+        return query_row_df
+
+    query_df = pd.DataFrame({'pat_id': ['short', 'long', 'medium', 'longest'],
+                             'seq_cleaned': ['a' * 100, 'a' * 3000, 'a' * 1000, 'a' * 5000]})
+    plan = {'cpu_budget': 1, 'pool_width': 1, 'max_pool_width': 1, 'mafft_threads': 1, 'available_memory_mb': 1024}
+    result_df = process_sequence_alignment_parallel(query_df, pd.DataFrame({'pol_ref_seq': ['a' * 3000]}), 'seq_cleaned',
+                                                    worker, 'mafft', resource_plan=plan,
+                                                    cost_model_path=str(tmp_path / 'cost_model.json'))
+    assert started == ['longest', 'long', 'medium', 'short']
+    assert result_df['pat_id'].tolist() == ['short', 'long', 'medium', 'longest']
+    assert list(longest_first_order([1.0, 3.0, 3.0, 2.0])) == [1, 2, 3, 0]
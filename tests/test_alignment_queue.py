@@ -0,0 +1,103 @@
+import datetime
+import threading
+import time
+
+import pandas as pd
+import psycopg2
+
+import alignment_queue_worker
+from alignment_task_queue import encode_frame, decode_frame
+
+
+def test_frames_round_trip_as_json():
+    df = pd.DataFrame({'pat_id': ['p1'], 'seq_sample_date': [datetime.date(2020, 1, 2)],
+                       'hiv1_subtype_lanl': [['B', 'C']], 'hiv1_subtype_similarity_percentage': [[91.5, 90.8]],
+                       'seq_cleaned_len': [1200]}, index=[7])
+    data = encode_frame(df)
+    assert b'pickle' not in data and data.startswith(b'{')
+    expected = df.assign(seq_sample_date='2020-01-02')
+    pd.testing.assert_frame_equal(decode_frame(memoryview(data)), expected)
+
+
+class FakeConnection:
+    closed = 0
+
+    def close(self):
+        self.closed = 1
+
+
+def test_worker_reconnects_after_connection_errors(monkeypatch):
+    connections, claims, writes = [], [], []
+    failures = {'claim': 1, 'complete': 1}
+    row_df = pd.DataFrame({'seq_cleaned': ['acgt']})
+
+    def connect(*args):
+        connections.append(FakeConnection())
+        return connections[-1]
+
+    def claim_tasks(connection, owner, stages, limit, lease_seconds):
+        claims.append(connection)
+        if failures['claim']:
+            failures['claim'] -= 1
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        return [(1, 'run', 'test_stage', row_df, 1)] if len(claims) == 2 else []
+
+    def complete_task(connection, task_id, owner, result_df):
+        writes.append(connection)
+        if failures['complete']:
+            failures['complete'] -= 1
+            raise psycopg2.InterfaceError('connection already closed')
+        return True
+
+    monkeypatch.setattr(alignment_queue_worker, 'connect', connect)
+    monkeypatch.setattr(alignment_queue_worker, 'claim_tasks', claim_tasks)
+    monkeypatch.setattr(alignment_queue_worker, 'complete_task', complete_task)
+    monkeypatch.setattr(alignment_queue_worker, 'heartbeat', lambda *args: set())
+    monkeypatch.setitem(alignment_queue_worker.QUEUE_STAGES, 'test_stage',
+                        (lambda query_row_df, *args: query_row_df, 'ref', 'seq_cleaned'))
+
+    worker = alignment_queue_worker.AlignmentQueueWorker('db', 'user', '', 'host', 5432, 'mafft', stages=['test_stage'],
+                                                         concurrency=1, poll_seconds=0.01, idle_exit_seconds=0.05)
+    worker._ref_tables['test_stage'] = pd.DataFrame()
+    stats = worker.run()
+
+    assert stats['claimed'] == 1 and stats['succeeded'] == 1
+    # The failed claim and the failed write-back each closed their connection and opened a new one
+    assert claims[0] is not claims[1] and writes[0] is not writes[1]
+    assert claims[0].closed and writes[0].closed
+
+
+def run_worker_with_heartbeat_connects(monkeypatch, connect_failures, lease_seconds, idle_exit_seconds):
+    heartbeats = []
+
+    def connect(*args):
+        if threading.current_thread().name == 'queue-heartbeat' and connect_failures['left']:
+            connect_failures['left'] -= 1
+            raise psycopg2.OperationalError('could not connect to server')
+        return FakeConnection()
+
+    monkeypatch.setattr(alignment_queue_worker, 'connect', connect)
+    monkeypatch.setattr(alignment_queue_worker, 'claim_tasks', lambda *args: [])
+    monkeypatch.setattr(alignment_queue_worker, 'heartbeat', lambda connection, *args: heartbeats.append(connection))
+    monkeypatch.setattr(alignment_queue_worker, 'requeue_expired_leases', lambda connection: 0)
+    monkeypatch.setattr(alignment_queue_worker, 'HEARTBEAT_RETRY_SECONDS', 0.01)
+    worker = alignment_queue_worker.AlignmentQueueWorker('db', 'user', '', 'host', 5432, 'mafft', concurrency=1,
+                                                         lease_seconds=lease_seconds, heartbeat_seconds=0.05,
+                                                         poll_seconds=0.01, idle_exit_seconds=idle_exit_seconds)
+    start = time.monotonic()
+    worker.run()
+    return worker, heartbeats, time.monotonic() - start
+
+
+def test_heartbeat_survives_failed_reconnects(monkeypatch):
+    worker, heartbeats, _ = run_worker_with_heartbeat_connects(monkeypatch, {'left': 2}, lease_seconds=5,
+                                                               idle_exit_seconds=0.5)
+    assert not worker.leases_lost
+    assert len(heartbeats) >= 3
+
+
+def test_worker_stops_when_leases_cannot_be_renewed(monkeypatch):
+    worker, heartbeats, seconds = run_worker_with_heartbeat_connects(monkeypatch, {'left': 10 ** 6},
+                                                                     lease_seconds=0.3, idle_exit_seconds=None)
+    assert worker.leases_lost and not heartbeats
+    assert seconds < 2
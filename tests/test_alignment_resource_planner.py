@@ -0,0 +1,47 @@
+import threading
+import time
+
+import alignment_resource_planner
+from alignment_resource_planner import plan_alignment_resources, AdaptiveConcurrencyLimiter
+
+
+def plan(monkeypatch, cpus, memory_mb, n_tasks):
+    monkeypatch.setattr(alignment_resource_planner, 'available_cpu_count', lambda: cpus)
+    monkeypatch.setattr(alignment_resource_planner, 'available_memory_bytes', lambda: memory_mb * 1024 * 1024)
+    return plan_alignment_resources(n_tasks)
+
+
+def test_spare_cores_go_to_mafft_threads(monkeypatch):
+    few = plan(monkeypatch, cpus=8, memory_mb=16000, n_tasks=2)
+    assert (few['pool_width'], few['mafft_threads'], few['max_pool_width']) == (2, 4, 2)
+    many = plan(monkeypatch, cpus=8, memory_mb=16000, n_tasks=1000)
+    assert (many['pool_width'], many['mafft_threads'], many['max_pool_width']) == (8, 1, 16)
+
+
+def test_pool_fits_in_memory(monkeypatch):
+    tight = plan(monkeypatch, cpus=8, memory_mb=3 * alignment_resource_planner.MAFFT_MEMORY_MB, n_tasks=1000)
+    assert tight['pool_width'] == tight['max_pool_width'] == 3
+    assert plan(monkeypatch, cpus=8, memory_mb=10, n_tasks=1000)['pool_width'] == 1
+
+
+def test_limiter_caps_concurrent_tasks():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=2, max_limit=2)
+    lock = threading.Lock()
+    running = {'now': 0, 'max': 0}
+
+    def task():
+        limiter.acquire()
+        with lock:
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+        time.sleep(0.01)
+        with lock:
+            running['now'] -= 1
+        limiter.release(0.01)
+
+    threads = [threading.Thread(target=task) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert running['max'] == 2 and limiter.completed == 8 and limiter.active == 0
@@ -0,0 +1,74 @@
+import asyncio
+import random
+import time
+
+import pytest
+
+import mafft_stand_in
+from async_mafft_engine import AsyncMafftEngine, perform_mafft_alignment_async, run_overlapped_batches
+from mafft_caller import MafftError, perform_mafft_alignment
+
+
+def executable(tmp_path, script):
+    path = tmp_path / 'mafft'
+    path.write_text('#!/bin/sh\n' + script)
+    path.chmod(0o755)
+    return str(path)
+
+
+def test_async_alignment_matches_the_subprocess_call():
+    rng = random.Random(0)
+    ref = ''.join(rng.choice('acgt') for _ in range(600))
+    query = ref[:200] + 'ttt' + ref[200:550]
+    assert perform_mafft_alignment_async(ref, query, mafft_stand_in.__file__) == \
+        perform_mafft_alignment(ref, query, mafft_stand_in.__file__)
+
+
+def test_batch_runs_at_most_max_concurrency_processes(tmp_path):
+    slow_mafft = executable(tmp_path, "cat > /dev/null\nsleep 0.2\nprintf '>reference\\nacgt\\n>query\\nac-t\\n'\n")
+    engine = AsyncMafftEngine(max_concurrency=2)
+    seen = []
+
+    async def run():
+        batch = asyncio.ensure_future(engine.align_batch([('acgt', 'act')] * 6, slow_mafft))
+        while not batch.done():
+            seen.append(engine.running)
+            await asyncio.sleep(0.01)
+        return await batch
+
+    assert asyncio.run(run()) == [('acgt', 'ac-t')] * 6
+    assert max(seen) == 2 and engine.running == 0
+
+
+def test_timeout_kills_mafft_and_is_transient(tmp_path):
+    hanging_mafft = executable(tmp_path, "sleep 30\n")
+    start = time.perf_counter()
+    with pytest.raises(MafftError) as error:
+        asyncio.run(AsyncMafftEngine(max_concurrency=1).align('acgt', 'act', hanging_mafft, timeout=0.3))
+    assert error.value.transient and time.perf_counter() - start < 5
+
+
+def test_failing_mafft_reports_its_stderr(tmp_path):
+    failing_mafft = executable(tmp_path, "cat > /dev/null\necho 'unknown option' >&2\nexit 1\n")
+    results = asyncio.run(AsyncMafftEngine().align_batch([('acgt', 'act')], failing_mafft))
+    assert isinstance(results[0], MafftError) and 'unknown option' in str(results[0]) and not results[0].transient
+
+
+def test_overlapped_batches_finish_in_batch_order():
+    events = []
+
+    async def align(batch):
+        events.append(('align', batch))
+        await asyncio.sleep(0.01)
+        return batch * 10
+
+    def finish(batch):
+        events.append(('finish', batch))
+        time.sleep(0.1)
+        events.append(('finished', batch))
+        return batch + 1
+
+    results = asyncio.run(run_overlapped_batches([1, 2, 3], lambda batch: batch, align, finish))
+    assert results == [11, 21, 31]
+    # Batch 2 is aligned while batch 1 is being finished
+    assert events.index(('finish', 10)) < events.index(('align', 2)) < events.index(('finished', 10))
@@ -0,0 +1,130 @@
+import socket
+
+import psycopg2
+import pytest
+
+import db_operations
+import db_server_starter
+from db_operations import (PIPELINE_TABLES, SCHEMA_LOCK_KEY, with_default_specs, table_ddl, schema_ddl, schema_hash,
+                           apply_schema, connect_when_ready)
+from db_server_starter import start_or_connect_postgres, postgres_is_listening
+
+
+def test_seq_gets_a_unique_key_on_patient_date_and_sequence():
+    db_tables_info = {"tables": {
+        "seq": {"column_dict": {"id": "SERIAL PRIMARY KEY", "pat_id": "VARCHAR(100)", "seq_sample_date": "DATE",
+                                "seq": "TEXT", "seq_cleaned": "TEXT"}},
+        "hiv_type_ref_seq": {"column_dict": {"id": "SERIAL PRIMARY KEY", "seq": "TEXT"}}}}
+    tables = with_default_specs(db_tables_info)["tables"]
+
+    assert "unique_keys" not in tables["hiv_type_ref_seq"]
+    statements = table_ddl("seq", tables["seq"])
+    assert ("CREATE UNIQUE INDEX IF NOT EXISTS seq_pat_id_seq_sample_date_seq_key ON seq "
+            "(pat_id, seq_sample_date, (md5(seq))) NULLS NOT DISTINCT;") in statements
+    # Applying the defaults twice adds nothing
+    assert with_default_specs({"tables": tables})["tables"] == tables
+
+
+def test_bootstrap_schema_creates_the_pipeline_tables():
+    seq_table = {"column_dict": {"id": "SERIAL PRIMARY KEY", "seq": "TEXT"}}
+    quarantine_table = {"column_dict": {"id": "SERIAL PRIMARY KEY", "stage": "TEXT", "query_row": "TEXT"}}
+    db_tables_info = with_default_specs({"tables": {"seq": seq_table, "alignment_quarantine": quarantine_table}})
+    statements = schema_ddl(db_tables_info, schema_hash(db_tables_info))
+
+    for table_name in PIPELINE_TABLES:
+        assert f"CREATE TABLE IF NOT EXISTS {table_name} (" in "\n".join(statements)
+    assert "CREATE INDEX IF NOT EXISTS alignment_tasks_queued_idx ON alignment_tasks USING btree (stage, id) " \
+           "WHERE status = 'queued';" in statements
+    # An entry of tables_info.json replaces the pipeline's own
+    assert db_tables_info["tables"]["alignment_quarantine"] == quarantine_table
+    # The schema hash covers the pipeline tables
+    assert schema_hash(db_tables_info) != schema_hash({"tables": {"seq": seq_table}})
+
+
+class FakeConnection:
+    """Records the statements, commits and rollbacks of apply_schema; applied_hashes stands in for schema_version."""
+
+    def __init__(self, applied_hashes=None):
+        self.applied_hashes = applied_hashes
+        self.statements = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.result = []
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, statement, params=None):
+        self.statements.append(statement)
+        if statement.startswith("SELECT 1 FROM schema_version"):
+            if self.applied_hashes is None:
+                raise psycopg2.errors.UndefinedTable('relation "schema_version" does not exist')
+            self.result = [(1,)] if params[0] in self.applied_hashes else []
+        elif statement.startswith("SELECT relname, relkind"):
+            self.result = [("seq", "r")]
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def fetchall(self):
+        return self.result
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+SEQ_TABLES_INFO = {"tables": {"seq": {"column_dict": {"id": "SERIAL PRIMARY KEY", "pat_id": "VARCHAR(100)",
+                                                      "seq": "TEXT"}}}}
+
+
+def test_schema_is_applied_in_one_transaction_and_then_skipped():
+    connection = FakeConnection()
+    assert apply_schema(connection, SEQ_TABLES_INFO).endswith("applied.")
+    assert connection.rollbacks == 1 and connection.commits == 1
+    lock, existing, ddl = connection.statements[1:]
+    assert lock == f"SELECT pg_advisory_xact_lock({SCHEMA_LOCK_KEY});"
+    # The existing seq table gets its missing columns and indexes, in the same statement as the other tables
+    digest = schema_hash(with_default_specs(SEQ_TABLES_INFO))
+    assert ddl == "\n".join(schema_ddl(with_default_specs(SEQ_TABLES_INFO), digest, {"seq": "r"}))
+    assert "CREATE TABLE IF NOT EXISTS alignment_tasks (" in ddl
+
+    current = FakeConnection(applied_hashes={digest})
+    assert apply_schema(current, SEQ_TABLES_INFO) == f"Schema {digest[:12]} is current."
+    assert len(current.statements) == 1 and current.commits == 1
+
+
+def test_connect_when_ready_waits_for_a_starting_server(monkeypatch):
+    errors = [psycopg2.OperationalError("FATAL:  the database system is starting up")] * 2
+    connection = object()
+
+    def connect(**kwargs):
+        if errors:
+            raise errors.pop()
+        return connection
+
+    monkeypatch.setattr(db_operations.psycopg2, "connect", connect)
+    monkeypatch.setattr(db_operations.time, "sleep", lambda seconds: None)
+    assert connect_when_ready("swe_db", "postgres", "", "localhost", 5432) is connection
+
+    errors = [psycopg2.OperationalError('FATAL:  database "swe_db" does not exist')]
+    with pytest.raises(psycopg2.OperationalError, match="does not exist"):
+        connect_when_ready("swe_db", "postgres", "", "localhost", 5432)
+
+
+def test_listening_server_is_used_without_pg_ctl(monkeypatch):
+    monkeypatch.setattr(db_server_starter.subprocess, "run", lambda *args, **kwargs: pytest.fail("pg_ctl was called"))
+    with socket.socket() as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        port = server.getsockname()[1]
+        assert start_or_connect_postgres("/nonexistent", "127.0.0.1", str(port)) == "PostgreSQL server already running."
+    assert not postgres_is_listening("127.0.0.1", str(port))
@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from db_operations import PIPELINE_TABLES
+from parallel_alignment_processor import process_sequence_alignment_isolated
+import hiv_typing_alignment_worker
+from hiv_typing_alignment_worker import perform_hiv_typing
+
+MAFFT_STAND_IN = os.path.join(os.path.dirname(hiv_typing_alignment_worker.__file__), 'mafft_stand_in.py')
+
+
+def hxb2_region_table():
+    seed_rows = PIPELINE_TABLES['hiv_type_ref_region']['seed_rows']
+    return pd.DataFrame(seed_rows['values'], columns=seed_rows['columns'])
+
+
+def test_typing_slices_every_region_out_of_one_alignment(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    # HXB2-like genome up to the end of pol; coordinates are 1-based genome positions
+    hxb2 = ''.join(rng.choice(list('acgt'), 5200))
+    siv = ''.join(base if rng.random() > 0.45 else 'acgt'[('acgt'.index(base) + 1) % 4] for base in hxb2)
+    ref_seq_df = pd.DataFrame({'seq_name': ['HXB2', 'SIVMM239'], 'pol_ref_seq': [hxb2, siv],
+                               'hiv_typing_pol_start_coord': [2085, 2085], 'hiv_typing_pol_end_coord': [5096, 5096]})
+    # Query from within gag to the end of RT
+    query_df = pd.DataFrame({'pat_id': ['p1'], 'seq_cleaned': [hxb2[699:4300]]})
+
+    alignments = []
+    mafft_alignment_function = hiv_typing_alignment_worker.mafft_alignment_function
+
+    def counting_alignment_function(mafft_engine):
+        align = mafft_alignment_function(mafft_engine)
+
+        def counted(*args, **kwargs):
+            alignments.append(args[:2])
+            return align(*args, **kwargs)
+        return counted
+
+    monkeypatch.setattr(hiv_typing_alignment_worker, 'mafft_alignment_function', counting_alignment_function)
+    typed_df, quarantine_df, _ = process_sequence_alignment_isolated(
+        query_df, ref_seq_df, 'seq_cleaned', perform_hiv_typing, MAFFT_STAND_IN,
+        cost_model_path=str(tmp_path / 'cost_model.json'), ref_region_df=hxb2_region_table())
+
+    assert quarantine_df.empty and len(alignments) == 1
+    row = typed_df.iloc[0]
+    assert row['hiv_type_lanl'] == 'HIV-1'
+    assert row['gag_query_seq'] == hxb2[789:2292]
+    assert (row['gag_query_seq_end_coord'] - row['gag_query_seq_start_coord'] + 1) == 2292 - 790 + 1
+    assert row['pr_rt_query_seq'] == hxb2[2252:3869]
+    assert row['rt_query_seq'] == hxb2[2549:4229]
+    # env starts past the end of this reference: nothing of the query is in it
+    assert set(row['env_query_seq']) <= {'-'}
@@ -0,0 +1,67 @@
+import json
+import random
+
+import pandas as pd
+
+from headless_batch_runner import resolve_input_files, ingest_and_qc, write_file_reports
+from user_prompter import load_header_mapping_profile
+
+# Stand-in for assets/col_description.xlsx, which is not in the repository
+COL_DESCR_DF = pd.DataFrame({
+    'tbl_name': ['seq', 'seq', 'seq', 'pat'],
+    'col_name': ['pat_id', 'seq', 'seq_sample_date', 'pat_id'],
+    'description': ['Patient id', 'Sequence', 'Sampling date', 'Patient id'],
+    'datatype': ['INTEGER', 'STRING', 'DATE', 'INTEGER'],
+    'upload_status': ['must upload', 'must upload', 'optional', 'must upload'],
+})
+
+
+def write_profile(tmp_path):
+    path = tmp_path / 'profile.json'
+    path.write_text(json.dumps({'data_file_type': ' Seq ',
+                                'header_map': {'Patient': 'pat_id', 'Sequence': 'seq', 'Comment': None}}))
+    return load_header_mapping_profile(str(path))
+
+
+def test_inputs_expand_to_supported_files_listed_once(tmp_path):
+    for name in ('b.csv', 'a.tsv', 'notes.md', 'c.CSV'):
+        (tmp_path / name).write_text('x\n')
+    (tmp_path / 'nested').mkdir()
+    (tmp_path / 'nested' / 'd.csv').write_text('x\n')
+
+    files = resolve_input_files([str(tmp_path), str(tmp_path / '*.csv'), str(tmp_path / 'missing.csv')])
+    assert [path[len(str(tmp_path)) + 1:] for path in files] == ['a.tsv', 'b.csv', 'c.CSV']
+
+
+def test_file_is_ingested_with_the_profile_and_qcd(tmp_path):
+    rng = random.Random(0)
+    seqs = [''.join(rng.choice('acgt') for _ in range(700)) for _ in range(4)]
+    pd.DataFrame({'Patient': ['1', '2', 'x3', '4', '5'],
+                  'Sequence': seqs[:3] + [seqs[0][:300], seqs[3]],
+                  'Comment': 'resubmitted'}).to_csv(tmp_path / 'site.csv', index=False)
+
+    report = ingest_and_qc(str(tmp_path / 'site.csv'), write_profile(tmp_path), COL_DESCR_DF)
+    assert report['error'] is None
+    assert report['rows_read'] == 5 and report['rows_invalid'] == 1
+    assert report['qc_removed'] == {'empty': 0, 'duplicate': 0, 'n_only': 0, 'low_acgt_ratio': 0, 'short': 1}
+    assert sorted(report['post_qc_df']['pat_id'].astype(str)) == ['1', '2', '5']
+    assert 'Comment' not in report['post_qc_df'].columns
+
+
+def test_unmapped_header_is_a_file_error(tmp_path):
+    pd.DataFrame({'Patient': ['1'], 'Sequence': ['acgt'], 'Lab': ['A']}).to_csv(tmp_path / 'other.csv', index=False)
+    report = ingest_and_qc(str(tmp_path / 'other.csv'), write_profile(tmp_path), COL_DESCR_DF)
+    assert report['error'].startswith('Error') and "'Lab'" in report['error']
+    assert report['post_qc_df'].empty
+
+
+def test_one_report_per_input_file(tmp_path):
+    reports = [{'file': '/site_a/batch.csv', 'error': None, 'post_qc': 2, 'post_qc_df': pd.DataFrame({'seq': ['a', 'c']})},
+               {'file': '/site_b/batch.csv', 'error': 'No valid rows.', 'post_qc': 0, 'post_qc_df': pd.DataFrame()}]
+    paths = write_file_reports(reports, str(tmp_path / 'reports'))
+
+    assert len(set(paths)) == 2
+    written = [json.loads(open(path).read()) for path in paths]
+    assert [report['file'] for report in written] == ['/site_a/batch.csv', '/site_b/batch.csv']
+    assert written[1]['error'] == 'No valid rows.'
+    assert all('post_qc_df' not in report for report in written)
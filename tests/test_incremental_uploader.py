@@ -0,0 +1,123 @@
+import pandas as pd
+import psycopg2
+
+import incremental_uploader
+from incremental_uploader import IncrementalUploadSink
+
+
+class FakeTable:
+    """Stands in for psycopg2.connect on a table held as a list of row tuples."""
+
+    columns = [('id', 'integer'), ('pat_id', 'integer'), ('seq', 'text'), ('mod_date', 'timestamp')]
+
+    def __init__(self, rows=(), failures=0):
+        self.rows = list(rows)
+        self.failures = failures
+        self.batches = []
+        self.commits = 0
+        self.connections = 0
+        self.closed = False
+
+    def __call__(self, **kwargs):
+        self.connections += 1
+        self.closed = False
+        return self
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, statement, params):
+        assert 'pg_attribute' in statement
+
+    def fetchall(self):
+        return self.columns
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def execute_values(self, cur, query, rows, template=None, page_size=None, fetch=False):
+        # Inserts the rows not in the table yet and returns their batch positions, like the bulk INSERT
+        if self.failures:
+            self.failures -= 1
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        self.batches.append(len(rows))
+        inserted = []
+        for position, *values in rows:
+            if tuple(values) not in self.rows:
+                self.rows.append(tuple(values))
+                inserted.append((position,))
+        return inserted
+
+
+def sink_on(table, monkeypatch, **kwargs):
+    monkeypatch.setattr(incremental_uploader.psycopg2, 'connect', table)
+    monkeypatch.setattr(incremental_uploader.psycopg2.extras, 'execute_values', table.execute_values)
+    return IncrementalUploadSink('db', 'user', 'password', 'localhost', 5432, **kwargs)
+
+
+def test_rows_are_uploaded_in_micro_batches_and_existing_rows_skipped(monkeypatch):
+    table = FakeTable(rows=[(1, 'acgt')])
+    sink = sink_on(table, monkeypatch, batch_size=3, flush_interval_seconds=60, keep_columns=['source_file'])
+    sink.put(pd.DataFrame({'pat_id': [1, 2, 3, 4], 'seq': ['acgt', 'aaaa', 'cccc', 'gggg'], 'source_file': 'a.csv'}))
+    sink.put(pd.DataFrame({'pat_id': [5, 2, 6], 'seq': ['tttt', 'aaaa', 'acga'], 'source_file': 'b.csv'}))
+    uploaded, not_uploaded = sink.close()
+
+    assert table.batches == [3, 3, 1]
+    assert table.commits == 3 and table.connections == 1 and table.closed
+    assert sorted(uploaded['pat_id']) == [2, 3, 4, 5, 6]
+    assert sorted(not_uploaded['pat_id']) == [1, 2]
+    assert uploaded.set_index('pat_id').loc[5, 'source_file'] == 'b.csv'
+    assert 'source_file' in not_uploaded.columns
+    assert len(table.rows) == 6
+
+
+def test_flush_commits_queued_rows_before_the_interval(monkeypatch):
+    table = FakeTable()
+    sink = sink_on(table, monkeypatch, batch_size=100, flush_interval_seconds=3600)
+    sink.put(pd.DataFrame({'pat_id': [1, 2], 'seq': ['acgt', 'aaaa']}))
+    sink.flush()
+    assert table.commits == 1 and len(table.rows) == 2
+
+    sink.put(pd.DataFrame({'pat_id': [3], 'seq': ['cccc']}))
+    uploaded, not_uploaded = sink.close()
+    assert table.batches == [2, 1]
+    assert len(uploaded) == 3 and not_uploaded.empty
+
+
+def test_lost_connection_retries_the_batch(monkeypatch):
+    monkeypatch.setattr(incremental_uploader.time, 'sleep', lambda seconds: None)
+    table = FakeTable(failures=2)
+    sink = sink_on(table, monkeypatch, batch_size=10, max_retries=3)
+    sink.put(pd.DataFrame({'pat_id': [1, 2], 'seq': ['acgt', 'aaaa']}))
+    uploaded, not_uploaded = sink.close()
+    assert table.connections == 3
+    assert len(uploaded) == 2 and len(table.rows) == 2
+
+
+def test_failed_upload_is_reported_and_stops_the_sink(monkeypatch):
+    monkeypatch.setattr(incremental_uploader.time, 'sleep', lambda seconds: None)
+    table = FakeTable(failures=5)
+    sink = sink_on(table, monkeypatch, batch_size=1, max_retries=1)
+    sink.put(pd.DataFrame({'pat_id': [1], 'seq': ['acgt']}))
+    sink.flush()
+    try:
+        sink.put(pd.DataFrame({'pat_id': [2], 'seq': ['aaaa']}))
+    except RuntimeError as e:
+        assert 'failed' in str(e)
+    else:
+        raise AssertionError('put() accepted rows after the upload failed')
+    result = sink.close()
+    assert isinstance(result, str) and result.startswith('An error occurred')
+    assert table.rows == []
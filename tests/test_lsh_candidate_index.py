@@ -0,0 +1,125 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import lsh_candidate_index
+from lsh_candidate_index import MinHashLSHIndex
+from pairwise_distance_engine import compute_transmission_edges
+
+
+def random_sequences(rng, count, length=300):
+    return [''.join(rng.choice('acgt') for _ in range(length)) for _ in range(count)]
+
+
+def test_batched_inserts_match_one_sorted_index(tmp_path):
+    rng = random.Random(0)
+    sequences = random_sequences(rng, 60)
+    # Near-copies, so bands share keys across batches
+    sequences += [seq[:150] + ('a' if seq[150] != 'a' else 'c') + seq[151:] for seq in sequences[:20]]
+    index = MinHashLSHIndex(str(tmp_path / 'index'), num_perm=32, bands=8)
+    for start in range(0, len(sequences), 25):
+        index.insert(range(start + 1, min(start + 25, len(sequences)) + 1), sequences[start:start + 25])
+    assert len(index) == len(sequences) and index.last_key == len(sequences)
+
+    queried = index.query(sequences[:5])
+    reloaded = MinHashLSHIndex(str(tmp_path / 'index'))
+    np.testing.assert_array_equal(index._order, reloaded._order)
+    np.testing.assert_array_equal(index._sorted_band_keys, reloaded._sorted_band_keys)
+    assert queried.equals(reloaded.query(sequences[:5]))
+    assert {1, 61} <= set(queried.loc[queried['query_position'] == 0, 'key'])
+
+
+class FakeSeqTable:
+    """Stands in for psycopg2.connect on a seq table held in a DataFrame, for the queries of the index."""
+
+    def __init__(self, seq_df):
+        self.seq_df = seq_df
+
+    def __call__(self, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def cursor(self, name=None):
+        return FakeCursor(self.seq_df)
+
+
+class FakeCursor(FakeSeqTable):
+    itersize = 2000
+
+    def execute(self, statement, params):
+        if 'id > %s' in statement:
+            rows_df = self.seq_df[self.seq_df['id'] > params[0]][['id', 'extracted_pol_query_seq_cleaned']]
+        else:
+            rows_df = self.seq_df[self.seq_df['id'].isin(params[0])][
+                ['id', 'extracted_pol_ref_seq', 'extracted_pol_query_seq']]
+        self.description = [(col,) for col in rows_df.columns]
+        self.rows = list(rows_df.itertuples(index=False, name=None))
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+
+def aligned_rows(sequences, hxb2):
+    return pd.DataFrame({'extracted_pol_query_seq_cleaned': sequences,
+                         'extracted_pol_ref_seq': [hxb2] * len(sequences),
+                         'extracted_pol_query_seq': sequences})
+
+
+def mutate(rng, seq, count):
+    seq = list(seq)
+    for position in rng.sample(range(len(seq)), count):
+        seq[position] = rng.choice([base for base in 'acgt' if base != seq[position]])
+    return ''.join(seq)
+
+
+def test_close_historical_sequences_match_brute_force_tn93(tmp_path, monkeypatch):
+    rng = random.Random(1)
+    hxb2 = random_sequences(rng, 1, 1000)[0]
+    historical = [mutate(rng, hxb2, 60) for _ in range(30)]
+    seq_df = aligned_rows(historical, hxb2).assign(id=range(1, 31), pat_id=[f"h{i}" for i in range(30)])
+    # New sequences 0.2% to 5% from a historical one, so some pairs are within 1.5% and some are not
+    new = [mutate(rng, historical[i], [2, 5, 10, 14, 20, 30, 50][i % 7]) for i in range(14)]
+    new_df = aligned_rows(new, hxb2).assign(pat_id=[f"n{i}" for i in range(14)])
+    monkeypatch.setattr(lsh_candidate_index.psycopg2, 'connect', FakeSeqTable(seq_df))
+
+    index = MinHashLSHIndex(str(tmp_path / 'index'))
+    assert lsh_candidate_index.sync_index_with_database(index, 'db', 'user', '', 'host', 5432) == 30
+    found_df = lsh_candidate_index.find_close_historical_sequences(index, 'db', 'user', '', 'host', 5432, new_df)
+
+    edges_df, _, _ = compute_transmission_edges(pd.concat([new_df, seq_df], ignore_index=True), id_columns=('pat_id',))
+    edges_df = edges_df[edges_df['pat_id_1'].str.startswith('n') != edges_df['pat_id_2'].str.startswith('n')]
+    brute_force = {}
+    for first, second, distance in zip(edges_df['pat_id_1'], edges_df['pat_id_2'], edges_df['tn93_distance']):
+        new_id, historical_id = (first, second) if first.startswith('n') else (second, first)
+        brute_force[(int(new_id[1:]), int(historical_id[1:]) + 1)] = distance
+
+    assert len(brute_force) >= 6
+    found = dict(zip(zip(found_df['query_position'], found_df['key']), found_df['tn93_distance']))
+    assert found.keys() == brute_force.keys()
+    for pair, distance in brute_force.items():
+        assert found[pair] == pytest.approx(distance)
+
+
+def test_main_queries_new_rows_against_the_synced_table(tmp_path, monkeypatch):
+    rng = random.Random(2)
+    hxb2 = random_sequences(rng, 1, 800)[0]
+    seq_df = aligned_rows([mutate(rng, hxb2, 40) for _ in range(5)], hxb2).assign(id=[3, 4, 7, 8, 9])
+    aligned_rows([mutate(rng, seq_df['extracted_pol_query_seq'][2], 3)], hxb2).to_csv(tmp_path / 'new.csv', index=False)
+    monkeypatch.setattr(lsh_candidate_index.psycopg2, 'connect', FakeSeqTable(seq_df))
+
+    args = ['--database', 'db', '--user', 'user', '--index-dir', str(tmp_path / 'index')]
+    assert lsh_candidate_index.main(args + ['query', str(tmp_path / 'new.csv'), '--output', str(tmp_path / 'pairs.csv')]) == 0
+    pairs_df = pd.read_csv(tmp_path / 'pairs.csv')
+    assert pairs_df[['query_position', 'key']].values.tolist() == [[0, 7]]
+    assert MinHashLSHIndex(str(tmp_path / 'index')).last_key == 9
@@ -0,0 +1,67 @@
+import random
+
+import pandas as pd
+
+import mafft_stand_in
+from hiv_typing_alignment_worker import perform_hiv_typing
+from parallel_alignment_processor import process_sequence_alignment_isolated
+from qc import process_sequences
+from synthetic_corpus_generator import synthetic_reference_tables, generate_synthetic_queries
+
+MAFFT_STAND_IN = mafft_stand_in.__file__
+
+
+def align(query, ref):
+    placement = mafft_stand_in.place_query(query, ref)
+    return [row for _, row in mafft_stand_in.merge_placements([('ref', ref)], [('query', placement)])]
+
+
+def test_mismatch_is_preferred_over_a_gap():
+    ref = 'acgtacgtacgtacgtacgt'
+    query = ref[:9] + 'g' + ref[10:]
+    assert align(query, ref) == [ref, query]
+    assert align(query, 'ttttt' + ref + 'ggggg') == ['ttttt' + ref + 'ggggg', '-----' + query + '-----']
+
+
+def test_insertion_opens_one_gap():
+    ref = 'gattacacctgaaggtcctttgcaatcgaggctacgtta'
+    query = ref[:20] + 'cccc' + ref[20:]
+    assert align(query, ref) == [ref[:20] + '----' + ref[20:], query]
+
+
+def mutate(seq, rate, rng):
+    return ''.join(base if rng.random() > rate else rng.choice([b for b in 'acgt' if b != base]) for base in seq)
+
+
+def test_columns_are_kept_on_both_sides_of_indels_at_hiv_divergence():
+    for seed in range(10):
+        rng = random.Random(seed)
+        ref = ''.join(rng.choice('acgt') for _ in range(1200))
+        # Query column -> reference column, None for inserted bases
+        query, truth = list(mutate(ref, 0.10, rng)), list(range(len(ref)))
+        del query[300:303], truth[300:303]
+        query[800:800], truth[800:800] = list('gatcaa'), [None] * 6
+        columns, insertions = mafft_stand_in.place_query(''.join(query), ref)
+
+        placed, query_position = {}, 0
+        for column in range(len(ref) + 1):
+            query_position += len(insertions[column])
+            if column < len(ref) and columns[column] != '-':
+                placed[query_position] = column
+                query_position += 1
+        aligned = [placed.get(position) == column for position, column in enumerate(truth) if column is not None]
+        assert sum(aligned) / len(aligned) >= 0.98, seed
+
+
+def test_synthetic_corpus_types_as_hiv_1(tmp_path):
+    type_ref_df, subtype_ref_df = synthetic_reference_tables(seed=0)
+    query_df = pd.concat(generate_synthetic_queries(type_ref_df, subtype_ref_df, 60, seed=1))
+    query_df = query_df[query_df['synthetic_source'].str.startswith('CON_')]
+    _, cleaned_df = process_sequences(query_df[['pat_id', 'seq_sample_date', 'seq']].copy())
+
+    typed_df, quarantine_df, _ = process_sequence_alignment_isolated(
+        cleaned_df, type_ref_df, 'seq_cleaned', perform_hiv_typing, MAFFT_STAND_IN,
+        cost_model_path=str(tmp_path / 'cost_model.json'))
+    assert quarantine_df.empty
+    # A few generated queries are too divergent from their source to type at all
+    assert (typed_df['hiv_type_lanl'] == 'HIV-1').mean() >= 0.9
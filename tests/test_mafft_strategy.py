@@ -0,0 +1,40 @@
+import pandas as pd
+
+import mafft_stand_in
+from mafft_strategy_selector import choose_mafft_strategy, SMALL_BATCH_SIZE, LARGE_BATCH_SIZE
+from mafft_strategy_calibrator import calibrate_mafft_strategies
+from qc import process_sequences
+from synthetic_corpus_generator import synthetic_reference_tables, generate_synthetic_queries
+
+
+def test_batch_size_decides_before_the_query():
+    ref, long_query, short_query = 'acgt' * 750, 'acgt' * 700, 'acgt' * 100
+    assert choose_mafft_strategy(ref, long_query, batch_size=SMALL_BATCH_SIZE - 1) == 'iterative'
+    assert choose_mafft_strategy(ref, long_query, batch_size=SMALL_BATCH_SIZE) == 'progressive'
+    assert choose_mafft_strategy(ref[:800], short_query, batch_size=SMALL_BATCH_SIZE) == 'iterative'
+    assert choose_mafft_strategy(ref, 'n' * 400 + long_query, batch_size=SMALL_BATCH_SIZE) == 'iterative'
+    assert choose_mafft_strategy(ref[:800], short_query, batch_size=LARGE_BATCH_SIZE) == 'progressive'
+
+
+def calibration_inputs():
+    type_ref_df, subtype_ref_df = synthetic_reference_tables(seed=0)
+    query_df = pd.concat(generate_synthetic_queries(type_ref_df, subtype_ref_df, 8, seed=1))
+    _, cleaned_df = process_sequences(query_df[['pat_id', 'seq_sample_date', 'seq']].copy())
+    return cleaned_df, type_ref_df, subtype_ref_df
+
+
+def test_calibrator_compares_strategies():
+    report = calibrate_mafft_strategies(*calibration_inputs(), mafft_stand_in.__file__, sample_size=6,
+                                        strategies=('iterative', 'adaptive'))
+    assert not isinstance(report, str), report
+    assert list(report['stage'].unique()) == ['typing', 'subtyping']
+    assert (report['quarantined_rows'] == 0).all()
+    assert (report.loc[report['stage'] == 'typing', 'compared_rows'] == 6).all()
+
+
+def test_calibrator_reports_failing_alignments(tmp_path):
+    failing_mafft = tmp_path / 'mafft'
+    failing_mafft.write_text("#!/bin/sh\necho 'no such option' >&2\nexit 1\n")
+    failing_mafft.chmod(0o755)
+    report = calibrate_mafft_strategies(*calibration_inputs(), str(failing_mafft), sample_size=2)
+    assert isinstance(report, str) and report.startswith("Error in typing with the iterative strategy")
@@ -0,0 +1,67 @@
+import random
+
+import numpy as np
+import pandas as pd
+
+from packed_sequence_array import PackedSequenceArray, pack_sequence_columns, unpack_sequence_columns
+from qc import process_sequences
+
+SEQUENCES = ['acgtrymkswbdhvn-', 'acg t1x', 'ttéa', '', None, 'ggg']
+EXPECTED = ['acgtrymkswbdhvn-', 'acg t1x', 'tt?a', '', None, 'ggg']
+
+
+def decoded(values):
+    # Missing sequences decode to the dtype's na_value, NaN
+    return [None if not isinstance(value, str) and pd.isna(value) else value for value in values]
+
+
+def test_round_trip_keeps_symbols_outside_the_alphabet():
+    array = PackedSequenceArray._from_sequence(SEQUENCES)
+    assert decoded(array.to_numpy()) == EXPECTED
+    assert decoded(array[i] for i in range(len(array))) == EXPECTED
+    assert array.lengths().tolist()[:4] == [16, 7, 4, 0]
+    assert decoded(array.str_slice(1, 3).to_numpy()) == [None if s is None else s[1:3] for s in EXPECTED]
+    assert decoded(pd.Series(array).astype(object)) == EXPECTED
+
+
+def test_take_and_isna_with_missing_values():
+    array = PackedSequenceArray._from_sequence(SEQUENCES)
+    assert array.isna().tolist() == [False, False, False, False, True, False]
+
+    taken = array.take([5, -1, 1], allow_fill=True)
+    assert decoded(taken.to_numpy()) == ['ggg', None, 'acg t1x']
+    assert taken.isna().tolist() == [False, True, False]
+    assert array.take([5, -1, 1]).to_numpy().tolist() == ['ggg', 'ggg', 'acg t1x']
+    assert array.take([-1, 0], allow_fill=True, fill_value='nn').to_numpy().tolist() == ['nn', EXPECTED[0]]
+    assert PackedSequenceArray._from_sequence([]).take([-1, -1], allow_fill=True).isna().all()
+
+    # Reindexing fills with None through take
+    series = pd.Series(array).reindex([0, 9])
+    assert series.isna().tolist() == [False, True]
+
+
+def test_concat_keeps_the_packed_dtype():
+    first = pd.Series(PackedSequenceArray._from_sequence(SEQUENCES[:3]))
+    second = pd.Series(PackedSequenceArray._from_sequence(SEQUENCES[3:]))
+    combined = pd.concat([first, second], ignore_index=True)
+    assert combined.dtype == first.dtype
+    assert decoded(combined.astype(object)) == EXPECTED
+    assert combined.isna().tolist() == [False, False, False, False, True, False]
+
+
+def test_qc_gives_the_same_result_on_packed_and_str_columns():
+    rng = random.Random(0)
+    seqs = [''.join(rng.choice('acgt') for _ in range(rng.choice([150, 700]))) for _ in range(30)]
+    seqs += ['n' * 400, seqs[0], 'acgtrykm' * 90, 'ac gt' * 150]
+    seq_df = pd.DataFrame({'pat_id': [f"p{i % 20}" for i in range(len(seqs))], 'seq': seqs})
+
+    str_results, str_df = process_sequences(seq_df.copy())
+    packed_results, packed_df = process_sequences(pack_sequence_columns(seq_df))
+
+    pd.testing.assert_frame_equal(unpack_sequence_columns(packed_df), str_df)
+    assert packed_results.keys() == str_results.keys()
+    for key, value in str_results.items():
+        if isinstance(value, pd.DataFrame):
+            pd.testing.assert_frame_equal(unpack_sequence_columns(packed_results[key]), value)
+        else:
+            assert np.all(packed_results[key] == value)
@@ -0,0 +1,88 @@
+import math
+
+import numpy as np
+import pytest
+
+from pairwise_distance_engine import (AMBIGUITY_MODES, PAIR_WEIGHTS, SYMBOL_MASKS, project_to_hxb2_frame,
+                                      ambiguity_fractions, cross_pair_counts, pair_counts, tn93_distance, p_distance,
+                                      compute_pairwise_distances)
+
+
+def random_masks(rng, count, length, ambiguous=0.01, substituted=0.02):
+    """Near-identical sequences with a few ambiguity codes, gaps and N."""
+    base = rng.choice(list('acgt'), length)
+    sequences = []
+    for _ in range(count):
+        seq = base.copy()
+        changed = rng.random(length)
+        seq[changed < substituted] = rng.choice(list('acgt'), (changed < substituted).sum())
+        seq[(changed >= 0.02) & (changed < 0.02 + ambiguous)] = 'r'
+        seq[(changed >= 0.5) & (changed < 0.505)] = '-'
+        seq[(changed >= 0.6) & (changed < 0.605)] = 'n'
+        seq[rng.random(length) < ambiguous / 2] = rng.choice(list('ymkswbdhv'))
+        sequences.append(''.join(seq))
+    return np.stack([SYMBOL_MASKS[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)] for seq in sequences])
+
+
+def naive_counts(masks, i, j, ambiguity, resolve_fraction):
+    """Pair counts position by position."""
+    eligible = ambiguity_fractions(masks) <= resolve_fraction
+    mode = 'average' if ambiguity == 'resolve' and not (eligible[i] and eligible[j]) else ambiguity
+    return sum(PAIR_WEIGHTS[mode][a, b] for a, b in zip(masks[i], masks[j]))
+
+
+def test_projection_drops_insertions_and_masks_uncovered_ends():
+    assert project_to_hxb2_frame('ac-gtacgt', '--aGtac--') == 'nngtacnn'
+    assert project_to_hxb2_frame('acgt', '----', frame_length=6) == 'nnnnnn'
+
+
+@pytest.mark.parametrize('ambiguity', AMBIGUITY_MODES)
+def test_block_and_pair_counts_match_position_by_position_counts(ambiguity):
+    rng = np.random.default_rng(0)
+    # The last sequences are too ambiguous to be resolved
+    masks = np.concatenate([random_masks(rng, 6, 400), random_masks(rng, 2, 400, ambiguous=0.1)])
+    expected = np.array([[naive_counts(masks, i, j, ambiguity, 0.015) for j in range(len(masks))]
+                         for i in range(len(masks))]).transpose(2, 3, 0, 1)
+
+    np.testing.assert_allclose(cross_pair_counts(masks[:5], masks, ambiguity), expected[:, :, :5], atol=1e-3)
+    first, second = np.triu_indices(len(masks), k=1)
+    np.testing.assert_allclose(pair_counts(masks, first, second, ambiguity, chunk_size=7),
+                               expected[:, :, first, second], atol=1e-3)
+
+
+def test_tn93_matches_the_published_formula():
+    counts = np.array([[300, 4, 9, 2], [3, 200, 1, 8], [7, 2, 250, 1], [1, 6, 2, 180]], dtype=float)
+    total = counts.sum()
+    g = (counts.sum(axis=0) + counts.sum(axis=1)) / (2 * total)
+    p1 = (counts[0, 2] + counts[2, 0]) / total
+    p2 = (counts[1, 3] + counts[3, 1]) / total
+    q = 1 - np.trace(counts) / total - p1 - p2
+    g_r, g_y = g[0] + g[2], g[1] + g[3]
+    expected = (-2 * g[0] * g[2] / g_r * math.log(1 - g_r / (2 * g[0] * g[2]) * p1 - q / (2 * g_r))
+                - 2 * g[1] * g[3] / g_y * math.log(1 - g_y / (2 * g[1] * g[3]) * p2 - q / (2 * g_y))
+                - 2 * (g_r * g_y - g[0] * g[2] * g_y / g_r - g[1] * g[3] * g_r / g_y) * math.log(1 - q / (2 * g_r * g_y)))
+
+    assert tn93_distance(counts) == pytest.approx(expected)
+    assert p_distance(counts) == pytest.approx(1 - np.trace(counts) / total)
+    assert tn93_distance(counts) >= p_distance(counts)
+    assert tn93_distance(np.zeros((4, 4))) == np.inf
+
+
+def test_blocked_threaded_edges_match_all_pairs():
+    rng = np.random.default_rng(1)
+    # Two clusters: pairs within a cluster are about 0.006 apart
+    masks = np.concatenate([random_masks(rng, 25, 700, ambiguous=0.002, substituted=0.004),
+                            random_masks(rng, 15, 700, ambiguous=0.002, substituted=0.004)])
+    first, second = np.triu_indices(len(masks), k=1)
+    counts = pair_counts(masks, first, second)
+    tn93, overlap = tn93_distance(counts), counts.sum(axis=(0, 1))
+    within = (tn93 <= 0.015) & (overlap >= 500)
+    expected = dict(zip(zip(first[within], second[within]), tn93[within]))
+
+    edges = {}
+    stats = compute_pairwise_distances(masks, lambda i, j, t, p, o: edges.update(zip(zip(i, j), t)),
+                                       block_size=8, workers=3)
+    assert stats['pairs'] == len(first) and stats['edges'] == len(edges)
+    assert 0 < len(expected) < len(first)
+    assert edges.keys() == expected.keys()
+    np.testing.assert_allclose([edges[pair] for pair in expected], list(expected.values()), rtol=1e-4)
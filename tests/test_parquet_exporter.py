@@ -0,0 +1,49 @@
+import os
+
+import pandas as pd
+import pytest
+
+pa = pytest.importorskip('pyarrow', exc_type=ImportError)
+
+from parquet_exporter import arrow_table, export_pipeline_outputs, read_parquet_dataset
+
+
+def known_rows(pat_ids, subtypes, start_coords):
+    return pd.DataFrame({'pat_id': pat_ids,
+                         'seq_sample_date': pd.to_datetime(['2021-05-03'] * len(pat_ids)).date,
+                         'seq_cleaned': ['acgt' * 200] * len(pat_ids),
+                         'extracted_pol_query_seq_start_coord': start_coords,
+                         'hiv1_subtype_lanl': subtypes,
+                         'hiv1_subtype_similarity_percentage': [97.5] * len(pat_ids),
+                         'hiv1_subtype_lanl_anomaly': [None] * len(pat_ids)})
+
+
+def test_schema_does_not_depend_on_the_values_of_a_run():
+    single = arrow_table(known_rows([1, 2], ['B', 'C'], [2253, 2260]))
+    aggregated = arrow_table(known_rows(['p3', 'p4'], [['B', 'B'], 'C'], [None, '2301']))
+    assert single.schema == aggregated.schema
+
+    assert single.schema.field('pat_id').type == pa.dictionary(pa.int32(), pa.string())
+    assert single.schema.field('seq_cleaned').type == pa.string()
+    assert single.schema.field('extracted_pol_query_seq_start_coord').type == pa.int64()
+    assert single.schema.field('hiv1_subtype_lanl').type == pa.list_(pa.string())
+    assert aggregated.column('hiv1_subtype_lanl').to_pylist() == [['B', 'B'], ['C']]
+    assert aggregated.column('extracted_pol_query_seq_start_coord').to_pylist() == [None, 2301]
+
+
+def test_runs_add_partitioned_files_that_readers_can_prune(tmp_path):
+    root = str(tmp_path)
+    qc_results = {'short_df': pd.DataFrame({'pat_id': ['9'], 'seq': ['acgt']}), 'empty_df': pd.DataFrame()}
+    written = export_pipeline_outputs(root, '2024-05-01', 'run1', qc_results=qc_results,
+                                      known_df=known_rows([1, 2, 3], ['B', 'C', 'C'], [2253, 2260, 2270]))
+    assert written == {'qc_rejected': 1, 'post_qc': 0, 'typed': 0, 'known_hiv1_subtypes': 3}
+    export_pipeline_outputs(root, '2024-05-01', 'run2', known_df=known_rows([4], [['C', 'C']], [2280]))
+
+    assert sorted(os.listdir(os.path.join(root, 'known_hiv1_subtypes', 'run_date=2024-05-01', 'subtype=C'))) == \
+        ['part-run1-0.parquet', 'part-run2-0.parquet']
+    assert os.listdir(os.path.join(root, 'qc_rejected', 'run_date=2024-05-01')) == ['qc_filter=short']
+
+    subtype_c = read_parquet_dataset(root, 'known_hiv1_subtypes', columns=['pat_id', 'hiv1_subtype_lanl'],
+                                     filters=[('subtype', '=', 'C')])
+    assert sorted(subtype_c['pat_id'].astype(str)) == ['2', '3', '4']
+    assert all(list(subtypes) in (['C'], ['C', 'C']) for subtypes in subtype_c['hiv1_subtype_lanl'])
@@ -0,0 +1,12 @@
+import warnings
+
+import pandas as pd
+
+from pipeline_benchmarks import post_qc_queries
+
+
+def test_post_qc_queries_copy_the_corpus_columns():
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', pd.errors.SettingWithCopyWarning)
+        post_qc_df = post_qc_queries(20)
+    assert len(post_qc_df) > 0 and 'seq_cleaned' in post_qc_df.columns
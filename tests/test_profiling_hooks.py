@@ -0,0 +1,29 @@
+import os
+
+import profiling_hooks
+
+
+def test_profile_run_merges_only_its_own_profiles(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling_hooks, 'PROFILE_MODE', 'cprofile')
+    monkeypatch.setenv('HIV_PIPELINE_PROFILE_DIR', str(tmp_path))
+    monkeypatch.setattr(profiling_hooks, 'PROFILE_DIR', str(tmp_path))
+
+    @profiling_hooks.profiled
+    def work():
+        return sum(range(1000))
+
+    # A leftover process profile of an earlier run
+    work()
+    profiling_hooks.write_process_profile(str(tmp_path))
+    os.replace(tmp_path / f"profile_{os.getpid()}.prof", tmp_path / 'profile_1.prof')
+
+    run_dir = profiling_hooks.start_profile_run()
+    work()
+    reports = profiling_hooks.finish_profile_run()
+
+    assert os.path.dirname(run_dir) == str(tmp_path)
+    assert reports == [os.path.join(run_dir, 'merged.prof'), os.path.join(run_dir, 'merged.txt')]
+    with open(reports[1]) as f:
+        assert f.readline().startswith('Merged from 1 process profile')
+    # Nothing left to write at exit
+    assert profiling_hooks.write_process_profile(str(tmp_path / 'after')) is None
@@ -0,0 +1,52 @@
+import random
+
+from recombination_scanner import query_position_matches, scan_mosaic
+
+
+def mutate(rng, seq, rate):
+    return ''.join(rng.choice('acgt'.replace(base, '')) if rng.random() < rate else base for base in seq)
+
+
+def references(rng, length=2000):
+    # Two B references close to each other, one C reference 15% away from them
+    con_b = ''.join(rng.choice('acgt') for _ in range(length))
+    con_c = mutate(rng, con_b, 0.15)
+    return [con_b, mutate(rng, con_b, 0.03), con_c], ['B', 'B', 'C']
+
+
+def test_query_positions_skip_query_gaps_and_compare_only_bases():
+    matches, compared = query_position_matches('ACG-TAC', 'a-gntaN')
+    assert matches.tolist() == [True, True, False, True, True, False]
+    assert compared.tolist() == [True, True, False, True, True, False]
+
+
+def test_recombinant_query_gets_a_breakpoint_near_the_junction():
+    rng = random.Random(0)
+    refs, subtypes = references(rng)
+    query = mutate(rng, refs[0][:1200] + refs[2][1200:], 0.01)
+    mosaic = scan_mosaic(refs, [query] * len(refs), subtypes)
+
+    (first, first_span), (second, second_span) = [segment.split(':') for segment in mosaic.split('|')]
+    assert (first, second) == ('B', 'C')
+    breakpoint = int(first_span.split('-')[1])
+    assert first_span.startswith('1-') and second_span == f"{breakpoint + 1}-2000"
+    assert abs(breakpoint - 1200) <= 50
+
+
+def test_gapped_alignments_are_scanned_in_query_positions():
+    rng = random.Random(1)
+    refs, subtypes = references(rng)
+    query = mutate(rng, refs[0], 0.01)
+    # A 30-nt insertion in the query: gaps in every reference, the query keeps 2030 positions
+    aligned_refs = [ref[:600] + '-' * 30 + ref[600:] for ref in refs]
+    aligned_query = query[:600] + 'acgt' * 7 + 'ac' + query[600:]
+    assert scan_mosaic(aligned_refs, [aligned_query] * len(refs), subtypes) == 'B:1-2030'
+
+
+def test_undecided_windows_and_short_queries_have_no_mosaic():
+    rng = random.Random(2)
+    refs, _ = references(rng)
+    query = mutate(rng, refs[0], 0.01)
+    # Same reference under two subtypes: no window leads by the margin
+    assert scan_mosaic([refs[0], refs[0]], [query, query], ['B', 'D']) == ''
+    assert scan_mosaic([ref[:300] for ref in refs], [query[:300]] * len(refs), ['B', 'B', 'C']) == ''
@@ -0,0 +1,27 @@
+import pytest
+from run_metrics import RunMetrics
+
+
+def test_prometheus_escapes_label_values():
+    metrics = RunMetrics()
+    metrics.increment('rows', 1, file='C:\\data\\"new"\nbatch.csv')
+    assert 'file="C:\\\\data\\\\\\"new\\"\\nbatch.csv"' in metrics.to_prometheus()
+
+
+def test_name_cannot_be_two_metric_types():
+    metrics = RunMetrics()
+    metrics.observe('queue_depth', 3)
+    with pytest.raises(ValueError):
+        metrics.set_gauge('queue_depth', 3)
+
+
+def test_stage_records_its_own_peak_increase():
+    metrics = RunMetrics()
+    with metrics.stage('allocate'):
+        block = bytearray(64 * 2 ** 20)
+        block[::4096] = b'x' * len(block[::4096])
+    with metrics.stage('idle'):
+        pass
+    allocate, idle = metrics.stages
+    assert idle['peak_rss_increase_mb'] == 0
+    assert allocate['process_peak_rss_mb'] <= idle['process_peak_rss_mb']
@@ -0,0 +1,93 @@
+import gzip
+import os
+
+import pandas as pd
+
+import sequence_file_writer
+from sequence_file_writer import export_dataframe_sequences, export_database_sequences
+
+
+def known_rows():
+    return pd.DataFrame({'pat_id': [1, 2, 3, 4],
+                         'seq_sample_date': ['2021-05-03', '2021-06-01', None, '2022-01-10'],
+                         'hiv1_subtype_lanl': ['B', 'C', ['C', 'C'], 'B'],
+                         'hiv1_subtype_lanl_anomaly': [None, None, None, None],
+                         'extracted_pol_query_seq_cleaned': ['acgtacgtac', 'ccgg', 'aatt', None],
+                         'extracted_pol_ref_seq': ['ac-gtacgt', 'acggtacgt', 'acggtacgt', 'acggtacgt'],
+                         'extracted_pol_query_seq': ['acagt-cgt', '--ggtacg-', 'acggtaccc', 'acgg']})
+
+
+def test_dataframes_stream_into_one_fasta_per_subtype(tmp_path):
+    df = known_rows()
+    # Chunks, as from the streaming pipeline
+    result = export_dataframe_sequences((df.iloc[start:start + 2] for start in (0, 2)),
+                                        str(tmp_path / 'pol_{subtype}.fasta.gz'),
+                                        header_template='{pat_id} {date}:{subtype}', split_by_subtype=True,
+                                        line_width=4)
+
+    assert result == {'files': {str(tmp_path / 'pol_B.fasta.gz'): 1, str(tmp_path / 'pol_C.fasta.gz'): 2},
+                      'skipped': 1}
+    with gzip.open(tmp_path / 'pol_B.fasta.gz', 'rt') as f:
+        assert f.read() == '>1_2021-05-03_B\nacgt\nacgt\nac\n'
+    with gzip.open(tmp_path / 'pol_C.fasta.gz', 'rt') as f:
+        assert f.read() == '>2_2021-06-01_C\nccgg\n>3__C\naatt\n'
+    assert sorted(os.listdir(tmp_path)) == ['pol_B.fasta.gz', 'pol_C.fasta.gz']
+
+
+def test_aligned_pol_phylip_starts_with_the_count_and_length(tmp_path):
+    result = export_dataframe_sequences(known_rows(), str(tmp_path / 'pol.phy'), seq_col='aligned_pol',
+                                        header_template='{pat_id}', file_format='phylip')
+
+    assert result == {'files': {str(tmp_path / 'pol.phy'): 3}, 'skipped': 1}
+    # Columns of the first row's HXB2 frame; uncovered ends are gaps
+    assert (tmp_path / 'pol.phy').read_text() == '3 8\n1 acgt-cgt\n2 --ggtacg\n3 acggtacc\n'
+
+
+def test_unaligned_phylip_is_an_error_and_leaves_no_files(tmp_path):
+    result = export_dataframe_sequences(known_rows(), str(tmp_path / 'trees' / 'pol.phy.gz'), file_format='phylip')
+    assert result.startswith('Error writing') and 'PHYLIP needs aligned sequences' in result
+    assert os.listdir(tmp_path / 'trees') == []
+
+
+class FakeServerCursor:
+    """Stands in for psycopg2.connect and its named cursor on a seq table held in a DataFrame."""
+
+    def __init__(self, seq_df):
+        self.seq_df = seq_df
+        self.fetches = []
+
+    def __call__(self, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def cursor(self, name=None):
+        assert name is not None
+        return self
+
+    def execute(self, query, params):
+        self.query, self.params = query, params
+        columns = query[len('SELECT '):query.index(' FROM')].split(', ')
+        self.rows = list(self.seq_df[columns].itertuples(index=False, name=None))
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        self.fetches.append(len(batch))
+        return batch
+
+
+def test_database_rows_are_read_in_batches(tmp_path, monkeypatch):
+    server = FakeServerCursor(known_rows())
+    monkeypatch.setattr(sequence_file_writer.psycopg2, 'connect', server)
+    result = export_database_sequences('db', 'user', 'password', 'localhost', 5432, str(tmp_path / 'pol.fasta'),
+                                       where='seq_sample_date >= %s', params=('2021-01-01',), batch_size=3)
+
+    assert server.query == ("SELECT extracted_pol_query_seq_cleaned, pat_id, seq_sample_date, hiv1_subtype_lanl, "
+                            "hiv1_subtype_lanl_anomaly FROM seq WHERE seq_sample_date >= %s ORDER BY id")
+    assert server.params == ('2021-01-01',) and server.fetches == [3, 1, 0]
+    assert result['files'] == {str(tmp_path / 'pol.fasta'): 3}
+    assert (tmp_path / 'pol.fasta').read_text().startswith('>1|2021-05-03|B\nacgtacgtac\n')
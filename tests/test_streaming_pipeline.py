@@ -0,0 +1,50 @@
+import functools
+import threading
+import time
+
+import pandas as pd
+
+import mafft_stand_in
+import streaming_pipeline
+from qc import process_sequences
+from synthetic_corpus_generator import synthetic_reference_tables, generate_synthetic_queries
+
+
+def test_typing_and_subtyping_share_the_pool_width(monkeypatch):
+    type_ref_df, subtype_ref_df = synthetic_reference_tables(seed=0)
+    seq_df = pd.concat(generate_synthetic_queries(type_ref_df, subtype_ref_df, 16, seed=1))
+    seq_df = seq_df[['pat_id', 'seq_sample_date', 'seq']].reset_index(drop=True)
+
+    lock = threading.Lock()
+    running = {'now': 0, 'max': 0, 'calls': 0}
+
+    def counted(worker_func):
+        @functools.wraps(worker_func)
+        def counted_worker(*args, **kwargs):
+            with lock:
+                running['now'] += 1
+                running['calls'] += 1
+                running['max'] = max(running['max'], running['now'])
+            try:
+                time.sleep(0.01)
+                return worker_func(*args, **kwargs)
+            finally:
+                with lock:
+                    running['now'] -= 1
+        return counted_worker
+
+    monkeypatch.setattr(streaming_pipeline, 'perform_hiv_typing', counted(streaming_pipeline.perform_hiv_typing))
+    monkeypatch.setattr(streaming_pipeline, 'align_hiv1_subtype_references',
+                        counted(streaming_pipeline.align_hiv1_subtype_references))
+    monkeypatch.setattr(streaming_pipeline, 'plan_alignment_resources', lambda n_tasks: {
+        'cpu_budget': 2, 'pool_width': 2, 'max_pool_width': 2, 'mafft_threads': 1, 'available_memory_mb': 1024})
+
+    result = streaming_pipeline.stream_sequence_data(seq_df, type_ref_df, subtype_ref_df, mafft_stand_in.__file__,
+                                                     qc_chunk_size=4)
+    assert not isinstance(result, str), result
+    assert result['stats']['subtyped'] > 0
+    # Both stages start 2 threads each, but only 2 alignments ever run at once
+    assert running['calls'] == result['stats']['typed'] + result['stats']['hiv1']
+    assert running['max'] == 2
+    _, post_qc_df = process_sequences(seq_df.copy())
+    assert result['stats']['post_qc'] == len(post_qc_df)
@@ -0,0 +1,28 @@
+import random
+
+import pandas as pd
+
+from qc import process_sequences, merge_qc_results
+from streaming_pipeline import qc_chunks
+
+
+def test_streaming_qc_matches_whole_table_qc():
+    rng = random.Random(0)
+    seqs = [''.join(rng.choice('acgt') for _ in range(700)) for _ in range(40)]
+    # Each sequence twice, the copy uppercase: duplicates once lowercased
+    seq_df = pd.DataFrame({'pat_id': [f"p{i}" for i in range(40)] * 2,
+                           'seq': seqs + [seq.upper() for seq in seqs]})
+
+    whole_results, whole_df = process_sequences(seq_df.copy())
+    parts = [(*process_sequences(chunk.copy()), len(chunk)) for chunk in qc_chunks(seq_df, 10)]
+    streamed_results = merge_qc_results([(results, count) for results, _, count in parts])
+    streamed_df = pd.concat([df for _, df, _ in parts]).sort_index()
+
+    assert len(parts) > 1
+    assert len(streamed_df) == len(whole_df) == 40
+    pd.testing.assert_frame_equal(streamed_df, whole_df)
+    for key, value in whole_results.items():
+        if isinstance(value, pd.DataFrame):
+            pd.testing.assert_frame_equal(streamed_results[key], value)
+        else:
+            assert streamed_results[key] == value
@@ -0,0 +1,36 @@
+import pandas as pd
+import pytest
+
+from subtype_msa_store import SubtypeMSAStore
+
+HXB2_POL = 'acgtacggtcatgcatgcca' * 5
+
+
+def rows(*pat_ids):
+    return pd.DataFrame({'pat_id': list(pat_ids), 'seq_sample_date': ['2021-05-03'] * len(pat_ids),
+                         'extracted_pol_ref_seq': [HXB2_POL] * len(pat_ids),
+                         'extracted_pol_query_seq': ['--' + HXB2_POL[2:]] * len(pat_ids)})
+
+
+def test_crashed_removal_hides_nothing(tmp_path, monkeypatch):
+    store = SubtypeMSAStore(str(tmp_path), 'B')
+    store.add(rows('p1', 'p2'))
+
+    def crash():
+        raise OSError("disk full")
+    monkeypatch.setattr(store, '_write_manifest', crash)
+    with pytest.raises(OSError):
+        store.remove(['p1|2021-05-03'])
+    monkeypatch.undo()
+
+    # The removal was never committed, and the versions after it reuse its number
+    store = SubtypeMSAStore(str(tmp_path), 'B')
+    assert store.add(rows('p3'))['version'] == 2
+    assert store.live_ids() == {'p1|2021-05-03', 'p2|2021-05-03', 'p3|2021-05-03'}
+    assert store.remove(['p2|2021-05-03']) == {'version': 3, 'removed': 1}
+
+    store = SubtypeMSAStore(str(tmp_path), 'B')
+    assert store.live_ids() == {'p1|2021-05-03', 'p3|2021-05-03'}
+    assert [seq_id for seq_id, _ in store.iter_rows()] == ['p1|2021-05-03', 'p3|2021-05-03']
+    assert store.live_ids(version=2) == {'p1|2021-05-03', 'p2|2021-05-03', 'p3|2021-05-03'}
+    assert [row for _, row in store.iter_rows()] == ['--' + HXB2_POL[2:]] * 2
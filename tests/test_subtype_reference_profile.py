@@ -0,0 +1,44 @@
+import warnings
+
+import pandas as pd
+
+import mafft_stand_in
+import subtype_reference_profile
+from hiv_typing_alignment_worker import perform_hiv_typing
+from hiv_subtyping_alignment_worker import perform_hiv_subtyping
+from parallel_alignment_processor import process_sequence_alignment_isolated
+from qc import process_sequences, categorize_hiv_typing
+from synthetic_corpus_generator import synthetic_reference_tables, generate_synthetic_queries
+
+
+def test_profile_calls_agree_with_pairwise_calls(tmp_path, monkeypatch):
+    monkeypatch.setattr(subtype_reference_profile, 'DEFAULT_CACHE_DIR', str(tmp_path / 'cache'))
+    type_ref_df, subtype_ref_df = synthetic_reference_tables(seed=0)
+    query_df = pd.concat(generate_synthetic_queries(type_ref_df, subtype_ref_df, 16, seed=1))
+    query_df = query_df[query_df['synthetic_source'].str.startswith('CON_')]
+    _, cleaned_df = process_sequences(query_df[['pat_id', 'seq_sample_date', 'seq']].copy())
+    options = {'cost_model_path': str(tmp_path / 'cost_model.json')}
+    typed_df, _, _ = process_sequence_alignment_isolated(cleaned_df, type_ref_df, 'seq_cleaned', perform_hiv_typing,
+                                                         mafft_stand_in.__file__, **options)
+    hiv1_df = categorize_hiv_typing(typed_df)['hiv1_df']
+    pairwise_df, _, _ = process_sequence_alignment_isolated(hiv1_df, subtype_ref_df, 'extracted_pol_query_seq_cleaned',
+                                                            perform_hiv_subtyping, mafft_stand_in.__file__, **options)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        comparison_result = subtype_reference_profile.compare_with_reference_profile(
+            hiv1_df, subtype_ref_df, pairwise_df, mafft_stand_in.__file__, **options)
+    assert not isinstance(comparison_result, str), comparison_result
+    summary_df, comparison_df = comparison_result
+
+    assert len(comparison_df) == len(pairwise_df) > 0
+    all_row = summary_df.set_index('hiv1_subtype_lanl').loc['ALL']
+    assert all_row['sequences'] == len(comparison_df)
+    assert summary_df.loc[summary_df['hiv1_subtype_lanl'] != 'ALL', 'sequences'].sum() == len(comparison_df)
+    assert all_row['agreement_percentage'] >= 80
+    assert comparison_df['similarity_delta'].abs().max() <= 5
+
+
+def test_unknown_subtyping_mode_is_an_error():
+    assert subtype_reference_profile.subtyping_worker_for_mode('pairwise') is perform_hiv_subtyping
+    assert subtype_reference_profile.subtyping_worker_for_mode('fast').startswith("Error")